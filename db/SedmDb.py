@@ -7,11 +7,14 @@ from astropy.time import Time
 from datetime import timedelta
 from werkzeug.security import generate_password_hash
 import os
+import re
 import sys
+import time
 import psycopg2.extras
 import psycopg2.errors
 
 import smtplib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from marshals.interface import update_status_request
 
@@ -91,10 +94,16 @@ class SedmDB:
     def __getattr__(self, name):
         return getattr(self.instance, name)
 
-    def execute_sql(self, sql, return_type='list'):
+    def execute_sql(self, sql, return_type='list', params=None):
         """
         Runs the SedmDB sql query in a safe way through the DBManager.
 
+        Args:
+            sql (str): sql query, with %s placeholders if params given
+            return_type (str): 'list' for tuples, otherwise DictRows
+            params (tuple/list/dict): parameters passed to the driver
+                instead of being interpolated into the sql string
+
         Returns the object with the results.
         """
         conn = self.pool_sedmdb.connect()
@@ -104,7 +113,7 @@ class SedmDB:
             cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
         try:
-            cursor.execute(sql)
+            cursor.execute(sql, params)
         except exc.DBAPIError as e:
             # an exception is raised, Connection is invalidated.
             if e.connection_invalidated:
@@ -114,10 +123,54 @@ class SedmDB:
             obj = cursor.fetchall()
             # print(obj)
             return obj
+        elif cursor.description is not None:
+            # e.g. UPDATE ... RETURNING
+            obj = cursor.fetchall()
+            conn.commit()
+            return obj
         else:
-            cursor.execute("commit;")
+            conn.commit()
             return []
 
+    def execute_many(self, statements):
+        """
+        Runs several parameterized statements in a single transaction.
+
+        Each statement is (sql, rows, method) where rows is a list of
+        parameter tuples and method is 'values' (psycopg2.extras.execute_values,
+        sql has a single VALUES %s placeholder) or 'batch'
+        (psycopg2.extras.execute_batch, sql has one %s per parameter).
+        Either all statements are committed or none are.
+
+        Args:
+            statements (list): list of (sql, rows, method) tuples
+
+        Returns:
+            int: number of rows sent
+        """
+        conn = self.pool_sedmdb.connect()
+        cursor = conn.cursor()
+        nrows = 0
+        try:
+            for sql, rows, method in statements:
+                if not rows:
+                    continue
+                if method == 'values':
+                    psycopg2.extras.execute_values(cursor, sql, rows,
+                                                   page_size=500)
+                else:
+                    psycopg2.extras.execute_batch(cursor, sql, rows,
+                                                  page_size=500)
+                nrows += len(rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+        return nrows
+
     def get_conn_sedmDB(self):
         """
         Runs the WSDB sql query in a safe way through the DBManager.
@@ -1865,6 +1918,79 @@ class SedmDB:
             (id, "Requests updated, columns 'column_names'")
                 if the update was successful
         """
+        keys = self._check_request_update(pardic)
+        if keys[0] == -1:
+            return keys
+        if not self.execute_sql('SELECT id FROM request WHERE id = %s;',
+                                params=(pardic['id'],)):
+            return -1, "ERROR: request does not exist!"
+
+        sql, params = _generate_update_sql_params(pardic, keys, 'request',
+                                                  True)
+        try:
+            self.execute_sql(sql, params=params)
+        except exc.IntegrityError:
+            return -1, "ERROR: update_request sql command failed with " \
+                       "an IntegrityError!"
+        except exc.ProgrammingError:
+            return -1, "ERROR: update_request sql command failed with " \
+                       "a ProgrammingError!"
+
+        return pardic['id'], "Requests updated, columns " + str(keys)[1:-1]
+
+    def update_requests(self, pardics):
+        """
+        Updates several requests in a single transaction.
+
+        Args:
+            pardics (list): list of dicts as given to update_request
+
+        Returns:
+            list of (id, "Requests updated, columns ...") or (-1, "ERROR...")
+            for each input dict, in order.  Rows with errors are skipped;
+            if the database update fails, every entry is an error.
+        """
+        results = []
+        good = []
+        for pardic in pardics:
+            keys = self._check_request_update(pardic)
+            results.append(keys)
+            if keys[0] != -1:
+                good.append((len(results) - 1, pardic, keys))
+        if not good:
+            return results
+        # Check the requests exist with one query
+        ids = [pardic['id'] for idx, pardic, keys in good]
+        existing = set(rx[0] for rx in self.execute_sql(
+            'SELECT id FROM request WHERE id = ANY(%s);', params=(ids,)))
+        # Group rows by the columns being updated
+        groups = {}
+        for idx, pardic, keys in good:
+            if pardic['id'] not in existing:
+                results[idx] = (-1, "ERROR: request does not exist!")
+                continue
+            sql, params = _generate_update_sql_params(pardic, keys, 'request',
+                                                      True)
+            groups.setdefault(sql, []).append(params)
+            results[idx] = (pardic['id'], "Requests updated, columns " +
+                            str(keys)[1:-1])
+        try:
+            self.execute_many([(sql, rows, 'batch')
+                               for sql, rows in groups.items()])
+        except (exc.DBAPIError, psycopg2.Error) as e:
+            return [(-1, "ERROR: update_requests sql command failed: %s"
+                     % str(e).strip())] * len(pardics)
+        return results
+
+    def _check_request_update(self, pardic):
+        """
+        Check the keys and values of a dictionary for update_request.
+
+        Returns:
+            list of keys to update (without 'id')
+
+            (-1, "ERROR...") if there was an issue with the dictionary
+        """
         param_types = {'id': int, 'object_id': int, 'user_id': int,
                        'allocation_id': int, 'exptime': str, 'priority': float,
                        'inidate': 'date', 'enddate': 'date', 'marshal_id': int,
@@ -1880,9 +2006,6 @@ class SedmDB:
         elif not (isinstance(pardic['id'], int) or isinstance(pardic['id'],
                                                               long)):
             return -1, "ERROR: parameter id must be of type 'int'!"
-        if pardic['id'] not in [rx[0] for rx in
-                                self.execute_sql('SELECT id FROM request;')]:
-            return -1, "ERROR: request does not exist!"
         keys.remove('id')
         if 'status' in keys:
             if pardic['status'] not in ['PENDING', 'ACTIVE', 'COMPLETED',
@@ -1904,18 +2027,7 @@ class SedmDB:
         type_check = _data_type_check(keys, pardic, param_types)
         if type_check:
             return -1, type_check
-
-        sql = _generate_update_sql(pardic, keys, 'request', True)
-        try:
-            self.execute_sql(sql)
-        except exc.IntegrityError:
-            return -1, "ERROR: update_request sql command failed with " \
-                       "an IntegrityError!"
-        except exc.ProgrammingError:
-            return -1, "ERROR: update_request sql command failed with " \
-                       "a ProgrammingError!"
-
-        return pardic['id'], "Requests updated, columns " + str(keys)[1:-1]
+        return keys
 
     def get_from_request(self, values, where_dict=None, compare_dict=None):
         """
@@ -1998,40 +2110,61 @@ class SedmDB:
         return results
 
     def expire_requests(self, update_growth=True, update_fritz=True,
-                        send_alerts=False, testing=False, interactive=False):
+                        send_alerts=False, testing=False, interactive=False,
+                        max_workers=8, retries=3):
         """
         Updates the request table. For all the active requests that were
             not completed, and had an expiry date before than NOW(),
             are marked as "EXPIRED".
 
+        All expiring requests are updated with a single UPDATE ... RETURNING,
+        then the marshal status updates and alert emails are sent
+        concurrently (see _dispatch_notifications).
+
+        Args:
+            update_growth (bool): update status on the Growth marshal
+            update_fritz (bool): update status on Fritz
+            send_alerts (bool): email the request owners
+            testing (bool): only count the expiring requests
+            interactive (bool): ask before sending notifications
+            max_workers (int): maximum concurrent notifications
+            retries (int): attempts per notification
+
         Returns:
             (N, "Requests expired")
         """
         # tests written
-        # 1. Get a list of request that are set to be expired.
-        ret = self.execute_sql("SELECT u.id, o.name, u.email, r.marshal_id, "
-                               "r.external_id, r.id "
-                               "FROM request r "
-                               "INNER JOIN object o ON (object_id = o.id) "
-                               "INNER JOIN users u ON (user_id = u.id) "
-                               "WHERE r.enddate < NOW() "
+        if testing:
+            # 1. Get a list of request that are set to be expired.
+            ret = self.execute_sql("SELECT u.id, o.name, u.email, "
+                                   "r.marshal_id, r.external_id, r.id "
+                                   "FROM request r "
+                                   "INNER JOIN object o ON (object_id = o.id) "
+                                   "INNER JOIN users u ON (user_id = u.id) "
+                                   "WHERE r.enddate < NOW() "
+                                   "AND (r.status = 'PENDING' "
+                                   "OR r.status = 'ACTIVE');")
+            print("Found %d expiring requests" % len(ret))
+            return len(ret), "Testing"
+
+        # 1. Expire them all at once and get back what was expired
+        ret = self.execute_sql("UPDATE request r "
+                               "SET status='EXPIRED', lastmodified=NOW() "
+                               "FROM object o, users u "
+                               "WHERE r.object_id = o.id "
+                               "AND r.user_id = u.id "
+                               "AND r.enddate < NOW() "
                                "AND (r.status = 'PENDING' "
-                               "OR r.status = 'ACTIVE');")
-
+                               "OR r.status = 'ACTIVE') "
+                               "RETURNING u.id, o.name, u.email, "
+                               "r.marshal_id, r.external_id, r.id;")
         n_expired = len(ret)
-        print("Found %d expiring requests" % n_expired)
-
-        if testing:
-            return n_expired, "Testing"
+        print("%d requests set to EXPIRED in database" % n_expired)
 
+        # 2. Collect marshal updates and emails
+        jobs = []
         for items in ret:
-            # Reset DB status in request table
-            sql = "UPDATE request SET status='EXPIRED', lastmodified=NOW() " \
-                  "WHERE id=%d;" % items[5]
-            self.execute_sql(sql)
-            print("Request %d status set to EXPIRED in database" % items[5])
-
-            if items[3] < 0:
+            if items[3] is not None and items[3] < 0:
                 print("Calib request %s expired." % items[1])
 
             # Which marshal are we from?
@@ -2039,54 +2172,50 @@ class SedmDB:
                 print("Expiring Fritz request %d for target %s" % (items[3],
                                                                    items[1]))
                 if send_alerts:
-                    print("Sending email to %s" % items[2])
-                    self.send_email_by_request(
-                        to=items[2],
-                        subject='Fritz request for target %s '
-                                'has expired' % items[1],
-                        template='expired_request',
-                        template_dict={
-                            'object_name': items[1],
-                            'marshal_url': fritz_view_source_url}
-                    )
+                    jobs.append((
+                        'email', items[2], self.send_email_by_request, (),
+                        {'to': items[2],
+                         'subject': 'Fritz request for target %s '
+                                    'has expired' % items[1],
+                         'template': 'expired_request',
+                         'template_dict': {
+                             'object_name': items[1],
+                             'marshal_url': fritz_view_source_url}}))
                 if update_fritz:
-                    print("Updating Fritz marshal")
-                    res = update_status_request("Expired", items[3], 'fritz')
-                    print(res)
+                    jobs.append(('fritz', items[3], update_status_request,
+                                 ("Expired", items[3], 'fritz'), {}))
 
             else:               # Growth request
-                print("Expiring Growth request %d for target %s" % (items[3],
+                print("Expiring Growth request %s for target %s" % (items[3],
                                                                     items[1]))
                 if send_alerts:
-                    print("Sending email to %s" % items[2])
-                    self.send_email_by_request(
-                        to=items[2],
-                        subject='Growth request for target %s '
-                                'has expired' % items[1],
-                        template='expired_request',
-                        template_dict={
-                            'object_name': items[1],
-                            'marshal_url': growth_view_source_url}
-                    )
-                if update_growth:
+                    jobs.append((
+                        'email', items[2], self.send_email_by_request, (),
+                        {'to': items[2],
+                         'subject': 'Growth request for target %s '
+                                    'has expired' % items[1],
+                         'template': 'expired_request',
+                         'template_dict': {
+                             'object_name': items[1],
+                             'marshal_url': growth_view_source_url}}))
+                # if the entry is greater than 1000
+                # then it should have come from the GROWTH MARSHAL
+                if update_growth and items[3] and items[3] > 1000:
                     from growth import growth
-                    # if the entry is greater than 1000
-                    # then it should have come from the GROWTH MARSHAL
-
-                    if items[3] and items[3] > 1000:
-                        print("Updating Growth marshal")
-                        res = growth.update_request(request_id=items[3],
-                                                    output_dir='/scr/rsw/',
-                                                    status='EXPIRED')
-                        print(res)
-            if interactive:
-                q = input("next: ")
-                if "Q" in q.upper():
-                    break
-
-        # sql = "UPDATE request SET status='EXPIRED', lastmodified=NOW() " \
-        #      "WHERE enddate < NOW() AND status ='PENDING';"
-        # self.execute_sql(sql)
+                    jobs.append(('growth', items[3], growth.update_request,
+                                 (),
+                                 {'request_id': items[3],
+                                  'output_dir': '/scr/rsw/',
+                                  'status': 'EXPIRED'}))
+
+        # 3. Send them
+        if jobs and interactive:
+            q = input("Send %d notifications? (Q to skip): " % len(jobs))
+            if "Q" in q.upper():
+                jobs = []
+        if jobs:
+            _dispatch_notifications(jobs, max_workers=max_workers,
+                                    retries=retries)
 
         return n_expired, "Requests expired"
 
@@ -2130,35 +2259,12 @@ class SedmDB:
 
             (id (long), "Observation added") if it completed successfully
         """
-        header_types = {'id': int, 'object_id': int, 'request_id': int,
-                        'mjd': float, 'airmass': float, 'airmass_end': float,
-                        'parang': float, 'parang_end': float, 'exptime': float,
-                        'fitsfile': str, 'lst': str, 'ra': float, 'dec': float,
-                        'tel_az': float, 'tel_el': float, 'tel_pa': float,
-                        'ra_off': float, 'dec_off': float, 'imtype': str,
-                        'camera': str, 'filter': str,
-                        'time_elapsed': float}
-
-        required_keys = ['object_id', 'request_id', 'mjd', 'airmass', 'exptime',
-                         'fitsfile', 'lst', 'ra', 'dec', 'tel_az', 'tel_el',
-                         'tel_pa', 'ra_off', 'dec_off']
-
         new_observation_id = _id_from_time()
         header_dict['id'] = new_observation_id
 
-        header_keys = list(header_dict.keys())
-
-        # Test for required keys
-        for key in required_keys:
-            if key not in header_keys:
-                return -1, "ERROR: %s not provided!" % (key,)
-        # Test for valid keys
-        for key in reversed(header_keys):
-            if key not in header_types:
-                return -1, "ERROR: %s is an invalid key!" % (key,)
-        type_check = _data_type_check(header_keys, header_dict, header_types)
-        if type_check:
-            return -1, type_check
+        header_keys = self._check_observation(header_dict)
+        if header_keys[0] == -1:
+            return header_keys
         # Check if observation already exists in DB
         observation_id = self.get_from_observation(['id'],
                                                    {'fitsfile':
@@ -2168,9 +2274,10 @@ class SedmDB:
             return -1, "ERROR: %s already in database with id %d!" % \
                    (header_dict['fitsfile'], int(observation_id[0][0]))
         else:
-            sql = _generate_insert_sql(header_dict, header_keys, 'observation')
+            sql, params = _generate_insert_sql_params(header_dict, header_keys,
+                                                      'observation')
             try:
-                self.execute_sql(sql)
+                self.execute_sql(sql, params=(params,))
             except exc.IntegrityError:
                 return -1, "ERROR(exc): adding observation sql command " \
                            "failed with an IntegrityError!"
@@ -2185,6 +2292,95 @@ class SedmDB:
                            "with a NumericValueOutOfRange error!"
             return new_observation_id, "Observation added"
 
+    def add_observations(self, header_dicts):
+        """
+        Adds several observations in a single transaction.
+
+        Args:
+            header_dicts (list): list of dicts as given to add_observation
+
+        Returns:
+            list of (id (long), "Observation added") or (-1, "ERROR...")
+            for each input dict, in order.  Rows with errors are skipped;
+            if the database insert fails, every entry is an error.
+        """
+        results = []
+        good = []
+        for header_dict in header_dicts:
+            header_dict['id'] = _id_from_time()
+            header_keys = self._check_observation(header_dict)
+            if header_keys[0] == -1:
+                results.append(header_keys)
+            else:
+                results.append((header_dict['id'], "Observation added"))
+                good.append((len(results) - 1, header_dict, header_keys))
+        if not good:
+            return results
+        # Check which observations already exist in DB with one query
+        fitsfiles = [header_dict['fitsfile'] for idx, header_dict, keys
+                     in good]
+        existing = self.execute_sql(
+            "SELECT id, fitsfile FROM observation WHERE fitsfile ~ ANY(%s);",
+            params=(fitsfiles,))
+        # Group rows by the columns being inserted
+        groups = {}
+        for idx, header_dict, header_keys in good:
+            prev = [ex for ex in existing
+                    if re.search(header_dict['fitsfile'], ex[1])]
+            if prev:
+                results[idx] = (-1, "ERROR: %s already in database with id "
+                                    "%d!" % (header_dict['fitsfile'],
+                                             int(prev[0][0])))
+                continue
+            sql, params = _generate_insert_sql_params(header_dict,
+                                                      header_keys,
+                                                      'observation')
+            groups.setdefault(sql, []).append(params)
+        try:
+            self.execute_many([(sql, rows, 'values')
+                               for sql, rows in groups.items()])
+        except (exc.DBAPIError, psycopg2.Error) as e:
+            return [(-1, "ERROR: adding observations sql command failed: %s"
+                     % str(e).strip())] * len(header_dicts)
+        return results
+
+    def _check_observation(self, header_dict):
+        """
+        Check the keys and values of a dictionary for add_observation.
+
+        Returns:
+            list of keys to insert
+
+            (-1, "ERROR...") if there was an issue with the dictionary
+        """
+        header_types = {'id': int, 'object_id': int, 'request_id': int,
+                        'mjd': float, 'airmass': float, 'airmass_end': float,
+                        'parang': float, 'parang_end': float, 'exptime': float,
+                        'fitsfile': str, 'lst': str, 'ra': float, 'dec': float,
+                        'tel_az': float, 'tel_el': float, 'tel_pa': float,
+                        'ra_off': float, 'dec_off': float, 'imtype': str,
+                        'camera': str, 'filter': str,
+                        'time_elapsed': float}
+
+        required_keys = ['object_id', 'request_id', 'mjd', 'airmass', 'exptime',
+                         'fitsfile', 'lst', 'ra', 'dec', 'tel_az', 'tel_el',
+                         'tel_pa', 'ra_off', 'dec_off']
+
+        header_keys = list(header_dict.keys())
+
+        # Test for required keys
+        for key in required_keys:
+            if key not in header_keys:
+                return -1, "ERROR: %s not provided!" % (key,)
+        # Test for valid keys
+        for key in reversed(header_keys):
+            if key not in header_types:
+                return -1, "ERROR: %s is an invalid key!" % (key,)
+        type_check = _data_type_check(header_keys, header_dict, header_types)
+        if type_check:
+            return -1, type_check
+        return header_keys
+
     def update_observation(self, pardic):
         """
 
@@ -4215,13 +4411,129 @@ def _generate_update_sql(pardic, param_list, table, lastmodified=False):
     return sql
 
 
+def _generate_insert_sql_params(pardic, param_list, table):
+    """
+    generate parameterized sql for an insert command
+
+    Args:
+        pardic (dict): (same as given to calling function)
+        param_list (list): list of names of parameters to insert
+        table (str): name of table
+
+    Returns:
+        (sql string with a single VALUES %s placeholder for
+         psycopg2.extras.execute_values, tuple of values)
+    """
+    columns = [param for param in param_list if pardic[param] is not None]
+    sql = "INSERT INTO %s (%s) VALUES %%s;" % (table, ', '.join(columns))
+    return sql, tuple(pardic[param] for param in columns)
+
+
+def _generate_update_sql_params(pardic, param_list, table, lastmodified=False):
+    """
+    generate parameterized sql for an update command
+
+    Args:
+        pardic (dict): (same as given to upper function) (must contain 'id')
+        param_list (list): list of names of parameters to update
+        table (str): name of table
+        lastmodified (bool): if the table has a lastmodified column
+
+    Returns:
+        (sql string with %s placeholders, tuple of values ending with id)
+    """
+    columns = [param for param in param_list if pardic[param] is not None]
+    sets = ["%s = %%s" % param for param in columns]
+    if lastmodified:
+        sets.append("lastmodified = NOW()")
+    sql = "UPDATE %s SET %s WHERE id = %%s;" % (table, ', '.join(sets))
+    return sql, tuple(pardic[param] for param in columns) + (pardic['id'],)
+
+
+def _notification_failed(target, res):
+    """Return an error string if a notification result indicates failure"""
+    if target == 'email':
+        # send_email_by_request only returns a value on failure
+        return res
+    if target == 'fritz':
+        if not isinstance(res, dict):
+            return "Bad response: %s" % res
+        return res.get('iserror')
+    if target == 'growth' and not res:
+        return "Update failed"
+    return None
+
+
+def _dispatch_notifications(jobs, max_workers=8, retries=3, backoff=2.):
+    """Run notification jobs concurrently, retrying failed ones.
+
+    Args:
+        jobs (list): (target, key, func, args, kwargs) tuples, where target
+            is 'email', 'fritz' or 'growth' and key identifies the recipient
+            or request in the report
+        max_workers (int): maximum number of jobs running at once
+        retries (int): attempts per job
+        backoff (float): wait before the first retry in seconds, doubled
+            for each subsequent retry
+
+    Returns:
+        dict: {target: (n_ok, [failed keys])}
+    """
+
+    def run(job):
+        target, key, func, args, kwargs = job
+        err = None
+        for attempt in range(retries):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            try:
+                err = _notification_failed(target, func(*args, **kwargs))
+            except Exception as e:
+                err = "%s: %s" % (type(e).__name__, e)
+            if not err:
+                return None
+            print("%s notification for %s failed (attempt %d/%d): %s" %
+                  (target, key, attempt + 1, retries, err))
+        return err
+
+    report = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(run, job): job for job in jobs}
+        for fut in as_completed(futures):
+            target, key = futures[fut][:2]
+            n_ok, failed = report.setdefault(target, (0, []))
+            if fut.result():
+                failed.append(key)
+            else:
+                report[target] = (n_ok + 1, failed)
+
+    # Summary
+    for target in sorted(report):
+        n_ok, failed = report[target]
+        print("%s notifications: %d sent, %d failed" % (target, n_ok,
+                                                        len(failed)))
+        if failed:
+            print("  failed: %s" % ', '.join(str(k) for k in failed))
+    return report
+
+
+# Last id handed out by _id_from_time
+_last_id = 0
+
+
 def _id_from_time():
-    """Generate an id from the current time of format YYYYMMDDHHMMSSsss"""
+    """Generate an id from the current time of format YYYYMMDDHHMMSSsss
+
+    Ids are unique within a process: if called again within the same
+    millisecond, the previous id plus one is returned.
+    """
+    global _last_id
     time = Time.now()
     tid = time.iso
     tid = tid.replace(
         '-', '').replace(' ', '').replace(':', '').replace('.', '')
-    return long(tid)
+    _last_id = max(long(tid), _last_id + 1)
+    return _last_id
 
 
 if __name__ == "__main__":
@@ -618,7 +618,8 @@ class ingestNight:
 
         import time
         #time.sleep(1000)
-        # 5. Add files to the database
+        # 5. Gather the observations to add to the database
+        pending = []
         for f in sorted(raw_files):
 
             # Open the header file
@@ -698,11 +699,21 @@ class ingestNight:
 
             # At this point we check to see if we have everything we need for
             # adding the target to the database
-            ret = None
-
             if all_fields_accounted_for:
                 print("Adding %s to the database" % f)
-                ret = self.db.add_observation(header_dict)
+                pending.append((f, hdu, header_dict))
+            else:
+                pending.append((f, hdu, None))
+
+        # 6. Add the observations in one transaction
+        new_obs = [header_dict for f, hdu, header_dict in pending
+                   if header_dict is not None]
+        rets = iter(self.db.add_observations(new_obs)) if new_obs else iter([])
+        for f, hdu, header_dict in pending:
+            ret = None
+
+            if header_dict is not None:
+                ret = next(rets)
                 print(ret)
 
             if add_telescope_stats:
@@ -51,6 +51,22 @@ def test_request_manipulation():
     assert db.get_from_request(['status'], {'enddate': '2016-04-25'})[0][0] == 'EXPIRED'
 
 
+def test_request_batch_update():
+    # test successful update_requests
+    ids = [rx[0] for rx in db.get_from_request(['id'], {})][:2]
+    upds = [{'id': rid, 'priority': 4.5, 'status': 'ACTIVE'} for rid in ids]
+    assert [res[0] for res in db.update_requests(upds)] == ids
+    assert [db.get_from_request(['priority', 'status'], {'id': rid})[0]
+            for rid in ids] == [(4.5, 'ACTIVE')] * len(ids)
+    # test that a bad row is reported and the others still go through
+    upds = [{'id': ids[0], 'maxairmass': 'r'}, {'id': ids[1], 'priority': 3.}]
+    res = db.update_requests(upds)
+    assert res[0] == (-1, "ERROR: maxairmass must be of type 'float'!")
+    assert res[1][0] == ids[1]
+    assert db.update_requests([{'id': 0, 'priority': 3.}]) == \
+        [(-1, "ERROR: request does not exist!")]
+
+
 def test_atomicrequest_manipulation():
     # test adding an atomicrequest
     areq = {'request_id':1, 'exptime': 240, 'filter': 'g', 'priority': 3, 'inidate': '2017-01-01',
@@ -7,6 +7,7 @@ Functions
     * :func:`cpprecal`     copies calibration images from previous day directory
     * :func:`find_recent`  finds the most recent processed calibration file
     * :func:`cpsci`        copies new science images files into redux directory
+    * :func:`dosci`        processes new science images, nproc at a time
     * :func:`proc_stds`    processes standard star observations
     * :func:`proc_bias_crrs`  processes biases and CR rejection
     * :func:`proc_bkg_flex`   processes bkg sub and flex calculation
@@ -16,6 +17,18 @@ Functions
     * :func:`bias_ready`    check if master bias files are present
 
 Note:
+    New raw images are detected with :class:`RawWatch.RawWatcher`, which
+    queues each image as soon as it is completely written, so the night loop
+    only handles new images instead of re-scanning the raw directory.
+    Primary headers are read through :func:`HdrIndex.get_header`, so each
+    image header is read from disk only once per night.
+    The find_recent functions look up previous calibrations in the
+    :mod:`CalCatalog` catalog of the redux directory.
+    New products are recorded in the :mod:`ProdManifest` manifest of the
+    redux directory for the web pages.
+    Finders are made by a single background worker process fed from a
+    queue (see :func:`make_finder`) rather than one new process per image.
+
     This is used as a python script as follows::
 
         usage: AutoReduce.py [-h] [--rawdir RAWDIR] [--reduxdir REDUXDIR]
@@ -32,15 +45,22 @@ Note:
           --local              Process data locally, no push to marshal or slack
                                or db update (False)
           --nodb               Do not update SEDM Db (False)
+          --nproc NPROC        Science frames to process concurrently
+                               (sci_workers in config, or 1)
 
 """
 import time
 import glob
+import atexit
+import fnmatch
 import sys
 import os
 import re
 import json
 import subprocess
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 # from subprocess import Popen, PIPE
 import astropy.io.fits as pf
 import logging
@@ -66,6 +86,25 @@ try:
 except ImportError:
     import drprc.rcimg as rcimg
 
+try:
+    from RawWatch import RawWatcher
+except ImportError:
+    from drpifu.RawWatch import RawWatcher
+
+try:
+    from HdrIndex import get_header
+except ImportError:
+    from drpifu.HdrIndex import get_header
+
+try:
+    import CalCatalog
+except ImportError:
+    import drpifu.CalCatalog as CalCatalog
+try:
+    import ProdManifest
+except ImportError:
+    import drpifu.ProdManifest as ProdManifest
+
 drp_ver = sedmpy_version.__version__
 logging.basicConfig(
     format='%(asctime)s %(funcName)s %(levelname)-8s %(message)s',
@@ -85,6 +124,20 @@ _rawpath = sedm_cfg['paths']['rawpath']
 _reduxpath = sedm_cfg['paths']['reduxpath']
 _srcpath = sedm_cfg['paths']['srcpath']
 _nomfs = sedm_cfg['nominal_file_size']
+# Number of science frames to process concurrently
+_sci_nproc = sedm_cfg.get('sci_workers', 1)
+# Serializes directory-wide steps (see serial_call)
+_serial_lock = threading.Lock()
+# Worker processes are spawned, not forked, so they do not inherit the open
+# header index connections or the raw watcher thread
+_mp_context = multiprocessing.get_context('spawn')
+# Cores used by ccd_to_cube.py for one cube (see _init_sci_worker)
+_cube_ncore = 8
+# Finder worker process and its job queue (see make_finder)
+_finder_jobs = None
+_finder_proc = None
+# Seconds to let the finder worker finish its queue at exit
+_finder_stop_timeout = 120.
 
 
 def link_refcube(curdir='./', date_str=None):
@@ -260,9 +313,7 @@ def cal_proc_ready(caldir='./', fsize=_nomfs, mintest=False, ncp=0,
                 # Are we complete?
                 if os.stat(cal).st_size >= fsize:
                     # Read FITS header
-                    ff = pf.open(cal)
-                    hdr = ff[0].header
-                    ff.close()
+                    hdr = get_header(cal)
                     # Get OBJECT keyword
                     try:
                         obj = hdr['OBJECT']
@@ -353,9 +404,7 @@ def docp(src, dest, onsky=True, verbose=False, skip_cals=False, nodb=False):
     # Was a science object copied
     nobj = 0
     # Read FITS header
-    ff = pf.open(src)
-    hdr = ff[0].header
-    ff.close()
+    hdr = get_header(src)
     # Get OBJECT and DOMEST keywords
     try:
         obj = hdr['OBJECT']
@@ -682,7 +731,8 @@ def proc_bias_crrs(ncp=1, piggyback=False):
     # END: proc_bias_crrs
 
 
-def cpsci(srcdir, destdir='./', fsize=_nomfs, datestr=None, nodb=False):
+def cpsci(srcdir, destdir='./', fsize=_nomfs, datestr=None, nodb=False,
+          srcfiles=None):
     """Copies new science ifu image files from srcdir to destdir.
 
     Searches for most recent ifu image in destdir and looks for and
@@ -696,6 +746,8 @@ def cpsci(srcdir, destdir='./', fsize=_nomfs, datestr=None, nodb=False):
         fsize (int): size of completely copied file in bytes
         datestr (str): YYYYMMDD date string
         nodb (bool): skip update of SEDM db
+        srcfiles (list): new raw files to consider (from a RawWatcher),
+            if None, all ifu images in srcdir are checked
 
     Returns:
         int: Number of ifu images actually copied
@@ -703,7 +755,8 @@ def cpsci(srcdir, destdir='./', fsize=_nomfs, datestr=None, nodb=False):
     """
 
     # Get files in destination directory
-    dflist = sorted(glob.glob(os.path.join(destdir, 'ifu*.fits')))
+    dflist = set(os.path.basename(f) for f in
+                 glob.glob(os.path.join(destdir, 'ifu*.fits')))
     # Record copies and standard star observations
     ncp = 0
     nstd = 0
@@ -712,7 +765,8 @@ def cpsci(srcdir, destdir='./', fsize=_nomfs, datestr=None, nodb=False):
     stds = []
     sciobj = []
     # Get list of source files
-    srcfiles = sorted(glob.glob(os.path.join(srcdir, 'ifu*.fits')))
+    if srcfiles is None:
+        srcfiles = sorted(glob.glob(os.path.join(srcdir, 'ifu*.fits')))
     # Loop over source files
     for fl in srcfiles:
         # get base filename
@@ -720,9 +774,8 @@ def cpsci(srcdir, destdir='./', fsize=_nomfs, datestr=None, nodb=False):
         # Is our source file complete?
         if os.stat(fl).st_size >= fsize:
             # has it been previously copied?
-            prev = [s for s in dflist if fn in s]
             # No? then copy the file
-            if len(prev) == 0:
+            if fn not in dflist:
                 # Call copy
                 nc, ns, nob = docp(fl, destdir + '/' + fn, skip_cals=True,
                                    nodb=nodb, verbose=True)
@@ -750,14 +803,285 @@ def cpsci(srcdir, destdir='./', fsize=_nomfs, datestr=None, nodb=False):
     # END: cpsci
 
 
-def dosci(destdir='./', datestr=None, local=False, nodb=False,
-          nopush_marshal=False, nopush_slack=False, oldext=False):
-    """Copies new science ifu image files from srcdir to destdir.
+def _init_sci_worker(lock, ncore):
+    """Share the serialization lock with a science pool worker and set the
+    number of cores each of its cubes may use"""
+    global _serial_lock, _cube_ncore
+    _serial_lock = lock
+    _cube_ncore = ncore
 
-    Searches for most recent ifu image in destdir and looks for and
-    copies any ifu images in srcdir that are newer and complete.
-    Then bias subtracts and CR rejects the copied images.  If any are standard
-    star observations, process them as well.
+
+def serial_call(cmd):
+    """Run a directory-wide step (make classify, make report, uploads).
+
+    These steps act on every product in the reduction directory, so they
+    are run one at a time even when several frames are being processed.
+
+    Args:
+        cmd (tuple): command to run
+
+    Returns:
+        int: return code of command
+
+    """
+    with _serial_lock:
+        logging.info(" ".join(cmd))
+        return subprocess.call(cmd)
+
+
+def run_report(datestr, contains, local=False, nopush_slack=False):
+    """Run pysedm_report.py for products matching contains"""
+    if local or nopush_slack:
+        cmd = ("pysedm_report.py", datestr, "--contains", contains)
+    else:
+        cmd = ("pysedm_report.py", datestr, "--contains", contains, "--slack")
+    logging.info(" ".join(cmd))
+    retcode = subprocess.call(cmd)
+    if retcode != 0:
+        logging.error("Error running report for " + contains)
+    return retcode
+
+
+def sci_extract(fl, hdr=None, destdir='./', datestr=None, std=False,
+                local=False, nopush_slack=False, oldext=False,
+                guider_movie=False):
+    """Per-frame processing that can run concurrently with other frames.
+
+    Builds the cube, extracts the spectrum, classifies (serialized),
+    and runs the per-frame report and verification.  SEDM db and marshal
+    updates are left to the caller, so they can be done in frame order.
+
+    Args:
+        fl (str): crr_b_ifu*.fits file to process
+        hdr (astropy.io.fits.Header): header of fl (science only)
+        destdir (str): destination directory (typically in /data/sedmdrp/redux)
+        datestr (str): YYYYMMDD date string
+        std (bool): True if a standard star observation
+        local (bool): set to skip pushing to slack
+        nopush_slack (bool): True if no update to slack
+        oldext (bool): True to use extract_star.py instead of extractstar.py
+        guider_movie (bool): True to make guider movie
+
+    Returns:
+        dict: results with keys 'new_cube' (cube built by this call) and
+            'extracted' (spectrum successfully extracted)
+
+    """
+    fn = fl.split('/')[-1]
+    res = {'new_cube': False, 'extracted': False}
+    proccubefn = "e3d_%s_*.fits" % fn.split('.')[0]
+    had_cube = len(glob.glob(os.path.join(destdir, proccubefn))) > 0
+    # Build cube, db update is done by caller
+    e3d_good = make_e3d(fnam=fl, destdir=destdir, datestr=datestr,
+                        nodb=True, sci=not std, hdr=hdr,
+                        guider_movie=guider_movie)
+    if not e3d_good:
+        logging.error("Cannot perform extraction for %s" % fn)
+        return res
+    res['new_cube'] = not had_cube
+    # Get seeing
+    seeing = rcimg.get_seeing(imfile=fn, destdir=destdir, save_fig=True)
+    if seeing > 0:
+        logging.info("seeing measured as %f" % seeing)
+    else:
+        logging.info("seeing not measured for %s" % fn)
+    if std:
+        # Use auto psf extraction for standard stars
+        if not oldext:
+            cmd = ("extractstar.py", datestr, "--auto", fn,
+                   "--std", "--tag", "robot",
+                   "--centroid", "brightest", "--seeing", "2.0")
+            # "--seeing", "%.2f" % seeing)
+        else:
+            logging.info("Old extraction method used")
+            cmd = ("extract_star.py", datestr, "--auto", fn,
+                   "--std", "--tag", "robot", "--maxpos")
+        logging.info("Extracting std star spectra for " + fn)
+    else:
+        # Use forced psf for science targets
+        if not oldext:
+            cmd = ("extractstar.py", datestr, "--auto", fn,
+                   "--autobins", "6", "--tag", "robot",
+                   "--centroid", "auto", "--byecr",
+                   "--seeing", "2.0")
+            # "--seeing", "%.2f" % seeing)
+        else:
+            logging.info("Old extraction method used")
+            cmd = ("extract_star.py", datestr, "--auto", fn,
+                   "--autobins", "6", "--tag", "robot")
+        logging.info("Extracting object spectra for " + fn)
+    logging.info(" ".join(cmd))
+    retcode = subprocess.call(cmd)
+    if retcode != 0:
+        logging.error("Error extracting %s spectrum for %s" %
+                      ("std star" if std else "object", fn))
+        badfn = "spec_auto_notfluxcal_" + fn.split('.')[0] + "_failed.fits"
+        cmd = ("touch", badfn)
+        subprocess.call(cmd)
+        return res
+    res['extracted'] = True
+    if not std:
+        # Run SNID, SNIascore, and NGSF
+        logging.info("Running SNID, SNIascore, NGSF for " + fn)
+        retcode = serial_call(("make", "classify"))
+        if retcode != 0:
+            logging.error("Error running SNID, SNIascore, or NGSF")
+    run_report(datestr, fn.split('.')[0], local=local,
+               nopush_slack=nopush_slack)
+    # run Verify.py
+    cmd = "~/sedmpy/drpifu/Verify.py %s --contains %s" % \
+          (datestr, fn.split('.')[0])
+    logging.info(cmd)
+    subprocess.call(cmd, shell=True)
+    # Record new products for the web pages
+    ProdManifest.update(destdir, '*%s*' % fn.split('.')[0])
+    return res
+    # END: sci_extract
+
+
+def sci_contsep(fl, datestr=None, local=False, nopush_slack=False):
+    """Contsep extraction, classification and report for a science frame.
+
+    Args:
+        fl (str): crr_b_ifu*.fits file to process
+        datestr (str): YYYYMMDD date string
+        local (bool): set to skip pushing to slack
+        nopush_slack (bool): True if no update to slack
+
+    Returns:
+        bool: True if contsep extraction succeeded
+
+    """
+    fn = fl.split('/')[-1]
+    cmd = ("extractstar.py", datestr, "--auto", fn,
+           "--autobins", "6", "--tag", "contsep",
+           "--centroid", "auto", "--contsep", "--byecr")
+    logging.info("Extracting contsep spectra for " + fn)
+    logging.info(" ".join(cmd))
+    retcode = subprocess.call(cmd)
+    if retcode != 0:
+        logging.error("Error extracting contsep spectrum for" + fn)
+        return False
+    # Run SNID
+    logging.info("Running SNID for contsep " + fn)
+    retcode = serial_call(("make", "classify"))
+    if retcode != 0:
+        logging.error("Error running SNID")
+    # run Verify.py
+    cmd = "~/sedmpy/drpifu/Verify.py %s --contains contsep_lstep1__%s" \
+          % (datestr, fn.split('.')[0])
+    subprocess.call(cmd, shell=True)
+    # run pysedm_report
+    run_report(datestr, "contsep_lstep1__" + fn.split('.')[0], local=local,
+               nopush_slack=nopush_slack)
+    # Record new products for the web pages
+    ProdManifest.update(os.getcwd(), '*contsep*%s*' % fn.split('.')[0])
+    return True
+    # END: sci_contsep
+
+
+def sci_update(fl, res, obj='', destdir='./', datestr=None, std=False,
+               local=False, nodb=False, nopush_marshal=False):
+    """Ordered stage for a frame: SEDM db, marshal and user updates.
+
+    Args:
+        fl (str): crr_b_ifu*.fits file processed
+        res (dict): results from :func:`sci_extract`
+        obj (str): object name
+        destdir (str): destination directory (typically in /data/sedmdrp/redux)
+        datestr (str): YYYYMMDD date string
+        std (bool): True if a standard star observation
+        local (bool): set to skip pushing to marshal
+        nodb (bool): if True no update to SEDM db
+        nopush_marshal (bool): True if no update to marshal
+
+    Returns:
+        None
+
+    """
+    fn = fl.split('/')[-1]
+    procfn = 'spec*auto*' + fn.split('.')[0] + '*.fits'
+    # Update SedmDb cube table
+    if res['new_cube']:
+        if nodb:
+            logging.warning("Not updating cube in SEDM db")
+        else:
+            cube_id = update_cube(fl)
+            if cube_id > 0:
+                logging.info("SEDM db accepted cube at id %d" % cube_id)
+            else:
+                logging.warning("SEDM db rejected cube")
+    if not res['extracted']:
+        return
+    if std:
+        # run make report
+        serial_call(("make", "report"))
+    else:
+        # Upload spectrum to marshal
+        if local or nopush_marshal:
+            logging.warning("nopush_marshal or local: skipping ztfupload")
+        else:
+            # fritz upload
+            retcode = serial_call(("make", "fritzupload"))
+            if retcode != 0:
+                logging.error("Error uploading spectra to fritz marshal")
+            # growth upload
+            retcode = serial_call(("make", "ztfupload"))
+            if retcode != 0:
+                logging.error("Error uploading spectra to growth marshal")
+    # check if extraction succeeded
+    proced = glob.glob(os.path.join(destdir, procfn))
+    if proced:
+        proced = proced[0]
+        if not std:
+            # notify user that followup successfully completed
+            if local or nopush_marshal:
+                logging.warning("nopush_marshal or local: skipping email")
+            else:
+                email_user(proced, datestr, obj)
+        if nodb:
+            logging.warning("Not updating spec in SEDM db")
+        else:
+            # Update SedmDb table spec
+            if std:
+                spec_id = update_spec(proced)
+            else:
+                spec_id = update_spec(proced, nopush_marshal=nopush_marshal)
+            if spec_id > 0:
+                logging.info("update of %s with spec_id %d" %
+                             (proced, spec_id))
+            else:
+                logging.warning("failed to update spec %s" % proced)
+    else:
+        logging.error("Not found: %s" % procfn)
+    if std:
+        # Did we generate a flux calibration?
+        flxcal = glob.glob(
+            os.path.join(destdir, "fluxcal_auto_robot_lstep1__%s_*.fits"
+                         % fn.split('.')[0]))
+        if flxcal:
+            # Generate effective area and efficiency plots
+            cmd = "~/sedmpy/drpifu/Eff.py %s --contains %s" % \
+                  (datestr, fn.split('.')[0])
+            logging.info(cmd)
+            subprocess.call(cmd, shell=True)
+        else:
+            logging.info("No flux calibration generated")
+    # END: sci_update
+
+
+def dosci(destdir='./', datestr=None, local=False, nodb=False,
+          nopush_marshal=False, nopush_slack=False, oldext=False,
+          nproc=_sci_nproc):
+    """Process new science ifu images in destdir.
+
+    Finds bias subtracted, CR rejected images that have not yet been
+    extracted, builds cubes and extracts spectra for them.  With nproc > 1,
+    the per-frame steps (cube, extraction, classification, report) for
+    several frames run concurrently in a process pool, while steps that act
+    on the whole directory (make classify, make report, marshal uploads)
+    are run one at a time and SEDM db and marshal updates are done in frame
+    order.
 
     Args:
         destdir (str): destination directory (typically in /data/sedmdrp/redux)
@@ -767,16 +1091,20 @@ def dosci(destdir='./', datestr=None, local=False, nodb=False,
         nopush_marshal (bool): True if no update to marshal
         nopush_slack (bool): True if no update to slack
         oldext (bool): True to use extract_star.py instead of extractstar.py
+        nproc (int): number of frames to process concurrently
 
     Returns:
         int: Number of ifu images actually copied
 
     """
+    global _serial_lock
     # don't make guider movie if we are local
     guider_movie = not local
     # Record copies and standard star observations
     ncp = 0
     copied = []
+    # Frames to process: (file, header, object, standard?)
+    frames = []
     # Get list of source files in destination directory
     srcfiles = sorted(glob.glob(os.path.join(destdir, 'crr_b_ifu*.fits')))
     # Loop over source files
@@ -788,9 +1116,7 @@ def dosci(destdir='./', datestr=None, local=False, nodb=False,
         # Is our source file processed?
         if len(proced) == 0:
             # Read FITS header
-            ff = pf.open(fl)
-            hdr = ff[0].header
-            ff.close()
+            hdr = get_header(fl)
             # Get OBJECT keyword
             try:
                 obj = hdr['OBJECT'].replace(" [A]", "").replace(" ", "-")
@@ -816,227 +1142,66 @@ def dosci(destdir='./', datestr=None, local=False, nodb=False,
             # record action
             copied.append(fn)
             ncp += 1
-            # are we a standard star?
-            if 'STD-' in obj:
-                e3d_good = make_e3d(fnam=fl, destdir=destdir, datestr=datestr,
-                                    nodb=nodb, sci=False, hdr=None,
-                                    guider_movie=guider_movie)
-                if e3d_good:
-                    # Get seeing
-                    seeing = rcimg.get_seeing(imfile=fn, destdir=destdir,
-                                              save_fig=True)
-                    # Use auto psf extraction for standard stars
-                    if seeing > 0:
-                        logging.info("seeing measured as %f" % seeing)
-                    else:
-                        logging.info("seeing not measured for %s" % fn)
-                    if not oldext:
-                        cmd = ("extractstar.py", datestr, "--auto", fn,
-                               "--std", "--tag", "robot",
-                               "--centroid", "brightest", "--seeing", "2.0")
-                        # "--seeing", "%.2f" % seeing)
-                    else:
-                        logging.info("Old extraction method used")
-                        cmd = ("extract_star.py", datestr, "--auto", fn,
-                               "--std", "--tag", "robot", "--maxpos")
-                    logging.info("Extracting std star spectra for " + fn)
-                    logging.info(" ".join(cmd))
-                    retcode = subprocess.call(cmd)
-                    if retcode != 0:
-                        logging.error("Error extracting std star spectra for "
-                                      + fn)
-                        badfn = "spec_auto_notfluxcal_" + fn.split('.')[0] + \
-                                "_failed.fits"
-                        cmd = ("touch", badfn)
-                        subprocess.call(cmd)
-                    else:
-                        if local or nopush_slack:
-                            cmd = ("pysedm_report.py", datestr, "--contains",
-                                   fn.split('.')[0])
-                        else:
-                            cmd = ("pysedm_report.py", datestr, "--contains",
-                                   fn.split('.')[0], "--slack")
-                        logging.info(" ".join(cmd))
-                        retcode = subprocess.call(cmd)
-                        if retcode != 0:
-                            logging.error("Error running pysedm_report for " +
-                                          fn.split('.')[0])
-                        # run Verify.py
-                        cmd = "~/sedmpy/drpifu/Verify.py %s --contains %s" % \
-                              (datestr, fn.split('.')[0])
-                        logging.info(cmd)
-                        subprocess.call(cmd, shell=True)
-                        # run make report
-                        cmd = ("make", "report")
-                        logging.info(" ".join(cmd))
-                        subprocess.call(cmd)
-                        # check if extraction succeeded
-                        proced = glob.glob(os.path.join(destdir, procfn))[0]
-                        if os.path.exists(proced):
-                            if nodb:
-                                logging.warning("Not updating spec in SEDM db")
-                            else:
-                                # Update SedmDb table spec
-                                spec_id = update_spec(proced)
-                                if spec_id > 0:
-                                    logging.info("update of %s with spec_id %d"
-                                                 % (proced, spec_id))
-                                else:
-                                    logging.warning("failed to update spec %s" %
-                                                    proced)
-                        else:
-                            logging.error("Not found: %s" % proced)
-                        # Did we generate a flux calibration?
-                        flxcal = glob.glob(
-                            os.path.join(destdir,
-                                         "fluxcal_auto_robot_lstep1__%s_*.fits"
-                                         % fn.split('.')[0]))
-                        if flxcal:
-                            # Generate effective area and efficiency plots
-                            cmd = "~/sedmpy/drpifu/Eff.py %s --contains %s" % \
-                                  (datestr, fn.split('.')[0])
-                            logging.info(cmd)
-                            subprocess.call(cmd, shell=True)
-                        else:
-                            logging.info("No flux calibration generated")
-                else:
-                    logging.error("Cannot perform extraction for %s" % fn)
+            frames.append((fl, hdr, obj, 'STD-' in obj))
+    if not frames:
+        return ncp, copied
+
+    nproc = max(1, min(nproc, len(frames)))
+    _serial_lock = _mp_context.Lock()
+    if nproc > 1:
+        # Share the cores between the concurrent cubes
+        ncore = max(1, (os.cpu_count() or _cube_ncore) // nproc)
+        logging.info("Processing %d frames with %d workers, %d cores each" %
+                     (len(frames), nproc, ncore))
+        pool = ProcessPoolExecutor(max_workers=nproc, mp_context=_mp_context,
+                                   initializer=_init_sci_worker,
+                                   initargs=(_serial_lock, ncore))
+    else:
+        pool = None
+    try:
+        # Start per-frame processing
+        futures = []
+        for fl, hdr, obj, std in frames:
+            kwargs = dict(hdr=None if std else hdr, destdir=destdir,
+                          datestr=datestr, std=std, local=local,
+                          nopush_slack=nopush_slack, oldext=oldext,
+                          guider_movie=guider_movie)
+            if pool is None:
+                futures.append(sci_extract(fl, **kwargs))
             else:
-                # Build cube for science observation
-                e3d_good = make_e3d(fnam=fl, destdir=destdir, datestr=datestr,
-                                    nodb=nodb, sci=True, hdr=hdr,
-                                    guider_movie=guider_movie)
-
-                if e3d_good:
-                    # Get seeing
-                    seeing = rcimg.get_seeing(imfile=fn, destdir=destdir,
-                                              save_fig=True)
-                    # Use forced psf for science targets
-                    if seeing > 0:
-                        logging.info("seeing measured as %f" % seeing)
-
-                    else:
-                        logging.info("seeing not measured for %s" % fn)
-                    if not oldext:
-                        cmd = ("extractstar.py", datestr, "--auto", fn,
-                               "--autobins", "6", "--tag", "robot",
-                               "--centroid", "auto", "--byecr",
-                               "--seeing", "2.0")
-                        # "--seeing", "%.2f" % seeing)
-                    else:
-                        logging.info("Old extraction method used")
-                        cmd = ("extract_star.py", datestr, "--auto", fn,
-                               "--autobins", "6", "--tag", "robot")
-                    logging.info("Extracting object spectra for " + fn)
-                    logging.info(" ".join(cmd))
-                    retcode = subprocess.call(cmd)
-                    if retcode != 0:
-                        logging.error("Error extracting object spectrum for "
-                                      + fn)
-                        badfn = "spec_auto_notfluxcal_" + fn.split('.')[0] + \
-                                "_failed.fits"
-                        cmd = ("touch", badfn)
-                        subprocess.call(cmd)
-                    else:
-                        # Run SNID, SNIascore, and NGSF
-                        logging.info("Running SNID, SNIascore, NGSF for " + fn)
-                        cmd = ("make", "classify")
-                        logging.info(" ".join(cmd))
-                        retcode = subprocess.call(cmd)
-                        if retcode != 0:
-                            logging.error("Error running SNID, SNIascore, "
-                                          "or NGSF")
-                        if local or nopush_slack:
-                            cmd = ("pysedm_report.py", datestr, "--contains",
-                                   fn.split('.')[0])
-                        else:
-                            cmd = ("pysedm_report.py", datestr, "--contains",
-                                   fn.split('.')[0], "--slack")
-                        logging.info(" ".join(cmd))
-                        retcode = subprocess.call(cmd)
-                        if retcode != 0:
-                            logging.error("Error running report for " +
-                                          fn.split('.')[0])
-                        # Upload spectrum to marshal
-                        if local or nopush_marshal:
-                            logging.warning("nopush_marshal or local: "
-                                            "skipping ztfupload")
-                        else:
-                            # fritz upload
-                            cmd = ("make", "fritzupload")
-                            retcode = subprocess.call(cmd)
-                            if retcode != 0:
-                                logging.error("Error uploading spectra to"
-                                              " fritz marshal")
-                            # growth upload
-                            cmd = ("make", "ztfupload")
-                            retcode = subprocess.call(cmd)
-                            if retcode != 0:
-                                logging.error("Error uploading spectra to"
-                                              " growth marshal")
-                        # run Verify.py
-                        cmd = "~/sedmpy/drpifu/Verify.py %s --contains %s" % \
-                              (datestr, fn.split('.')[0])
-                        subprocess.call(cmd, shell=True)
-                        # notify user that followup successfully completed
-                        proced = glob.glob(os.path.join(destdir, procfn))[0]
-                        if os.path.exists(proced):
-                            if local or nopush_marshal:
-                                logging.warning("nopush_marshal or local: "
-                                                "skipping email")
-                            else:
-                                email_user(proced, datestr, obj)
-                            if nodb:
-                                logging.warning("No update of spec in SEDM db")
-                            else:
-                                # Update SedmDb table spec
-                                spec_id = update_spec(
-                                    proced, nopush_marshal=nopush_marshal)
-                                logging.info("update of %s with spec_id %d" %
-                                             (proced, spec_id))
-                        else:
-                            logging.error("Not found: %s" % proced)
-                        # contsep extraction
-                        cmd = ("extractstar.py", datestr, "--auto", fn,
-                               "--autobins", "6", "--tag", "contsep",
-                               "--centroid", "auto", "--contsep", "--byecr")
-                        logging.info("Extracting contsep spectra for " + fn)
-                        logging.info(" ".join(cmd))
-                        retcode = subprocess.call(cmd)
-                        if retcode != 0:
-                            logging.error("Error extracting contsep spectrum "
-                                          "for" + fn)
-                        else:
-                            # Run SNID
-                            logging.info("Running SNID for contsep " + fn)
-                            cmd = ("make", "classify")
-                            logging.info(" ".join(cmd))
-                            retcode = subprocess.call(cmd)
-                            if retcode != 0:
-                                logging.error("Error running SNID")
-                            # run Verify.py
-                            cmd = "~/sedmpy/drpifu/Verify.py %s " \
-                                  "--contains contsep_lstep1__%s" \
-                                  % (datestr, fn.split('.')[0])
-                            subprocess.call(cmd, shell=True)
-                            # run pysedm_report
-                            if local or nopush_slack:
-                                cmd = ("pysedm_report.py", datestr,
-                                       "--contains",
-                                       "contsep_lstep1__" + fn.split('.')[0])
-                            else:
-                                cmd = ("pysedm_report.py", datestr,
-                                       "--contains",
-                                       "contsep_lstep1__" + fn.split('.')[0],
-                                       "--slack")
-                            logging.info(" ".join(cmd))
-                            retcode = subprocess.call(cmd)
-                            if retcode != 0:
-                                logging.error("Error running report for " +
-                                              "contsep_lstep1__" +
-                                              fn.split('.')[0])
+                futures.append(pool.submit(sci_extract, fl, **kwargs))
+        # Ordered updates as each frame finishes
+        contsep = []
+        for (fl, hdr, obj, std), fut in zip(frames, futures):
+            if pool is None:
+                res = fut
+            else:
+                try:
+                    res = fut.result()
+                except Exception as e:
+                    logging.error("Processing failed for %s: %s" % (fl, e))
+                    continue
+            sci_update(fl, res, obj=obj, destdir=destdir, datestr=datestr,
+                       std=std, local=local, nodb=nodb,
+                       nopush_marshal=nopush_marshal)
+            # contsep extraction for science targets
+            if res['extracted'] and not std:
+                if pool is None:
+                    sci_contsep(fl, datestr=datestr, local=local,
+                                nopush_slack=nopush_slack)
                 else:
-                    logging.error("Cannot perform extraction for %s" % fn)
+                    contsep.append(pool.submit(sci_contsep, fl,
+                                               datestr=datestr, local=local,
+                                               nopush_slack=nopush_slack))
+        for fut in contsep:
+            try:
+                fut.result()
+            except Exception as e:
+                logging.error("contsep processing failed: %s" % e)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
     return ncp, copied
     # END: dosci
 
@@ -1059,14 +1224,14 @@ def make_e3d(fnam=None, destdir=None, datestr=None, nodb=False, sci=False,
     else:
         lab = "STD"
     cmd = ("ccd_to_cube.py", datestr, "--build", fn, "--solvewcs",
-           "--ncore", "8")
+           "--ncore", "%d" % _cube_ncore)
     if hdr:
         # Check for moving target: no guider image for those
         if 'RA_RATE' in hdr and 'DEC_RATE' in hdr:
             if hdr['RA_RATE'] != 0. or hdr['DEC_RATE'] != 0.:
                 logging.info("Non-sidereal object")
                 cmd = ("ccd_to_cube.py", datestr, "--build", fn,
-                       "--ncore", "8")
+                       "--ncore", "%d" % _cube_ncore)
 
     proccubefn = "e3d_%s_*.fits" % fn.split('.')[0]
     procedcube = glob.glob(os.path.join(destdir, proccubefn))
@@ -1583,8 +1748,69 @@ def email_user(spec_file, utdate, object_name):
                                                 'link': link, 'status': status})
 
 
+def _finder_worker(jobs):
+    """Make finders for the ifu files put on the jobs queue"""
+    try:
+        import acq_finder
+    except ImportError:
+        import drpifu.acq_finder as acq_finder
+    acq_finder.serve(jobs)
+
+
+def _stop_finder_worker():
+    """Let the finder worker finish its queued jobs and exit.
+
+    A worker still busy after _finder_stop_timeout seconds (e.g. stuck in
+    a plot) is terminated, so it cannot keep AutoReduce from exiting.
+    """
+    global _finder_jobs, _finder_proc
+    if _finder_proc is not None:
+        _finder_jobs.put(None)
+        _finder_proc.join(_finder_stop_timeout)
+        if _finder_proc.is_alive():
+            logging.warning("Finder worker did not finish, terminating")
+            _finder_proc.terminate()
+            _finder_proc.join(5.)
+        _finder_proc = None
+        _finder_jobs = None
+
+
+def start_finder_worker():
+    """Start the background process that makes finders, if not running.
+
+    The worker imports the finder code once and then makes finders for
+    the ifu files queued by :func:`make_finder`, one at a time.  Progress
+    is recorded in finders/finder_status.json of the redux directory.
+
+    Returns:
+        bool: True if the worker is running
+
+    """
+    global _finder_jobs, _finder_proc
+    if _finder_proc is not None and _finder_proc.is_alive():
+        return True
+    try:
+        _finder_jobs = _mp_context.Queue()
+        _finder_proc = _mp_context.Process(target=_finder_worker,
+                                           args=(_finder_jobs,), daemon=True)
+        _finder_proc.start()
+    except OSError as e:
+        logging.warning("Cannot start finder worker: %s" % e)
+        _finder_proc = None
+        _finder_jobs = None
+        return False
+    atexit.unregister(_stop_finder_worker)
+    atexit.register(_stop_finder_worker)
+    logging.info("Started finder worker, pid %d" % _finder_proc.pid)
+    return True
+
+
 def make_finder(ffile):
-    """ Spawn a process that makes a finder for the ifu file """
+    """ Queue a finder for the ifu file on the finder worker """
+    if start_finder_worker():
+        _finder_jobs.put(os.path.abspath(ffile))
+        return
+    # Fall back to a separate process for this file
     spy = os.path.join(os.getenv("HOME"), "spy")
     prog = os.path.join(os.getenv("HOME"), "sedmpy", "drpifu", "acq_finder.py")
     cmd = (spy, prog, "--imfile", ffile)
@@ -1594,8 +1820,9 @@ def make_finder(ffile):
 def find_recent(redd, fname, destdir, dstr):
     """Find the most recent version of fname and copy it to destdir.
 
-    Look through sorted list of redux directories to find most recent
-    version of the input file.  Copy (link) it into the destination directory.
+    Look up the most recent version of the input file in the catalog of
+    redux directories (see CalCatalog).  Copy (link) it into the
+    destination directory.
 
     Args:
         redd (str): reduced directory (something like /data/sedmdrp/redux)
@@ -1615,24 +1842,15 @@ def find_recent(redd, fname, destdir, dstr):
     if len(local_file) == 1:
         logging.warning("%s already exists in %s" % (fname, destdir))
         ret = True
-    # Search in redd for file
+    # Search in redd catalog for file
     else:
-        # Get all but the most recent reduced data directories
-        fspec = os.path.join(redd, '20??????')
-        srtlist = sorted([d for d in glob.glob(fspec)
-                          if os.path.isdir(d)])
-        redlist = srtlist[0:srtlist.index(destdir)]
-        logging.info("Looking backwards for %s starting at %s" %
-                     (fname, redlist[-1]))
-        # Go back in reduced dir list until we find our file
-        for d in reversed(redlist):
-            src = glob.glob(os.path.join(d, '20??????' + fname))
-            if len(src) == 1:
-                os.symlink(src[0], os.path.join(destdir, dstr + fname))
-                ret = True
-                logging.info("Found %s in directory %s, linking to %s" %
-                             (fname, d, destdir))
-                break
+        logging.info("Looking backwards for %s before %s" % (fname, dstr))
+        d, src = CalCatalog.find_latest(redd, '20??????' + fname, dstr)
+        if src is not None:
+            os.symlink(src, os.path.join(destdir, dstr + fname))
+            ret = True
+            logging.info("Found %s in directory %s, linking to %s" %
+                         (fname, d, destdir))
     if not ret:
         logging.warning(dstr + fname + " not found")
 
@@ -1642,8 +1860,9 @@ def find_recent(redd, fname, destdir, dstr):
 def find_recent_bias(redd, fname, destdir):
     """Find the most recent version of fname and copy it to destdir.
 
-    Look through sorted list of redux directories to find most recent
-    version of the input file.  Copy it to the destination directory.
+    Look up the most recent version of the input file in the catalog of
+    redux directories (see CalCatalog).  Copy it to the destination
+    directory.
 
     Args:
         redd (str): reduced directory (something like /data/sedmdrp/redux)
@@ -1662,34 +1881,42 @@ def find_recent_bias(redd, fname, destdir):
     if len(local_file) == 1:
         logging.warning("%s already exists in %s" % (fname, destdir))
         ret = True
-    # Search in redd for file
+    # Search in redd catalog for file
     else:
-        # Get all but the most recent reduced data directories
-        fspec = os.path.join(redd, '20??????')
-        srtlist = sorted([d for d in glob.glob(fspec)
-                          if os.path.isdir(d)])
-        redlist = srtlist[0:srtlist.index(destdir)]
-        logging.info("Looking backwards for %s starting at %s" %
-                     (fname, redlist[-1]))
-        # Go back in reduced dir list until we find our file
-        for d in reversed(redlist):
-            src = glob.glob(os.path.join(d, fname))
-            if len(src) == 1:
-                os.symlink(src[0], os.path.join(destdir, fname))
-                ret = True
-                logging.info("Found %s in directory %s, linking to %s" %
-                             (fname, d, os.path.join(destdir, fname)))
-                break
+        dstr = os.path.basename(os.path.normpath(destdir))
+        logging.info("Looking backwards for %s before %s" % (fname, dstr))
+        d, src = CalCatalog.find_latest(redd, fname, dstr)
+        if src is not None:
+            os.symlink(src, os.path.join(destdir, fname))
+            ret = True
+            logging.info("Found %s in directory %s, linking to %s" %
+                         (fname, d, os.path.join(destdir, fname)))
     if not ret:
         logging.warning("%s not found" % fname)
     return ret
 
 
+def select_fluxcal(files):
+    """Select the first real (not linked) telluric corrected flux cal"""
+    for s in files:
+        # Skip sym-links
+        if os.path.islink(s):
+            continue
+        # Read FITS header
+        hdr = get_header(s)
+        # Skip if not Telluric corrected
+        if 'TELLFLTR' not in hdr:
+            continue
+        return s
+    return None
+
+
 def find_recent_fluxcal(redd, fname, destdir):
     """Find the most recent version of fname and copy it to destdir.
 
-    Look through sorted list of redux directories to find most recent
-    version of the input file.  Copy it to the destination directory.
+    Look up the most recent version of the input file in the catalog of
+    redux directories (see CalCatalog).  Copy it to the destination
+    directory.
 
     Args:
         redd (str): reduced directory (something like /data/sedmdrp/redux)
@@ -1708,40 +1935,21 @@ def find_recent_fluxcal(redd, fname, destdir):
     if len(local_file) >= 1:
         logging.warning("%s already exists in %s" % (fname, destdir))
         ret = True
-    # Search in redd for file
+    # Search in redd catalog for file
     else:
-        # Get all but the most recent reduced data directories
-        fspec = os.path.join(redd, '20??????')
-        srtlist = sorted([d for d in glob.glob(fspec)
-                          if os.path.isdir(d)])
-        redlist = srtlist[0:srtlist.index(destdir)]
-        logging.info("Looking backwards for %s starting at %s" %
-                     (fname, redlist[-1]))
-        # Go back in reduced dir list until we find our file
-        for d in reversed(redlist):
-            src = sorted(glob.glob(os.path.join(d, fname)))
-            for s in src:
-                # Skip sym-links
-                if os.path.islink(s):
-                    continue
-                # Read FITS header
-                ff = pf.open(s)
-                hdr = ff[0].header
-                ff.close()
-                # Skip if not Telluric corrected
-                if 'TELLFLTR' not in hdr:
-                    continue
-                newfile = os.path.join(destdir, s.split('/')[-1])
-                try:
-                    os.symlink(s, newfile)
-                except OSError:
-                    logging.warning("File already exists: %s" % newfile)
-                ret = True
-                logging.info("Found %s in directory %s, linking to %s" %
-                             (fname, d, newfile))
-                break
-            if ret:
-                break
+        dstr = os.path.basename(os.path.normpath(destdir))
+        logging.info("Looking backwards for %s before %s" % (fname, dstr))
+        d, src = CalCatalog.find_latest(redd, fname, dstr,
+                                        select=select_fluxcal)
+        if src is not None:
+            newfile = os.path.join(destdir, src.split('/')[-1])
+            try:
+                os.symlink(src, newfile)
+            except OSError:
+                logging.warning("File already exists: %s" % newfile)
+            ret = True
+            logging.info("Found %s in directory %s, linking to %s" %
+                         (fname, d, newfile))
     if not ret:
         logging.warning("%s not found" % fname)
     return ret
@@ -1792,9 +2000,7 @@ def cpprecal(dirlist, destdir='./', fsize=_nomfs, nodb=False):
         for src in flist:
             if os.stat(src).st_size >= fsize:
                 # Read FITS header
-                ff = pf.open(src)
-                hdr = ff[0].header
-                ff.close()
+                hdr = get_header(src)
                 # Get OBJECT keyword
                 obj = hdr['OBJECT']
                 # Filter Calibs and avoid test images
@@ -1845,7 +2051,7 @@ def cpprecal(dirlist, destdir='./', fsize=_nomfs, nodb=False):
     # END: cpprecal
 
 
-def cpcal(srcdir, destdir='./', fsize=_nomfs, nodb=False):
+def cpcal(srcdir, destdir='./', fsize=_nomfs, nodb=False, srcfiles=None):
     """Copy raw cal files from srcdir into destdir.
 
     Find calibration files taken within 10 hours of the day changeover
@@ -1856,6 +2062,8 @@ def cpcal(srcdir, destdir='./', fsize=_nomfs, nodb=False):
         destdir (str): place to put the cal images
         fsize (int): size of completely copied file in bytes
         nodb (bool): skip update of SEDM db
+        srcfiles (list): new raw files to consider (from a RawWatcher),
+            if None, all raw images in srcdir are checked
 
     Returns:
         int: number of images actually copied
@@ -1867,7 +2075,10 @@ def cpcal(srcdir, destdir='./', fsize=_nomfs, nodb=False):
     # Get list of current raw calibration files
     # (within 10 hours of day changeover)
     fspec = os.path.join(srcdir, "ifu%s_0*.fits" % sdate)
-    flist = sorted(glob.glob(fspec))
+    if srcfiles is None:
+        flist = sorted(glob.glob(fspec))
+    else:
+        flist = sorted(fnmatch.filter(srcfiles, fspec))
     # Record number copied
     ncp = 0
     # Loop over file list
@@ -1887,9 +2098,7 @@ def cpcal(srcdir, destdir='./', fsize=_nomfs, nodb=False):
         # Copy only if source complete or larger than local file
         if src_size >= fsize and src_size > loc_size:
             # Read FITS header
-            ff = pf.open(src)
-            hdr = ff[0].header
-            ff.close()
+            hdr = get_header(src)
             # Get OBJECT keyword
             try:
                 obj = hdr['OBJECT']
@@ -1935,7 +2144,8 @@ def cpcal(srcdir, destdir='./', fsize=_nomfs, nodb=False):
 
 def obs_loop(rawlist=None, redd=None, check_precal=True, indir=None,
              piggyback=False, local=False, nodb=False, use_refcube=False,
-             nopush_marshal=False, nopush_slack=False, oldext=False):
+             nopush_marshal=False, nopush_slack=False, oldext=False,
+             nproc=_sci_nproc):
     """One night observing loop: processes calibrations and science data
 
     Copy raw cal files until we are ready to process the night's
@@ -1960,6 +2170,7 @@ def obs_loop(rawlist=None, redd=None, check_precal=True, indir=None,
         nopush_marshal (bool): True if no update to marshal
         nopush_slack (bool): True if no update to slack
         oldext (bool): True to use extract_star.py instead of extracstar.py
+        nproc (int): number of science frames to process concurrently
 
     Returns:
         bool: True if night completed normally, False otherwise
@@ -2017,217 +2228,247 @@ def obs_loop(rawlist=None, redd=None, check_precal=True, indir=None,
 
     logging.info("Found %d spec focus plots" % len(focus_plots))
 
-    # Check if processed cal files are ready
-    if not cube_ready(outdir, cur_date_str):
-        # Wait for cal files until sunset
-        if piggyback:
-            logging.info("Skipping check for raw cal files")
-            ncp = 0
-        else:
-            if check_precal:
-                # Copy raw cal files from previous date directory
-                npre = cpprecal(rawlist, outdir, nodb=nodb)
-                logging.info("Linked %d raw cal files from %s" % (npre,
-                                                                  rawlist[-2]))
-            # Now check the current source dir for raw cal files
-            ncp = cpcal(srcdir, outdir, nodb=nodb)
-            logging.info("Linked %d raw cal files from %s" % (ncp, srcdir))
-        # Now loop until we have the raw cal files we need or sun is down
-        while not cal_proc_ready(outdir, ncp=ncp, test_cal_ims=piggyback):
-            # Wait a minute
-            logging.info("waiting 60s for more raw cal files...")
-            now = Time(datetime.utcnow())
-            time.sleep(60)
+    # Watch for new raw images instead of re-scanning srcdir
+    if piggyback:
+        watcher = None
+    else:
+        watcher = RawWatcher(srcdir)
+        watcher.start()
+    try:
+        # Check if processed cal files are ready
+        if not cube_ready(outdir, cur_date_str):
+            # Wait for cal files until sunset
             if piggyback:
-                logging.info("checking for processed cal files")
+                logging.info("Skipping check for raw cal files")
                 ncp = 0
             else:
-                if check_precal and now.to_datetime().hour >= 20:
-                    logging.info("checking %s for new raw cal files..."
-                                 % rawlist[-2])
-                    ncp = cpprecal(rawlist, outdir, nodb=nodb)
-                    logging.info("Linked %d raw cal files from %s"
-                                 % (ncp, rawlist[-2]))
-                else:
-                    logging.info("checking %s for new raw cal files..."
-                                 % srcdir)
-                    ncp = cpcal(srcdir, outdir, nodb=nodb)
+                if check_precal:
+                    # Copy raw cal files from previous date directory
+                    npre = cpprecal(rawlist, outdir, nodb=nodb)
+                    logging.info("Linked %d raw cal files from %s" %
+                                 (npre, rawlist[-2]))
+                # Now check the current source dir for raw cal files
+                ncp = cpcal(srcdir, outdir, nodb=nodb)
                 logging.info("Linked %d raw cal files from %s" % (ncp, srcdir))
-            if ncp <= 0:
-                # Check to see if we are still before an hour after sunset
+            # Now loop until we have the raw cal files we need or sun is down
+            while not cal_proc_ready(outdir, ncp=ncp, test_cal_ims=piggyback):
+                # Wait up to a minute
+                logging.info("waiting 60s for more raw cal files...")
                 now = Time(datetime.utcnow())
-                if now < evening_civil_twilight:
-                    logging.info("UT  = %s < civil twilight (%s),"
-                                 " so keep  waiting" %
-                                 (now.iso.split()[-1],
-                                  evening_civil_twilight.iso.split()[-1]))
+                if watcher is None:
+                    time.sleep(60)
+                    new_files = None
                 else:
-                    logging.info("UT = %s >= civil twilight (%s), "
-                                 "time to get a cal set" %
-                                 (now.iso.split()[-1],
-                                  evening_civil_twilight.iso.split()[-1]))
-                    break
-            else:
-                # Get new listing
-                retcode = subprocess.call("~/spy what ifu*.fits > what.list",
-                                          shell=True)
-                # Link what.txt
-                if not os.path.islink(os.path.join('what.txt')):
-                    os.symlink('what.list', 'what.txt')
-                if retcode != 0:
-                    logging.error("what oops!")
+                    new_files = watcher.get(timeout=60.)
+                if piggyback:
+                    logging.info("checking for processed cal files")
+                    ncp = 0
+                else:
+                    if check_precal and now.to_datetime().hour >= 20:
+                        logging.info("checking %s for new raw cal files..."
+                                     % rawlist[-2])
+                        ncp = cpprecal(rawlist, outdir, nodb=nodb)
+                        logging.info("Linked %d raw cal files from %s"
+                                     % (ncp, rawlist[-2]))
+                    else:
+                        logging.info("checking %s for new raw cal files..."
+                                     % srcdir)
+                        ncp = cpcal(srcdir, outdir, nodb=nodb,
+                                    srcfiles=new_files)
+                    logging.info("Linked %d raw cal files from %s" %
+                                 (ncp, srcdir))
+                if ncp <= 0:
+                    # Check to see if we are still before an hour after sunset
+                    now = Time(datetime.utcnow())
+                    if now < evening_civil_twilight:
+                        logging.info("UT  = %s < civil twilight (%s),"
+                                     " so keep  waiting" %
+                                     (now.iso.split()[-1],
+                                      evening_civil_twilight.iso.split()[-1]))
+                    else:
+                        logging.info("UT = %s >= civil twilight (%s), "
+                                     "time to get a cal set" %
+                                     (now.iso.split()[-1],
+                                      evening_civil_twilight.iso.split()[-1]))
+                        break
+                else:
+                    # Get new listing
+                    retcode = subprocess.call(
+                        "~/spy what ifu*.fits > what.list", shell=True)
+                    # Link what.txt
+                    if not os.path.islink(os.path.join('what.txt')):
+                        os.symlink('what.list', 'what.txt')
+                    if retcode != 0:
+                        logging.error("what oops!")
 
-        # Process calibrations if we are using them
-        if cal_proc_ready(outdir, mintest=True, test_cal_ims=piggyback):
-            # bias subtract and CR reject
-            start_time = time.time()
-            if proc_bias_crrs(20, piggyback=piggyback):
-                procb_time = int(time.time() - start_time)
-                if not piggyback:
-                    # Make cal images
-                    subprocess.call(("make", "calimgs"))
-                # Process calibration
+            # Process calibrations if we are using them
+            if cal_proc_ready(outdir, mintest=True, test_cal_ims=piggyback):
+                # bias subtract and CR reject
                 start_time = time.time()
-                if use_refcube:
-                    link_refcube(curdir=outdir, date_str=cur_date_str)
-                    logging.info("linked Traces from ref dir into %s" %
-                                 cur_date_str)
-                else:
-                    cmd = ("ccd_to_cube.py", cur_date_str, "--tracematch",
-                           "--hexagrid")
-                    logging.info(" ".join(cmd))
-                    subprocess.call(cmd)
-                procg_time = int(time.time() - start_time)
-                if os.path.exists(
-                   os.path.join(outdir, cur_date_str + '_HexaGrid.pkl')):
-                    # Process wavelengths
+                if proc_bias_crrs(20, piggyback=piggyback):
+                    procb_time = int(time.time() - start_time)
+                    if not piggyback:
+                        # Make cal images
+                        subprocess.call(("make", "calimgs"))
+                    # Process calibration
                     start_time = time.time()
+                    if use_refcube:
+                        link_refcube(curdir=outdir, date_str=cur_date_str)
+                        logging.info("linked Traces from ref dir into %s" %
+                                     cur_date_str)
+                    else:
+                        cmd = ("ccd_to_cube.py", cur_date_str, "--tracematch",
+                               "--hexagrid")
+                        logging.info(" ".join(cmd))
+                        subprocess.call(cmd)
+                    procg_time = int(time.time() - start_time)
+                    if os.path.exists(
+                       os.path.join(outdir, cur_date_str + '_HexaGrid.pkl')):
+                        # Process wavelengths
+                        start_time = time.time()
+
+                        # from dask.distributed import Client
+                        # client = Client(threads_per_worker=2, n_workers=32)
+                        # Build the wavesolution with pysedm v-0.40.0
+                        cmd = ("ccd_to_cube.py", cur_date_str, "--wavesol")
+                        logging.info(" ".join(cmd))
+                        subprocess.call(cmd)
 
-                    # from dask.distributed import Client
-                    # client = Client(threads_per_worker=2, n_workers=32)
-                    # Build the wavesolution with pysedm v-0.40.0
-                    cmd = ("ccd_to_cube.py", cur_date_str, "--wavesol")
-                    logging.info(" ".join(cmd))
-                    subprocess.call(cmd)
-
-                    """
-                    # Spawn nsub sub-processes to solve wavelengths faster
-                    nsub = 8
-                    cmd = ("derive_wavesolution.py", cur_date_str,
-                           "--nsub", "%d" % nsub)
-                    logging.info(" ".join(cmd))
-                    subprocess.Popen(cmd)
-                    time.sleep(60)
-                    # Get a list of solved spaxels
-                    wslist = glob.glob(os.path.join(outdir, cur_date_str +
-                                                    '_WaveSolution_range*.pkl'))
-                    # Wait until they are all finished
-                    nfin = len(wslist)
-                    while nfin < nsub:
+                        """
+                        # Spawn nsub sub-processes to solve wavelengths faster
+                        nsub = 8
+                        cmd = ("derive_wavesolution.py", cur_date_str,
+                               "--nsub", "%d" % nsub)
+                        logging.info(" ".join(cmd))
+                        subprocess.Popen(cmd)
                         time.sleep(60)
-                        wslist = glob.glob(
-                            os.path.join(outdir, cur_date_str +
-                                         '_WaveSolution_range*.pkl'))
-                        if len(wslist) != nfin:
-                            print("\nFinished %d out of %d parts"
-                                  % (len(wslist), nsub))
-                            nfin = len(wslist)
-                        else:
-                            print(".", end="", flush=True)
-                    logging.info("Finished all %d parts, merging..." % nsub)
-                    # Merge the solutions
-                    subprocess.call(("derive_wavesolution.py", cur_date_str,
-                                     "--merge"))
-                    """
-                procw_time = int(time.time() - start_time)
-                if os.path.exists(
-                   os.path.join(outdir, cur_date_str + '_WaveSolution.parquet')):
-                    # Process flat
-                    start_time = time.time()
-                    cmd = ("ccd_to_cube.py", cur_date_str, "--flat")
-                    logging.info(" ".join(cmd))
-                    subprocess.call(cmd)
-                    if not (os.path.exists(
-                            os.path.join(outdir, cur_date_str + '_Flat.fits'))):
-                        logging.info("Making of %s_Flat.fits failed!"
-                                     % cur_date_str)
+                        # Get a list of solved spaxels
+                        wslist = glob.glob(os.path.join(outdir, cur_date_str +
+                                                        '_WaveSolution_range*.pkl'))
+                        # Wait until they are all finished
+                        nfin = len(wslist)
+                        while nfin < nsub:
+                            time.sleep(60)
+                            wslist = glob.glob(
+                                os.path.join(outdir, cur_date_str +
+                                             '_WaveSolution_range*.pkl'))
+                            if len(wslist) != nfin:
+                                print("\nFinished %d out of %d parts"
+                                      % (len(wslist), nsub))
+                                nfin = len(wslist)
+                            else:
+                                print(".", end="", flush=True)
+                        logging.info("Finished all %d parts, merging..." % nsub)
+                        # Merge the solutions
+                        subprocess.call(("derive_wavesolution.py", cur_date_str,
+                                         "--merge"))
+                        """
+                    procw_time = int(time.time() - start_time)
+                    if os.path.exists(
+                       os.path.join(outdir, cur_date_str + '_WaveSolution.parquet')):
+                        # Process flat
+                        start_time = time.time()
+                        cmd = ("ccd_to_cube.py", cur_date_str, "--flat")
+                        logging.info(" ".join(cmd))
+                        subprocess.call(cmd)
+                        if not (os.path.exists(
+                                os.path.join(outdir, cur_date_str + '_Flat.fits'))):
+                            logging.info("Making of %s_Flat.fits failed!"
+                                         % cur_date_str)
+                    else:
+                        logging.error("Making of %s cube failed!" %
+                                      cur_date_str)
+                    procf_time = int(time.time() - start_time)
+                    # Report times
+                    logging.info("Calibration processing took "
+                                 "%d s (bias,crrs), %d s (grid),"
+                                 "%d s (waves),  and %d s (flat)" %
+                                 (procb_time, procg_time, procw_time,
+                                  procf_time))
+                    # Make cube report
+                    cmd = "~/miniconda3/bin/python " \
+                          "~/sedmpy/drpifu/CubeReport.py %s" % cur_date_str
+                    if not local:
+                        # send to slack pysedm_report channel
+                        cmd += " --slack"
+                    logging.info(cmd)
+                    subprocess.call(cmd, shell=True)
+            # Check status
+            if cube_ready(outdir, cur_date_str):
+                if nodb:
+                    logging.warning("Not updating SEDM db")
                 else:
-                    logging.error("Making of %s cube failed!" % cur_date_str)
-                procf_time = int(time.time() - start_time)
-                # Report times
-                logging.info("Calibration processing took "
-                             "%d s (bias,crrs), %d s (grid),"
-                             "%d s (waves),  and %d s (flat)" %
-                             (procb_time, procg_time, procw_time, procf_time))
-                # Make cube report
-                cmd = "~/miniconda3/bin/python " \
-                      "~/sedmpy/drpifu/CubeReport.py %s" % cur_date_str
-                if not local:
-                    cmd += " --slack"   # send to slack pysedm_report channel
-                logging.info(cmd)
-                subprocess.call(cmd, shell=True)
-        # Check status
-        if cube_ready(outdir, cur_date_str):
-            if nodb:
-                logging.warning("Not updating SEDM db")
+                    # Update spec_calib table in sedmdb
+                    spec_calib_id = update_calibration(cur_date_str)
+                    logging.info("SEDM db accepted spec_calib at id %d" %
+                                 spec_calib_id)
+                # Record tonight's calibrations in the catalog (flux
+                # calibrations are recorded at the end of the night)
+                CalCatalog.update_night(redd, cur_date_str,
+                                        patterns=CalCatalog.cal_patterns)
             else:
-                # Update spec_calib table in sedmdb
-                spec_calib_id = update_calibration(cur_date_str)
-                logging.info("SEDM db accepted spec_calib at id %d" %
-                             spec_calib_id)
-        else:
-            logging.error("These calibrations failed!")
-            logging.info("Let's get our calibrations from a previous night")
-            nct = find_recent(redd, '_TraceMatch.pkl', outdir,
-                              cur_date_str)
-            nctm = find_recent(redd, '_TraceMatch_WithMasks.pkl', outdir,
-                               cur_date_str)
-            ncg = find_recent(redd, '_HexaGrid.pkl', outdir, cur_date_str)
-            ncw = find_recent(redd, '_WaveSolution.parquet', outdir, cur_date_str)
-            ncf = find_recent(redd, '_Flat.fits', outdir, cur_date_str)
-            if not bias_ready(outdir):
-                ncb = find_recent_bias(redd, 'bias0.1.fits', outdir)
-                nc2 = find_recent_bias(redd, 'bias2.0.fits', outdir)
-                nc1 = find_recent_bias(redd, 'bias1.0.fits', outdir)
-            else:
-                ncb = True
-                nc2 = True
-                nc1 = True
-            # Check for bias failure
-            if not ncb or not nc2:
-                if not nc1:
-                    msg = "Calibration stage biases failed: bias0.1 = %s, " \
-                          "bias2.0 = %s, bias1.0 = %s, stopping" % (ncb,
-                                                                    nc2, nc1)
-                    sys.exit(msg)
+                logging.error("These calibrations failed!")
+                logging.info("Let's get our calibrations from a previous "
+                             "night")
+                nct = find_recent(redd, '_TraceMatch.pkl', outdir,
+                                  cur_date_str)
+                nctm = find_recent(redd, '_TraceMatch_WithMasks.pkl', outdir,
+                                   cur_date_str)
+                ncg = find_recent(redd, '_HexaGrid.pkl', outdir, cur_date_str)
+                ncw = find_recent(redd, '_WaveSolution.parquet', outdir, cur_date_str)
+                ncf = find_recent(redd, '_Flat.fits', outdir, cur_date_str)
+                if not bias_ready(outdir):
+                    ncb = find_recent_bias(redd, 'bias0.1.fits', outdir)
+                    nc2 = find_recent_bias(redd, 'bias2.0.fits', outdir)
+                    nc1 = find_recent_bias(redd, 'bias1.0.fits', outdir)
                 else:
-                    logging.info("Using Andor single speed biases")
-            # Check for geom failure
-            if not nct or not nctm or not ncg or not ncw or not ncf:
-                msg = "Calibration stage geom failed: trace = %s, " \
-                      "trace/mask = %s, grid = %s, wave = %s, flat = %s, "\
-                      "stopping" % (nct, nctm, ncg, ncw, ncf)
-                sys.exit(msg)
-            # If we get here, we are done
-            logging.info("Using older calibration files")
-    else:
-        logging.info("Calibrations already present in %s" % outdir)
-
-    logging.info("Calibration stage complete, ready for science!")
-    # Link recent flux cal file
-    find_recent_fluxcal(redd, 'fluxcal*.fits', outdir)
-    # Keep track of no copy
-    nnc = 0
-    # loop and copy new files
-    doit = True
-    try:
+                    ncb = True
+                    nc2 = True
+                    nc1 = True
+                # Check for bias failure
+                if not ncb or not nc2:
+                    if not nc1:
+                        msg = "Calibration stage biases failed: " \
+                              "bias0.1 = %s, bias2.0 = %s, bias1.0 = %s, " \
+                              "stopping" % (ncb, nc2, nc1)
+                        sys.exit(msg)
+                    else:
+                        logging.info("Using Andor single speed biases")
+                # Check for geom failure
+                if not nct or not nctm or not ncg or not ncw or not ncf:
+                    msg = "Calibration stage geom failed: trace = %s, " \
+                          "trace/mask = %s, grid = %s, wave = %s, flat = %s, "\
+                          "stopping" % (nct, nctm, ncg, ncw, ncf)
+                    sys.exit(msg)
+                # If we get here, we are done
+                logging.info("Using older calibration files")
+        else:
+            logging.info("Calibrations already present in %s" % outdir)
+
+        logging.info("Calibration stage complete, ready for science!")
+        # Link recent flux cal file
+        find_recent_fluxcal(redd, 'fluxcal*.fits', outdir)
+        # Keep track of no copy
+        nnc = 0
+        # Science images queued during the calibration stage were skipped by
+        # cpcal, so check the whole raw directory on the first pass
+        full_scan = True
+        # loop and copy new files
+        doit = True
         while doit:
             # Wait for morning civil twilight
 
-            # Wait a minute
+            # Wait up to a minute
             logging.info("waiting 60s for new ifu images...")
             sys.stdout.flush()
-            time.sleep(60)
+            if watcher is None:
+                time.sleep(60)
+                new_files = None
+            else:
+                new_files = watcher.get(timeout=60.)
+                if full_scan:
+                    new_files = None
+                    full_scan = False
             # Check for new ifu images
             logging.info("checking %s for new ifu images..." % srcdir)
             sys.stdout.flush()
@@ -2237,15 +2478,17 @@ def obs_loop(rawlist=None, redd=None, check_precal=True, indir=None,
                 nsci, science = dosci(outdir, datestr=cur_date_str,
                                       local=local, nodb=nodb,
                                       nopush_marshal=nopush_marshal,
-                                      nopush_slack=nopush_slack, oldext=oldext)
+                                      nopush_slack=nopush_slack, oldext=oldext,
+                                      nproc=nproc)
                 ncp = nsci
             else:
                 ncp, copied = cpsci(srcdir, outdir, datestr=cur_date_str,
-                                    nodb=nodb)
+                                    nodb=nodb, srcfiles=new_files)
                 nsci, science = dosci(outdir, datestr=cur_date_str,
                                       local=local, nodb=nodb,
                                       nopush_marshal=nopush_marshal,
-                                      nopush_slack=nopush_slack, oldext=oldext)
+                                      nopush_slack=nopush_slack, oldext=oldext,
+                                      nproc=nproc)
             # We copied some new ones so report processing time
             if ncp > 0:
                 proc_time = int(time.time() - start_time)
@@ -2271,6 +2514,8 @@ def obs_loop(rawlist=None, redd=None, check_precal=True, indir=None,
                     # Normal termination
                     subprocess.call(("make", "report"))
                     ret = True
+                    # Record tonight's flux calibrations in the catalog
+                    CalCatalog.update_night(redd, cur_date_str)
                 else:
                     logging.info("No new image for %d minutes but UT = "
                                  "%s <= %s, so civil twilight has not started, "
@@ -2286,6 +2531,9 @@ def obs_loop(rawlist=None, redd=None, check_precal=True, indir=None,
     # Handle a ctrl-C
     except KeyboardInterrupt:
         sys.exit("Exiting")
+    finally:
+        if watcher is not None:
+            watcher.stop()
 
     return ret
     # END: obs_loop
@@ -2332,9 +2580,7 @@ def clean_post_redux(outdir, utdstr):
     for fl in flist:
         if 'failed' in fl:
             continue
-        ff = pf.open(fl)
-        hdr = ff[0].header
-        ff.close()
+        hdr = get_header(fl)
         try:
             obj = hdr['OBJECT']
         except KeyError:
@@ -2375,7 +2621,8 @@ def clean_post_redux(outdir, utdstr):
 
 def go(rawd=_rawpath, redd=_reduxpath, wait=False, use_refcube=False,
        check_precal=True, indate=None, piggyback=False, local=False,
-       nopush_marshal=False, nopush_slack=False, nodb=False, oldext=False):
+       nopush_marshal=False, nopush_slack=False, nodb=False, oldext=False,
+       nproc=_sci_nproc):
     """Outermost infinite loop that watches for a new raw directory.
 
     Keep a list of raw directories in `redd` and fire off
@@ -2395,6 +2642,7 @@ def go(rawd=_rawpath, redd=_reduxpath, wait=False, use_refcube=False,
         nopush_slack (bool): True if no slack update required
         nodb (bool): True if no update of SEDM Db
         oldext (bool): True to use extract_star.py instead of extractstar.py
+        nproc (int): number of science frames to process concurrently
 
     Returns:
         None
@@ -2423,7 +2671,7 @@ def go(rawd=_rawpath, redd=_reduxpath, wait=False, use_refcube=False,
                             piggyback=piggyback, local=local, nodb=nodb,
                             nopush_marshal=nopush_marshal,
                             use_refcube=use_refcube, nopush_slack=nopush_slack,
-                            oldext=oldext)
+                            oldext=oldext, nproc=nproc)
             its += 1
             logging.info("Finished SEDM observing iteration %d in raw dir %s" %
                          (its, rawlist[-1]))
@@ -2461,7 +2709,8 @@ def go(rawd=_rawpath, redd=_reduxpath, wait=False, use_refcube=False,
                                 piggyback=piggyback, local=local, nodb=nodb,
                                 nopush_marshal=nopush_marshal,
                                 nopush_slack=nopush_slack,
-                                use_refcube=use_refcube, oldext=oldext)
+                                use_refcube=use_refcube, oldext=oldext,
+                                nproc=nproc)
                 its += 1
                 logging.info("Finished SEDM observing iteration %d in "
                              "raw dir %s" % (its, rawlist[-1]))
@@ -2475,7 +2724,8 @@ def go(rawd=_rawpath, redd=_reduxpath, wait=False, use_refcube=False,
                         piggyback=piggyback, local=local, nodb=nodb,
                         nopush_marshal=nopush_marshal,
                         nopush_slack=nopush_slack,
-                        use_refcube=use_refcube, oldext=oldext)
+                        use_refcube=use_refcube, oldext=oldext,
+                        nproc=nproc)
         its += 1
         logging.info("Finished SEDM processing in raw dir %s with status %d" %
                      (indir, stat))
@@ -2517,6 +2767,9 @@ if __name__ == '__main__':
                         help='Clean UTDate directory')
     parser.add_argument('--use_refcube', action="store_true", default=False,
                         help="Use reference traces from 20230407")
+    parser.add_argument('--nproc', type=int, default=_sci_nproc,
+                        help='Science frames to process concurrently (%d)'
+                             % _sci_nproc)
 
     args = parser.parse_args()
 
@@ -2544,4 +2797,5 @@ if __name__ == '__main__':
            check_precal=(not args.skip_precal), indate=args.date,
            piggyback=args.piggyback, local=args.local, nodb=arg_nodb,
            nopush_marshal=arg_nopush_marshal, nopush_slack=arg_nopush_slack,
-           oldext=args.oldext, use_refcube=False)  # args.use_refcube)
+           oldext=args.oldext, use_refcube=False,  # args.use_refcube)
+           nproc=args.nproc)
@@ -0,0 +1,304 @@
+"""Catalog of calibration products in the redux directory tree.
+
+Functions
+    * :func:`find_latest`   most recent product matching a pattern before a date
+    * :func:`update_night`  record the products of one night in the catalog
+    * :func:`rebuild`       rebuild the catalog from every night directory
+
+Note:
+    The catalog is kept in <reduxpath>/cal_catalog.json.  For each file
+    pattern (relative to a night directory, e.g. '20??????_Flat.fits' or
+    'bias0.1.fits') it records the matching files in every night directory.
+    Looking up the latest product before a date is then a bisection of the
+    sorted night list instead of a glob of every night directory.
+
+    A pattern not yet in the catalog is added with a one-time scan of all
+    nights.  Nights are re-scanned with :func:`update_night` when their
+    calibrations are finished, and lazily when a catalogued file has gone
+    missing (e.g. compressed by clean_post_redux) or when a night with no
+    matching file was modified after it was scanned.
+
+    The time of each scan is recorded, and the catalog file is re-read and
+    merged under a lock before it is written, so that concurrent processes
+    keep the most recent scan of each night.
+
+    This is used as a python script as follows::
+
+        usage: CalCatalog.py [-h] [--reduxdir REDUXDIR] [--night YYYYMMDD]
+
+        optional arguments:
+          -h, --help           show this help message and exit
+          --reduxdir REDUXDIR  Reduced directory (/data/sedmdrp/redux)
+          --night YYYYMMDD     Only re-scan this night (None: rebuild all)
+
+"""
+import os
+import re
+import glob
+import json
+import time
+import fcntl
+import bisect
+import logging
+import argparse
+
+import sedmpy_version
+
+# Get pipeline configuration
+# Find config file: default is sedmpy/config/sedmconfig.json
+try:
+    configfile = os.environ["SEDMCONFIG"]
+except KeyError:
+    configfile = os.path.join(sedmpy_version.CONFIG_DIR, "sedmconfig.json")
+with open(configfile) as config_file:
+    sedm_cfg = json.load(config_file)
+
+_reduxpath = sedm_cfg['paths']['reduxpath']
+
+# Products of the calibration stage of a night
+cal_patterns = [
+    '20??????_TraceMatch.pkl', '20??????_TraceMatch_WithMasks.pkl',
+    '20??????_HexaGrid.pkl', '20??????_WaveSolution.parquet',
+    '20??????_Flat.fits', 'bias0.1.fits', 'bias2.0.fits', 'bias1.0.fits'
+]
+# Patterns catalogued on a rebuild
+_default_patterns = cal_patterns + ['fluxcal*.fits']
+
+# Loaded catalogs, one per redux directory
+_catalogs = {}
+
+
+def catalog_file(redd):
+    """Return the catalog file name for redux directory redd"""
+    return os.path.join(redd, 'cal_catalog.json')
+
+
+def list_nights(redd):
+    """Return sorted list of YYYYMMDD night directories in redd"""
+    return sorted([os.path.basename(d)
+                   for d in glob.glob(os.path.join(redd, '20??????'))
+                   if os.path.isdir(d) and
+                   re.match(r'^\d{8}$', os.path.basename(d))])
+
+
+def _read(redd):
+    """Read the catalog file of redd.
+
+    Returns:
+        dict: pattern: (sorted nights, {night: files}, {night: scan time})
+
+    """
+    try:
+        with open(catalog_file(redd)) as cat_file:
+            cat = json.load(cat_file)
+        pats = cat['patterns']
+        scanned = cat.get('scanned', {})
+    except (OSError, ValueError, KeyError):
+        return {}
+    # keep sorted night lists for bisection
+    return {pat: (sorted(ents), ents, scanned.get(pat, {}))
+            for pat, ents in pats.items()}
+
+
+def _load(redd):
+    """Load (or create) the catalog for redd"""
+    if redd not in _catalogs:
+        _catalogs[redd] = _read(redd)
+    return _catalogs[redd]
+
+
+def _merge(cat, disk):
+    """Add the entries of disk scanned later than those of cat to cat"""
+    for pat, (dnights, dents, dstamps) in disk.items():
+        if pat not in cat:
+            cat[pat] = (dnights, dents, dstamps)
+            continue
+        nights, ents, stamps = cat[pat]
+        for night in dnights:
+            if night not in ents or \
+                    dstamps.get(night, 0.) > stamps.get(night, 0.):
+                if night not in ents:
+                    bisect.insort(nights, night)
+                ents[night] = dents[night]
+                if night in dstamps:
+                    stamps[night] = dstamps[night]
+
+
+def _save(redd, merge=True):
+    """Write catalog for redd atomically.
+
+    Args:
+        redd (str): reduced directory
+        merge (bool): first merge in the newer entries written to the
+            catalog file by other processes (False: replace the file)
+
+    """
+    cat = _load(redd)
+    cfile = catalog_file(redd)
+    tmp = cfile + '.tmp%d' % os.getpid()
+    try:
+        with open(cfile + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if merge:
+                _merge(cat, _read(redd))
+            out = {'patterns': {pat: ents
+                                for pat, (nights, ents, st) in cat.items()},
+                   'scanned': {pat: st
+                               for pat, (nights, ents, st) in cat.items()}}
+            with open(tmp, 'w') as cat_file:
+                json.dump(out, cat_file)
+            os.replace(tmp, cfile)
+    except OSError as e:
+        logging.warning("Cannot write catalog %s: %s" % (cfile, e))
+
+
+def _scan(redd, night, pattern):
+    """Return sorted files matching pattern in one night directory"""
+    return sorted(glob.glob(os.path.join(redd, night, pattern)))
+
+
+def _set(cat, pattern, night, files, stamp=None):
+    """Record files for night, scanned at time stamp, in pattern entry of cat
+    """
+    nights, ents, stamps = cat.setdefault(pattern, ([], {}, {}))
+    if night not in ents:
+        bisect.insort(nights, night)
+    ents[night] = files
+    stamps[night] = time.time() if stamp is None else stamp
+
+
+def _modified_since(redd, night, stamp):
+    """True if night directory was modified after time stamp"""
+    try:
+        return os.stat(os.path.join(redd, night)).st_mtime > stamp
+    except OSError:
+        return False
+
+
+def _add_pattern(redd, pattern):
+    """Catalog a new pattern with a scan of every night"""
+    logging.info("Cataloging %s in %s" % (pattern, redd))
+    cat = _load(redd)
+    for night in list_nights(redd):
+        _set(cat, pattern, night, _scan(redd, night, pattern))
+    _save(redd)
+
+
+def update_night(redd, night, patterns=None):
+    """Re-scan one night directory for catalogued products.
+
+    Args:
+        redd (str): reduced directory (something like /data/sedmdrp/redux)
+        night (str): YYYYMMDD night directory to scan
+        patterns (list): patterns to update (None: all catalogued patterns)
+
+    Returns:
+        int: number of product files found
+
+    """
+    cat = _load(redd)
+    if patterns is None:
+        patterns = list(cat.keys()) or _default_patterns
+    nfound = 0
+    for pattern in patterns:
+        files = _scan(redd, night, pattern)
+        _set(cat, pattern, night, files)
+        nfound += len(files)
+    _save(redd)
+    return nfound
+
+
+def rebuild(redd, patterns=None):
+    """Rebuild the catalog from scratch.
+
+    Args:
+        redd (str): reduced directory (something like /data/sedmdrp/redux)
+        patterns (list): patterns to catalog (None: catalogued and default)
+
+    Returns:
+        int: number of nights scanned
+
+    """
+    cat = _load(redd)
+    if patterns is None:
+        patterns = sorted(set(cat.keys()) | set(_default_patterns))
+    cat.clear()
+    nights = list_nights(redd)
+    for night in nights:
+        for pattern in patterns:
+            _set(cat, pattern, night, _scan(redd, night, pattern))
+    _save(redd, merge=False)
+    return len(nights)
+
+
+def find_latest(redd, pattern, before, select=None):
+    """Find the most recent product matching pattern before a night.
+
+    Args:
+        redd (str): reduced directory (something like /data/sedmdrp/redux)
+        pattern (str): glob pattern relative to a night directory
+        before (str): YYYYMMDD, only nights earlier than this are searched
+        select (callable): takes the sorted list of matches in a night and
+            returns the chosen file or None; default is the single match
+
+    Returns:
+        (str, str): night and file found, or (None, None)
+
+    """
+    if select is None:
+        def select(files):
+            return files[0] if len(files) == 1 else None
+
+    cat = _load(redd)
+    if pattern not in cat:
+        _add_pattern(redd, pattern)
+    nights, ents, stamps = cat[pattern]
+    changed = False
+    # Catalog any nights added since the last update
+    if not nights or nights[-1] < before:
+        last = nights[-1] if nights else ''
+        for night in list_nights(redd):
+            if last < night < before:
+                _set(cat, pattern, night, _scan(redd, night, pattern))
+                changed = True
+    idx = bisect.bisect_left(nights, before)
+    found = (None, None)
+    for night in reversed(nights[:idx]):
+        files = ents[night]
+        if files:
+            # Catalogued files removed or renamed since?
+            stale = not all(os.path.lexists(f) for f in files)
+        else:
+            # Products made in this night since it was scanned?
+            stale = _modified_since(redd, night, stamps.get(night, 0.))
+        if stale:
+            files = _scan(redd, night, pattern)
+            _set(cat, pattern, night, files)
+            changed = True
+        if not files:
+            continue
+        src = select(files)
+        if src is not None:
+            found = (night, src)
+            break
+    if changed:
+        _save(redd)
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="""Build catalog of calibration products""",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--reduxdir', type=str, default=_reduxpath,
+                        help='Reduced directory (%s)' % _reduxpath)
+    parser.add_argument('--night', type=str, default=None,
+                        help='Only re-scan this night (YYYYMMDD)')
+    args = parser.parse_args()
+
+    if args.night is not None:
+        print("Found %d products in %s" %
+              (update_night(args.reduxdir, args.night), args.night))
+    else:
+        print("Cataloged %d nights in %s" % (rebuild(args.reduxdir),
+                                             args.reduxdir))
@@ -25,75 +25,156 @@ with open(configfile) as config_file:
 _reduxpath = sedm_cfg['paths']['reduxpath']
 
 
-def calc_s2n(spec_file=None, start_wave=4000., end_wave=8000., overwrite=False):
+def s2n_window(w0, dw, npx, start_wave=4000., end_wave=8000.):
+    """Pixel window for the S/N calculation.
+
+    Args:
+        w0 (float): wavelength of first pixel (CRVAL1)
+        dw (float): wavelength step (CDELT1)
+        npx (int): number of pixels (NAXIS1)
+        start_wave (float): requested start wavelength in Angstroms
+        end_wave (float): requested end wavelength in Angstroms
+
+    Returns:
+        (slice, float, float): pixels with sw0 < wave < sw1, sw0 and sw1
+
+    """
+    w1 = w0 + dw * float(npx - 1)
+    wave = np.arange(start=w0, stop=w1, step=dw)
+    # Get wavelength range
+    sw0 = max(start_wave, w0)
+    sw1 = min(end_wave, w1)
+    # wave is sorted: the window is one contiguous slice
+    i0 = np.searchsorted(wave, sw0, side='right')
+    i1 = np.searchsorted(wave, sw1, side='left')
+    return slice(i0, max(i0, i1)), sw0, sw1
+
+
+def update_ascii(spec_file, s2nmed, sw0, sw1):
+    """Record S/N keywords after the leading comments of an ascii spectrum.
+
+    The file is streamed to a temporary file which then replaces it;
+    S/N keywords from a previous calculation are dropped.
+
+    Args:
+        spec_file (str): spec_*.txt ascii spectrum file
+        s2nmed (float): median S/N
+        sw0 (float): start wavelength of the S/N calculation
+        sw1 (float): end wavelength of the S/N calculation
+
+    """
+    s2n_lines = ["# S2N_MEDIAN: " + str(s2nmed) + "\n",
+                 "# S2N_WL_START: " + str(sw0) + "\n",
+                 "# S2N_WL_END: " + str(sw1) + "\n"]
+    tmp = spec_file + '.tmp%d' % os.getpid()
+    try:
+        with open(spec_file, "r") as specIn, open(tmp, "w") as specOut:
+            in_header = True
+            for line in specIn:
+                if in_header and line.split()[:1] != ['#']:
+                    specOut.writelines(s2n_lines)
+                    in_header = False
+                if in_header and line.startswith("# S2N_"):
+                    continue
+                specOut.write(line)
+            if in_header:
+                specOut.writelines(s2n_lines)
+        os.replace(tmp, spec_file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def calc_s2n(spec_file=None, start_wave=4000., end_wave=8000., overwrite=False,
+             _windows=None):
     """
     Calculates S/N from the input file.
     """
 
     s2nmed = None
     if spec_file is not None:
-        # Open fits file
-        ff = pf.open(spec_file.replace('.txt', '.fits'), mode='update')
-        # Have we already calculated S/N?
-        if 'S2NMED' in ff[0].header and not overwrite:
-            ff.close()
-            return None
-        # get S/N ratio
-        flux = ff[0].data
-        noise = np.sqrt(ff[1].data)
-        s2nspec = flux / noise
-        # Get wavelength scale
-        w0 = ff[0].header['CRVAL1']
-        dw = ff[0].header['CDELT1']
-        npx = ff[0].header['NAXIS1']
-        w1 = w0 + dw * float(npx - 1)
-        wave = np.arange(start=w0, stop=w1, step=dw)
-        # Get wavelength range
-        if start_wave < w0:
-            sw0 = w0
-        else:
-            sw0 = start_wave
-        if end_wave > w1:
-            sw1 = w1
-        else:
-            sw1 = end_wave
-        sample_range = [i for i, w in enumerate(wave) if sw0 < w < sw1]
-        s2nmed = np.nanmedian(s2nspec[sample_range])
-        if s2nmed != s2nmed or not np.isfinite(s2nmed):
-            print("Warning - bad s2nmed!")
-            s2nmed = 1.0
+        # Open fits file (data are memory mapped)
+        with pf.open(spec_file.replace('.txt', '.fits'), mode='update',
+                     memmap=True) as ff:
+            hdr = ff[0].header
+            # Have we already calculated S/N?
+            if 'S2NMED' in hdr and not overwrite:
+                return None
+            # Get wavelength range
+            key = (hdr['CRVAL1'], hdr['CDELT1'], hdr['NAXIS1'])
+            if _windows is not None and key in _windows:
+                win, sw0, sw1 = _windows[key]
+            else:
+                win, sw0, sw1 = s2n_window(*key, start_wave=start_wave,
+                                           end_wave=end_wave)
+                if _windows is not None:
+                    _windows[key] = (win, sw0, sw1)
+            # get S/N ratio in window
+            s2nspec = ff[0].data[win] / np.sqrt(ff[1].data[win])
+            s2nmed = np.nanmedian(s2nspec) if s2nspec.size else np.nan
+            if s2nmed != s2nmed or not np.isfinite(s2nmed):
+                print("Warning - bad s2nmed!")
+                s2nmed = 1.0
+
+            hdr['S2NMED'] = (s2nmed, 'Median S/N')
+            hdr['S2NWL0'] = (sw0, 'Start wave for S/N Calc')
+            hdr['S2NWHI'] = (sw1, 'End wave for S/N Calc')
 
         # Update ascii file
-        with open(spec_file, "r") as specIn:
-            spec_lines = specIn.readlines()
-
-            comment_lines_count = 0
-            for line in spec_lines:
-                if line.split()[0] == '#':
-                    comment_lines_count += 1
-                else:
-                    break
-
-            ff[0].header['S2NMED'] = (s2nmed, 'Median S/N')
-            ff[0].header['S2NWL0'] = (sw0, 'Start wave for S/N Calc')
-            ff[0].header['S2NWHI'] = (sw1, 'End wave for S/N Calc')
-
-            spec_lines.insert(comment_lines_count,
-                              "# S2N_WL_END: " + str(sw1) + "\n")
-            spec_lines.insert(comment_lines_count,
-                              "# S2N_WL_START: " + str(sw0) + "\n")
-            spec_lines.insert(comment_lines_count,
-                              "# S2N_MEDIAN: " + str(s2nmed) + "\n")
-
-        # Write out updated files
-        with open(spec_file, "w") as specOut:
-            specOut.write("".join(spec_lines))
-        ff.close()
+        update_ascii(spec_file, s2nmed, sw0, sw1)
 
     return s2nmed
     # END calc_s2n
 
 
+def calc_s2n_batch(flist, start_wave=4000., end_wave=8000., overwrite=False):
+    """Calculates S/N for a list of spectra.
+
+    Spectra on the same wavelength grid share one S/N window.
+
+    Args:
+        flist (list): spec_*.txt ascii spectrum files
+        start_wave (float): start wavelength in Angstroms
+        end_wave (float): end wavelength in Angstroms
+        overwrite (bool): recalculate S/N if already done
+
+    Returns:
+        dict: S/N by file, for files that were calculated
+
+    """
+    windows = {}
+    s2ns = {}
+    for fl in flist:
+        try:
+            s2n = calc_s2n(spec_file=fl, start_wave=start_wave,
+                           end_wave=end_wave, overwrite=overwrite,
+                           _windows=windows)
+        except (OSError, KeyError, IndexError) as e:
+            print("Cannot calculate S/N for %s: %s" % (fl, e))
+            continue
+        if s2n is not None:
+            s2ns[fl] = s2n
+    return s2ns
+
+
+def calc_s2n_night(indir, start_wave=4000., end_wave=8000., overwrite=False):
+    """Calculates S/N for every spectrum in a night directory.
+
+    Args:
+        indir (str): night directory
+        start_wave (float): start wavelength in Angstroms
+        end_wave (float): end wavelength in Angstroms
+        overwrite (bool): recalculate S/N if already done
+
+    Returns:
+        dict: S/N by file, for files that were calculated
+
+    """
+    flist = sorted(glob.glob(os.path.join(indir, 'spec_*.txt')))
+    return calc_s2n_batch(flist, start_wave=start_wave, end_wave=end_wave,
+                          overwrite=overwrite)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="""
 
@@ -128,14 +209,10 @@ if __name__ == '__main__':
 
         indir = os.path.join(_reduxpath, args.indir)
 
-        flist = glob.glob(os.path.join(indir, 'spec_*.txt'))
-
-        if len(flist) > 0:
-            for fl in flist:
-                s2n = calc_s2n(spec_file=fl, start_wave=args.s0,
-                               end_wave=args.s1, overwrite=args.overwrite)
-                if s2n is not None:
-                    print("S/N(%.1f-%.1f A) = %.2f in %s" %
-                          (args.s0, args.s1, float(s2n), fl))
+        s2ns = calc_s2n_night(indir, start_wave=args.s0, end_wave=args.s1,
+                              overwrite=args.overwrite)
+        for fl in sorted(s2ns):
+            print("S/N(%.1f-%.1f A) = %.2f in %s" %
+                  (args.s0, args.s1, float(s2ns[fl]), fl))
     else:
         print("unknown params: try CalcS2N.py --help")
@@ -7,11 +7,13 @@ Created on Thu Aug 11 11:23:00 2016
 import datetime
 import glob
 import os
+import time
 import argparse
-import re
+from concurrent.futures import ProcessPoolExecutor
 import drpifu.RunSnid as RunSnid
 import drpifu.RunSNIascore as RunSNIascore
 import drpifu.RunNgsf as RunNgsf
+import drpifu.SpecHeader as SpecHeader
 import json
 import sedmpy_version
 
@@ -20,122 +22,171 @@ with open(configfile) as config_file:
     sedm_cfg = json.load(config_file)
 
 _redd = sedm_cfg['paths']['reduxpath']
+# Number of spectra to classify concurrently
+_class_nproc = sedm_cfg.get('classify_workers', 1)
+# Time limit in seconds for each classifier run on one spectrum
+_timeouts = {'snid': 600., 'sniascore': 900., 'ngsf': 1800.}
+_timeouts.update(sedm_cfg.get('classify_timeouts', {}))
+
+# Classifiers in the order they are run: name, key word in spectrum header
+# showing it was already run, run function and record function
+_tools = [
+    ('snid', 'SNID', RunSnid.call_snid, RunSnid.record_snid),
+    ('sniascore', 'SNIASC', RunSNIascore.call_sniascore,
+     RunSNIascore.record_sniascore),
+    ('ngsf', 'NGSF', RunNgsf.call_ngsf, RunNgsf.record_ngsf)
+]
+
+
+def skip_reason(fl):
+    """Return why spectrum fl is not classified, or None"""
+    # don't classify standard stars
+    if "STD" in fl or "BD" in fl or "Feige" in fl or "HZ" in fl:
+        return "standard star"
+    if "Hiltner" in fl or "Kopff" in fl or "LTT" in fl:
+        return "standard star"
+    # don't classify galaxies
+    if "NGC" in fl or "PGC" in fl or "MCG" in fl or "2MASX" in fl:
+        return "galaxy"
+    # don't classify stars
+    if "TYC" in fl or "SAO" in fl or "HD" in fl or "Tycho" in fl:
+        return "star"
+    # skip uncalibrated objects
+    if "notfluxcal" in fl:
+        return "uncalibrated"
+    return None
+
+
+def classify_spec(specfl, hdr, overwrite=False, timeouts=None):
+    """Run the classifiers on one spectrum and record their results.
+
+    The classifiers are run one after the other, since each records its
+    results in the same spectrum files.  An error in one classifier is
+    reported in its row and does not stop the others.
+
+    Args:
+        specfl (str): spec_*.txt ascii spectrum file in the current directory
+        hdr (SpecHeader.SpecHeader): header of the spectrum
+        overwrite (bool): re-run classifiers that were already run
+        timeouts (dict): time limit in seconds for each classifier
+
+    Returns:
+        list: one (spectrum, classifier, status, seconds, result) row
+            per classifier
 
-
-def classify(spec_dir='./', overwrite=False):
-    """
-    Runs snid in batch mode on all the *_SEDM.txt files found in the given
-    directory.  If a given file was already classified, it skips it, unless
-    overwrite is requested.
     """
-
-    summary = []
-    flb = glob.glob(os.path.join(spec_dir, "spec_*.txt"))
-    for fl in flb:
-        print(fl)
-        # don't classify standard stars
-        if "STD" in fl or "BD" in fl or "Feige" in fl or "HZ" in fl:
-            print("standard star")
-            continue
-        if "Hiltner" in fl or "Kopff" in fl or "LTT" in fl:
-            print("standard star")
-            continue
-        # don't classify galaxies
-        if "NGC" in fl or "PGC" in fl or "MCG" in fl or "2MASX" in fl:
-            print("galaxy")
-            continue
-        # don't classify stars
-        if "TYC" in fl or "SAO" in fl or "HD" in fl or "Tycho" in fl:
-            print("star")
+    if timeouts is None:
+        timeouts = _timeouts
+    rows = []
+    for tool, key, call, record in _tools:
+        if hdr.has_key_like(key) and not overwrite:
+            rows.append((specfl, tool, "done before", 0., ""))
             continue
-        # skip uncalibrated objects
-        if "notfluxcal" in fl:
-            print("uncalibrated")
-            continue
-        # retrieve the quality and tracking rate of the spectra.
-        with open(fl, "r") as sfl:
-            lines = sfl.readlines()
+        start = time.time()
+        try:
+            if call(specfl, timeout=timeouts.get(tool)):
+                res = record(spec_file=specfl)
+                status = "ran" if res else "record failed"
+            else:
+                res = ""
+                status = "failed"
+        except Exception as e:
+            res = ""
+            status = "error: %s" % e
+        rows.append((specfl, tool, status, time.time() - start, res))
+    return rows
 
-            q = [li for li in lines if "QUALITY" in li]
 
-            if len(q) > 0:
-                token = re.search(r'\(?([0-9]+)\)?', q[0])
-                q = int(token.group(1))
-            else:
-                if "crr_b_ifu" in fl:
-                    q = 1
-                else:
-                    q = 5
+def _init_worker(spec_dir):
+    """Classifiers write their outputs in the current directory"""
+    os.chdir(spec_dir)
 
-            t = [li for li in lines if "RA_RATE" in li]
 
-            if len(t) > 0:
-                ra_rate = float(t[0].split()[2])
-            else:
-                ra_rate = 0.
+def _classify_worker(job):
+    """Classify one spectrum in a worker process"""
+    specfl, hdr, overwrite, timeouts = job
+    return classify_spec(specfl, hdr, overwrite=overwrite, timeouts=timeouts)
 
-            t = [li for li in lines if "DEC_RATE" in li]
 
-            if len(t) > 0:
-                dec_rate = float(t[0].split()[-1])
-            else:
-                dec_rate = 0.
+def print_summary(rows):
+    """Print the table of classifier results"""
+    wid = max([len("Spectrum")] + [len(r[0]) for r in rows])
+    print("%-*s %-10s %-14s %8s  %s" % (wid, "Spectrum", "Classifier",
+                                        "Status", "Time(s)", "Result"))
+    for specfl, tool, status, dt, res in rows:
+        print("%-*s %-10s %-14s %8.1f  %s" % (wid, specfl, tool, status, dt,
+                                              res))
 
-            # non-sidereal, then skip
-            if ra_rate != 0. or dec_rate != 0.:
-                print("non-sidereal")
-                continue
 
-            # If quality is good, check for previous classification
-            if q < 3 or q == 5:
-                specfl = fl.split('/')[-1]
-                # Check for SNID first
-                clas = [li for li in lines if "SNID" in li]
-                # If the file has been classified by SNID, move to the next
-                if len(clas) > 0 and not overwrite:
-                    print("already classified by SNID")
-                else:
-                    # If we are here, we run the classification with SNID
-                    good = RunSnid.run_snid(spec_file=specfl,
-                                            overwrite=overwrite)
-                    # If we actually ran, record the results
-                    if good:
-                        res = specfl + " " + RunSnid.record_snid(
-                            spec_file=specfl)
-                        summary.append(res)
-                # Check for SNIascore
-                scor = [li for li in lines if "SNIASC" in li]
-                if len(scor) > 0 and not overwrite:
-                    print("already run through SNIascore")
-                else:
-                    # If we are here, we run SNIascore
-                    good = RunSNIascore.run_sniascore(spec_file=specfl,
-                                                      overwrite=overwrite)
-                    # If we actually ran, record the results
-                    if good:
-                        res = specfl + " " + RunSNIascore.record_sniascore(
-                            spec_file=specfl)
-                        summary.append(res)
-                # Check for NGSF
-                ngsf = [li for li in lines if "NGSF" in li]
-                if len(ngsf) > 0 and not overwrite:
-                    print("already classified by NGSF")
-                else:
-                    # If we are here, we run NGSF
-                    good = RunNgsf.run_ngsf(spec_file=specfl,
-                                            overwrite=overwrite)
-                    # If we actually ran, record the results
-                    if good:
-                        res = specfl + " " + RunNgsf.record_ngsf(
-                            spec_file=specfl)
-                        summary.append(res)
-            else:
-                print("bad quality")
+def classify_batch(spec_dir='./', overwrite=False, nproc=_class_nproc,
+                   timeouts=None):
+    """Classify all the spec_*.txt files in a directory concurrently.
+
+    Each spectrum header is read once (see :mod:`SpecHeader`) to select
+    the spectra to classify, then up to nproc spectra are classified at the
+    same time, each in a separate process.  Every classifier run is limited
+    to its timeout.
+
+    Args:
+        spec_dir (str): directory with spec_*.txt ascii spectra
+        overwrite (bool): re-run classifiers that were already run
+        nproc (int): number of spectra to classify concurrently
+        timeouts (dict): time limit in seconds for each classifier
+            (default from classify_timeouts in config, or _timeouts)
+
+    Returns:
+        list: (spectrum, classifier, status, seconds, result) rows
+
+    """
+    spec_dir = os.path.abspath(spec_dir)
+    if timeouts is None:
+        timeouts = _timeouts
+    rows = []
+    jobs = []
+    flist = sorted(glob.glob(os.path.join(spec_dir, "spec_*.txt")))
+    hdrs = SpecHeader.read_headers([fl for fl in flist
+                                    if skip_reason(fl) is None])
+    for fl in flist:
+        specfl = fl.split('/')[-1]
+        reason = skip_reason(fl)
+        if reason is None:
+            if fl not in hdrs:
                 continue
+            hdr = hdrs[fl]
+            q = hdr.quality
+            if q is None:
+                q = 1 if "crr_b_ifu" in fl else 5
+            if hdr.ra_rate != 0. or hdr.dec_rate != 0.:
+                reason = "non-sidereal"
+            elif not (q < 3 or q == 5):
+                reason = "bad quality"
+        if reason is not None:
+            print("%s: %s" % (specfl, reason))
+            continue
+        jobs.append((specfl, hdr, overwrite, timeouts))
+
+    if not jobs:
+        print("No spectra to classify in %s" % spec_dir)
+        return rows
+    nproc = max(1, min(nproc, len(jobs)))
+    print("Classifying %d spectra, %d at a time" % (len(jobs), nproc))
+    with ProcessPoolExecutor(max_workers=nproc, initializer=_init_worker,
+                             initargs=(spec_dir,)) as pool:
+        for spec_rows in pool.map(_classify_worker, jobs):
+            rows.extend(spec_rows)
 
-    # END loop over each file matching *_SEDM.txt
-    for res in summary:
-        print(res)
+    print_summary(rows)
+    return rows
+
+
+def classify(spec_dir='./', overwrite=False, nproc=1):
+    """
+    Runs snid in batch mode on all the *_SEDM.txt files found in the given
+    directory.  If a given file was already classified, it skips it, unless
+    overwrite is requested.
+    """
+
+    return classify_batch(spec_dir=spec_dir, overwrite=overwrite, nproc=nproc)
 
     
 if __name__ == '__main__':
@@ -153,6 +204,11 @@ if __name__ == '__main__':
                         default=None)
     parser.add_argument('--overwrite', action="store_true", default=False,
                         help='Overwrite existing classification')
+    parser.add_argument('--nproc', type=int, default=_class_nproc,
+                        help='Spectra to classify concurrently (%d)' %
+                        _class_nproc)
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Time limit in s for each classifier run')
 
     args = parser.parse_args()
     
@@ -173,5 +229,11 @@ if __name__ == '__main__':
     os.chdir(specdir)
     print(os.getcwd())
 
+    if args.timeout is not None:
+        tmouts = {tool: args.timeout for tool in _timeouts}
+    else:
+        tmouts = None
+
     # Run snid on extracted spectra
-    classify(spec_dir=specdir, overwrite=args.overwrite)
+    classify_batch(spec_dir=specdir, overwrite=args.overwrite,
+                   nproc=args.nproc, timeouts=tmouts)
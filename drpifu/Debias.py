@@ -2,19 +2,27 @@
 
 Functions:
     * :func:`add_prefix` adds bias "b_" prefix to input name
-    * :func:`full_frame` calculates smoothed overscan vector
+    * :func:`oscan_vector` calculates smoothed overscan vector
     * :func:`remove` subtracts overscan and converts to electrons
+    * :func:`debias` bias subtracts one image file
+    * :func:`debias_files` bias subtracts a list of image files
 
 Note:
     This is used as a python script as follows::
 
-        Debias.py file [file ...]]
+        Debias.py [-h] [--nproc NPROC] file [file ...]
 
         positional arguments:
          file           An image file to be processed
 
+        optional arguments:
+         --nproc NPROC  Number of images to process at once (1)
+
 """
+import sys
 import time
+import argparse
+import multiprocessing
 import astropy.io.fits as pf
 import numpy as np
 from scipy.ndimage import filters
@@ -22,6 +30,9 @@ import sedmpy_version
 
 drp_ver = sedmpy_version.__version__
 
+# Master biases read so far (per process), as float32
+_mbias = {}
+
 
 def calculate_oscan(dat, header):
     """Subtract overscan from image"""
@@ -69,14 +80,15 @@ def calculate_oscan(dat, header):
     return scan_value, ps_x1, os_x0-1
 
 
-def pixoscan(dat):
+def oscan_vector(dat):
     """Calculate smoothed overscan vector
 
     Args:
         dat (numpy array): image frame
 
     Returns:
-        numpy vector: median smoothed overscan image
+        (numpy vector, float): median smoothed overscan for each row and
+            median overscan value
 
     """
 
@@ -85,14 +97,32 @@ def pixoscan(dat):
     smooth = filters.median_filter(oscan, size=50)
     oscan_val = np.nanmedian(smooth)
 
+    return smooth, oscan_val
+
+
+def pixoscan(dat):
+    """Calculate smoothed overscan vector
+
+    Args:
+        dat (numpy array): image frame
+
+    Returns:
+        numpy vector: median smoothed overscan image
+
+    """
+
+    smooth, oscan_val = oscan_vector(dat)
+
     return np.tile(smooth, (2048, 1)), oscan_val
 
 
-def remove(fits_obj):
+def remove(fits_obj, inplace=False):
     """Return the overscan-subtracted and gain-corrected version of input
 
     Args:
         fits_obj (fits object): fits science image to be oscan-subtracted
+        inplace (bool): modify the data array in place, if it is a writable
+            floating point array
 
     Returns:
         data array: oscan-subtracted and gain corrected image
@@ -107,104 +137,185 @@ def remove(fits_obj):
     except KeyError:
         gain = 1.8  # Guess the gain
 
+    if not (inplace and dat.dtype.kind == 'f' and dat.flags.writeable):
+        dat = dat.astype(np.float32)
+
     # get overscan if correctly sized
     if dat.shape == (2048, 2048):
-        oscan_img, val = pixoscan(dat)
-        osub_img = (dat - oscan_img.T) * gain
+        smooth, val = oscan_vector(dat)
+        # overscan is a function of row: broadcast along columns
+        dat -= smooth[:, np.newaxis]
     else:
         val = 0.
-        osub_img = dat * gain
+    dat *= gain
 
     # update header
     fits_obj[0].header['OSCANVAL'] = (val, 'Median Overscan Value')
     fits_obj[0].header['OSCANSUB'] = (True, 'Overscan subtracted?')
 
-    return osub_img
+    return dat
 
 
-def add_prefix(fname):
-    """Adds bias prefix to input name
+def get_mbias(bfname):
+    """Return master bias data as float32, reading each file once
 
     Args:
-        fname (str): file to be de-biased
+        bfname (str): master bias file
 
     Returns:
-        str: input filename with "b_" prepended
+        numpy array: master bias image
 
     """
+    if bfname not in _mbias:
+        with pf.open(bfname) as mbias:
+            _mbias[bfname] = mbias[0].data.astype(np.float32)
+    return _mbias[bfname]
 
-    sp = fname.split("/")
-    sp[-1] = 'b_' + sp[-1]
 
-    return "/".join(sp)
+def debias(ifile):
+    """Bias subtract, overscan subtract and gain correct an image
 
+    Writes the result to add_prefix(ifile).  The master bias for the
+    image ADCSPEED (bias<speed>.fits) is read from the current directory.
 
-if __name__ == '__main__':
-    import sys
+    Args:
+        ifile (str): image file to be processed
 
-    files = sys.argv[1:]
-    
-    for ifile in files:
-        try:
-            if ifile[-5:] != '.fits':
-                continue
-        except:
-            continue
+    Returns:
+        str: output file name, or None if the image was not processed
+
+    """
 
-        FF = pf.open(ifile)
-        adcspeed = FF[0].header['ADCSPEED']
+    # The raw image is read memory mapped, and converted (and scaled) once
+    # to float32: all the following steps work in place on that copy
+    FF = pf.open(ifile, memmap=True, do_not_scale_image_data=True)
+    adcspeed = FF[0].header['ADCSPEED']
 
-        bfname = "bias%1.1f.fits" % adcspeed
+    bfname = "bias%1.1f.fits" % adcspeed
+    try:
+        mbias = get_mbias(bfname)
+    except FileNotFoundError:
+        print("Master bias not found: %s" % bfname)
+        FF.close()
+        return None
+
+    img = FF[0].data.astype(np.float32)
+    bscale = FF[0].header.pop('BSCALE', 1.)
+    bzero = FF[0].header.pop('BZERO', 0.)
+    if bscale != 1.:
+        img *= bscale
+    if bzero != 0.:
+        img += bzero
+
+    # Are we an image from the Andor camera?
+    do_andor = 'PSCANX0' in FF[0].header
+
+    if do_andor:
+
+        # Subtract overscan
+        osval, x0, x1 = calculate_oscan(img, FF[0].header)
+        if osval > 0.:
+            img -= osval
+
+        # Gain value
         try:
-            mbias = pf.open(bfname)
-        except FileNotFoundError:
-            print("Master bias not found: %s" % bfname)
-            continue
+            and_gain = FF[0].header['GAIN']
+        except KeyError:
+            and_gain = 0.9
+
+        # Bias frame subtraction and gain correction
+        img -= mbias
+        img *= and_gain
 
-        # Are we an image from the Andor camera?
-        do_andor = 'PSCANX0' in FF[0].header
+        # Trim overscan
+        FF[0].data = img[:, x0:x1]
+        FF[0].header['OSCANTRM'] = (True, 'Overscan regions trimmed?')
 
-        if do_andor:
+    else:
+        # Bias frame subtraction
+        img -= mbias
+        FF[0].data = img
 
-            # Subtract overscan
-            img = FF[0].data
-            img = img.astype(np.float32)
-            osval, x0, x1 = calculate_oscan(img, FF[0].header)
-            if osval > 0.:
-                img -= osval
+        # Overscan subtraction
+        FF[0].data = remove(FF, inplace=True)
 
-            # Gain value
-            try:
-                and_gain = FF[0].header['GAIN']
-            except KeyError:
-                and_gain = 0.9
+    outname = add_prefix(ifile)
+    FF[0].header['BIASSUB'] = (True, 'Bias subtracted?')
+    FF[0].header['MBIASFN'] = (bfname, 'Master Bias file used')
+    try:
+        GAIN = FF[0].header['GAIN']
+        FF[0].header['GAIN'] = (1.0, 'GAIN Adjusted (was %s)' % GAIN)
+    except KeyError:
+        GAIN = 1.8  # Guess the gain
+        FF[0].header['GAIN'] = (1.0,
+                                'GAIN Adjusted (was guessed %s)' % GAIN)
+    FF[0].header['BUNIT'] = 'electron'
+    FF[0].header.add_history('drpifu.Debias run on %s' %
+                             time.strftime("%c"))
+    FF[0].header['DRPVER'] = drp_ver
+    FF.writeto(outname)
+    FF.close()
 
-            # Bias frame subtraction and gain correction
-            FF[0].data = (img - mbias[0].data) * and_gain
+    return outname
 
-            # Trim overscan
-            FF[0].data = FF[0].data[:, x0:x1]
-            FF[0].header['OSCANTRM'] = (True, 'Overscan regions trimmed?')
 
-        else:
-            # Bias frame subtraction
-            FF[0].data = FF[0].data - mbias[0].data
-
-            # Overscan subtraction
-            FF[0].data = remove(FF)
-
-        outname = add_prefix(ifile)
-        FF[0].header['BIASSUB'] = (True, 'Bias subtracted?')
-        FF[0].header['MBIASFN'] = (bfname, 'Master Bias file used')
-        try: 
-            GAIN = FF[0].header['GAIN']
-            FF[0].header['GAIN'] = (1.0, 'GAIN Adjusted (was %s)' % GAIN)
-        except KeyError:
-            GAIN = 1.8  # Guess the gain
-            FF[0].header['GAIN'] = (1.0,
-                                    'GAIN Adjusted (was guessed %s)' % GAIN)
-        FF[0].header['BUNIT'] = 'electron'
-        FF[0].header.add_history('drpifu.Debias run on %s' %
-                                 time.strftime("%c"))
-        FF[0].header['DRPVER'] = drp_ver
-        FF.writeto(outname)
+def _debias_worker(ifile):
+    """Pool worker: debias ifile, reporting instead of raising errors"""
+    try:
+        return debias(ifile)
+    except Exception as e:
+        print("Error debiasing %s: %s" % (ifile, e))
+        return False
+
+
+def debias_files(files, nproc=1):
+    """Bias subtract a list of images, nproc at a time
+
+    Args:
+        files (list): image files to be processed
+        nproc (int): number of worker processes
+
+    Returns:
+        list: output file names (None for images without a master bias,
+            False for images that failed), in the order of files
+
+    """
+
+    files = [f for f in files if f[-5:] == '.fits']
+    nproc = max(1, min(nproc, len(files)))
+    if nproc > 1:
+        with multiprocessing.Pool(nproc) as pool:
+            return pool.map(_debias_worker, files, chunksize=1)
+    return [_debias_worker(f) for f in files]
+
+
+def add_prefix(fname):
+    """Adds bias prefix to input name
+
+    Args:
+        fname (str): file to be de-biased
+
+    Returns:
+        str: input filename with "b_" prepended
+
+    """
+
+    sp = fname.split("/")
+    sp[-1] = 'b_' + sp[-1]
+
+    return "/".join(sp)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="""Bias subtract images""",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('files', type=str, nargs='+',
+                        help='An image file to be processed')
+    parser.add_argument('--nproc', type=int, default=1,
+                        help='Number of images to process at once (1)')
+    args = parser.parse_args()
+
+    outnames = debias_files(args.files, nproc=args.nproc)
+    if False in outnames:
+        sys.exit(1)
@@ -2,13 +2,18 @@ import glob
 import os
 import sys
 import time
-import subprocess
 import numpy as np
 import json
 import datetime
 
 import sedmpy_version
 
+try:
+    import SpecHeader
+except ImportError:
+    import drpifu.SpecHeader as SpecHeader
+import fritz.fritz_journal as fritz_journal
+
 # Get pipeline configuration
 # Find config file: default is sedmpy/config/sedmconfig.json
 try:
@@ -56,6 +61,20 @@ def seeing_stats(statfile=None):
     return see_min, see_med, see_max, see_std
 
 
+def _last(val):
+    """Last word of a header value ('' if empty)"""
+    words = val.split()
+    return words[-1] if words else ''
+
+
+def _fmt(hdr, key, fmt, default=""):
+    """Format the first value of header keyword key, or return default"""
+    val = hdr.getfloat(key)
+    if val is None:
+        return default
+    return fmt % val
+
+
 def report():
     """Generate DRP report using output spec_*.txt files"""
     # comment?
@@ -67,6 +86,7 @@ def report():
     obsdate = os.getcwd().split('/')[-1]
     flist = glob.glob("spec_*.txt")
     flist.sort()
+    hdrs = SpecHeader.read_headers(flist)
     print("\nReport generated on %s" % time.strftime("%c"))
     if comment:
         print("\n%s" % comment)
@@ -96,129 +116,73 @@ def report():
             objname = tname[0].split('.txt')[0]
         # Get time string
         tstr = ':'.join(f.split('_ifu')[-1].split('_')[1:4])
-        # check the ascii spectrum file for SNID data
-        with open(f, "r") as sfl:
-            lines = sfl.readlines()
-            # check for SNID classification
-            clas = [li for li in lines if "SNIDMATCHTYPE" in li]
-            ctype = ""
-            if len(clas) > 0:
-                for cl in clas:
-                    ctype += (" %s" % cl.split()[-1])
-            # check for SNID subtype
-            clas = [li for li in lines if "SNIDMATCHSUBTYPE" in li]
-            stype = ""
-            if len(clas) > 0:
-                for cl in clas:
-                    st = cl.split()[-1]
-                    if st != '-':
-                        stype += ("%s" % st)
-                    else:
-                        stype = ""
-                if len(stype) > 0:
-                    ctype += "-"
-                    ctype += stype
-            # get SNID redshift
-            zmch = [li for li in lines if "SNIDMATCHREDSHIFT" in li]
-            if len(zmch) > 0:
-                zmch = ("%.4f" % float(zmch[0].split()[-1]))
-            else:
-                zmch = ""
-            # get SNID rlap
-            rlap = [li for li in lines if "RLAP" in li]
-            if len(rlap) > 0:
-                rlap = ("%.2f" % float(rlap[0].split()[-1]))
-            else:
-                rlap = ""
-            # get SNIascore
-            snia_score = [li for li in lines if "SNIASCORE" in li]
-            if len(snia_score) > 0:
-                snia_score = ("%.3f" % float(snia_score[0].split()[-1]))
-            else:
-                snia_score = ""
-            # get SNIascore err
-            snia_score_err = [li for li in lines if "SNIASCORE_ERR" in li]
-            if len(snia_score_err) > 0:
-                snia_score_err = ("%.3f" % float(snia_score_err[0].split()[-1]))
-            else:
-                snia_score_err = ""
-            # get SNIascore redshift
-            snia_z = [li for li in lines if "SNIASCORE_Z" in li]
-            if len(snia_z) > 0:
-                snia_z = ("%.3f" % float(snia_z[0].split()[-1]))
-            else:
-                snia_z = ""
-            # get SNIascore redshift err
-            snia_z_err = [li for li in lines if "SNIASCORE_ZERR" in li]
-            if len(snia_z_err) > 0:
-                snia_z_err = ("%.3f" % float(snia_z_err[0].split()[-1]))
-            else:
-                snia_z_err = ""
-            # get NGSF classification
-            clas = [li for li in lines if "NGSFTYPE" in li]
-            ntype = ""
-            if len(clas) > 0:
-                for cl in clas:
-                    ntype += ("%s" % cl.split()[-1])
-            # check for NGSF subtype
-            clas = [li for li in lines if "NGSFSUBTYPE" in li]
-            stype = ""
-            if len(clas) > 0:
-                for cl in clas:
-                    st = cl.split()[-1]
-                    if 'SUBTYPE' not in st:
-                        stype += ("%s" % st)
-                    else:
-                        stype = ""
-                if len(stype) > 0:
-                    ntype += "-"
-                    ntype += stype
-            # get NGSF redshift
-            ngsfz = [li for li in lines if "NGSFREDSHIFT" in li]
-            if len(ngsfz) > 0:
-                ngsfz = ("%.2f" % float(ngsfz[0].split()[-1]))
-            else:
-                ngsfz = ""
-            # get NGSF CHI2/DOF
-            fracsn = [li for li in lines if "NGSFFRAC_SN" in li]
-            if len(fracsn) > 0:
-                fracsn = ("%.2f" % float(fracsn[0].split()[-1]))
-            else:
-                fracsn = ""
-            # get flux calibration
-            flxcal = [li for li in lines if "FLUXCAL" in li]
-            if len(flxcal) > 0:
-                flxcal = flxcal[0].split()[-1]
-            else:
-                flxcal = "False"
-            # get method
-            meth = f.split('__crr')[0].split('spec_')[-1]
-            meth = meth.split('auto_')[-1]
-            # get exposure time
-            expt = [li for li in lines if "EXPTIME" in li]
-            if len(expt) > 0:
-                expt = ("%.1f" % float(expt[0].split()[-1]))
-            else:
-                expt = "-"
-            # get airmass
-            air = [li for li in lines if "AIRMASS" in li]
-            if len(air) > 0:
-                air = ("%.3f" % float(air[0].split()[-1]))
-            else:
-                air = "-"
-            # get program ID
-            prid = [li for li in lines if "P60PRID" in li]
-            if len(prid) > 0:
-                prid = prid[0].split()[-1]
-            else:
-                prid = "-"
-            # get Quality
-            quality = [li for li in lines if "QUALITY" in li]
-            if len(quality) > 0:
-                quality = int(quality[0].split()[-1])
-            else:
-                quality = 9
-            sfl.close()
+        # check the ascii spectrum header for SNID data
+        hdr = hdrs.get(f)
+        if hdr is None:
+            continue
+        # check for SNID classification
+        ctype = ""
+        for cl in hdr.values("SNIDMATCHTYPE"):
+            ctype += (" %s" % _last(cl))
+        # check for SNID subtype
+        clas = hdr.values("SNIDMATCHSUBTYPE")
+        stype = ""
+        if len(clas) > 0:
+            for cl in clas:
+                st = _last(cl)
+                if st not in ('-', ''):
+                    stype += ("%s" % st)
+                else:
+                    stype = ""
+            if len(stype) > 0:
+                ctype += "-"
+                ctype += stype
+        # get SNID redshift
+        zmch = _fmt(hdr, "SNIDMATCHREDSHIFT", "%.4f")
+        # get SNID rlap
+        rlap = _fmt(hdr, "SNIDMATCHRLAP", "%.2f")
+        # get SNIascore
+        snia_score = _fmt(hdr, "SNIASCORE", "%.3f")
+        # get SNIascore err
+        snia_score_err = _fmt(hdr, "SNIASCORE_ERR", "%.3f")
+        # get SNIascore redshift
+        snia_z = _fmt(hdr, "SNIASCORE_Z", "%.3f")
+        # get SNIascore redshift err
+        snia_z_err = _fmt(hdr, "SNIASCORE_ZERR", "%.3f")
+        # get NGSF classification
+        ntype = ""
+        for cl in hdr.values("NGSFTYPE"):
+            ntype += ("%s" % _last(cl))
+        # check for NGSF subtype
+        clas = hdr.values("NGSFSUBTYPE")
+        stype = ""
+        if len(clas) > 0:
+            for cl in clas:
+                st = _last(cl)
+                if st:
+                    stype += ("%s" % st)
+                else:
+                    stype = ""
+            if len(stype) > 0:
+                ntype += "-"
+                ntype += stype
+        # get NGSF redshift
+        ngsfz = _fmt(hdr, "NGSFREDSHIFT", "%.2f")
+        # get NGSF CHI2/DOF
+        fracsn = _fmt(hdr, "NGSFFRAC_SN", "%.2f")
+        # get method
+        meth = f.split('__crr')[0].split('spec_')[-1]
+        meth = meth.split('auto_')[-1]
+        # get exposure time
+        expt = _fmt(hdr, "EXPTIME", "%.1f", "-")
+        # get airmass
+        air = _fmt(hdr, "AIRMASS", "%.3f", "-")
+        # get program ID
+        prid = _last(hdr.get("P60PRID", "-"))
+        # get Quality
+        quality = hdr.quality
+        if quality is None:
+            quality = 9
         if ctype == "":
             if "STD" in f:
                 ctype = " STD"
@@ -243,7 +207,8 @@ def report():
     for r in recs:
         print(r)
     # Check for contsep uploads
-    flist = glob.glob("spec_auto_contsep_*.upl")
+    flist = fritz_journal.UploadJournal('./').uploaded_files(
+        "spec_auto_contsep_*")
     if len(flist) > 0:
         print("\nThere were/was %d contsep spectra uploaded to the marshal"
               % len(flist))
@@ -258,15 +223,19 @@ def report():
     if len(flist) > 0:
         flist.sort()
         print("\nThere were/was %d failed extraction(s)" % len(flist))
+        try:
+            with open('what.list') as what_file:
+                what_lines = what_file.readlines()
+        except OSError:
+            what_lines = []
         for f in flist:
             tstr = ':'.join(f.split('ifu')[-1].split('_')[1:4])
             tok = f.split("_failed")[0].split("_ifu")[-1]
-            try:
-                out = subprocess.check_output(('grep', tok, 'what.list'),
-                                              universal_newlines=True)
-                out = out.split()[3]
-            except subprocess.CalledProcessError:
-                out = tok
+            out = tok
+            for li in what_lines:
+                if tok in li:
+                    out = li.split()[3]
+                    break
             print("%8s %-25s FAILED" % (tstr, out))
     else:
         print("\nThere were no failed extractions")
@@ -1,9 +1,38 @@
 """Plot efficiency trend for SEDM
 
+Functions
+    * :func:`std_efficiency`  mean efficiency of one standard in 100 nm bands
+    * :func:`ingest`          add new standard star observations to the table
+    * :func:`plot_trend`      plot the efficiency trend from the table
+
+Note:
+    The efficiency of every standard star observation
+    (spec_aperture_*_STD-*_ea.fits) is kept in the SQLite table
+    <reduxpath>/SEDM_eff_trend.db, keyed by file and mtime.  Each run only
+    reads the files of nights not yet in the table (and of the last few
+    nights, in case they were re-reduced) before plotting the whole trend
+    from the table.  Rejected observations are recorded too, so they are
+    not read again.
+
+    This is used as a python script as follows::
+
+        usage: EffTrend.py [-h] [--reduxdir REDUXDIR] [--recent YYYYMMDD]
+                           [--rescan]
+
+        optional arguments:
+          -h, --help           show this help message and exit
+          --reduxdir REDUXDIR  Reduced directory (/data/sedmdrp/redux)
+          --recent YYYYMMDD    Only plot data from this night on (None: all)
+          --rescan             Check every night for new or changed files
+
 """
 import glob
 import os
+import re
 import csv
+import sqlite3
+import logging
+import argparse
 
 import pylab as pl
 import numpy as np
@@ -13,142 +42,215 @@ import astropy.io.fits as pf
 import json
 import sedmpy_version
 
-configfile = os.path.join(sedmpy_version.CONFIG_DIR, 'sedmconfig.json')
+# Get pipeline configuration
+# Find config file: default is sedmpy/config/sedmconfig.json
+try:
+    configfile = os.environ["SEDMCONFIG"]
+except KeyError:
+    configfile = os.path.join(sedmpy_version.CONFIG_DIR, "sedmconfig.json")
 with open(configfile) as config_file:
     sedm_cfg = json.load(config_file)
 
 sdir = sedm_cfg['paths']['reduxpath']
-fspec = os.path.join(sdir, '20??????')
-dlist = sorted([d for d in glob.glob(fspec) if os.path.isdir(d)])[1:]
-
-recent = False  # do the whole data set
-recent_date = 20180101
 
 area = 18000.0  # P60 area in cm^2
 refl = 0.82     # P60 reflectance fraction
-da = []
-ef1 = []
-ef2 = []
-ef3 = []
-ef4 = []
-ef5 = []
-efs = []
-for d in dlist:
-    ddate = d.split('/')[-1]
-    dtime = Time(ddate[0:4]+'-'+ddate[4:6]+'-'+ddate[6:])
-    ddate_int = int(ddate)
-
-    # Recent data
-    if recent and (ddate_int < recent_date):
-        continue
-
-    print(d)
-
-    fspec = os.path.join(d, 'spec_aperture_*_STD-*_ea.fits')
-    slist = glob.glob(fspec)
-
-    for s in slist:
-        ff = pf.open(s)
+# Wavelength bands (nm) of the trend
+bands = [(400, 500), (500, 600), (600, 700), (700, 800), (800, 900)]
+# Nights at the end of the table that are always checked again
+_recheck = 3
+
+logging.basicConfig(
+    format='%(asctime)s %(funcName)s %(levelname)-8s %(message)s',
+    datefmt='%Y%m%d %H:%M:%S', level=logging.INFO)
+
+
+def table_file(reduxdir=sdir):
+    """Return the efficiency table file for reduxdir"""
+    return os.path.join(reduxdir, 'SEDM_eff_trend.db')
+
+
+def open_table(reduxdir=sdir):
+    """Open (or create) the efficiency table for reduxdir"""
+    con = sqlite3.connect(table_file(reduxdir), timeout=30.)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS efficiency ("
+        "path TEXT PRIMARY KEY, night TEXT, mtime REAL, object TEXT, "
+        "status TEXT, %s)" % ", ".join("e%d REAL" % (i + 1)
+                                       for i in range(len(bands))))
+    con.execute("CREATE INDEX IF NOT EXISTS eff_night "
+                "ON efficiency (night)")
+    con.execute("CREATE TABLE IF NOT EXISTS nights (night TEXT PRIMARY KEY)")
+    con.commit()
+    return con
+
+
+def std_efficiency(sfile):
+    """Mean efficiency (%) of a standard star observation in each band.
+
+    Args:
+        sfile (str): spec_aperture_*_STD-*_ea.fits file
+
+    Returns:
+        (str, list): status ('ok' or reason for rejection) and list of
+            band efficiencies (None if rejected)
+
+    """
+    with pf.open(sfile) as ff:
         hdr = ff[0].header
         ea = ff[0].data
-        # Avoid bad quality
-        if hdr['QUALITY'] != 0:
-            print("Bad quality: %s" % s)
-            continue
-        # Avoid edge objects
-        xx = ff[0].header['XPOS']
-        yy = ff[0].header['YPOS']
-        if abs(xx) > 10 or abs(yy) > 10:
-            print("Close to the edge: %s" % s)
-            continue
+    # Avoid bad quality
+    if hdr['QUALITY'] != 0:
+        return 'quality', None
+    # Avoid edge objects
+    if abs(hdr['XPOS']) > 10 or abs(hdr['YPOS']) > 10:
+        return 'edge', None
+    # Calculate efficiency
+    ef = 100. * ea / (area * refl)
+    # Calculate wavelengths in nm
+    wl = ((1 + np.arange(len(ea))) * hdr['CDELT1'] + hdr['CRVAL1']) / 10.
+    effs = []
+    for lo, hi in bands:
+        vec = ef[(wl > lo) & (wl < hi)]
+        if len(vec) < 1:
+            return 'coverage', None
+        eb = np.nanmean(vec)
+        if eb > 100 or eb < 0:
+            return 'range', None
+        effs.append(float(eb))
+    return 'ok', effs
 
-        # Calculate efficiency
-        ef = 100. * ea / (18000.0 * 0.82)
-        # Calculate wavelengths
-        lam0 = hdr['CRVAL1']
-        dlam = hdr['CDELT1']
-        wl = (1 + np.arange(len(ea))) * dlam + lam0
-        wl = wl / 10.   # Convert to nm
 
-        # Check each 100 nm bin
+def ingest(reduxdir=sdir, rescan=False):
+    """Add new standard star observations to the efficiency table.
 
-        # 400 - 500 nm
-        vec = ef[(wl > 400) * (wl < 500)]
-        if len(vec) < 1:
-            continue
-        e1 = np.nanmean(vec)
-        if e1 > 100 or e1 < 0:
-            continue
+    Only nights not yet in the table and the last few nights in the table
+    are searched, and only files not in the table or changed since are read.
+    Rows of files no longer in a searched night are deleted.
 
-        # 500 - 600 nm
-        vec = ef[(wl > 500) * (wl < 600)]
-        if len(vec) < 1:
-            continue
-        e2 = np.nanmean(vec)
-        if e2 > 100 or e2 < 0:
-            continue
+    Args:
+        reduxdir (str): reduced directory (something like /data/sedmdrp/redux)
+        rescan (bool): search every night for new or changed files
 
-        # 600 - 700 nm
-        vec = ef[(wl > 600) * (wl < 700)]
-        if len(vec) < 1:
-            continue
-        e3 = np.nanmean(vec)
-        if e3 > 100 or e3 < 0:
-            continue
+    Returns:
+        int: number of files read
 
-        # 700 - 800 nm
-        vec = ef[(wl > 700) * (wl < 800)]
-        if len(vec) < 1:
-            continue
-        e4 = np.nanmean(vec)
-        if e4 > 100 or e4 < 0:
+    """
+    nights = sorted([os.path.basename(d)
+                     for d in glob.glob(os.path.join(reduxdir, '20??????'))
+                     if os.path.isdir(d) and
+                     re.match(r'^\d{8}$', os.path.basename(d))])[1:]
+    con = open_table(reduxdir)
+    done = set(r[0] for r in con.execute("SELECT night FROM nights"))
+    if not rescan:
+        done -= set(sorted(done)[-_recheck:])
+    known = {r[0]: r[1] for r in
+             con.execute("SELECT path, mtime FROM efficiency")}
+    nread = 0
+    for night in nights:
+        if night in done:
             continue
+        rows = []
+        paths = sorted(glob.glob(os.path.join(
+            reduxdir, night, 'spec_aperture_*_STD-*_ea.fits')))
+        for s in paths:
+            try:
+                mtime = os.path.getmtime(s)
+                if known.get(s) == mtime:
+                    continue
+                status, effs = std_efficiency(s)
+            except (OSError, KeyError, TypeError, ValueError) as e:
+                logging.warning("Cannot read %s: %s" % (s, e))
+                continue
+            nread += 1
+            if status != 'ok':
+                logging.info("Rejected (%s): %s" % (status, s))
+                effs = [None] * len(bands)
+            obj = os.path.basename(s).split('_STD-')[-1].split('_ea')[0]
+            rows.append([s, night, mtime, obj, status] + effs)
+        # Files removed or renamed since the night was last searched
+        present = set(paths)
+        gone = [(r[0],) for r in con.execute(
+            "SELECT path FROM efficiency WHERE night = ?", (night,))
+            if r[0] not in present]
+        with con:
+            con.executemany("DELETE FROM efficiency WHERE path = ?", gone)
+            con.executemany("INSERT OR REPLACE INTO efficiency VALUES (%s)" %
+                            ", ".join("?" * (5 + len(bands))), rows)
+            con.execute("INSERT OR IGNORE INTO nights VALUES (?)", (night,))
+        if rows:
+            logging.info("%s: %d standards" % (night, len(rows)))
+        if gone:
+            logging.info("%s: removed %d standards" % (night, len(gone)))
+    con.close()
+    return nread
 
-        # 800 - 900 nm
-        vec = ef[(wl > 800) * (wl < 900)]
-        if len(vec) < 1:
-            continue
-        e5 = np.nanmean(vec)
-        if e5 > 100 or e5 < 0:
-            continue
 
-        # Fill efficiency vectors
-        ef1.append(e1)
-        ef2.append(e2)
-        ef3.append(e3)
-        ef4.append(e4)
-        ef5.append(e5)
-        efs.append(s)
-
-        da.append(ddate[0:4]+'-'+ddate[4:6]+'-'+ddate[6:])
-
-t = Time(da)
-pl.plot_date(t.plot_date, ef1, '^', linestyle='None', markersize=2.0,
-             label='400-500 nm')
-pl.plot_date(t.plot_date, ef2, 'v', linestyle='None', markersize=2.0,
-             label='500-600 nm')
-pl.plot_date(t.plot_date, ef3, 'x', linestyle='None', markersize=2.0,
-             label='600-700 nm')
-pl.plot_date(t.plot_date, ef4, 'D', linestyle='None', markersize=2.0,
-             label='700-800 nm')
-pl.plot_date(t.plot_date, ef5, 'o', linestyle='None', markersize=2.0,
-             label='800-900 nm')
-pl.gcf().autofmt_xdate()
-pl.xlabel('Date (UTC)')
-pl.ylabel('Efficiency (%)')
-pl.title('Efficiency Trend')
-pl.legend(loc=2)
-pl.grid(True)
-pl.ylim(-1, 45)
-if recent:
-    ofil = os.path.join(sdir, 'SEDM_eff_recent_pysedm.pdf')
-    tfil = os.path.join(sdir, 'SEDM_eff_recent_pysedm.txt')
-else:
-    ofil = os.path.join(sdir, 'SEDM_eff_trend_pysedm.pdf')
-    tfil = os.path.join(sdir, 'SEDM_eff_trend_pysedm.txt')
-pl.savefig(ofil)
-with open(tfil, 'w') as dfil:
-    dat_writer = csv.writer(dfil, delimiter=" ", quoting=csv.QUOTE_MINIMAL)
-    dat_writer.writerows(zip(da, ef1, ef2, ef3, ef4, ef5, efs))
+def plot_trend(reduxdir=sdir, recent_date=None):
+    """Plot the efficiency trend from the efficiency table.
+
+    Args:
+        reduxdir (str): reduced directory (something like /data/sedmdrp/redux)
+        recent_date (str): YYYYMMDD, only plot from this night (None: all)
+
+    Returns:
+        str: plot file
+
+    """
+    con = open_table(reduxdir)
+    rows = con.execute(
+        "SELECT night, %s, path FROM efficiency "
+        "WHERE status='ok' AND night >= ? ORDER BY night, path" %
+        ", ".join("e%d" % (i + 1) for i in range(len(bands))),
+        (recent_date or '',)).fetchall()
+    con.close()
+    da = [r[0][0:4] + '-' + r[0][4:6] + '-' + r[0][6:] for r in rows]
+    effs = np.array([r[1:1 + len(bands)] for r in rows],
+                    dtype=float).reshape(-1, len(bands))
+    efs = [r[-1] for r in rows]
+
+    pl.figure()
+    if da:
+        t = Time(da)
+        for i, ((lo, hi), mark) in enumerate(zip(bands,
+                                                 ['^', 'v', 'x', 'D', 'o'])):
+            pl.plot_date(t.plot_date, effs[:, i], mark, linestyle='None',
+                         markersize=2.0, label='%d-%d nm' % (lo, hi))
+    pl.gcf().autofmt_xdate()
+    pl.xlabel('Date (UTC)')
+    pl.ylabel('Efficiency (%)')
+    pl.title('Efficiency Trend')
+    pl.legend(loc=2)
+    pl.grid(True)
+    pl.ylim(-1, 45)
+    if recent_date:
+        ofil = os.path.join(reduxdir, 'SEDM_eff_recent_pysedm.pdf')
+        tfil = os.path.join(reduxdir, 'SEDM_eff_recent_pysedm.txt')
+    else:
+        ofil = os.path.join(reduxdir, 'SEDM_eff_trend_pysedm.pdf')
+        tfil = os.path.join(reduxdir, 'SEDM_eff_trend_pysedm.txt')
+    pl.savefig(ofil)
+    pl.close()
+    with open(tfil, 'w') as dfil:
+        dat_writer = csv.writer(dfil, delimiter=" ",
+                                quoting=csv.QUOTE_MINIMAL)
+        dat_writer.writerows(zip(da, *effs.T, efs))
+    return ofil
+
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="""Plot efficiency trend for SEDM""",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--reduxdir', type=str, default=sdir,
+                        help='Reduced directory (%s)' % sdir)
+    parser.add_argument('--recent', type=str, default=None,
+                        help='Only plot data from this night on (YYYYMMDD)')
+    parser.add_argument('--rescan', action="store_true", default=False,
+                        help='Check every night for new or changed files')
+    args = parser.parse_args()
 
+    logging.info("Read %d new standards" % ingest(args.reduxdir,
+                                                   rescan=args.rescan))
+    logging.info("Plotted %s" % plot_trend(args.reduxdir,
+                                           recent_date=args.recent))
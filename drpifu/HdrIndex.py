@@ -0,0 +1,222 @@
+"""Persistent per-night index of FITS primary headers.
+
+Functions
+    * :func:`get_header`    get primary header of a file using the index
+    * :func:`index_night`   pre-load the index for all images in a directory
+
+Classes
+    * :class:`HeaderIndex`  SQLite cache of primary headers for one night
+
+Note:
+    Headers are keyed by real path (symlinks in the redux directory resolve
+    to the raw image), size and mtime, so a header is read from the FITS file
+    only once per version of the file.  The index for night YYYYMMDD is kept
+    in <reduxpath>/YYYYMMDD/YYYYMMDD_hdr_index.db and is shared by AutoReduce,
+    ReProcess and Plan.  If the redux directory for a night does not exist,
+    headers are only cached in memory.
+
+    This is used as a python script as follows::
+
+        usage: HdrIndex.py [-h] [--reduxdir REDUXDIR] indir
+
+        positional arguments:
+          indir                directory of images to index
+
+        optional arguments:
+          -h, --help           show this help message and exit
+          --reduxdir REDUXDIR  Reduced directory (/data/sedmdrp/redux)
+
+"""
+import os
+import re
+import glob
+import json
+import sqlite3
+import logging
+import argparse
+import astropy.io.fits as pf
+
+import sedmpy_version
+
+# Get pipeline configuration
+# Find config file: default is sedmpy/config/sedmconfig.json
+try:
+    configfile = os.environ["SEDMCONFIG"]
+except KeyError:
+    configfile = os.path.join(sedmpy_version.CONFIG_DIR, "sedmconfig.json")
+with open(configfile) as config_file:
+    sedm_cfg = json.load(config_file)
+
+_reduxpath = sedm_cfg['paths']['reduxpath']
+
+# Open indices, one per night
+_indices = {}
+
+
+class HeaderIndex:
+    """SQLite cache of FITS primary headers.
+
+    Args:
+        dbfile (str): SQLite file for the index, or None for memory only
+
+    """
+
+    def __init__(self, dbfile=None):
+        self.dbfile = dbfile
+        self._mem = {}
+        self._con = None
+        if dbfile is not None:
+            try:
+                self._con = sqlite3.connect(dbfile, timeout=30.)
+                self._con.execute(
+                    "CREATE TABLE IF NOT EXISTS headers ("
+                    "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                    "header TEXT)")
+                self._con.commit()
+            except sqlite3.Error as e:
+                logging.warning("Cannot open header index %s: %s" %
+                                (dbfile, e))
+                self._con = None
+
+    def get(self, path):
+        """Return primary header of path, reading the file only if needed.
+
+        Args:
+            path (str): FITS file (may be a symlink)
+
+        Returns:
+            astropy.io.fits.Header: copy of the primary header
+
+        """
+        real = os.path.realpath(path)
+        st = os.stat(real)
+        key = (st.st_size, st.st_mtime)
+        # In memory?
+        ent = self._mem.get(real)
+        if ent is not None and ent[0] == key:
+            return ent[1].copy()
+        # In index?
+        hstr = None
+        if self._con is not None:
+            try:
+                row = self._con.execute(
+                    "SELECT size, mtime, header FROM headers WHERE path=?",
+                    (real,)).fetchone()
+            except sqlite3.Error:
+                row = None
+            if row is not None and (row[0], row[1]) == key:
+                hstr = row[2]
+        if hstr is not None:
+            hdr = pf.Header.fromstring(hstr)
+        else:
+            # Read primary header only
+            hdr = pf.getheader(real, 0)
+            if self._con is not None:
+                try:
+                    with self._con:
+                        self._con.execute(
+                            "INSERT OR REPLACE INTO headers "
+                            "VALUES (?, ?, ?, ?)",
+                            (real, st.st_size, st.st_mtime, hdr.tostring()))
+                except sqlite3.Error as e:
+                    logging.warning("Cannot update header index: %s" % e)
+        self._mem[real] = (key, hdr)
+        return hdr.copy()
+
+    def close(self):
+        """Close the index"""
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+
+def index_file(night, reduxdir=None):
+    """Return the index file for a night, or None if it cannot be kept.
+
+    Args:
+        night (str): YYYYMMDD night
+        reduxdir (str): reduced directory (like /data/sedmdrp/redux)
+
+    Returns:
+        str: SQLite file name or None
+
+    """
+    if reduxdir is None:
+        reduxdir = _reduxpath
+    ndir = os.path.join(reduxdir, night)
+    if not os.path.isdir(ndir):
+        return None
+    return os.path.join(ndir, night + '_hdr_index.db')
+
+
+def get_index(path, reduxdir=None):
+    """Return the (shared) header index for the night path belongs to.
+
+    Args:
+        path (str): FITS file in a YYYYMMDD raw or redux directory
+        reduxdir (str): reduced directory (like /data/sedmdrp/redux)
+
+    Returns:
+        HeaderIndex: index for the night
+
+    """
+    night = os.path.basename(os.path.dirname(os.path.realpath(path)))
+    if not re.match(r'^\d{8}$', night):
+        night = None
+    if night not in _indices:
+        dbfile = index_file(night, reduxdir) if night else None
+        _indices[night] = HeaderIndex(dbfile)
+    return _indices[night]
+
+
+def get_header(path, reduxdir=None):
+    """Get the primary header of a FITS file, using the night index.
+
+    Drop-in replacement for pf.open(path)[0].header.
+
+    Args:
+        path (str): FITS file
+        reduxdir (str): reduced directory (like /data/sedmdrp/redux)
+
+    Returns:
+        astropy.io.fits.Header: primary header
+
+    """
+    return get_index(path, reduxdir).get(path)
+
+
+def index_night(indir, pattern='*.fits*', reduxdir=None):
+    """Read the headers of all images in indir into the index.
+
+    Args:
+        indir (str): directory of images
+        pattern (str): glob pattern for images
+        reduxdir (str): reduced directory (like /data/sedmdrp/redux)
+
+    Returns:
+        int: number of headers indexed
+
+    """
+    nidx = 0
+    for fl in sorted(glob.glob(os.path.join(indir, pattern))):
+        try:
+            get_header(fl, reduxdir)
+            nidx += 1
+        except OSError as e:
+            logging.warning("Cannot index %s: %s" % (fl, e))
+    return nidx
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="""Index FITS headers of a night directory""",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('indir', type=str,
+                        help='directory of images to index')
+    parser.add_argument('--reduxdir', type=str, default=_reduxpath,
+                        help='Reduced directory (%s)' % _reduxpath)
+    args = parser.parse_args()
+
+    print("Indexed %d headers from %s" % (index_night(args.indir,
+                                                      reduxdir=args.reduxdir),
+                                          args.indir))
@@ -1,4 +1,5 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from stsci.image.numcombine import numCombine
 import astropy.io.fits as pf
 import numpy as np
@@ -9,8 +10,119 @@ from Debias import calculate_oscan
 drp_ver = sedmpy_version.__version__
 
 
+def combine_stack(stack, combtype="mean", nlow=0, nhigh=0):
+    """Combine a stack of images along the first axis like numCombine
+
+    Args:
+        stack (numpy array): images to combine, shape (nimages, ny, nx)
+        combtype (str): median, mean, sum, minimum
+        nlow (int): Number of low pixels to throw out at each pixel
+        nhigh (int): Number of high pixels to throw out at each pixel
+
+    Returns:
+        numpy array: float32 combined image, shape (ny, nx)
+
+    """
+    nimg = stack.shape[0]
+    if nlow + nhigh >= nimg:
+        raise ValueError("Cannot reject %d low and %d high pixels from %d "
+                         "images" % (nlow, nhigh, nimg))
+    if nlow > 0 or nhigh > 0:
+        stack = np.sort(stack, axis=0)[nlow:nimg - nhigh]
+
+    if combtype == "median":
+        comb = np.median(stack, axis=0)
+    elif combtype == "mean":
+        comb = np.mean(stack, axis=0, dtype=np.float64)
+    elif combtype == "sum":
+        comb = np.sum(stack, axis=0, dtype=np.float64)
+    elif combtype == "minimum":
+        comb = np.min(stack, axis=0)
+    else:
+        raise ValueError("Unknown combination type: %s" % combtype)
+
+    return comb.astype(np.float32)
+
+
+def tiled_combine(flist, combtype="mean", nlow=0, nhigh=0, sub_oscan=False,
+                  strip=128, nthreads=1):
+    """Combine images in strips of rows read from memory mapped files
+
+    Only one strip of each input image is in memory at a time, so memory
+    use does not grow with the number of images.
+
+    Args:
+        flist (list of str): The list of files to combine
+        combtype (str): median, mean, sum, minimum
+        nlow (int): Number of low pixels to throw out at each pixel
+        nhigh (int): Number of high pixels to throw out at each pixel
+        sub_oscan (bool): If True, subtract overscan before combining
+        strip (int): Number of rows combined at once
+        nthreads (int): Number of strips combined in parallel
+
+    Returns:
+        (numpy array, astropy.io.fits.Header): combined image and header of
+            the last input image
+
+    """
+
+    # Open inputs without scaling, so the data stay memory mapped
+    hdus = []
+    scales = []
+    hdr = None
+    for fl in flist:
+        inhdu = pf.open(fl, memmap=True, do_not_scale_image_data=True)
+        hdr = inhdu[0].header
+        bscale = hdr.get('BSCALE', 1.)
+        bzero = hdr.get('BZERO', 0.)
+        scan_val = 0.
+        if sub_oscan:
+            # Needs the full frame, but only one at a time
+            img = inhdu[0].data.astype(np.float32) * bscale + bzero
+            scan_val, x0, x1 = calculate_oscan(img, hdr)
+            del img
+            if scan_val < 0.:
+                scan_val = 0.
+        hdus.append(inhdu)
+        scales.append((bscale, bzero - scan_val))
+
+    ny, nx = hdus[0][0].data.shape
+    oimg = np.zeros((ny, nx), dtype=np.float32)
+
+    def combine_rows(y0):
+        y1 = min(y0 + strip, ny)
+        stack = np.empty((len(hdus), y1 - y0, nx), dtype=np.float32)
+        for i, (inhdu, (bscale, offset)) in enumerate(zip(hdus, scales)):
+            stack[i] = inhdu[0].data[y0:y1]
+            if bscale != 1.:
+                stack[i] *= bscale
+            if offset != 0.:
+                stack[i] += offset
+        oimg[y0:y1] = combine_stack(stack, combtype=combtype, nlow=nlow,
+                                    nhigh=nhigh)
+
+    try:
+        if nthreads > 1:
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                list(executor.map(combine_rows, range(0, ny, strip)))
+        else:
+            for y in range(0, ny, strip):
+                combine_rows(y)
+    finally:
+        for inhdu in hdus:
+            inhdu.close()
+
+    # The scaled output is float, like the data read by pf.open
+    hdr = hdr.copy()
+    for key in ('BSCALE', 'BZERO'):
+        hdr.remove(key, ignore_missing=True)
+
+    return oimg, hdr
+
+
 def imcombine(flist, fout, listfile=None, combtype="mean",
-              nlow=0, nhigh=0, sub_oscan=False):
+              nlow=0, nhigh=0, sub_oscan=False, tiled=False, strip=128,
+              nthreads=1):
 
     """Convenience wrapper around STSCI python task numCombine
 
@@ -22,6 +134,11 @@ def imcombine(flist, fout, listfile=None, combtype="mean",
         nlow (int): Number of low pixels to throw out in median calculation
         nhigh (int): Number of high pixels to throw out in median calculation
         sub_oscan (bool): If True, subtract overscan before combining
+        tiled (bool): If True, combine in strips of rows with tiled_combine
+            instead of loading all images for numCombine.  Results agree
+            with numCombine to float32 rounding.
+        strip (int): Number of rows per strip when tiled
+        nthreads (int): Number of strips combined in parallel when tiled
     
     Returns:
         None
@@ -31,24 +148,29 @@ def imcombine(flist, fout, listfile=None, combtype="mean",
 
     """
 
-    imstack = []
-    hdr = {}
-    for fl in flist:
-        inhdu = pf.open(fl)
-        img = inhdu[0].data
-        img = img.astype(np.float32)
-        if sub_oscan:
-            scan_val, x0, x1 = calculate_oscan(img, inhdu[0].header)
-            if scan_val > 0.:
-                img -= scan_val
-        imstack.append(img)
+    if tiled:
+        oimg, hdr = tiled_combine(flist, combtype=combtype, nlow=nlow,
+                                  nhigh=nhigh, sub_oscan=sub_oscan,
+                                  strip=strip, nthreads=nthreads)
+    else:
+        imstack = []
+        hdr = {}
+        for fl in flist:
+            inhdu = pf.open(fl)
+            img = inhdu[0].data
+            img = img.astype(np.float32)
+            if sub_oscan:
+                scan_val, x0, x1 = calculate_oscan(img, inhdu[0].header)
+                if scan_val > 0.:
+                    img -= scan_val
+            imstack.append(img)
 
-        hdr = inhdu[0].header
+            hdr = inhdu[0].header
 
-    result = numCombine(imstack, combinationType=combtype,
-                        nlow=nlow, nhigh=nhigh)
+        result = numCombine(imstack, combinationType=combtype,
+                            nlow=nlow, nhigh=nhigh)
 
-    oimg = result.combArrObj
+        oimg = result.combArrObj
 
     ncom = 1
     for fl in flist:
@@ -96,6 +218,12 @@ if __name__ == '__main__':
     parser.add_argument('--reject', type=str, default='none')
     parser.add_argument('--outname', type=str, default=None)
     parser.add_argument('--sub_oscan', action="store_true", default=False)
+    parser.add_argument('--tiled', action="store_true", default=False,
+                        help='Combine memory mapped images in strips')
+    parser.add_argument('--strip', type=int, default=128,
+                        help='Rows per strip with --tiled')
+    parser.add_argument('--nthreads', type=int, default=1,
+                        help='Strips combined in parallel with --tiled')
     args = parser.parse_args()
 
     filelist = args.files
@@ -104,4 +232,5 @@ if __name__ == '__main__':
         print("Set --outname")
 
     imcombine(filelist, out, listfile=args.listfile, combtype=args.combtype,
-              nlow=args.Nlo, nhigh=args.Nhi, sub_oscan=args.sub_oscan)
+              nlow=args.Nlo, nhigh=args.Nhi, sub_oscan=args.sub_oscan,
+              tiled=args.tiled, strip=args.strip, nthreads=args.nthreads)
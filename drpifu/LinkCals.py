@@ -11,6 +11,11 @@ import argparse
 import json
 import sedmpy_version
 
+try:
+    import CalCatalog
+except ImportError:
+    import drpifu.CalCatalog as CalCatalog
+
 configfile = os.path.join(sedmpy_version.CONFIG_DIR, 'sedmconfig.json')
 with open(configfile) as config_file:
     sedm_cfg = json.load(config_file)
@@ -48,8 +53,9 @@ def bias_ready(caldir='./'):
 def find_recent(redd, fname, destdir, dstr):
     """Find the most recent version of fname and copy it to destdir.
 
-    Look through sorted list of redux directories to find most recent
-    version of the input file.  Copy (link) it into the destination directory.
+    Look up the most recent version of the input file in the catalog of
+    redux directories (see CalCatalog).  Copy (link) it into the
+    destination directory.
 
     Args:
         redd (str): reduced directory (something like /data/sedmdrp/redux)
@@ -69,24 +75,14 @@ def find_recent(redd, fname, destdir, dstr):
     if len(local_file) == 1:
         logging.warning("%s already exists in %s" % (fname, destdir))
         ret = True
-    # Search in redd for file
+    # Search in redd catalog for file
     else:
-        # Get all but the most recent reduced data directories
-        fspec = os.path.join(redd, '20??????')
-        redlist = sorted([d for d in glob.glob(fspec)
-                          if os.path.isdir(d)])[0:-1]
-        # Go back in reduced dir list until we find our file
-        for d in reversed(redlist):
-            # Skip dirs newer than current dir (if any)
-            if int(d.split('/')[-1]) >= int(dstr):
-                continue
-            src = glob.glob(os.path.join(d, '20??????' + fname))
-            if len(src) == 1:
-                os.symlink(src[0], os.path.join(destdir, dstr + fname))
-                ret = True
-                logging.info("Found %s in directory %s, linking to %s" %
-                             (fname, d, destdir))
-                break
+        d, src = CalCatalog.find_latest(redd, '20??????' + fname, dstr)
+        if src is not None:
+            os.symlink(src, os.path.join(destdir, dstr + fname))
+            ret = True
+            logging.info("Found %s in directory %s, linking to %s" %
+                         (fname, d, destdir))
     if not ret:
         logging.warning(dstr + fname + " not found")
 
@@ -96,8 +92,9 @@ def find_recent(redd, fname, destdir, dstr):
 def find_recent_bias(redd, fname, destdir, dstr):
     """Find the most recent version of fname and copy it to destdir.
 
-    Look through sorted list of redux directories to find most recent
-    version of the input file.  Copy it to the destination directory.
+    Look up the most recent version of the input file in the catalog of
+    redux directories (see CalCatalog).  Copy it to the destination
+    directory.
 
     Args:
         redd (str): reduced directory (something like /data/sedmdrp/redux)
@@ -117,34 +114,33 @@ def find_recent_bias(redd, fname, destdir, dstr):
     if len(local_file) == 1:
         logging.warning("%s already exists in %s" % (fname, destdir))
         ret = True
-    # Search in redd for file
+    # Search in redd catalog for file
     else:
-        # Get all but the most recent reduced data directories
-        fspec = os.path.join(redd, '20??????')
-        redlist = sorted([d for d in glob.glob(fspec)
-                          if os.path.isdir(d)])[0:-1]
-        # Go back in reduced dir list until we find our file
-        for d in reversed(redlist):
-            # Skip dirs newer than current dir (if any)
-            if int(d.split('/')[-1]) >= int(dstr):
-                continue
-            src = glob.glob(os.path.join(d, fname+'*'))
-            if len(src) == 1:
-                os.symlink(src[0], os.path.join(destdir, fname))
-                ret = True
-                logging.info("Found %s in directory %s, linking to %s" %
-                             (fname, d, os.path.join(destdir, fname)))
-                break
+        d, src = CalCatalog.find_latest(redd, fname + '*', dstr)
+        if src is not None:
+            os.symlink(src, os.path.join(destdir, fname))
+            ret = True
+            logging.info("Found %s in directory %s, linking to %s" %
+                         (fname, d, os.path.join(destdir, fname)))
     if not ret:
         logging.warning("%s not found" % fname)
     return ret
 
 
+def select_real(files):
+    """Select the first file that is not a symlink"""
+    for ss in files:
+        if not os.path.islink(ss):
+            return ss
+    return None
+
+
 def find_recent_std(redd, fname, destdir, dstr):
     """Find the most recent version of fname and copy it to destdir.
 
-    Look through sorted list of redux directories to find most recent
-    version of the input file.  Copy it to the destination directory.
+    Look up the most recent version of the input file in the catalog of
+    redux directories (see CalCatalog).  Copy it to the destination
+    directory.
 
     Args:
         redd (str): reduced directory (something like /data/sedmdrp/redux)
@@ -164,31 +160,14 @@ def find_recent_std(redd, fname, destdir, dstr):
     if len(local_file) == 1:
         logging.warning("%s already exists in %s" % (fname, destdir))
         ret = True
-    # Search in redd for file
+    # Search in redd catalog for file
     else:
-        # Get all but the most recent reduced data directories
-        fspec = os.path.join(redd, '20??????')
-        redlist = sorted([d for d in glob.glob(fspec)
-                          if os.path.isdir(d)])[0:-1]
-        # Go back in reduced dir list until we find our file
-        for d in reversed(redlist):
-            # Skip dirs newer than current dir (if any)
-            if int(d.split('/')[-1]) >= int(dstr):
-                continue
-            src = glob.glob(os.path.join(d, fname))
-            if len(src) >= 1:
-                src.sort()
-                for ss in src:
-                    # skip symlinks
-                    if os.path.islink(ss):
-                        continue
-                    outlink = os.path.join(destdir, ss.split('/')[-1])
-                    os.symlink(ss, outlink)
-                    ret = True
-                    logging.info("Found %s, linking to %s" % (ss, outlink))
-                    break
-                if ret:
-                    break
+        d, ss = CalCatalog.find_latest(redd, fname, dstr, select=select_real)
+        if ss is not None:
+            outlink = os.path.join(destdir, ss.split('/')[-1])
+            os.symlink(ss, outlink)
+            ret = True
+            logging.info("Found %s, linking to %s" % (ss, outlink))
     if not ret:
         logging.warning("%s not found" % fname)
     return ret
@@ -2,10 +2,14 @@
 
 import sys
 import os
-import astropy.io.fits as pf
 from datetime import datetime
 from astropy.time import Time
 
+try:
+    from HdrIndex import get_header
+except ImportError:
+    from drpifu.HdrIndex import get_header
+
 
 def filename_to_date(filename):
     rute = os.path.basename(filename)
@@ -39,19 +43,18 @@ def extract_info(infiles):
             has_rc = True
         if rute.startswith('ifu'):
             has_ifu = True
-        ff = pf.open(ifile)
-        is_andor = 'PSCANX0' in ff[0].header
-        ff[0].header['filename'] = ifile
-        if 'JD' not in ff[0].header:
+        hdr = get_header(ifile)
+        is_andor = 'PSCANX0' in hdr
+        hdr['filename'] = ifile
+        if 'JD' not in hdr:
             print('Warning: no JD keyword in header, generating from fname')
             jd = filename_to_date(ifile)
-            ff[0].header['JD'] = jd
-        elif ff[0].header['JD'] <= 0:
+            hdr['JD'] = jd
+        elif hdr['JD'] <= 0:
             print('Warning JD keyword value illegal, generating from fname')
             jd = filename_to_date(ifile)
-            ff[0].header['JD'] = jd
-        headers.append(ff[0].header)
-        ff.close()
+            hdr['JD'] = jd
+        headers.append(hdr)
     if has_rc and has_ifu:
         print("Has both rc and ifu images: choose one or the other")
         sys.exit(1)
@@ -186,7 +189,7 @@ make_preamble_rc = """
 PY = ~/spy
 PYC = ~/sedmpy/drpifu
 PYR = ~/sedmpy/drprc
-IMCOMBINE = $(PY) $(PYC)/Imcombine.py
+IMCOMBINE = $(PY) $(PYC)/Imcombine.py --tiled --nthreads 4
 REPORT = $(PY) $(PYR)/DrpReport.py
 
 BSUB = $(PY) $(PYC)/Debias.py
@@ -221,7 +224,7 @@ PY = ~/spy
 PYC = ~/sedmpy/drpifu
 PYG = ~/sedmpy/growth
 PYF = ~/sedmpy/fritz
-IMCOMBINE = $(PY) $(PYC)/Imcombine.py
+IMCOMBINE = $(PY) $(PYC)/Imcombine.py --tiled --nthreads 4
 REPORT = $(PY) $(PYC)/DrpReport.py
 CLASS = $(PY) $(PYC)/Classify.py
 SIG2NOISE = $(PY) $(PYC)/CalcS2N.py
@@ -346,7 +349,12 @@ def to_makefile(objs, calibs, make_rc, make_andor):
     f = open("Makefile", "w")
     clean = "\n\nclean:\n\trm %s" % all_targs
 
-    bias = "\nbias: %s $(BIAS)" % biases
+    # Images without a bias subtracted version are processed in one batch,
+    # so Debias.py reads each master bias once
+    bias = "\nNEWBIAS = $(filter-out $(patsubst b_%,%,$(wildcard b_*fits))," \
+           "$(SRCS))"
+    bias += "\n\nbias: %s\n\t$(if $(NEWBIAS),$(BSUB) --nproc 16 " \
+            "$(NEWBIAS))" % biases
     bias += "\n\n$(BIAS): %s\n\t$(BSUB) $(subst b_,,$@)" % biases
 
     f.write(preamble + bias + "\n\nall: %s%s" % (all_targs, clean) +
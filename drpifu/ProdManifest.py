@@ -0,0 +1,306 @@
+"""Manifest of the data products in the directories of a night.
+
+Functions
+    * :func:`get`           get the (cached) manifest of a product directory
+    * :func:`update`        refresh a manifest after new products were made
+    * :func:`product_info`  product type and object of a product file
+
+Classes
+    * :class:`ProductManifest`  type, object, size and mtime of each product
+
+Note:
+    Each product directory of a night (the redux directory, its finders
+    directory and the rc png directories) has a manifest in
+    <dir>/.manifest/products.json.  Listing a directory through its manifest
+    costs a single stat of the directory while nothing has changed; when the
+    directory has changed only the new files are stat'ed.  The pipeline
+    calls :func:`update` as products are made, so the manifest is current
+    when the web pages read it, and the web layer keeps recently used
+    manifests in an in-process LRU cache (see :func:`get`).  The web layer
+    gets its manifests read-only: it never writes manifests or creates
+    .manifest directories.
+
+    Manifests are only cached in memory if they cannot be written.  A
+    directory modified within _mtime_margin seconds of its last listing is
+    listed again, so files created in the same time stamp tick as a listing
+    are not missed.
+
+    This is used as a python script as follows::
+
+        usage: ProdManifest.py [-h] [--force] dirs [dirs ...]
+
+        positional arguments:
+          dirs        product directories to update
+
+        optional arguments:
+          -h, --help  show this help message and exit
+          --force     re-stat every product
+
+"""
+import os
+import json
+import time
+import fnmatch
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+
+# Manifest location relative to the product directory
+_manifest_dir = '.manifest'
+_manifest_name = 'products.json'
+# Number of manifests kept by get()
+_cache_size = 128
+# Directories modified within this many seconds of their last listing are
+# listed again (coarse or skewed file system time stamps)
+_mtime_margin = 2.
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def manifest_file(dirname):
+    """Return the manifest file of product directory dirname"""
+    return os.path.join(dirname, _manifest_dir, _manifest_name)
+
+
+def product_info(name):
+    """Product type and object of a product file.
+
+    The type is the name prefix and extension (e.g. spec.txt, e3d.fits,
+    finder.png), the object the last field of names like
+    spec_auto_robot_lstep1__crr_b_ifu20210101_01_02_03_ZTF21aaaaaaa.txt.
+
+    Args:
+        name (str): product file name
+
+    Returns:
+        (str, str): product type and object ('' if not known)
+
+    """
+    root, ext = os.path.splitext(name)
+    if ext == '.gz':
+        root, ext2 = os.path.splitext(root)
+        ext = ext2 + ext
+    fields = root.split('_')
+    ptype = fields[0] + ext
+    obj = fields[-1] if len(fields) > 2 else ''
+    return ptype, obj
+
+
+class ProductManifest:
+    """Type, object, size and mtime of the products in a directory.
+
+    Args:
+        dirname (str): product directory
+        readonly (bool): never write the manifest file
+
+    """
+
+    def __init__(self, dirname, readonly=False):
+        self.dirname = dirname
+        self.readonly = readonly
+        self.dir_mtime = None
+        self.scanned = 0.
+        self.products = {}
+        self._lock = threading.Lock()
+        try:
+            with open(manifest_file(dirname)) as man_file:
+                man = json.load(man_file)
+            self.dir_mtime = man['dir_mtime']
+            self.products = man['products']
+            self.scanned = man.get('scanned', 0.)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _stat(self, name):
+        """Return manifest entry for name, or None if it is gone"""
+        try:
+            st = os.stat(os.path.join(self.dirname, name))
+        except OSError:
+            return None
+        ptype, obj = product_info(name)
+        return {'type': ptype, 'object': obj, 'size': st.st_size,
+                'mtime': st.st_mtime}
+
+    def _save(self):
+        """Write manifest atomically (unless read-only)"""
+        if self.readonly:
+            return
+        mfile = manifest_file(self.dirname)
+        tmp = mfile + '.tmp%d' % os.getpid()
+        try:
+            with open(tmp, 'w') as man_file:
+                json.dump({'dir_mtime': self.dir_mtime,
+                           'scanned': self.scanned,
+                           'products': self.products}, man_file)
+            os.replace(tmp, mfile)
+        except OSError as e:
+            logging.debug("Cannot write manifest %s: %s" % (mfile, e))
+
+    def refresh(self, force=False):
+        """Bring the manifest up to date with its directory.
+
+        Args:
+            force (bool): re-stat every product, not only new ones
+
+        Returns:
+            bool: True if the manifest changed
+
+        """
+        with self._lock:
+            return self._refresh(force)
+
+    def _refresh(self, force):
+        """Update manifest, the caller holds the lock"""
+        try:
+            dir_mtime = os.stat(self.dirname).st_mtime
+        except OSError:
+            changed = bool(self.products)
+            self.dir_mtime = None
+            self.products = {}
+            return changed
+        # Unchanged since listed, and not modified close to the listing?
+        if dir_mtime == self.dir_mtime and not force and \
+                dir_mtime < self.scanned - _mtime_margin:
+            return False
+        # Make the manifest directory before the directory is listed, so
+        # creating it does not look like a change next time
+        mdir = os.path.join(self.dirname, _manifest_dir)
+        if not self.readonly and not os.path.isdir(mdir):
+            try:
+                os.mkdir(mdir)
+                dir_mtime = os.stat(self.dirname).st_mtime
+            except OSError:
+                pass
+        scanned = time.time()
+        products = {}
+        with os.scandir(self.dirname) as entries:
+            for ent in entries:
+                # Skip hidden and temporary files, as glob does
+                if ent.name.startswith('.'):
+                    continue
+                if not force and ent.name in self.products:
+                    products[ent.name] = self.products[ent.name]
+                    continue
+                try:
+                    if not ent.is_file():
+                        continue
+                except OSError:
+                    continue
+                prod = self._stat(ent.name)
+                if prod is not None:
+                    products[ent.name] = prod
+        changed = products != self.products
+        self.products = products
+        self.dir_mtime = dir_mtime
+        self.scanned = scanned
+        self._save()
+        return changed
+
+    def record(self, pattern):
+        """Re-stat the products matching pattern (after they were rewritten).
+
+        Args:
+            pattern (str): glob pattern of product names
+
+        Returns:
+            int: number of products recorded
+
+        """
+        nrec = 0
+        with self._lock:
+            for name in fnmatch.filter(list(self.products), pattern):
+                prod = self._stat(name)
+                if prod is None:
+                    del self.products[name]
+                else:
+                    self.products[name] = prod
+                    nrec += 1
+            if nrec:
+                self._save()
+        return nrec
+
+    def glob(self, pattern):
+        """Sorted full paths of the products matching pattern.
+
+        Drop-in replacement for sorted(glob.glob(os.path.join(dirname,
+        pattern))) for a pattern without a directory part.
+
+        """
+        return [os.path.join(self.dirname, name) for name in
+                sorted(fnmatch.filter(self.products, pattern))]
+
+    def exists(self, name):
+        """True if product name is in the directory"""
+        return name in self.products
+
+    def select(self, ptype=None, obj=None):
+        """Sorted full paths of the products of a type and/or object"""
+        return [os.path.join(self.dirname, name)
+                for name, prod in sorted(self.products.items())
+                if (ptype is None or prod['type'] == ptype) and
+                (obj is None or prod['object'] == obj)]
+
+
+def get(dirname, readonly=False):
+    """Get the up to date manifest of a product directory.
+
+    Recently used manifests are kept in memory (least recently used are
+    dropped first), so a manifest that has not changed costs one stat.
+
+    Args:
+        dirname (str): product directory
+        readonly (bool): do not write the manifest or create its directory
+            (used by the web pages)
+
+    Returns:
+        ProductManifest: manifest (empty if dirname does not exist)
+
+    """
+    dirname = os.path.abspath(dirname)
+    with _cache_lock:
+        man = _cache.pop(dirname, None)
+        if man is None:
+            man = ProductManifest(dirname, readonly=readonly)
+        man.readonly = readonly
+        _cache[dirname] = man
+        while len(_cache) > _cache_size:
+            _cache.popitem(last=False)
+    man.refresh()
+    return man
+
+
+def update(dirname, pattern=None, force=False):
+    """Update the manifest of dirname after new products were made.
+
+    Args:
+        dirname (str): product directory
+        pattern (str): glob pattern of products that may have been
+            rewritten in place (re-stat'ed even if already listed)
+        force (bool): re-stat every product
+
+    Returns:
+        int: number of products in the manifest
+
+    """
+    man = get(dirname)
+    if force:
+        man.refresh(force=True)
+    elif pattern is not None:
+        man.record(pattern)
+    return len(man.products)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="""Update product manifests""",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('dirs', type=str, nargs='+',
+                        help='product directories to update')
+    parser.add_argument('--force', action="store_true", default=False,
+                        help='re-stat every product')
+    args = parser.parse_args()
+
+    for d in args.dirs:
+        print("%d products in %s" % (update(d, force=args.force), d))
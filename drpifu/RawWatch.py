@@ -0,0 +1,246 @@
+"""Watch a raw data directory for completed SEDM ifu images.
+
+Classes
+    * :class:`RawWatcher`   queues raw images as soon as they are complete
+
+Functions
+    * :func:`is_complete`   check if a raw image has been completely written
+
+Note:
+    If the ``watchdog`` package is installed, file system events (inotify on
+    Linux) are used to detect new images the moment they are closed after
+    writing (or renamed into place, as rsync does).  Otherwise the directory
+    is scanned every ``poll`` seconds and an image is only queued once its
+    size has reached the nominal size and is unchanged between two scans.
+    When watching events, :meth:`RawWatcher.get` also scans the directory
+    whenever its wait times out, as a backstop for file systems that do not
+    report events (e.g. NFS written by another host) or a dropped event
+    queue.
+
+    Typical use in a night loop::
+
+        watcher = RawWatcher(srcdir)
+        watcher.start()
+        while doit:
+            new_files = watcher.get(timeout=60.)
+            ...
+        watcher.stop()
+
+"""
+import os
+import json
+import queue
+import fnmatch
+import logging
+import threading
+
+import sedmpy_version
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import PatternMatchingEventHandler
+except ImportError:
+    Observer = None
+    PatternMatchingEventHandler = object
+
+# Get pipeline configuration
+# Find config file: default is sedmpy/config/sedmconfig.json
+try:
+    configfile = os.environ["SEDMCONFIG"]
+except KeyError:
+    configfile = os.path.join(sedmpy_version.CONFIG_DIR, "sedmconfig.json")
+with open(configfile) as config_file:
+    sedm_cfg = json.load(config_file)
+
+_nomfs = sedm_cfg['nominal_file_size']
+
+
+def is_complete(fname, fsize=_nomfs):
+    """Check if a raw image has been completely written.
+
+    Args:
+        fname (str): raw image file
+        fsize (int): size of completely copied file in bytes
+
+    Returns:
+        bool: True if file exists and is at least fsize bytes
+
+    """
+    try:
+        return os.stat(fname).st_size >= fsize
+    except OSError:
+        return False
+
+
+class _RawEventHandler(PatternMatchingEventHandler):
+    """Pass closed or renamed raw images on to the watcher"""
+
+    def __init__(self, watcher):
+        super().__init__(patterns=[watcher.pattern], ignore_directories=True)
+        self.watcher = watcher
+
+    def on_closed(self, event):
+        self.watcher.add(event.src_path)
+
+    def on_moved(self, event):
+        self.watcher.add(event.dest_path)
+
+    def on_created(self, event):
+        # Some file systems do not report close events: catch files that
+        # arrive complete (hard links, NFS) here
+        self.watcher.add(event.src_path)
+
+
+class RawWatcher:
+    """Queue completed raw images that appear in a raw directory.
+
+    Each image is queued exactly once, the first time it is seen complete,
+    so consumers only ever deal with new, fully written images instead of
+    re-scanning the whole directory.
+
+    Args:
+        rawdir (str): raw directory to watch (like /data/sedmdrp/raw/YYYYMMDD)
+        pattern (str): glob pattern of images to watch for
+        fsize (int): size of completely copied file in bytes
+        poll (float): scan interval in seconds when watchdog is unavailable
+
+    """
+
+    def __init__(self, rawdir, pattern='ifu*.fits', fsize=_nomfs, poll=10.):
+        self.rawdir = rawdir
+        self.pattern = pattern
+        self.fsize = fsize
+        self.poll = poll
+        self.queue = queue.Queue()
+        self._seen = set()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._observer = None
+        self._poller = None
+
+    def add(self, fname):
+        """Queue fname if it is a complete raw image not yet queued.
+
+        Args:
+            fname (str): raw image file
+
+        Returns:
+            bool: True if fname was queued
+
+        """
+        bname = os.path.basename(fname)
+        if not fnmatch.fnmatch(bname, self.pattern):
+            return False
+        fname = os.path.join(self.rawdir, bname)
+        with self._lock:
+            if fname in self._seen or not is_complete(fname, self.fsize):
+                return False
+            self._seen.add(fname)
+        self.queue.put(fname)
+        return True
+
+    def scan(self, stable=False):
+        """Scan raw directory once and queue any new complete images.
+
+        Args:
+            stable (bool): also require the file size to be unchanged since
+                the previous scan (used when polling without close events)
+
+        Returns:
+            int: number of images queued
+
+        """
+        nadd = 0
+        try:
+            entries = list(os.scandir(self.rawdir))
+        except OSError as e:
+            logging.warning("Cannot scan %s: %s" % (self.rawdir, e))
+            return nadd
+        for ent in sorted(entries, key=lambda x: x.name):
+            if not fnmatch.fnmatch(ent.name, self.pattern):
+                continue
+            if ent.path in self._seen:
+                continue
+            if stable:
+                try:
+                    size = ent.stat().st_size
+                except OSError:
+                    continue
+                last = self._sizes.get(ent.path)
+                self._sizes[ent.path] = size
+                if last != size:
+                    continue
+                del self._sizes[ent.path]
+            if self.add(ent.path):
+                nadd += 1
+        return nadd
+
+    def _poll_loop(self):
+        """Fallback scanner thread used when watchdog is not installed"""
+        while not self._stop.wait(self.poll):
+            self.scan(stable=True)
+
+    def start(self):
+        """Queue images already present and start watching for new ones.
+
+        Returns:
+            int: number of images already present and queued
+
+        """
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.schedule(_RawEventHandler(self), self.rawdir,
+                                    recursive=False)
+            self._observer.start()
+            logging.info("Watching %s for new %s images" %
+                         (self.rawdir, self.pattern))
+        else:
+            self._poller = threading.Thread(target=self._poll_loop,
+                                            daemon=True)
+            self._poller.start()
+            logging.info("watchdog not available, scanning %s every %.0fs "
+                         "for new %s images" %
+                         (self.rawdir, self.poll, self.pattern))
+        # Catch anything written before we started watching
+        return self.scan()
+
+    def stop(self):
+        """Stop watching the raw directory"""
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        if self._poller is not None:
+            self._poller.join()
+            self._poller = None
+
+    def get(self, timeout=60.):
+        """Wait for new complete images.
+
+        Blocks until at least one image is available or timeout expires,
+        then returns all images currently queued.  When watching events and
+        nothing arrived before timeout, the directory is scanned instead in
+        case events were missed.
+
+        Args:
+            timeout (float): maximum time to wait in seconds
+
+        Returns:
+            list: sorted list of new complete raw image files (may be empty)
+
+        """
+        new_files = []
+        try:
+            new_files.append(self.queue.get(timeout=timeout))
+        except queue.Empty:
+            # Backstop for file systems without events
+            if self._observer is None or not self.scan(stable=True):
+                return new_files
+        while True:
+            try:
+                new_files.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return sorted(new_files)
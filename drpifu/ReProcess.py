@@ -44,6 +44,16 @@ try:
 except ImportError:
     from drpifu.LinkCals import find_recent_std
 
+try:
+    from HdrIndex import get_header
+except ImportError:
+    from drpifu.HdrIndex import get_header
+
+try:
+    import CalCatalog
+except ImportError:
+    import drpifu.CalCatalog as CalCatalog
+
 try:
     import rcimg
 except ImportError:
@@ -99,9 +109,7 @@ def docp(src, dest, onsky=True, verbose=False, skip_cals=False, header=None):
     nobj = 0
     # Read FITS header if needed
     if header is None:
-        ff = pf.open(src)
-        hdr = ff[0].header
-        ff.close()
+        hdr = get_header(src)
     else:
         hdr = header
     # Get OBJECT and DOMEST keywords
@@ -251,9 +259,7 @@ def cpcal(srcdir, destdir='./', fsize=_nomfs):
         # Copy only if source complete or larger than local file
         if (src_size >= fsize and src_size > loc_size) or '.gz' in src:
             # Read FITS header
-            ff = pf.open(src)
-            hdr = ff[0].header
-            ff.close()
+            hdr = get_header(src)
             # Get OBJECT keyword
             try:
                 obj = hdr['OBJECT']
@@ -345,9 +351,7 @@ def cpprecal(rawd=None, destdir=None, cdate=None, fsize=_nomfs):
         for src in flist:
             if os.stat(src).st_size >= fsize or '.gz' in src:
                 # Read FITS header
-                ff = pf.open(src)
-                hdr = ff[0].header
-                ff.close()
+                hdr = get_header(src)
                 # Get OBJECT keyword
                 obj = hdr['OBJECT']
                 # Filter Calibs and avoid test images
@@ -515,9 +519,7 @@ def bias_proc_ready(caldir='./', fsize=_nomfs, mintest=False, ncp=0):
             # Are we complete?
             if os.stat(cal).st_size >= fsize:
                 # Read FITS header
-                ff = pf.open(cal)
-                hdr = ff[0].header
-                ff.close()
+                hdr = get_header(cal)
                 # Get OBJECT keyword
                 try:
                     obj = hdr['OBJECT']
@@ -645,9 +647,7 @@ def clean_raw_data(odir):
         if os.path.islink(fl):
             os.remove(fl)
         else:
-            ff = pf.open(fl)
-            hdr = ff[0].header
-            ff.close()
+            hdr = get_header(fl)
             try:
                 obj = hdr['OBJECT']
             except KeyError:
@@ -984,9 +984,7 @@ def dosci(destdir='./', datestr=None, nodb=False, posdic=None, oldext=False,
         # Is our source file processed?
         if len(proced) == 0:
             # Read FITS header
-            ff = pf.open(fl)
-            hdr = ff[0].header
-            ff.close()
+            hdr = get_header(fl)
             # Get OBJECT keyword
             try:
                 obj = hdr['OBJECT'].split("[")[0].strip().replace(" ", "-")
@@ -1223,9 +1221,7 @@ def get_extract_pos(indir, indate):
         if '_failed' in specfs:
             continue
         # Get fits header
-        ff = pf.open(specfs)
-        header = ff[0].header
-        ff.close()
+        header = get_header(specfs)
         # Get OBJECT keyword
         try:
             objname = header['OBJECT']
@@ -1377,9 +1373,7 @@ def re_cube(redd=None, ut_date=None, nodb=False, ignore_bad=False):
         # Loop over source files
         for fl in srcfiles:
             # Read FITS header
-            ff = pf.open(fl)
-            hdr = ff[0].header
-            ff.close()
+            hdr = get_header(fl)
             # Get OBJECT keyword
             try:
                 obj = hdr['OBJECT']
@@ -1611,6 +1605,8 @@ def re_calib(redd=None, ut_date=None, nodb=False):
                                 % spec_calib_id)
                         logging.info(
                             "Calibration stage complete, ready for science!")
+                        # Record new calibrations in the catalog
+                        CalCatalog.update_night(redd, ut_date)
                         # Make cube report
                         cmd = "python ~/sedmpy/drpifu/CubeReport.py %s" % \
                             ut_date
@@ -11,6 +11,7 @@ if __name__ == "__main__":
     import logging
     import datetime
     import AutoReduce as ar
+    import fritz.fritz_journal as fritz_journal
     import astropy.io.fits as pf
 
     logging.basicConfig(
@@ -120,11 +121,10 @@ if __name__ == "__main__":
             with open(text_file, "w") as textOut:
                 textOut.write("".join(spec_lines))
             # make ready to re-upload to marshal
-            upl_file = glob.glob(
-                os.path.join(rd, dd, "spec_auto_robot_lstep1__*_%s_*.upl" %
-                             ob_id))
-            if upl_file:
-                os.remove(upl_file[0])
+            journal = fritz_journal.UploadJournal(os.path.join(rd, dd))
+            for upl_file in journal.uploaded_files(
+                    "spec_auto_robot_lstep1__*_%s_*" % ob_id):
+                journal.forget(upl_file)
             if args.local:
                 pars = ["pysedm_report.py", dd, "--contains", ob_id]
             else:
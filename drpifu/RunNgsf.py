@@ -6,10 +6,15 @@ Created on Thu Aug 11 11:23:00 2016
 """
 
 import csv
+import os
 import argparse
+import signal
 import subprocess
-import re
 import astropy.io.fits as pf
+try:
+    import SpecHeader
+except ImportError:
+    import drpifu.SpecHeader as SpecHeader
 import numpy as np
 
 
@@ -200,7 +205,34 @@ def parse_and_fill(spec, ngsfoutput):
     return pars["bestMatchType"], pars
 
 
-def run_ngsf(spec_file=None, overwrite=False):
+def call_ngsf(spec_file, timeout=None):
+    """
+    Runs ngsf in batch mode on the input file, killing it (and anything it
+    started) after timeout seconds.  Returns True if ngsf was run to
+    completion.
+    """
+    cm = ["ngsf_run", spec_file]
+    print(" ".join(cm))
+    try:
+        # In its own session, so a timeout kills everything it started
+        proc = subprocess.Popen(cm, start_new_session=True)
+    except OSError as e:
+        print("Error running ngsf: %s" % e)
+        return False
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+        print("ngsf timed out after %.0f s" % timeout)
+        return False
+    return True
+
+
+def run_ngsf(spec_file=None, overwrite=False, timeout=None):
     """
     Runs ngsf in batch mode on the input file.  If a given file was already
     classified, it skips it, unless overwrite is requested.
@@ -210,35 +242,24 @@ def run_ngsf(spec_file=None, overwrite=False):
     if spec_file is not None:
         fl = spec_file
         # retrieve the quality and classification of the spectra.
-        with open(fl, "r") as sfl:
-            l = sfl.readlines()
-
-            q = [li for li in l if "QUALITY" in li]
+        hdr = SpecHeader.read_header(fl)
 
-            if len(q) > 0:
-                token = re.search(r'\(?([0-9]+)\)?', q[0])
-                q = int(token.group(1))
+        q = hdr.quality
+        if q is None:
+            if "crr_b_ifu" in fl:
+                q = 1
             else:
-                if "crr_b_ifu" in fl:
-                    q = 1
-                else:
-                    q = 5
-            print("quality = %d" % q)
+                q = 5
+        print("quality = %d" % q)
 
-            # check for previous classification
-            clas = [li for li in l if "NGSF" in li]
-            if clas:
-                print("classification: ", clas)
+        # check for previous classification
+        clas = [key for key, _ in hdr.cards if "NGSF" in key]
+        if clas:
+            print("classification: ", clas)
 
         if (q < 3 or q == 5) and (len(clas) <= 0 or overwrite):
             # If we are here, we run the classification with ngsf
-            cm = "ngsf_run %s" % fl.replace(" ", "\\ ")
-            print(cm)
-            try:
-                subprocess.call(cm, shell=True)
-                ran = True
-            except:
-                print("Error running ngsf")
+            ran = call_ngsf(fl, timeout=timeout)
         else:
             if q >= 3:
                 print("low quality spectrum")
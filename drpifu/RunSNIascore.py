@@ -7,9 +7,13 @@ Created on Mon Nov 30 2020
 
 import os
 import argparse
+import signal
 import subprocess
-import re
 import astropy.io.fits as pf
+try:
+    import SpecHeader
+except ImportError:
+    import drpifu.SpecHeader as SpecHeader
 
 
 def parse_and_fill(spec, sniascore_output):
@@ -79,7 +83,36 @@ def parse_and_fill(spec, sniascore_output):
     return pars
 
 
-def run_sniascore(spec_file=None, overwrite=False):
+def call_sniascore(spec_file, timeout=None):
+    """
+    Runs SNIascore in batch mode on the input file, killing it (and anything it
+    started) after timeout seconds.  Returns True if SNIascore was run to
+    completion.
+    """
+    cm = ["matlab", "-nodisplay", "-r",
+          "addpath('/home/cfremling/SEDM_ML/');SNIascore('%s');quit" %
+          spec_file]
+    print(" ".join(cm))
+    try:
+        # In its own session, so a timeout kills everything it started
+        proc = subprocess.Popen(cm, start_new_session=True)
+    except OSError as e:
+        print("Error running SNIascore: %s" % e)
+        return False
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+        print("SNIascore timed out after %.0f s" % timeout)
+        return False
+    return True
+
+
+def run_sniascore(spec_file=None, overwrite=False, timeout=None):
     """
     Runs SNIascore in batch mode on the input file.  If a given file was already
     classified, it skips it, unless overwrite is requested.
@@ -89,36 +122,24 @@ def run_sniascore(spec_file=None, overwrite=False):
     if spec_file is not None:
         fl = spec_file
         # retrieve the quality and classification of the spectra.
-        with open(fl, "r") as sfl:
-            ll = sfl.readlines()
-
-            q = [li for li in ll if "QUALITY" in li]
+        hdr = SpecHeader.read_header(fl)
 
-            if len(q) > 0:
-                token = re.search(r'\(?([0-9]+)\)?', q[0])
-                q = int(token.group(1))
+        q = hdr.quality
+        if q is None:
+            if "crr_b_ifu" in fl:
+                q = 1
             else:
-                if "crr_b_ifu" in fl:
-                    q = 1
-                else:
-                    q = 5
-            print("quality = %d" % q)
+                q = 5
+        print("quality = %d" % q)
 
-            # check for previous classification
-            clas = [li for li in ll if "SNIASCOR" in li]
-            if clas:
-                print("SNIascore: ", clas)
+        # check for previous classification
+        clas = [key for key, _ in hdr.cards if "SNIASCOR" in key]
+        if clas:
+            print("SNIascore: ", clas)
 
         if (q < 3 or q == 5) and (len(clas) <= 0 or overwrite):
             # If we are here, we run SNIascore
-            cm = "matlab -nodisplay -r \"addpath('/home/cfremling/SEDM_ML/');" \
-                 "SNIascore('%s');quit\"" % fl.replace(" ", "\\ ")
-            print(cm)
-            try:
-                subprocess.call(cm, shell=True)
-                ran = True
-            except:
-                print("Error running SNIascore")
+            ran = call_sniascore(fl, timeout=timeout)
         else:
             if q >= 3:
                 print("low quality spectrum")
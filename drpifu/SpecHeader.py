@@ -0,0 +1,217 @@
+"""Read the header of SEDM ascii spectra (spec_*.txt).
+
+Functions
+    * :func:`read_header`   header of one spectrum, using the night cache
+    * :func:`read_headers`  headers of a list of spectra, using the night cache
+
+Classes
+    * :class:`SpecHeader`   keyword values from the leading '#' lines
+
+Note:
+    Only the leading comment block of a spectrum (lines like
+    ``# KEYWORD: value``) is read.  Parsed headers are cached by file size
+    and mtime in the sidecar spec_headers.json of the spectrum directory, so
+    the report generator, classifiers and uploaders read each version of a
+    spectrum header only once.  If the sidecar cannot be written, headers
+    are only cached in memory.
+
+"""
+import os
+import re
+import json
+import logging
+
+# Sidecar cache file name in each spectrum directory
+_sidecar_name = 'spec_headers.json'
+
+# Loaded sidecars, one per directory: {'files': {name: entry}, 'dirty': bool}
+_sidecars = {}
+
+
+class SpecHeader:
+    """Keyword values from the header of an ascii spectrum.
+
+    Keywords may appear more than once (e.g. after re-classification), so
+    all values are kept in file order; :meth:`get` returns the first.
+
+    Args:
+        cards (list): (keyword, value) string pairs in file order
+        fname (str): spectrum file the header was read from
+
+    """
+
+    def __init__(self, cards, fname=None):
+        self.cards = [tuple(c) for c in cards]
+        self.fname = fname
+        self._first = {}
+        for key, val in self.cards:
+            self._first.setdefault(key, val)
+
+    def __contains__(self, key):
+        return key in self._first
+
+    def get(self, key, default=None):
+        """First value of keyword key, or default if not present"""
+        return self._first.get(key, default)
+
+    def values(self, key):
+        """All values of keyword key, in file order"""
+        return [val for k, val in self.cards if k == key]
+
+    def getfloat(self, key, default=None):
+        """First value of keyword key as a float, or default"""
+        try:
+            return float(self._first[key].split()[-1])
+        except (KeyError, IndexError, ValueError):
+            return default
+
+    def has_key_like(self, text):
+        """True if any keyword contains text (e.g. 'SNID')"""
+        return any(text in key for key, _ in self.cards)
+
+    @property
+    def quality(self):
+        """Extraction quality (int), or None if not recorded"""
+        val = self._first.get('QUALITY')
+        if val is None:
+            return None
+        token = re.search(r'([0-9]+)', val)
+        return int(token.group(1)) if token else None
+
+    @property
+    def ra_rate(self):
+        """Non-sidereal RA rate (0. if sidereal)"""
+        return self.getfloat('RA_RATE', 0.)
+
+    @property
+    def dec_rate(self):
+        """Non-sidereal Dec rate (0. if sidereal)"""
+        return self.getfloat('DEC_RATE', 0.)
+
+    @property
+    def exptime(self):
+        """Exposure time in s, or None"""
+        return self.getfloat('EXPTIME')
+
+    @property
+    def airmass(self):
+        """Airmass, or None"""
+        return self.getfloat('AIRMASS')
+
+    @property
+    def req_id(self):
+        """SEDM request id (str), or '' if not recorded"""
+        return self.get('REQ_ID', '')
+
+
+def parse_header(fname):
+    """Parse the leading comment block of an ascii spectrum.
+
+    Args:
+        fname (str): spec_*.txt ascii spectrum file
+
+    Returns:
+        list: (keyword, value) string pairs in file order
+
+    """
+    cards = []
+    with open(fname, "r") as sfl:
+        for line in sfl:
+            if line[:1] != '#':
+                break
+            if ':' not in line:
+                continue
+            key, val = line[1:].split(':', 1)
+            cards.append((key.strip(), val.strip()))
+    return cards
+
+
+def sidecar_file(specdir):
+    """Return the header cache file for a spectrum directory"""
+    return os.path.join(specdir, _sidecar_name)
+
+
+def _load_sidecar(specdir):
+    """Load (or create) the header cache of specdir"""
+    if specdir not in _sidecars:
+        files = {}
+        try:
+            with open(sidecar_file(specdir)) as side_file:
+                files = json.load(side_file)['files']
+        except (OSError, ValueError, KeyError):
+            pass
+        _sidecars[specdir] = {'files': files, 'dirty': False}
+    return _sidecars[specdir]
+
+
+def _save_sidecar(specdir):
+    """Write the header cache of specdir atomically, if it changed"""
+    side = _load_sidecar(specdir)
+    if not side['dirty']:
+        return
+    sfile = sidecar_file(specdir)
+    tmp = sfile + '.tmp%d' % os.getpid()
+    try:
+        with open(tmp, 'w') as side_file:
+            json.dump({'files': side['files']}, side_file)
+        os.replace(tmp, sfile)
+        side['dirty'] = False
+    except OSError as e:
+        logging.debug("Cannot write header cache %s: %s" % (sfile, e))
+
+
+def _get(fname):
+    """Header of fname from the cache of its directory, parsing if needed"""
+    specdir, name = os.path.split(os.path.abspath(fname))
+    side = _load_sidecar(specdir)
+    st = os.stat(fname)
+    ent = side['files'].get(name)
+    if ent is None or ent['size'] != st.st_size or \
+            ent['mtime'] != st.st_mtime:
+        ent = {'size': st.st_size, 'mtime': st.st_mtime,
+               'cards': parse_header(fname)}
+        side['files'][name] = ent
+        side['dirty'] = True
+    return specdir, SpecHeader(ent['cards'], fname=fname)
+
+
+def read_header(fname):
+    """Read the header of an ascii spectrum.
+
+    Args:
+        fname (str): spec_*.txt ascii spectrum file
+
+    Returns:
+        SpecHeader: header of the spectrum
+
+    """
+    specdir, hdr = _get(fname)
+    _save_sidecar(specdir)
+    return hdr
+
+
+def read_headers(flist):
+    """Read the headers of a list of ascii spectra.
+
+    The header caches are written once, after all spectra are read.
+    Spectra that cannot be read are left out.
+
+    Args:
+        flist (list): spec_*.txt ascii spectrum files
+
+    Returns:
+        dict: SpecHeader by file name
+
+    """
+    hdrs = {}
+    dirs = set()
+    for fname in flist:
+        try:
+            specdir, hdrs[fname] = _get(fname)
+        except OSError as e:
+            logging.warning("Cannot read %s: %s" % (fname, e))
+            continue
+        dirs.add(specdir)
+    for specdir in dirs:
+        _save_sidecar(specdir)
+    return hdrs
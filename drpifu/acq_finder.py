@@ -3,8 +3,14 @@
 Created on Tue Jul 14 15:01:50 2015
 
 @author: nadiablago
+
+Finders can also be made by a long running worker (see :func:`serve`) that
+takes ifu image names from a queue, so the matplotlib/aplpy set-up is only
+done once.  Finders are written atomically and never re-made if present; the
+progress of each finder is recorded in finders/finder_status.json.
 """
 import subprocess
+import time
 from astropy.io import fits as pf
 from astropy.wcs import WCS
 from astropy import units as u
@@ -19,6 +25,18 @@ try:
     import fitsutils
 except ImportError:
     import drprc.fitsutils as fitsutils
+try:
+    import zscale
+except ImportError:
+    import drprc.zscale as zscale
+try:
+    from HdrIndex import get_header
+except ImportError:
+    from drpifu.HdrIndex import get_header
+try:
+    import ProdManifest
+except ImportError:
+    import drpifu.ProdManifest as ProdManifest
 import datetime
 import os
 import sys
@@ -44,21 +62,84 @@ _srcpath = sedm_cfg['paths']['srcpath']
 _altrcpath = sedm_cfg['paths']['rawpath']
 
 
+# Images (primary HDU and WCS) read for finders, by file name
+_image_cache = {}
+
+
+def get_image(myfile):
+    """Return primary HDU and WCS of myfile, reading it only once"""
+    mtime = os.path.getmtime(myfile)
+    ent = _image_cache.get(myfile)
+    if ent is None or ent[0] != mtime:
+        if len(_image_cache) > 8:
+            _image_cache.clear()
+        with pf.open(myfile) as hdul:
+            hdu = pf.PrimaryHDU(hdul[0].data, hdul[0].header)
+        ent = (mtime, hdu, WCS(hdu.header))
+        _image_cache[myfile] = ent
+    return ent[1], ent[2]
+
+
+def save_atomic(save, findername):
+    """Call save(name) with a temporary name, then move it to findername"""
+    tmp = os.path.join(os.path.dirname(os.path.abspath(findername)),
+                       ".tmp%d_%s" % (os.getpid(),
+                                      os.path.basename(findername)))
+    try:
+        save(tmp)
+        os.replace(tmp, findername)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def status_file(reduxdir):
+    """Finder status file for reduxdir"""
+    return os.path.join(reduxdir, "finders", "finder_status.json")
+
+
+def set_status(reduxdir, name, status, **kwargs):
+    """Record the status of finder (or finder job) name"""
+    sfile = status_file(reduxdir)
+    os.makedirs(os.path.dirname(sfile), exist_ok=True)
+    try:
+        with open(sfile) as stat_file:
+            stats = json.load(stat_file)
+    except (OSError, ValueError):
+        stats = {}
+    ent = {"status": status,
+           "time": datetime.datetime.utcnow().isoformat(timespec="seconds")}
+    ent.update(kwargs)
+    stats[name] = ent
+    tmp = sfile + ".tmp%d" % os.getpid()
+    try:
+        with open(tmp, "w") as stat_file:
+            json.dump(stats, stat_file, indent=1)
+        os.replace(tmp, sfile)
+    except OSError as e:
+        print("Cannot write finder status %s: %s" % (sfile, e))
+
+
+def limits_cache(findername):
+    """Display limits cache shared by the finders in a directory"""
+    return os.path.join(os.path.dirname(os.path.abspath(findername)),
+                        "display_limits.json")
+
+
 def finder(myfile, findername, searchrad=0.2/60.):
 
-    kra = fitsutils.get_par(myfile, "OBJRA")
-    kdec = fitsutils.get_par(myfile, "OBJDEC")
+    hdulist, wcs = get_image(myfile)
+    hdr = hdulist.header
+    kra = hdr.get("OBJRA")
+    kdec = hdr.get("OBJDEC")
     if not kra or not kdec:
-        kra = fitsutils.get_par(myfile, "OBRA")
-        kdec = fitsutils.get_par(myfile, "OBDEC")
+        kra = hdr.get("OBRA")
+        kdec = hdr.get("OBDEC")
     ora, odec = coordinates_conversor.hour2deg(kra, kdec)
-    utc = fitsutils.get_par(myfile, "UTC")
-    hdulist = pf.open(myfile)[0]
-    img = hdulist.data * 1.            
+    utc = hdr.get("UTC")
+    img = hdulist.data * 1.
     img = img.T
 
-    wcs = WCS(hdulist.header)
-
     target_pix = wcs.wcs_world2pix([(np.array([ora, odec], np.float_))], 1)[0]
 
     # check bounds
@@ -90,16 +171,21 @@ def finder(myfile, findername, searchrad=0.2/60.):
     print(img.shape, target_pix, corner_pix, dx, int(target_pix[0])-dx,
           int(target_pix[0])+dx, int(target_pix[1])-dx, int(target_pix[1])+dx)
 
+    region = ((int(target_pix[0])-dx, int(target_pix[0])+dx),
+              (int(target_pix[1])-dx, int(target_pix[1])+dx))
     if (x < 2*dx-1) or (y < 2*dx-1):
-        imgslice_target = img[int(target_pix[0])-2*dx:int(target_pix[0])+2*dx,
-                              int(target_pix[1])-2*dx:int(target_pix[1])+2*dx]
-
-    # zmin, zmax = zscale.zscale()
-    zmin = np.percentile(imgslice_target.flatten(), 5)
-    zmax = np.percentile(imgslice_target.flatten(), 98.5)
+        region = ((int(target_pix[0])-2*dx, int(target_pix[0])+2*dx),
+                  (int(target_pix[1])-2*dx, int(target_pix[1])+2*dx))
+        imgslice_target = img[region[0][0]:region[0][1],
+                              region[1][0]:region[1][1]]
+
+    # Display limits of the (transposed) target region
+    zmin, zmax = zscale.cached_display_limits(
+        myfile, region=region, transpose=True, data=imgslice_target, lo=5,
+        hi=98.5, cache_file=limits_cache(findername))
    
     print("Min: %.1f, max: %.1f" % (zmin, zmax))
-    gc = aplpy.FITSFigure(myfile, figsize=(10, 9), north=True)
+    gc = aplpy.FITSFigure(hdulist, figsize=(10, 9), north=True)
     gc.show_grayscale(vmin=zmin, vmax=zmax, smooth=1, kernel="gauss")
     gc.add_scalebar(0.1/60.)
     gc.scalebar.set_label('10 arcsec')
@@ -127,8 +213,8 @@ def finder(myfile, findername, searchrad=0.2/60.):
     gc.add_label(ras[1]+dxs[1]*1.1, decs[1]+dys[1]*1.1, 'E', relative=False,
                  color="white", horizontalalignment="center")
 
-    img_name = fitsutils.get_par(myfile, "NAME").strip()
-    img_filter = fitsutils.get_par(myfile, "FILTER")
+    img_name = hdr.get("NAME").strip()
+    img_filter = hdr.get("FILTER")
     gc.add_label(0.05, 0.95, 'Object: %s' % img_name, relative=True,
                  color="white", horizontalalignment="left")
     gc.add_label(0.05, 0.9, 'Filter: SDSS %s' % img_filter, relative=True,
@@ -145,7 +231,10 @@ def finder(myfile, findername, searchrad=0.2/60.):
         gc.add_label(0.05, 0.70, 'FAILED ACQUISITION', relative=True,
                      color="red", horizontalalignment="left")
     
-    gc.save(findername)
+    try:
+        save_atomic(gc.save, findername)
+    finally:
+        gc.close()
     print("Created %s" % findername)
     
 
@@ -162,31 +251,29 @@ def simple_finder(myfile, findername):
     # name = fitsutils.get_par(myfile, "NAME")
     # filter = fitsutils.get_par(myfile, "FILTER")
 
-    # zmin, zmax = zscale.zscale()
-    zmin = np.percentile(newimg.flatten(), 10)
-    zmax = np.percentile(newimg.flatten(), 99)
+    zmin, zmax = zscale.cached_display_limits(
+        myfile, region=((1165, 2040), (1137, 2040)), transpose=True,
+        data=newimg, lo=10, hi=99, cache_file=limits_cache(findername))
     plt.figure(figsize=(10, 9))
     plt.imshow(newimg, origin="lower", cmap=plt.get_cmap('gray'),
                vmin=zmin, vmax=zmax)
 
-    plt.savefig(findername)
+    save_atomic(plt.savefig, findername)
+    plt.close()
 
     print("Created ", findername)
 
 
 def simple_finder_astro(myfile, findername, searchrad=28./3600):  
 
-    hdulist = pf.open(myfile)[0]
-    img = hdulist.data * 1.            
+    hdulist, wcs = get_image(myfile)
+    img = hdulist.data * 1.
 
     # name = fitsutils.get_par(myfile, "NAME")
     # filter = fitsutils.get_par(myfile, "FILTER")
 
-    ra, dec = coordinates_conversor.hour2deg(fitsutils.get_par(myfile, "OBJRA"),
-                                             fitsutils.get_par(myfile,
-                                                               "OBJDEC"))
-    
-    wcs = WCS(hdulist.header)
+    ra, dec = coordinates_conversor.hour2deg(hdulist.header.get("OBJRA"),
+                                             hdulist.header.get("OBJDEC"))
 
     target_pix = wcs.wcs_world2pix([(np.array([ra, dec], np.float_))], 1)[0]
     corner_pix = wcs.wcs_world2pix([(np.array([ra+searchrad, dec+searchrad],
@@ -200,11 +287,12 @@ def simple_finder_astro(myfile, findername, searchrad=28./3600):
     
     # size = int( (searchrad/0.394)/2)
     
-    # zmin, zmax = zscale.zscale()
-    newimg = img[targ_x-dx: targ_x+dx, targ_y-dy: targ_y+dy]
+    region = ((targ_x-dx, targ_x+dx), (targ_y-dy, targ_y+dy))
+    newimg = img[region[0][0]:region[0][1], region[1][0]:region[1][1]]
 
-    zmin = np.percentile(newimg.flatten(), 5)
-    zmax = np.percentile(newimg.flatten(), 98.5)
+    zmin, zmax = zscale.cached_display_limits(
+        myfile, region=region, data=newimg, lo=5, hi=98.5,
+        cache_file=limits_cache(findername))
     
     print("X %d Y %d Size %d, %d zmin=%.2f zmax=%.2f. Size = %s" %
           (targ_x, targ_y, dx, dy, zmin, zmax, newimg.shape))
@@ -228,35 +316,24 @@ def simple_finder_astro(myfile, findername, searchrad=28./3600):
     # plt.plot(Y, X, "+", color="r", ms=20, mfc=None, mew=2)
     # plt.xlim(Y-dy, Y+dy, X-dx, X+dx)
 
-    plt.savefig(findername)
+    save_atomic(plt.savefig, findername)
+    plt.close()
 
     print("Created ", findername)
 
     
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description="""
-    
-    Creates a finder chart for every acquisition image in the folder
-    specified as a parameter.
-    As a final step, it copies the acquisition image to the "agn" machine
-    to visualize it.
-        
-    """, formatter_class=argparse.RawTextHelpFormatter)
-    
-    parser.add_argument('-d', '--rcdir', type=str, dest="rcdir",
-                        help='Directory with rc images from tonight.',
-                        default=None)
-    parser.add_argument('-r', '--reduxdir', type=str, dest="reduxdir",
-                        help='Directory with reduced ifu images from tonight.',
-                        default=None)
-    parser.add_argument('-i', '--imfile', type=str, dest="imfile",
-                        help='IFU image that requires a finder',
-                        default=None)
-    
-    args = parser.parse_args()
+def make_finders(imfile=None, rcdir=None, reduxdir=None):
+    """Make finders for the acquisition images of a night.
+
+    Args:
+        imfile (str): ifu image: only make finders for its object
+        rcdir (str): directory with the rc images (None: tonight)
+        reduxdir (str): directory with the reduced ifu images (None: tonight)
 
-    imfile = args.imfile
+    Returns:
+        int: number of finders made
+
+    """
 
     if imfile:
         timestamp = imfile.split('/')[-2]
@@ -268,8 +345,6 @@ if __name__ == "__main__":
         if 'STD' in objnam:
             objnam = objnam.split('STD-')[-1].split()[0]
     else:
-        rcdir = args.rcdir
-        reduxdir = args.reduxdir
         objnam = None
         if rcdir is None:
             timestamp = datetime.datetime.isoformat(datetime.datetime.utcnow())
@@ -298,16 +373,16 @@ if __name__ == "__main__":
 
     for f in files:
         try:
-            ff = pf.open(f)
+            hdr = get_header(f)
         except OSError:
             print("WARNING - corrupt fits file: %s" % f)
             continue
-        if "IMGTYPE" in ff[0].header:
-            imgtype = ff[0].header["IMGTYPE"]
+        if "IMGTYPE" in hdr:
+            imgtype = hdr["IMGTYPE"]
         else:
             imgtype = ''
-        if "OBJECT" in ff[0].header:
-            obj = ff[0].header["OBJECT"]
+        if "OBJECT" in hdr:
+            obj = hdr["OBJECT"]
         else:
             obj = ''
         if (imgtype.upper() == "ACQUISITION" or "ACQ" in imgtype.upper() or
@@ -318,15 +393,16 @@ if __name__ == "__main__":
             else:
                 filesacq.append(f)
         else:
-            if 'OBJECT' in ff[0].header:
-                if 'finding' in ff[0].header['OBJECT'] and \
-                        objnam in ff[0].header['OBJECT']:
+            if 'OBJECT' in hdr:
+                if 'finding' in hdr['OBJECT'] and \
+                        objnam in hdr['OBJECT']:
                     filesacq.append(f)
 
     n_acq = len(filesacq)
     print("Found %d files for finders:\n%s" % (n_acq, filesacq))
 
     n_find = 0
+    n_made = 0
     for f in filesacq:
         n_find += 1
         print("Trying finder %d of %d: %s" % (n_find, n_acq, f))
@@ -376,35 +452,107 @@ if __name__ == "__main__":
                         if returncode != 0:
                             print("Astrometry failed for %s, "
                                   "skipping finder %s" % (dest, finderpath))
+                            set_status(reduxdir, finderplotf, "failed",
+                                       source=f, error="astrometry")
                             continue
                         returncode = subprocess.call(
                             [_srcpath+'bin/do_astrom', dest])
                     if returncode != 0:
                         print("Astrometry failed for %s, skipping finder %s" %
                               (dest, finderpath))
+                        set_status(reduxdir, finderplotf, "failed",
+                                   source=f, error="astrometry")
                         continue
                 else:
                     print("Astrometry file already exists: %s" % astrof)
                 # Check results
                 if not os.path.isfile(astrof):
                     print("Astrometry results not found %s" % astrof)
+                    set_status(reduxdir, finderplotf, "failed",
+                               source=f, error="astrometry")
                     continue
 
             print("Using astrometry in %s" % astrof)
+            set_status(reduxdir, finderplotf, "running", source=f)
+            kind = "finder"
             try:
                 finder(astrof, finderpath)
             except ValueError:
                 print("Bad astrometry for this file: %s" % astrof)
+                set_status(reduxdir, finderplotf, "failed", source=f,
+                           error="bad astrometry")
                 continue
             except AttributeError:
                 print("Error when generating the finder for file %s" % f)
                 print(sys.exc_info()[0])
+                kind = "simple"
                 simple_finder_astro(astrof, finderpath)
 
             except:
                 print("Error when generating the finder for file %s. "
                       "Probably montage is broken." % astrof)
                 print(sys.exc_info()[0])
+                kind = "simple"
                 simple_finder_astro(astrof, finderpath)
+            set_status(reduxdir, finderplotf, "done", source=f, kind=kind)
+            n_made += 1
         else:
             print("Finder already exists: %s" % finderpath)
+
+    if n_made:
+        ProdManifest.update(os.path.join(reduxdir, "finders"))
+    return n_made
+
+
+def serve(jobs):
+    """Make finders for the ifu images put on the jobs queue.
+
+    Runs until None is put on the queue.  The result of each job is
+    recorded in the finder status file of the image directory.
+
+    Args:
+        jobs (multiprocessing.Queue): queue of ifu image file names
+
+    """
+    while True:
+        imfile = jobs.get()
+        if imfile is None:
+            break
+        reduxdir = os.path.dirname(os.path.abspath(imfile))
+        job = os.path.basename(imfile)
+        set_status(reduxdir, job, "running")
+        start = time.time()
+        try:
+            nmade = make_finders(imfile=imfile)
+            set_status(reduxdir, job, "done", finders=nmade,
+                       seconds=round(time.time() - start, 1))
+        except Exception as e:
+            print("Finder job for %s failed: %s" % (imfile, e))
+            set_status(reduxdir, job, "failed", error=str(e))
+
+    
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+    
+    Creates a finder chart for every acquisition image in the folder
+    specified as a parameter.
+    As a final step, it copies the acquisition image to the "agn" machine
+    to visualize it.
+        
+    """, formatter_class=argparse.RawTextHelpFormatter)
+    
+    parser.add_argument('-d', '--rcdir', type=str, dest="rcdir",
+                        help='Directory with rc images from tonight.',
+                        default=None)
+    parser.add_argument('-r', '--reduxdir', type=str, dest="reduxdir",
+                        help='Directory with reduced ifu images from tonight.',
+                        default=None)
+    parser.add_argument('-i', '--imfile', type=str, dest="imfile",
+                        help='IFU image that requires a finder',
+                        default=None)
+    
+    args = parser.parse_args()
+
+    make_finders(imfile=args.imfile, rcdir=args.rcdir,
+                 reduxdir=args.reduxdir)
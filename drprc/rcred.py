@@ -11,7 +11,6 @@ import glob
 import shutil
 import sys
 import numpy as np
-from scipy.stats import sigmaclip
 
 import ccdproc
 
@@ -20,6 +19,7 @@ import subprocess
 import argparse
 import datetime
 import logging
+import multiprocessing
 
 try:
     import fitsutils
@@ -32,6 +32,7 @@ except ImportError:
     import drprc.rcsex as sextractor
 
 from astropy.io import fits
+from astropy.nddata import CCDData, StdDevUncertainty
 from astropy.wcs import WCS
 
 try:
@@ -43,6 +44,14 @@ try:
     import cosmics
 except ImportError:
     import drprc.cosmics as cosmics
+try:
+    import zscale
+except ImportError:
+    import drprc.zscale as zscale
+try:
+    import ProdManifest
+except ImportError:
+    import drpifu.ProdManifest as ProdManifest
 
 try:
     from target_mag import get_target_mag
@@ -65,6 +74,7 @@ _logpath = sedm_cfg['paths']['logpath']
 _photpath = sedm_cfg['paths']['photpath']
 _reduxpath = sedm_cfg['paths']['reduxpath']
 _db = sedm_cfg['persistence']['db']
+_rc_nproc = sedm_cfg.get('rc_workers', 1)
 
 FORMAT = '%(asctime)-15s %(levelname)s [%(name)s] %(message)s'
 now = datetime.datetime.utcnow()
@@ -105,7 +115,90 @@ def get_xy_coords(image, ra, dec):
     return coords
 
 
-def create_masterbias(biasdir=None, copy2refphot=False):
+def scan_headers(files, keys=("IMGTYPE", "ADCSPEED", "EXPTIME")):
+    """
+    Reads the primary header of each file once and returns the requested
+    keywords, instead of re-opening the file for each fitsutils.get_par.
+
+    Returns a dictionary {file: {key: value}}, value is None if the key is
+    missing.  Files that cannot be read are left out.
+    """
+    hdrs = {}
+    for ff in files:
+        try:
+            hdr = fits.getheader(ff, 0, ignore_missing_end=True)
+        except OSError:
+            logger.error("problems opening file %s" % ff)
+            continue
+        hdrs[ff] = {k: hdr.get(k) for k in keys}
+    return hdrs
+
+
+def _combine_strip(job):
+    """
+    Combines rows y0:y1 of the input files (multiprocessing worker).
+    """
+    files, y0, y1, kwargs = job
+    strip = []
+    for ff in files:
+        with fits.open(ff, memmap=False) as hdul:
+            strip.append(CCDData(hdul[0].section[y0:y1, :], unit='adu'))
+    comb = ccdproc.combine(strip, **kwargs)
+    if comb.uncertainty is not None:
+        unc = comb.uncertainty.array
+    else:
+        unc = None
+    return y0, y1, comb.data, comb.mask, unc
+
+
+def combine_median(files, nproc=_rc_nproc, nstrip=None, **kwargs):
+    """
+    Median combine of files with ccdproc.combine, done in strips of rows.
+
+    Each strip is read from the files (as a section, without loading the
+    whole image) and combined with ccdproc.combine(**kwargs) by a pool of
+    nproc processes.  Combining and
+    clipping are done per pixel, so the result is the same as combining the
+    whole images at once, but only a strip of each image is in memory at a
+    time.
+
+    Returns a CCDData with the header of the first file, like
+    ccdproc.combine.
+    """
+    kwargs.setdefault("method", "median")
+    combined = ccdproc.fits_ccddata_reader(filename=files[0], unit='adu')
+    ny = combined.data.shape[0]
+    if nstrip is None:
+        nstrip = max(4 * nproc, 8)
+    edges = np.linspace(0, ny, min(nstrip, ny) + 1).astype(int)
+    jobs = [(files, y0, y1, kwargs) for y0, y1 in zip(edges[:-1], edges[1:])]
+
+    data = np.zeros(combined.data.shape, dtype=np.float64)
+    mask = np.zeros(combined.data.shape, dtype=bool)
+    unc = np.zeros(combined.data.shape, dtype=np.float64)
+    have_mask = False
+    have_unc = False
+    if nproc > 1:
+        with multiprocessing.Pool(nproc) as pool:
+            strips = pool.map(_combine_strip, jobs)
+    else:
+        strips = [_combine_strip(job) for job in jobs]
+    for y0, y1, sdata, smask, sunc in strips:
+        data[y0:y1, :] = sdata
+        if smask is not None:
+            mask[y0:y1, :] = smask
+            have_mask = True
+        if sunc is not None:
+            unc[y0:y1, :] = sunc
+            have_unc = True
+
+    combined.data = data
+    combined.mask = mask if have_mask else None
+    combined.uncertainty = StdDevUncertainty(unc) if have_unc else None
+    return combined
+
+
+def create_masterbias(biasdir=None, copy2refphot=False, nproc=_rc_nproc):
     """
     Combines slow and fast readout mode biases for the specified channel.
     """
@@ -136,14 +229,15 @@ def create_masterbias(biasdir=None, copy2refphot=False):
     lslowbias = []
 
     # Select all filts that are Bias with RC
-    for ff in glob.glob("rc*[0-9].fits"):
+    hdrs = scan_headers(glob.glob("rc*[0-9].fits"))
+    for ff, hdr in hdrs.items():
         try:
-            if "BIAS" in str.upper(fitsutils.get_par(ff, "IMGTYPE").upper()):
-                if fitsutils.get_par(ff, "ADCSPEED") == 2:
+            if "BIAS" in str.upper(hdr["IMGTYPE"].upper()):
+                if hdr["ADCSPEED"] == 2:
                     lfastbias.append(ff)
                 else:
                     lslowbias.append(ff)
-        except (KeyError, OSError, AttributeError):
+        except (KeyError, AttributeError):
             pass
 
     logger.info("Files for bias SLOW mode: %s" % lslowbias)
@@ -151,10 +245,10 @@ def create_masterbias(biasdir=None, copy2refphot=False):
 
     if len(lfastbias) > 0 and dofast:
 
-        fstacked = ccdproc.combine(lfastbias, method="median",
+        fstacked = combine_median(lfastbias, nproc=nproc, method="median",
                                    sigma_clip=True,
                                    sigma_clip_low_thresh=None,
-                                   sigma_clip_high_thresh=2.0, unit='adu')
+                                   sigma_clip_high_thresh=2.0)
         fstacked.header['HISTORY'] = 'Master Bias stacked'
         fstacked.header['NSTACK'] = (len(lfastbias), 'number of images stacked')
         fstacked.header['STCKMETH'] = ("median", 'method used for stacking')
@@ -177,10 +271,10 @@ def create_masterbias(biasdir=None, copy2refphot=False):
 
     if len(lslowbias) > 0 and doslow:
 
-        sstacked = ccdproc.combine(lslowbias, method="median",
+        sstacked = combine_median(lslowbias, nproc=nproc, method="median",
                                    sigma_clip=True,
                                    sigma_clip_low_thresh=None,
-                                   sigma_clip_high_thresh=2.0, unit='adu')
+                                   sigma_clip_high_thresh=2.0)
 
         sstacked.header['HISTORY'] = 'Master Bias stacked'
         sstacked.header['NSTACK'] = (len(lslowbias), 'number of images stacked')
@@ -204,7 +298,7 @@ def create_masterbias(biasdir=None, copy2refphot=False):
 
 
 def create_masterflat(flatdir=None, biasdir=None, plot=True, twilight=False,
-                      copy2refphot=False):
+                      copy2refphot=False, nproc=_rc_nproc):
     """
     Creates a masterflat from both dome flats and sky flats if the number of
     counts in the given filter is not saturated and not too low
@@ -252,30 +346,31 @@ def create_masterflat(flatdir=None, biasdir=None, plot=True, twilight=False,
     bias_fast = "Bias_rc_fast.fits"
 
     if not os.path.isfile(bias_slow) and not os.path.isfile(bias_fast):
-        create_masterbias(biasdir)
+        create_masterbias(biasdir, nproc=nproc)
 
     lstflat = []    # list of slow twilight flat images
     lftflat = []    # list of fast twilight flat images (not currently used)
     lsdflat = []    # list of slow dome flat images
     lfdflat = []    # list of fast dome flat images
 
-    for ff in glob.glob("rc*[0-9].fits"):
+    hdrs = scan_headers(glob.glob("rc*[0-9].fits"))
+    for ff, hdr in hdrs.items():
         try:
-            if fitsutils.has_par(ff, "IMGTYPE"):
-                imtype = str.upper(fitsutils.get_par(ff, "IMGTYPE"))
+            if hdr["IMGTYPE"] is not None:
+                imtype = str.upper(hdr["IMGTYPE"])
             else:
                 continue
             if "twilight" in imtype.lower():
-                if fitsutils.get_par(ff, "ADCSPEED") == 2:
+                if hdr["ADCSPEED"] == 2:
                     lftflat.append(ff)
                 else:
                     lstflat.append(ff)
             if "dome" in imtype.lower():
-                if fitsutils.get_par(ff, "ADCSPEED") == 2:
+                if hdr["ADCSPEED"] == 2:
                     lfdflat.append(ff)
                 else:
                     lsdflat.append(ff)
-        except (OSError, KeyError):
+        except (TypeError, KeyError):
             logger.error("Error with retrieving parameters for file %s" % ff)
             pass
 
@@ -414,22 +509,20 @@ def create_masterflat(flatdir=None, biasdir=None, plot=True, twilight=False,
                 if os.path.isfile(out_norm):
                     os.remove(out_norm)
 
-                # read in flats
+                # read in flat levels
                 scales = []
-                stack = []
                 ref_mode = 1.
                 for ffl in lfiles:
-                    ccdd = ccdproc.fits_ccddata_reader(ffl)
-                    stack.append(ccdd)
-                    if len(stack) == 1:
-                        ref_mode = ccdd.header['FLMODE']
-                    scales.append(ref_mode / ccdd.header['FLMODE'])
-
-                stacked = ccdproc.combine(stack, method="median",
-                                          sigma_clip=True,
-                                          sigma_clip_low_thresh=2.,
-                                          sigma_clip_high_thresh=2.,
-                                          scale=scales)
+                    flmode = fits.getheader(ffl, 0)['FLMODE']
+                    if len(scales) == 0:
+                        ref_mode = flmode
+                    scales.append(ref_mode / flmode)
+
+                stacked = combine_median(lfiles, nproc=nproc, method="median",
+                                         sigma_clip=True,
+                                         sigma_clip_low_thresh=2.,
+                                         sigma_clip_high_thresh=2.,
+                                         scale=scales)
                 stacked.header['HISTORY'] = 'Master %s %s flat combined' % \
                                             (speed, kind)
                 stacked.header['NSTACK'] = (len(lfiles),
@@ -722,8 +815,11 @@ def clean_cosmic(fl):
     array, header = cosmics.fromfits(fl)
 
     try:
+        # Share the cores with the other reduce_images processes
+        nthreads = max(1, (os.cpu_count() or 1) // max(1, _rc_nproc))
         c = cosmics.CosmicsImage(array, gain=g, readnoise=rn, sigclip=8.0,
-                                 sigfrac=0.3, satlevel=64000.0)
+                                 sigfrac=0.3, satlevel=64000.0,
+                                 engine="fast", nthreads=nthreads)
         c.run(maxiter=3)
         out = fl.replace('.fits', '_clean.fits')
 
@@ -865,22 +961,21 @@ def plot_reduced_image(image, verbose=False, ut_id=None, to_raw=False):
         if not os.path.isdir(png_dir):
             os.makedirs(png_dir)
 
-    c, lo, hi = sigmaclip(d[np.isfinite(d)], low=2.5, high=2.5)
-    pltmn = c.mean()
-    pltstd = 100.
-    if np.isnan(pltmn):
-        pltmn = 0.
-    if c.std() > pltstd:
-        pltstd = c.std()
     if is_norm:
         pltmn = 1.
         pltstd = 0.25
+        vmin, vmax = pltmn - pltstd, pltmn + 2. * pltstd
+    else:
+        # mean - std to mean + 2 std of the 2.5 sigma clipped image
+        vmin, vmax = zscale.cached_display_limits(
+            image, data=d, method='sigclip', minstd=100.,
+            cache_file=os.path.join(png_dir, "display_limits.json"))
+        pltmn, pltstd = (2. * vmin + vmax) / 3., (vmax - vmin) / 3.
 
     if verbose:
         print("%s %s mn: %.2f, std: %.2f" % (name, filt, pltmn, pltstd))
 
-    plt.imshow(d, vmin=(pltmn-pltstd), vmax=(pltmn+2.*pltstd),
-               cmap=plt.get_cmap('Greys_r'))
+    plt.imshow(d, vmin=vmin, vmax=vmax, cmap=plt.get_cmap('Greys_r'))
     if ut_id is not None:
         plt.title("%s %s %s-band [%ds]. On target=%s" % (ut_id, name, filt,
                                                          exptime, ontarget))
@@ -899,13 +994,15 @@ def plot_reduced_image(image, verbose=False, ut_id=None, to_raw=False):
         outfile = imname.replace(".fits", ".png")
     plt.savefig(os.path.join(png_dir, outfile))
     plt.close()
+    ProdManifest.update(png_dir, outfile)
     if verbose:
         print(outfile)
 
 
 def reduce_image(image, flatdir=None, biasdir=None, cosmic=False,
                  astrometry=True, target_dir='reduced', overwrite=False,
-                 kind_use=None, speed_use=None, save_int=False):
+                 kind_use=None, speed_use=None, save_int=False,
+                 make_cals=True):
     """
     Applies Flat field and bias calibrations to the image.
 
@@ -919,6 +1016,9 @@ def reduce_image(image, flatdir=None, biasdir=None, cosmic=False,
             flat fielding on the image.
     6. - Compute the image zeropoint.
 
+    If make_cals is False, the master bias and flats are not created here
+    (see reduce_images).
+
     """
 
     logger.info("Reducing image %s" % image)
@@ -992,7 +1092,8 @@ def reduce_image(image, flatdir=None, biasdir=None, cosmic=False,
     # Compute BIAS
     if biasdir is None or biasdir == "":
         biasdir = "."
-    create_masterbias(biasdir)
+    if make_cals:
+        create_masterbias(biasdir)
 
     bias_slow = os.path.join(biasdir, "Bias_rc_slow.fits")
     bias_fast = os.path.join(biasdir, "Bias_rc_fast.fits")
@@ -1000,7 +1101,8 @@ def reduce_image(image, flatdir=None, biasdir=None, cosmic=False,
     # Compute flat field
     if flatdir is None or flatdir == "":
         flatdir = "."
-    create_masterflat(flatdir, biasdir)
+    if make_cals:
+        create_masterflat(flatdir, biasdir)
 
     # New names for the object.
     debiased = os.path.join(os.path.dirname(img), "b_" + os.path.basename(img))
@@ -1162,6 +1264,62 @@ def reduce_image(image, flatdir=None, biasdir=None, cosmic=False,
     return slice_names
 
 
+def _reduce_worker(job):
+    """
+    Reduces one image (multiprocessing worker).
+    """
+    image, kwargs = job
+    try:
+        return image, reduce_image(image, **kwargs)
+    except OSError:
+        logger.error("Error when reducing image %s" % image)
+        return image, None
+
+
+def reduce_images(images, nproc=_rc_nproc, cosmic_exptime=None, **kwargs):
+    """
+    Reduces independent images concurrently with reduce_image.
+
+    The master bias and flats are created first for each image directory,
+    then the images are reduced by a pool of nproc processes (astrometry,
+    cosmic ray removal, slicing, bias and flat calibration).  Output files
+    are the same as for reduce_image.
+
+    cosmic_exptime: if given, remove cosmic rays from images with EXPTIME
+        above this value (overrides cosmic in kwargs).
+    kwargs: passed on to reduce_image.
+
+    Returns a dictionary {image: list of reduced files or None}, in the
+    order of the input images.
+    """
+    flatdir = kwargs.get('flatdir')
+    biasdir = kwargs.get('biasdir')
+    for imdir in sorted(set(os.path.dirname(os.path.abspath(im))
+                            for im in images)):
+        create_masterbias(biasdir or imdir, nproc=nproc)
+        create_masterflat(flatdir or imdir, biasdir or imdir, nproc=nproc)
+
+    kwargs['make_cals'] = False
+    jobs = []
+    for image in images:
+        ikwargs = dict(kwargs)
+        if cosmic_exptime is not None:
+            exptime = fitsutils.get_par(image, "EXPTIME")
+            ikwargs['cosmic'] = exptime is not None and \
+                exptime > cosmic_exptime
+        jobs.append((image, ikwargs))
+
+    if nproc > 1 and len(jobs) > 1:
+        logger.info("Reducing %d images with %d processes" % (len(jobs),
+                                                              nproc))
+        with multiprocessing.Pool(min(nproc, len(jobs))) as pool:
+            results = pool.map(_reduce_worker, jobs, chunksize=1)
+    else:
+        results = [_reduce_worker(job) for job in jobs]
+
+    return dict(results)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="""
 
@@ -1198,6 +1356,9 @@ if __name__ == '__main__':
                         default=False)
     parser.add_argument('--cosmic', action="store_true", default=False,
                         help='Whether cosmic rays should be removed.')
+    parser.add_argument('--nproc', type=int, default=_rc_nproc,
+                        help='Number of images to reduce in parallel '
+                             '(%d)' % _rc_nproc)
 
     args = parser.parse_args()
 
@@ -1243,18 +1404,17 @@ if __name__ == '__main__':
     mydir = os.path.abspath(photdir)
     timestamp = os.path.basename(mydir)
     # Gather all RC fits files in the folder with the keyword IMGTYPE=SCIENCE
-    for f in glob.glob(os.path.join(mydir, "rc%s_??_??_??.fits" % timestamp)):
-        try:
-            if (fitsutils.has_par(f, "IMGTYPE") and
-                    ((fitsutils.get_par(f, "IMGTYPE").upper() == "SCIENCE") or (
-                        "ACQ" in fitsutils.get_par(f, "IMGTYPE").upper()))):
-                myfiles.append(f)
-        except (OSError, KeyError):
-            logger.error("problems opening file %s" % f)
-
-    create_masterbias(mydir)
+    hdrs = scan_headers(glob.glob(os.path.join(mydir, "rc%s_??_??_??.fits" %
+                                               timestamp)))
+    for f, hdr in hdrs.items():
+        if hdr["IMGTYPE"] is not None and \
+                (hdr["IMGTYPE"].upper() == "SCIENCE" or
+                 "ACQ" in hdr["IMGTYPE"].upper()):
+            myfiles.append(f)
+
+    create_masterbias(mydir, nproc=args.nproc)
     # logger.info("Create masterflat", mydir)
-    create_masterflat(mydir)
+    create_masterflat(mydir, nproc=args.nproc)
 
     if len(myfiles) == 0:
         logger.warning("Found no files to process")
@@ -1265,40 +1425,38 @@ if __name__ == '__main__':
     # Reduce them
     phot_zp = {'u': None, 'g': None, 'r': None, 'i': None}
     reducedfiles = []
+    toreduce = []
     for f in myfiles:
         logger.info(f)
         # make_mask_cross(f)
         if (fitsutils.has_par(f, "IMGTYPE") and
                 (fitsutils.get_par(f, "IMGTYPE").upper() == "SCIENCE" or (
                     "ACQUI" in fitsutils.get_par(f, "IMGTYPE").upper()))):
-            if args.cosmic:
-                if fitsutils.get_par(f, "EXPTIME") > 30.:
-                    do_cosmic = True
-                else:
-                    do_cosmic = False
-            else:
-                do_cosmic = False
-            try:
-                reduced = reduce_image(f, cosmic=do_cosmic,
-                                       kind_use='twilight', speed_use='slow',
-                                       overwrite=args.overwrite)
-                for rf in reduced:
-                    if fitsutils.get_par(rf, "ONTARGET"):
-                        target_object = fitsutils.get_par(rf, "OBJECT")
-                        target_filter = target_object.split()[-1]
-                        target_name = target_object.split()[0]
-                        logger.info("Getting quick %s-band mag for %s in %s"
-                                    % (target_filter, target_name, rf))
-                        target_mag, target_magerr, std_zp = get_target_mag(rf, zeropoint=phot_zp)
-                        # logger.info("Quick MAG = %.3f +- %.3f" % (target_mag, target_magerr))
-                        if std_zp is not None:
-                            logger.info("Quick MAG_ZP: %.3f" % std_zp)
-                            if phot_zp[target_filter] is None:
-                                phot_zp[target_filter] = std_zp
-                reducedfiles.extend(reduced)
-            except OSError:
-                logger.error("Error when reducing image %s" % f)
-                pass
+            toreduce.append(f)
+
+    allreduced = reduce_images(toreduce, nproc=args.nproc,
+                               cosmic_exptime=30. if args.cosmic else None,
+                               kind_use='twilight', speed_use='slow',
+                               overwrite=args.overwrite)
+    # Quick photometry in order, to pass on the zeropoints
+    for f in toreduce:
+        reduced = allreduced[f]
+        if reduced is None:
+            continue
+        for rf in reduced:
+            if fitsutils.get_par(rf, "ONTARGET"):
+                target_object = fitsutils.get_par(rf, "OBJECT")
+                target_filter = target_object.split()[-1]
+                target_name = target_object.split()[0]
+                logger.info("Getting quick %s-band mag for %s in %s"
+                            % (target_filter, target_name, rf))
+                target_mag, target_magerr, std_zp = get_target_mag(rf, zeropoint=phot_zp)
+                # logger.info("Quick MAG = %.3f +- %.3f" % (target_mag, target_magerr))
+                if std_zp is not None:
+                    logger.info("Quick MAG_ZP: %.3f" % std_zp)
+                    if phot_zp[target_filter] is None:
+                        phot_zp[target_filter] = std_zp
+        reducedfiles.extend(reduced)
 
     # If copy is requested, then we copy the whole folder or just the
     # missing files to transient.
@@ -8,8 +8,10 @@ Updated on Thu Feb  6 2020 by neill
 
 import os
 import shutil
+import tempfile
 import subprocess
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits as pf
 from astropy.io import ascii
 
@@ -34,6 +36,7 @@ with open(configfile) as config_file:
     sedm_cfg = json.load(config_file)
 
 _focuspath = sedm_cfg['paths']['focuspath']
+_sex_nproc = sedm_cfg.get('sex_workers', 1)
 
 rootdir = _focuspath
 
@@ -41,50 +44,92 @@ if not (os.path.isdir(rootdir)):
     rootdir = "/tmp"
 
 
-def run_sex(flist, mask=False, cosmics=False, overwrite=False):
-    
-    d = os.path.dirname(flist[0])
-    if d == "":
-        d = "."
-    os.chdir(d)
-
-    # Create the directory where the sextracted images are going to go.
-    sexdir = os.path.join(d, "sextractor")    
-    if not os.path.isdir(sexdir):
-        os.makedirs(sexdir)
-        
-    newlist = []
+def sex_catalog(ff):
+    """Return the sextractor catalog name for image ff"""
+    d = os.path.dirname(os.path.abspath(ff))
+    return os.path.join(d, "sextractor",
+                        os.path.basename(ff).replace(".fits", ".sex"))
+
+
+def _sex_one(ff, newimage):
+    """Run sextractor on ff in a private working directory.
+
+    The catalog is written to a private name and moved into place when
+    complete, so several instances can run at the same time.
+
+    Returns:
+        str: newimage, or None if sextractor failed
+
+    """
+    sexdir = os.path.dirname(newimage)
+    wdir = tempfile.mkdtemp(prefix="sex_", dir=sexdir)
+    try:
+        catalog = os.path.join(wdir, "image.sex")
+        cmd = ["sex", "-c", "%s/config/daofind.sex" % os.environ["SEDMPY"],
+               ff, "-CATALOG_NAME", catalog]
+        print(" ".join(cmd))
+        subprocess.call(cmd, cwd=wdir)
+        if not os.path.isfile(catalog):
+            print("sextractor produced no catalog for", ff)
+            return None
+        os.replace(catalog, newimage)
+    finally:
+        shutil.rmtree(wdir, ignore_errors=True)
+    return newimage
+
+
+def run_sex(flist, mask=False, cosmics=False, overwrite=False,
+            nproc=_sex_nproc):
+    """Run sextractor on a list of images.
+
+    Catalogs are written to the sextractor subdirectory of each image
+    directory.  Up to nproc instances of sextractor are run at a time.
+
+    Returns:
+        list: catalogs, in the order of flist (failed images are left out)
+
+    """
+
+    jobs = []
     for ff in flist:
-        newimage = os.path.join(sexdir, os.path.basename(ff).replace(".fits",
-                                                                     ".sex"))
+        ff = os.path.abspath(ff)
+        newimage = sex_catalog(ff)
+        # Create the directory where the sextracted images are going to go.
+        sexdir = os.path.dirname(newimage)
+        if not os.path.isdir(sexdir):
+            os.makedirs(sexdir, exist_ok=True)
 
         if os.path.isfile(newimage) and not overwrite:
-            newlist.append(newimage)
             print("Sextracted image %s already exists." % newimage)
-        else:
-            try:
-                ff = os.path.abspath(ff)
-                if mask:
-                    print("Mask no longer implemented.")
-                    out = ff
-                else:
-                    out = ff
-                    
-                if cosmics and (not fitsutils.has_par(out, "CRREJ") or
-                                fitsutils.get_par(out, "CRREJ") == 0):
-                    print("sextractor cosmic ray cleaning not implemented")
-                    out = ff
-    
-                cmd = "sex -c %s/config/daofind.sex %s" % (os.environ["SEDMPY"],
-                                                           out)
-                subprocess.call(cmd, shell=True)
-                print(cmd)
-                shutil.move("image.sex", newimage)
-                newlist.append(newimage)
-            except IOError:
-                print("IOError detected reading file", ff)
-                pass
-        
+            jobs.append((None, newimage))
+            continue
+        try:
+            if mask:
+                print("Mask no longer implemented.")
+            if cosmics and (not fitsutils.has_par(ff, "CRREJ") or
+                            fitsutils.get_par(ff, "CRREJ") == 0):
+                print("sextractor cosmic ray cleaning not implemented")
+        except IOError:
+            print("IOError detected reading file", ff)
+            continue
+        jobs.append((ff, newimage))
+
+    todo = [job for job in jobs if job[0] is not None]
+    nproc = max(1, min(nproc, len(todo)))
+    if nproc > 1:
+        with ThreadPoolExecutor(max_workers=nproc) as executor:
+            done = list(executor.map(lambda job: _sex_one(*job), todo))
+    else:
+        done = [_sex_one(*job) for job in todo]
+    results = dict(zip([job[0] for job in todo], done))
+
+    newlist = []
+    for ff, newimage in jobs:
+        if ff is None:
+            newlist.append(newimage)
+        elif results[ff] is not None:
+            newlist.append(results[ff])
+
     return newlist
 
 
@@ -600,21 +645,22 @@ def analyse_image(sexfile, arcsecpix=0.394, is_rccam=True):
     return nsources, fwhm, ellipticity, bkg
 
 
-def get_focus(lfiles, plot=True, interactive=False):
+def get_focus(lfiles, plot=True, interactive=False, nproc=_sex_nproc):
     """
     Receives a list of focus files and returns the best focus value.
 
     """
-    sexfiles = run_sex(lfiles)
+    sexfiles = run_sex(lfiles, nproc=nproc)
     focus, sigma = analyse_sex(sexfiles, plot=plot, interactive=interactive)
     return focus, sigma
 
 
-def get_focus_ifu(lfiles, plot=True, debug=False, interactive=False):
+def get_focus_ifu(lfiles, plot=True, debug=False, interactive=False,
+                  nproc=_sex_nproc):
     """
     Receives a list of focus ifu files and returns the best focus.
     """
-    sexfiles = run_sex(lfiles)
+    sexfiles = run_sex(lfiles, nproc=nproc)
     res = analyse_sex_ifu(sexfiles, plot=plot, debug=debug,
                           interactive=interactive)
     
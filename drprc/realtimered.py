@@ -53,6 +53,7 @@ with open(configfile) as config_file:
 
 _logpath = sedm_cfg['paths']['logpath']
 _photpath = sedm_cfg['paths']['photpath']
+_rc_nproc = sedm_cfg.get('rc_workers', 1)
 
 SLACK_CHANNEL = "pysedm-report"
 
@@ -264,10 +265,11 @@ def plot_raw_image(image, verbose=False, ut_id=None):
 
 
 def reduce_on_the_fly(photdir, nocopy=False, proc_na=False, do_phot=False,
-                      local=False, one_pass=False):
+                      local=False, one_pass=False, nproc=_rc_nproc):
     """
     Waits for new images to appear in the directory to trigger their
-    incremental reduction as well.
+    incremental reduction as well.  New images that arrive together are
+    reduced in parallel by nproc processes (see rcred.reduce_images).
     """
 
     # Current time to check against sun_rise
@@ -403,27 +405,45 @@ def reduce_on_the_fly(photdir, nocopy=False, proc_na=False, do_phot=False,
             new.sort()
             logger.info("Detected %d new incoming files in the last 30s." %
                         len(new))
+            # Read headers once
+            hdrs = rcred.scan_headers(new, keys=("IMGTYPE", "REQ_ID",
+                                                 "EXPTIME"))
+            toreduce = []
             for n in new:
                 # Make sure imgtype is available
-                if not fitsutils.has_par(n, "IMGTYPE"):
+                if n not in hdrs or hdrs[n]["IMGTYPE"] is None:
                     print("Image", n, "Does not have an IMGTYPE")
                     time.sleep(0.5)
-                    if not fitsutils.has_par(n, "IMGTYPE"):
+                    hdrs.update(rcred.scan_headers([n], keys=("IMGTYPE",
+                                                              "REQ_ID",
+                                                              "EXPTIME")))
+                    if n not in hdrs or hdrs[n]["IMGTYPE"] is None:
                         print("Image", n, "STILL Does not have an IMGTYPE")
+                        hdrs.pop(n, None)
                         continue
                 # Make a plot of image
-                imtype = fitsutils.get_par(n, "IMGTYPE")
-                req_id = fitsutils.get_par(n, "REQ_ID")
+                imtype = hdrs[n]["IMGTYPE"]
                 imname = os.path.basename(n).replace(".fits", "")
                 utid = "_".join(imname.split("_")[1:])
                 plot_raw_image(n, ut_id=utid)
+                if "SCIENCE" in imtype.upper() or "ACQ" in imtype.upper() or \
+                        "STANDARD" in imtype.upper() or \
+                        "POINTING" in imtype.upper() or \
+                        ("NA" in imtype.upper() and proc_na):
+                    toreduce.append(n)
+
+            # Reduce them all at once
+            allreduced = rcred.reduce_images(toreduce, nproc=nproc,
+                                             cosmic_exptime=30.)
+
+            for n in toreduce:
+                imtype = hdrs[n]["IMGTYPE"]
+                req_id = hdrs[n]["REQ_ID"]
+                reduced = allreduced[n]
+                if reduced is None:
+                    reduced = []
                 if "SCIENCE" in imtype.upper() or "ACQ" in imtype.upper() or \
                         "STANDARD" in imtype.upper():
-                    if fitsutils.get_par(n, "EXPTIME") > 30.:
-                        do_cosmic = True
-                    else:
-                        do_cosmic = False
-                    reduced = rcred.reduce_image(n, cosmic=do_cosmic)
                     # perform quick photometry if requested
                     if do_phot:
                         for rf in reduced:
@@ -491,11 +511,6 @@ def reduce_on_the_fly(photdir, nocopy=False, proc_na=False, do_phot=False,
                         else:
                             print('Local mode: not updating fritz')
                 elif "POINTING" in imtype.upper():
-                    if fitsutils.get_par(n, "EXPTIME") > 30.:
-                        do_cosmic = True
-                    else:
-                        do_cosmic = False
-                    reduced = rcred.reduce_image(n, cosmic=do_cosmic)
                     for r in reduced:
                         # push to slack
                         png_dir = os.path.dirname(r) + '/png/'
@@ -510,12 +525,6 @@ def reduce_on_the_fly(photdir, nocopy=False, proc_na=False, do_phot=False,
                                                  channel=SLACK_CHANNEL)
                         else:
                             print("Cannot push: %s" % imgf)
-                elif "NA" in imtype.upper() and proc_na:
-                    if fitsutils.get_par(n, "EXPTIME") > 30.:
-                        do_cosmic = True
-                    else:
-                        do_cosmic = False
-                    _ = rcred.reduce_image(n, cosmic=do_cosmic)
         # Check for focus plots
         focus_plots = glob.glob(os.path.join(photdir, "rcfocus*.png"))
         for fp in focus_plots:
@@ -555,6 +564,9 @@ if __name__ == '__main__':
                         help='process locally', default=False)
     parser.add_argument('-o', '--one_pass', action="store_true",
                         help='make only one pass through images', default=False)
+    parser.add_argument('--nproc', type=int, default=_rc_nproc,
+                        help='Number of images to reduce in parallel '
+                             '(%d)' % _rc_nproc)
 
     args = parser.parse_args()
 
@@ -571,7 +583,8 @@ if __name__ == '__main__':
     logger.info("Reducing RC data in %s", phot_dir)
 
     reduce_on_the_fly(phot_dir, nocopy=args.nocopy, proc_na=args.proc_na,
-                      local=args.local, one_pass=args.one_pass)
+                      local=args.local, one_pass=args.one_pass,
+                      nproc=args.nproc)
 
     ntopgz, nredgz = gzip_fits_files(phot_dir)
     logger.info("Gzipped %d top-level and %d reduced fits files" %
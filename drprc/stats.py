@@ -8,10 +8,6 @@ import datetime
 import glob
 import os
 
-try:
-    import fitsutils
-except ImportError:
-    import drprc.fitsutils as fitsutils
 try:
     import coordinates_conversor as cc
 except ImportError:
@@ -48,77 +44,191 @@ _photpath = sedm_cfg['paths']['photpath']
 plt.switch_backend('Agg')
 
 
+# Columns of the stats sidecar (one record per examined file)
+stats_dtype = np.dtype([
+    ('path', 'U160'), ('mtime', 'f8'), ('ok', '?'), ('obj', 'U64'),
+    ('jd', 'f8'), ('ns', 'i4'), ('fwhm', 'f4'), ('ellipticity', 'f4'),
+    ('bkg', 'f4'), ('airmass', 'f4'), ('in_temp', 'f4'), ('imtype', 'U16'),
+    ('out_temp', 'f4'), ('in_hum', 'f4'), ('focpos', 'f4')])
+
+
+def sidecar_file(statfile):
+    """Return the sidecar file for stats log statfile"""
+    return os.path.splitext(statfile)[0] + ".npy"
+
+
+def load_sidecar(statfile, mmap_mode=None):
+    """Load the stats sidecar of statfile.
+
+    Args:
+        statfile (str): stats log (like <photdir>/stats/stats.log)
+        mmap_mode (str): passed on to np.load (use 'r' for read only access)
+
+    Returns:
+        numpy record array with stats_dtype (empty if there is no sidecar)
+
+    """
+    try:
+        data = np.load(sidecar_file(statfile), mmap_mode=mmap_mode)
+        if data.dtype == stats_dtype:
+            return data
+        print("Sidecar %s has an old format, rebuilding" %
+              sidecar_file(statfile))
+    except (OSError, ValueError):
+        pass
+    return np.zeros(0, dtype=stats_dtype)
+
+
+def _save_sidecar(statfile, data):
+    """Write the stats sidecar of statfile atomically"""
+    tmp = sidecar_file(statfile) + ".tmp%d" % os.getpid()
+    with open(tmp, "wb") as out:
+        np.save(out, data)
+    os.replace(tmp, sidecar_file(statfile))
+
+
+def _fmt_val(val, fmt):
+    """Format a weather value, flagging missing values as nan"""
+    if np.isnan(val):
+        return 'nan'
+    return fmt % val
+
+
+def stats_line(rec):
+    """Format one sidecar record as a stats.log line"""
+    return "%s,%s,%.5f,%d,%.2f,%.3f,%.3f,%.2f,%s,%s,%s,%s,%.2f\n" % (
+        rec['path'], rec['obj'], rec['jd'], rec['ns'], rec['fwhm'],
+        rec['ellipticity'], rec['bkg'], rec['airmass'],
+        _fmt_val(rec['in_temp'], '%.1f'), rec['imtype'],
+        _fmt_val(rec['out_temp'], '%.2f'), _fmt_val(rec['in_hum'], '%.2f'),
+        rec['focpos'])
+
+
+def _use_imtype(imtype):
+    """Are stats kept for images of type imtype?"""
+    return ("ACQ" in imtype or imtype == "SCIENCE" or
+            imtype == "FOCUS" or imtype == "GUIDER")
+
+
+def _get_file_stats(ff, hd, sf, rec):
+    """Fill sidecar record rec for image ff with sextractor catalog sf"""
+    try:
+        # get observation parameters
+        rec['jd'] = hd["JD"]
+        rec['obj'] = hd["OBJECT"]
+        rec['airmass'] = hd["AIRMASS"]
+        # get weather values
+        for key, col in (("IN_AIR", 'in_temp'), ("OUT_AIR", 'out_temp'),
+                         ("IN_HUM", 'in_hum')):
+            rec[col] = np.nan if hd[key] < -99 else hd[key]
+        rec['focpos'] = hd["FOCPOS"]
+        # get image stats
+        rec['ns'], rec['fwhm'], rec['ellipticity'], rec['bkg'] = \
+            sextractor.analyze_img(sf)
+        rec['ok'] = True
+    except Exception as e:
+        print("Error when retrieving the stats parameters from the "
+              "header of file %s.\n Error %s" % (ff, e))
+
+
 def get_sextractor_stats(files):
-    
-    files.sort()
-    sexfiles = [os.path.join(os.path.join(os.path.dirname(ff), "sextractor"),
-                             os.path.basename(ff).replace(".fits.gz", ".sex")) if ".gz" in ff else
-                os.path.join(os.path.join(os.path.dirname(ff), "sextractor"),
-                             os.path.basename(ff).replace(".fits", ".sex"))
-                for ff in files]
-    sexfiles.sort()
-
-    if not os.path.isdir(os.path.join(os.path.dirname(files[0]), "stats")):
-        os.makedirs(os.path.join(os.path.dirname(files[0]), "stats"))
-
-    with open(os.path.join(os.path.dirname(files[0]),
-                           "stats/stats.log"), "w") as out:
-        for i, ff in enumerate(files):
-            try:
-                if fitsutils.has_par(ff, "IMGTYPE"):
-                    imtype = fitsutils.get_par(ff, "IMGTYPE")
-                    imtype = imtype.upper()
-                else:
-                    imtype = "NONE"
-
-                if not ("ACQ" in imtype or imtype == "SCIENCE" or
-                        imtype == "FOCUS" or imtype == "GUIDER"):
-                    continue 
-
-                sflist = []
-                if not os.path.isfile(sexfiles[i]):
-                    sflist = sextractor.run_sex([ff])
-                if sflist and len(sflist) > 0:
-                    sf = sflist[0]
-                else:
-                    sf = sexfiles[i]
-
-                hd = pf.open(ff)[0].header
-                try:
-                    # get observation parameters
-                    jd = hd["JD"]
-                    obj = hd["OBJECT"]
-                    airmass = hd["AIRMASS"]
-                    in_temp = hd["IN_AIR"]
-                    out_temp = hd["OUT_AIR"]
-                    in_hum = hd["IN_HUM"]
-                    foc_pos = hd["FOCPOS"]
-                    # get weather string (includes imtype)
-                    weather_string = ''
-                    if in_temp < -99:
-                        weather_string += 'nan,'
-                    else:
-                        weather_string += '%.1f,' % in_temp
-                    weather_string += imtype
-                    if out_temp < -99:
-                        weather_string += ',nan,'
-                    else:
-                        weather_string += ',%.2f,' % out_temp
-                    if in_hum < -99:
-                        weather_string += 'nan'
-                    else:
-                        weather_string += '%.2f' % in_hum
-                    # get image stats
-                    ns, fwhm, ellipticity, bkg = sextractor.analyze_img(sf)
-                    out.write(
-                        "%s,%s,%.5f,%d,%.2f,%.3f,%.3f,%.2f,%s,%.2f\n"
-                        % (os.path.abspath(ff), obj, jd, ns, fwhm, ellipticity,
-                           bkg, airmass, weather_string, foc_pos))
-                except Exception as e:
-                    print("Error when retrieving the stats parameters from the "
-                          "header of file %s.\n Error %s" % (ff, e))
-            except IOError:
-                print("Error when opening file %s" % ff)
+    """Update the stats log of the directory of files.
+
+    The stats log (<dir>/stats/stats.log) is only appended to: each image is
+    examined once per modification time and the results are kept in a
+    sidecar record array (<dir>/stats/stats.npy) that can be memory mapped
+    by the web pages.  The log is only rewritten when an image already in it
+    has been modified since.
+
+    Args:
+        files (list): rc images in one directory
+
+    Returns:
+        int: number of images added to the stats log
+
+    """
+    files = sorted([os.path.abspath(ff) for ff in files])
+    statdir = os.path.join(os.path.dirname(files[0]), "stats")
+    if not os.path.isdir(statdir):
+        os.makedirs(statdir)
+    statfile = os.path.join(statdir, "stats.log")
+
+    old = load_sidecar(statfile)
+    seen = {p: (i, mt) for i, (p, mt) in enumerate(zip(old['path'],
+                                                         old['mtime']))}
+    # No sidecar yet, or log out of step with it (e.g. removed by hand)?
+    rewrite = len(old) == 0 or (not os.path.isfile(statfile) and
+                                np.any(old['ok']))
+
+    todo = []
+    for ff in files:
+        try:
+            mtime = os.path.getmtime(ff)
+        except OSError:
+            print("Error when opening file %s" % ff)
+            continue
+        if ff in seen and seen[ff][1] == mtime:
+            continue
+        todo.append((ff, mtime))
+    if not todo and not rewrite:
+        return 0
+
+    new = np.zeros(len(todo), dtype=stats_dtype)
+    keep = np.ones(len(todo), dtype=bool)
+    hdrs = {}
+    sexfiles = {}
+    need_sex = []
+    for i, (ff, mtime) in enumerate(todo):
+        new[i]['path'] = ff
+        new[i]['mtime'] = mtime
+        try:
+            hd = pf.getheader(ff, 0)
+        except IOError:
+            print("Error when opening file %s" % ff)
+            # try again next time
+            keep[i] = False
+            continue
+        new[i]['imtype'] = str(hd.get("IMGTYPE", "NONE")).upper()
+        if not _use_imtype(new[i]['imtype']):
+            continue
+        hdrs[ff] = hd
+        sf = os.path.join(os.path.dirname(ff), "sextractor",
+                          os.path.basename(ff).replace(".fits.gz", ".sex")
+                          if ".gz" in ff else
+                          os.path.basename(ff).replace(".fits", ".sex"))
+        sexfiles[ff] = sf
+        # Catalog older than the image?
+        if not os.path.isfile(sf) or os.path.getmtime(sf) < mtime:
+            need_sex.append(ff)
+    if need_sex:
+        sextractor.run_sex(need_sex, overwrite=True)
+
+    for rec in new:
+        if rec['path'] in hdrs:
+            _get_file_stats(rec['path'], hdrs[rec['path']],
+                            sexfiles[rec['path']], rec)
+    new = new[keep]
+
+    # Replace records of modified images
+    replaced = [seen[p][0] for p in new['path'] if p in seen]
+    if replaced:
+        rewrite = rewrite or np.any(old['ok'][replaced])
+        old = np.delete(old, replaced)
+    data = np.concatenate([old, new])
+    data = data[np.argsort(data['path'], kind='stable')]
+
+    if rewrite:
+        lines = data[data['ok']]
+        mode = "w"
+    else:
+        lines = new[new['ok']]
+        mode = "a"
+    with open(statfile, mode) as out:
+        for rec in lines:
+            out.write(stats_line(rec))
+    _save_sidecar(statfile, data)
+
+    return int(np.sum(new['ok']))
 
 
 def plot_stats(statfile):
@@ -230,5 +340,6 @@ if __name__ == '__main__':
     rclist = glob.glob(os.path.join(os.path.abspath(photdir), "rc*[0-9].fit*"))
     print("Running stats on %d rc images in %s" % (len(rclist), photdir))
     if len(rclist) > 0:
-        get_sextractor_stats(rclist)
+        nadd = get_sextractor_stats(rclist)
+        print("Added %d images to stats log" % nadd)
         plot_stats(os.path.join(os.path.abspath(photdir), "stats/stats.log"))
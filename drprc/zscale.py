@@ -1,3 +1,5 @@
+import os
+import json
 import math
 import numpy
 
@@ -8,6 +10,9 @@ BAD_PIXEL = 1
 KREJ = 2.5
 MAX_ITERATIONS = 5
 
+# Display limits computed so far: key -> [zmin, zmax]
+_limits_cache = {}
+
 
 def zscale(image, nsamples=1000, contrast=0.25):
     """Implement IRAF zscale algorithm
@@ -19,12 +24,14 @@ def zscale(image, nsamples=1000, contrast=0.25):
 
     # Sample the image
     samples = zsc_sample(image, nsamples)
+    samples = numpy.sort(samples[numpy.isfinite(samples)])
     npix = len(samples)
-    samples.sort()
+    if npix == 0:
+        return numpy.nan, numpy.nan
     zmin = samples[0]
     zmax = samples[-1]
     # For a zero-indexed array
-    center_pixel = (npix - 1) / 2
+    center_pixel = (npix - 1) // 2
     if npix % 2 == 1:
         median = samples[center_pixel]
     else:
@@ -66,19 +73,20 @@ def zsc_fit_line(samples, npix, krej, ngrow, maxiter):
 
     #
     # First re-map indices from -1.0 to 1.0
-    xscale = 2.0 / (npix - 1)
-    xnorm = numpy.arange(npix)
-    xnorm = xnorm * xscale - 1.0
+    xscale = 2.0 / max(1, npix - 1)
+    xnorm = numpy.arange(npix) * xscale - 1.0
+    samples = numpy.asarray(samples, dtype=float)
 
     ngoodpix = npix
     minpix = max(MIN_NPIXELS, int(npix*MAX_REJECT))
     last_ngoodpix = npix + 1
 
-    # This is the mask used in k-sigma clipping.  0 is good, 1 is bad
-    badpix = numpy.zeros(npix, dtype="int32")
+    # Mask used in k-sigma clipping: True is good
+    good = numpy.ones(npix, dtype=bool)
+    kernel = numpy.ones(ngrow, dtype="int32")
 
     #
-    #  Iterate
+    #  Iterate (at most maxiter times)
     intercept = 0.
     slope = 0.
 
@@ -86,45 +94,37 @@ def zsc_fit_line(samples, npix, krej, ngrow, maxiter):
 
         if (ngoodpix >= last_ngoodpix) or (ngoodpix < minpix):
             break
-        
-        # Accumulate sums to calculate straight line fit
-        goodpixels = numpy.where(badpix == GOOD_PIXEL)
-        sumx = xnorm[goodpixels].sum()
-        sumxx = (xnorm[goodpixels]*xnorm[goodpixels]).sum()
-        sumxy = (xnorm[goodpixels]*samples[goodpixels]).sum()
-        sumy = samples[goodpixels].sum()
-        sumn = len(goodpixels[0])
+
+        # Straight line fit to the good pixels
+        xg = xnorm[good]
+        yg = samples[good]
+        sumn = len(xg)
+        sumx = xg.sum()
+        sumxx = numpy.dot(xg, xg)
+        sumxy = numpy.dot(xg, yg)
+        sumy = yg.sum()
 
         delta = sumn * sumxx - sumx * sumx
         # Slope and intercept
         intercept = (sumxx * sumy - sumx * sumxy) / delta
         slope = (sumn * sumxy - sumx * sumy) / delta
-        
+
         # Subtract fitted line from the data array
-        fitted = xnorm*slope + intercept
-        flat = samples - fitted
+        flat = samples - (xnorm*slope + intercept)
 
         # Compute the k-sigma rejection threshold
-        ngoodpix, mean, sigma = zsc_compute_sigma(flat, badpix)
+        ngoodpix, mean, sigma = zsc_compute_sigma(flat, good)
+        if sigma is None:
+            break
 
+        # Reject pixels further than k*sigma from the fitted line, and
+        # grow the rejected regions by ngrow
         threshold = sigma * krej
+        bad = numpy.abs(flat) > threshold
+        bad |= ~good
+        good = numpy.convolve(bad, kernel, mode='same') == 0
 
-        # Detect and reject pixels further than k*sigma from the fitted line
-        lcut = -threshold
-        hcut = threshold
-        below = numpy.where(flat < lcut)
-        above = numpy.where(flat > hcut)
-
-        badpix[below] = BAD_PIXEL
-        badpix[above] = BAD_PIXEL
-        
-        # Convolve with a kernel of length ngrow
-        kernel = numpy.ones(ngrow, dtype="int32")
-        badpix = numpy.convolve(badpix, kernel, mode='same')
-
-        ngoodpix = len(numpy.where(badpix == GOOD_PIXEL)[0])
-        
-        niter += 1
+        ngoodpix = int(good.sum())
 
     # Transform the line coefficients back to the X range [0:npix-1]
     zstart = intercept - slope
@@ -136,20 +136,23 @@ def zsc_fit_line(samples, npix, krej, ngrow, maxiter):
 def zsc_compute_sigma(flat, badpix):
 
     # Compute the rms deviation from the mean of a flattened array.
-    # Ignore rejected pixels
+    # Ignore rejected pixels (badpix is either the good pixel boolean mask
+    # or an integer mask with GOOD_PIXEL for good pixels)
+    if badpix.dtype == bool:
+        good = flat[badpix]
+    else:
+        good = flat[badpix == GOOD_PIXEL]
 
-    # Accumulate sum and sum of squares
-    goodpixels = numpy.where(badpix == GOOD_PIXEL)
-    sumz = flat[goodpixels].sum()
-    sumsq = (flat[goodpixels]*flat[goodpixels]).sum()
-    ngoodpix = len(goodpixels[0])
+    ngoodpix = len(good)
     if ngoodpix == 0:
         mean = None
         sigma = None
     elif ngoodpix == 1:
-        mean = sumz
+        mean = good.sum()
         sigma = None
     else:
+        sumz = good.sum()
+        sumsq = numpy.dot(good, good)
         mean = sumz / ngoodpix
         temp = sumsq / (ngoodpix - 1) - sumz*sumz / (ngoodpix * (ngoodpix - 1))
         if temp < 0:
@@ -158,3 +161,155 @@ def zsc_compute_sigma(flat, badpix):
             sigma = math.sqrt(temp)
 
     return ngoodpix, mean, sigma
+
+
+def percentiles(data, pcts, nsamples=None):
+    """Linearly interpolated percentiles of the finite values of data.
+
+    Same as numpy.percentile, but only partially sorts the data.
+
+    Args:
+        data (numpy array): image or cut-out
+        pcts (list): percentiles (0 - 100)
+        nsamples (int): if given, only use (about) this many pixels,
+            sampled on a regular grid
+
+    Returns:
+        numpy array: the percentiles
+    """
+    data = numpy.asarray(data)
+    if nsamples is not None and data.ndim == 2:
+        data = zsc_sample(data, nsamples)
+    vals = data.ravel()
+    vals = vals[numpy.isfinite(vals)]
+    if len(vals) == 0:
+        return numpy.full(len(pcts), numpy.nan)
+    pos = numpy.asarray(pcts, dtype=float) / 100. * (len(vals) - 1)
+    lo = numpy.floor(pos).astype(int)
+    hi = numpy.minimum(lo + 1, len(vals) - 1)
+    part = numpy.partition(vals, numpy.union1d(lo, hi))
+    frac = pos - lo
+    return part[lo] * (1. - frac) + part[hi] * frac
+
+
+def sigclip_stats(data, low=2.5, high=2.5):
+    """Mean and standard deviation of the sigma clipped finite values"""
+    c = numpy.asarray(data, dtype=float).ravel()
+    c = c[numpy.isfinite(c)]
+    delta = 1
+    while delta and c.size:
+        c_std = c.std()
+        c_mean = c.mean()
+        size = c.size
+        c = c[(c >= c_mean - c_std * low) & (c <= c_mean + c_std * high)]
+        delta = size - c.size
+    if not c.size:
+        return numpy.nan, numpy.nan
+    return c.mean(), c.std()
+
+
+def display_limits(data, method='percentile', lo=5., hi=98.5, nsamples=None,
+                   contrast=0.25, minstd=100.):
+    """Display limits for an image or cut-out.
+
+    Args:
+        data (numpy array): image or cut-out
+        method (str): 'percentile': lo and hi percentiles,
+            'zscale': IRAF zscale with nsamples (1000) and contrast,
+            'sigclip': mean - std to mean + 2 std of the 2.5 sigma clipped
+            pixels, with std at least minstd
+        lo, hi (float): percentiles for the 'percentile' method
+        nsamples (int): sample (about) this many pixels (None: all,
+            except for zscale)
+
+    Returns:
+        (float, float): zmin, zmax
+    """
+    if method == 'percentile':
+        zmin, zmax = percentiles(data, [lo, hi], nsamples=nsamples)
+    elif method == 'zscale':
+        zmin, zmax = zscale(data, nsamples=nsamples or 1000,
+                            contrast=contrast)
+    elif method == 'sigclip':
+        if nsamples is not None:
+            data = zsc_sample(data, nsamples)
+        mean, std = sigclip_stats(data)
+        if numpy.isnan(mean):
+            mean = 0.
+        if not std > minstd:
+            std = minstd
+        zmin, zmax = mean - std, mean + 2. * std
+    else:
+        raise ValueError("Unknown display limits method: %s" % method)
+    return float(zmin), float(zmax)
+
+
+def _load_limits(cache_file):
+    try:
+        with open(cache_file) as cfile:
+            return json.load(cfile)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_limits(cache_file, entries):
+    cached = _load_limits(cache_file)
+    cached.update(entries)
+    tmp = cache_file + '.tmp%d' % os.getpid()
+    try:
+        with open(tmp, 'w') as cfile:
+            json.dump(cached, cfile)
+        os.replace(tmp, cache_file)
+    except OSError as e:
+        print("Cannot write display limits cache %s: %s" % (cache_file, e))
+
+
+def cached_display_limits(fname, hdu=0, region=None, transpose=False,
+                          data=None, cache_file=None, **kwargs):
+    """Display limits for (a region of) an image file, cached.
+
+    Limits are kept per file version (path, size and mtime), HDU, region
+    and display_limits parameters, in memory and optionally in a json
+    cache_file shared between processes (e.g. all finders of a night).
+
+    Args:
+        fname (str): image file
+        hdu (int): HDU index
+        region (tuple): ((x0, x1), (y0, y1)) slice of the data array, or
+            None for the full image
+        transpose (bool): region is a slice of the transposed data array
+        data (numpy array): the data of the region, if already read
+        cache_file (str): json file to keep the limits in
+        kwargs: passed on to display_limits
+
+    Returns:
+        (float, float): zmin, zmax
+    """
+    real = os.path.realpath(fname)
+    st = os.stat(real)
+    if region is not None:
+        region = [[int(v) for v in r] for r in region]
+    key = json.dumps([real, st.st_size, st.st_mtime, hdu, region,
+                      bool(transpose), sorted(kwargs.items())])
+    if key in _limits_cache:
+        return tuple(_limits_cache[key])
+    if cache_file is not None:
+        cached = _load_limits(cache_file)
+        if key in cached:
+            _limits_cache[key] = cached[key]
+            return tuple(cached[key])
+    if data is None:
+        from astropy.io import fits
+        with fits.open(real, memmap=False) as hdul:
+            data = hdul[hdu].data
+            if transpose:
+                data = data.T
+            if region is not None:
+                data = data[max(0, region[0][0]):region[0][1],
+                            max(0, region[1][0]):region[1][1]]
+            data = numpy.array(data)
+    limits = display_limits(data, **kwargs)
+    _limits_cache[key] = list(limits)
+    if cache_file is not None:
+        _save_limits(cache_file, {key: list(limits)})
+    return limits
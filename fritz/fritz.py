@@ -1,13 +1,14 @@
 import json
 import glob
 import requests
-import subprocess
 import argparse
 import os
 import datetime
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sedmpy_version
 from marshals.interface import api, update_status_request
+import drpifu.SpecHeader as SpecHeader
 try:
     from fritz_commenter import add_SNID_pysedm_autoannot as add_annots
 except ImportError:
@@ -24,6 +25,10 @@ try:
     from fritz_commenter import add_S2N_autoannot as add_s2n_annots
 except ImportError:
     from fritz.fritz_commenter import add_S2N_autoannot as add_s2n_annots
+try:
+    import fritz_journal
+except ImportError:
+    import fritz.fritz_journal as fritz_journal
 
 configfile = os.path.join(sedmpy_version.CONFIG_DIR, 'sedmconfig.json')
 with open(configfile) as config_file:
@@ -43,6 +48,16 @@ default_id = 37
 instrument_id = 2
 telescope_id = 37
 
+# Number of sources uploaded concurrently
+_fritz_nproc = sedm_cfg.get('fritz_workers', 1)
+
+# Annotations posted after each spectrum, in this order:
+# (journal step, function, label)
+_annotations = [('snid', add_annots, 'SNID'),
+                ('sniascore', add_ia_annots, 'SNIascore'),
+                ('ngsf', add_ngsf_annots, 'NGSF'),
+                ('s2n', add_s2n_annots, 'S2N')]
+
 
 def write_json_file(pydict, output_file):
     """
@@ -75,29 +90,28 @@ def get_keywords_from_file(inputfile, keywords, sep=':'):
 
     :param inputfile: input spectrum text file
     :param keywords: dictionary of keywords to get from file
-    :param sep: separator character
+    :param sep: separator character (the header is always split on ':')
     :return:
     """
     return_dict = {}
+    hdr = SpecHeader.read_header(inputfile)
 
     for k, v in keywords.items():
+        val = hdr.get(v)
+        if val is None:
+            print("Not found: %s" % k)
+            continue
         try:
-            out = subprocess.check_output('grep %s %s' % (v, inputfile),
-                                          shell=True, universal_newlines=True)
             if k.upper() == 'EXPTIME':
-                outstr = out.split(sep, 1)[-1]
-                return_dict[k] = float(outstr)
+                return_dict[k] = float(val)
             elif v.upper() == 'OBSDATE':
-                date_str = out.split(sep, 1)[-1].split()[-1]
-                out = subprocess.check_output('grep OBSTIME %s' % inputfile,
-                                              shell=True,
-                                              universal_newlines=True)
-                date_str += "T" + out.split(sep, 1)[-1].split()[-1]
+                date_str = val.split()[-1]
+                date_str += "T" + hdr.get('OBSTIME', '').split()[-1]
                 date_str = date_str.split('.')[0] + "Z"
                 return_dict[k] = date_str
             else:
-                return_dict[k] = out.split(sep, 1)[-1].split()[-1].strip()
-        except subprocess.CalledProcessError:
+                return_dict[k] = val.split()[-1].strip()
+        except (ValueError, IndexError):
             print("Not found: %s" % k)
 
     return return_dict
@@ -237,34 +251,18 @@ def read_request(request_file):
     return json.load(open(request_file, 'r'))
 
 
-def update_target_by_request_id(request_id, add_spectra=False, spectra_file='',
-                                add_status=False, status='Completed',
-                                search_db=None, reducedby=None, testing=False):
+def lookup_request(request_id, search_db=None):
     """
-    Go through the request and find the one that matches the objname
+    Look up the marshal request, group, source and user of a SEDM request
     :param request_id:
-    :param add_spectra:
-    :param spectra_file:
-    :param add_status:
-    :param status:
     :param search_db:
-    :param reducedby:
-    :param testing:
-    :return: 
+    :return: dictionary with marshal_id, group_id, object_name, username and
+             email (None values if no dbase given), or None if the request
+             cannot be uploaded to fritz
     """
 
-    marshal_id = None
-    group_id = None
-    spec_id = None
-    object_name = None
-    username = None
-    email = None
-    # Return values
-    spec_ret = None
-    status_ret = None
-    status_tns = False
-    return_link = None
-    spec_stat = ''
+    target = {'marshal_id': None, 'group_id': None, 'object_name': None,
+              'username': None, 'email': None}
     # Look in the SEDM Db
     if search_db:
         print("Searching SedmDB")
@@ -279,8 +277,8 @@ def update_target_by_request_id(request_id, add_spectra=False, spectra_file='',
                                              {"id": request_id})[0]
         except IndexError:
             print("Unable to retrieve ids from database")
-            return return_link, spec_ret, status_ret, spec_id, status_tns
-        marshal_id = res[0]
+            return None
+        target['marshal_id'] = res[0]
         object_id = res[1]
         user_id = res[2]
         external_id = res[3]
@@ -288,7 +286,7 @@ def update_target_by_request_id(request_id, add_spectra=False, spectra_file='',
         # is this a Fritz object?
         if external_id != 2 and external_id != 4:
             print("Not a Fritz object!")
-            return return_link, spec_ret, status_ret, spec_id, status_tns
+            return None
         else:
             if external_id == 4:
                 print("AMPEL trigger")
@@ -296,28 +294,68 @@ def update_target_by_request_id(request_id, add_spectra=False, spectra_file='',
                 print("Fritz trigger")
         # set group id
         if share_id == 2:
-            group_id = 209
+            target['group_id'] = 209
         else:
-            group_id = 209
+            target['group_id'] = 209
         # get source name
         try:
             res = search_db.get_from_object(["name"], {"id": object_id})[0]
         except IndexError:
             print("Unable to retrieve object_name from database")
-            return return_link, spec_ret, status_ret, spec_id, status_tns
-        object_name = res[0]
+            return None
+        target['object_name'] = res[0]
         # get user name and email
         try:
             res = search_db.get_from_users(["name", "email"],
                                            {"id": user_id})[0]
         except IndexError:
             print("Unable to retrieve username, email from database")
-            return return_link, spec_ret, status_ret, spec_id, status_tns
-        username = res[0]
-        email = res[1]
+            return None
+        target['username'] = res[0]
+        target['email'] = res[1]
     else:
         print("no dbase given!")
 
+    return target
+
+
+def update_target_by_request_id(request_id, add_spectra=False, spectra_file='',
+                                add_status=False, status='Completed',
+                                search_db=None, reducedby=None, testing=False,
+                                target=None, journal=None):
+    """
+    Go through the request and find the one that matches the objname
+    :param request_id:
+    :param add_spectra:
+    :param spectra_file:
+    :param add_status:
+    :param status:
+    :param search_db:
+    :param reducedby:
+    :param testing:
+    :param target: request info from lookup_request (looked up if None)
+    :param journal: UploadJournal to record each upload step in, steps
+                    already done are skipped (None: no journal)
+    :return: 
+    """
+
+    spec_id = None
+    # Return values
+    spec_ret = None
+    status_ret = None
+    status_tns = False
+    return_link = None
+    spec_stat = ''
+    if target is None:
+        target = lookup_request(request_id, search_db=search_db)
+    if target is None:
+        return return_link, spec_ret, status_ret, spec_id, status_tns
+    marshal_id = target['marshal_id']
+    group_id = target['group_id']
+    object_name = target['object_name']
+    username = target['username']
+    email = target['email']
+
     # Did we get a marshal ID?
     if marshal_id is None:
         print("Unable to find marshal id for target %s" % object_name)
@@ -331,11 +369,21 @@ def update_target_by_request_id(request_id, add_spectra=False, spectra_file='',
                                                  now.minute,
                                                  now.second)
         if add_spectra:
-            spec_ret = upload_spectra(spectra_file, request_id=marshal_id,
-                                      sourceid=object_name, testing=testing,
-                                      group_id=group_id)
+            posted = None
+            if journal is not None and journal.done(spectra_file, 'spectrum'):
+                posted = journal.entry(spectra_file, 'spectrum')
+                print("Spectrum already posted")
+                spec_ret = {'status': 'success',
+                            'data': {'id': posted['spec_id']},
+                            'quality': posted['quality']}
+            else:
+                spec_ret = upload_spectra(spectra_file, request_id=marshal_id,
+                                          sourceid=object_name,
+                                          testing=testing, group_id=group_id)
             if not spec_ret:
                 spec_stat = 'Failed ' + ts_str
+                if journal is not None:
+                    journal.record(spectra_file, 'spectrum', ok=False)
             else:
                 # get quality
                 try:
@@ -354,42 +402,39 @@ def update_target_by_request_id(request_id, add_spectra=False, spectra_file='',
                     print("Spectrum id = %d" % spec_id)
                 except KeyError:
                     spec_id = None
+                if journal is not None and posted is None:
+                    journal.record(spectra_file, 'spectrum',
+                                   ok=spec_id is not None, spec_id=spec_id,
+                                   quality=quality)
                 if spec_id is None:
                     print("Warning: unable to obtain spec_id")
                 else:
-                    # now upload pysedm_report and SNID info
-                    annots_posted = add_annots(spectra_file,
-                                               object_id=object_name,
-                                               spec_id=spec_id, testing=testing)
-                    if annots_posted:
-                        print("SNID annotations successfully posted")
-                    else:
-                        print("Warning: SNID annotations encountered a problem")
-                    # now upload SNIascore info
-                    ia_annots_posted, status_tns = add_ia_annots(
-                        spectra_file, object_id=object_name, spec_id=spec_id,
-                        testing=testing)
-                    if ia_annots_posted:
-                        print("SNIascore annotations successfully posted")
-                    else:
-                        print("Warning: SNIascore annotations encountered a "
-                              "problem")
-                    # now upload  NGSF info
-                    ngsf_annots_posted = add_ngsf_annots(
-                        spectra_file, object_id=object_name, spec_id=spec_id,
-                        testing=testing)
-                    if ngsf_annots_posted:
-                        print("NGSF annotations successfully posted")
-                    else:
-                        print("Warning: NGSF annotations encountered a problem")
-                    # now upload S2N info
-                    s2n_annots_posted = add_s2n_annots(
-                        spectra_file, object_id=object_name, spec_id=spec_id,
-                        testing=testing)
-                    if s2n_annots_posted:
-                        print("S2N annotations successfully posted")
-                    else:
-                        print("Warning: S2N annotations encountered a problem")
+                    # now upload pysedm_report, SNID, SNIascore, NGSF and
+                    # S2N info, in order
+                    for step, add_func, label in _annotations:
+                        if journal is not None and journal.done(spectra_file,
+                                                                step):
+                            print("%s annotations already posted" % label)
+                            status_tns = status_tns or journal.entry(
+                                spectra_file, step).get('tns', False)
+                            continue
+                        annots_posted = add_func(spectra_file,
+                                                 object_id=object_name,
+                                                 spec_id=spec_id,
+                                                 testing=testing)
+                        tns = False
+                        if isinstance(annots_posted, tuple):
+                            annots_posted, tns = annots_posted
+                            status_tns = tns
+                        if journal is not None:
+                            journal.record(spectra_file, step,
+                                           ok=annots_posted, tns=tns)
+                        if annots_posted:
+                            print("%s annotations successfully posted" %
+                                  label)
+                        else:
+                            print("Warning: %s annotations encountered a "
+                                  "problem" % label)
         if add_status:
             try:
                 status_ret = update_status_request(spec_stat, marshal_id,
@@ -405,17 +450,103 @@ def update_target_by_request_id(request_id, add_spectra=False, spectra_file='',
 
     return return_link, spec_ret, status_ret, spec_id, status_tns
 
-          
+
+def upload_source(jobs, journal, reducedby=None, testing=False):
+    """
+    Upload the spectra of one source, in order, recording each upload in
+    the journal
+    :param jobs: list of (spectrum file, request id, lookup_request target)
+    :param journal: UploadJournal of the night
+    :param reducedby:
+    :param testing: do not record uploads in the journal if True
+    :return: list of update_target_by_request_id results, one per spectrum
+    """
+    results = []
+    for fi, req_id, target in jobs:
+        res = update_target_by_request_id(
+            req_id, add_status=True, status='Completed', add_spectra=True,
+            spectra_file=fi, reducedby=reducedby, testing=testing,
+            target=target, journal=None if testing else journal)
+        r, spec, stat, spec_id, tns = res
+        # Mark as uploaded
+        if stat and not testing:
+            journal.record(fi, 'uploaded', spec_ok=bool(spec),
+                           spec_id=spec_id, url=r, tns=tns)
+        results.append(res)
+    return results
+
+
+def report_upload(out, fi, res):
+    """
+    Write the upload report line of spectrum fi
+    :param out: open report file
+    :param fi: spectrum file
+    :param res: update_target_by_request_id result for fi
+    """
+    r, spec, stat, spec_id, tns = res
+    if not stat:
+        return
+    # Extract object name
+    tname = fi.split('_ifu')[-1].split('_')[4:]
+    if len(tname) > 1:
+        objname = '_'.join(tname).split('.txt')[0]
+    else:
+        objname = tname[0].split('.txt')[0]
+    # Extract observation id
+    fname = os.path.basename(fi)
+    if 'ifu' in fname:
+        obs_id = ":".join(fname.split('_ifu')[-1].split('_')[1:4])
+    elif 'rc' in fname:
+        obs_id = ":".join(fname.split('_rc')[-1].split('_')[1:4])
+    else:
+        obs_id = "..:..:.."
+    # log upload
+    out.write("%s %s: " % (obs_id, objname))
+    # Was a spectrum uploaded?
+    if spec:
+        out.write("OK ")
+    else:
+        out.write("NO ")
+    # Was status updated?
+    if stat:
+        out.write("OK ")
+    else:
+        out.write("NO ")
+    # Do we have a spec id?
+    if spec_id:
+        out.write("%9d " % spec_id)
+    else:
+        out.write("       -1 ")
+    if r:
+        print("URL: " + r)
+        out.write("%s " % r)
+    else:
+        print("URL: None")
+        out.write("None ")
+    if tns:
+        print("Uploaded to TNS")
+        out.write("TNS\n")
+    else:
+        out.write("\n")
+    out.flush()
+
+
 def parse_ztf_by_dir(target_dir, upfil=None, dbase=None, reducedby=None,
-                     testing=False):
+                     testing=False, nproc=_fritz_nproc):
     """Given a target directory get all files that have ztf or ZTF as base 
        name
 
+       The requests are looked up in the database first, then the sources
+       are uploaded concurrently (nproc at a time), the spectra of each
+       source in order.  Uploads are recorded in the night's upload journal
+       (see fritz_journal) and spectra already uploaded are skipped.
+
        :param target_dir:
        :param upfil:
        :param dbase:
        :param reducedby:
        :param testing:
+       :param nproc: number of sources to upload concurrently
        """
 
     if target_dir[-1] != '/':
@@ -426,7 +557,7 @@ def parse_ztf_by_dir(target_dir, upfil=None, dbase=None, reducedby=None,
     # files += glob.glob('%sspec_*ZTF*.txt' % target_dir)
 
     # list of all spectra in directory
-    fls = glob.glob('%sspec_*.txt' % target_dir)
+    fls = sorted(glob.glob('%sspec_*.txt' % target_dir))
     # scrape out unneeded files or find upfil in list
     files = []
     for fi in fls:
@@ -450,81 +581,48 @@ def parse_ztf_by_dir(target_dir, upfil=None, dbase=None, reducedby=None,
             # add all others
             files.append(fi)
 
-    report_fname = "report_ztf_fritz.txt"
-    started = os.path.exists(os.path.join(target_dir, report_fname))
-    out = open(target_dir + report_fname, "a")
-    if not started:
-        out.write("\nZTF fritz marshal upload report for %s started on %s\n\n" %
-                  (target_dir.split('/')[-2],
-                   datetime.datetime.now().strftime("%c")))
+    journal = fritz_journal.UploadJournal(target_dir)
+    # Look up requests here (the database connection is not shared),
+    # grouping the spectra by source to keep each source's uploads in order
+    sources = {}
     for fi in files:
         # Has it already been uploaded?
-        if os.path.exists(fi.split('.')[0] + ".upl"):
+        if journal.uploaded(fi):
             print("Already uploaded: %s" % fi)
             continue
 
         # Extract request ID
-        req_id = subprocess.check_output(('grep', 'REQ_ID', fi),
-                                         universal_newlines=True)
-        req_id = req_id.split(':', 1)[-1].strip()
+        req_id = SpecHeader.read_header(fi).req_id
         if not req_id:
             print("No REQ_ID found: %s" % fi)
             continue
-        # Extract object name
-        tname = fi.split('_ifu')[-1].split('_')[4:]
-        if len(tname) > 1:
-            objname = '_'.join(tname).split('.txt')[0]
-        else:
-            objname = tname[0].split('.txt')[0]
-        # Extract observation id
-        fname = os.path.basename(fi)
-        if 'ifu' in fname:
-            obs_id = ":".join(fname.split('_ifu')[-1].split('_')[1:4])
-        elif 'rc' in fname:
-            obs_id = ":".join(fname.split('_rc')[-1].split('_')[1:4])
-        else:
-            obs_id = "..:..:.."
-        # Are we uploading only one file?
-        if upfil is not None:
-            # if this is not the file, skip
-            if upfil not in fi:
+        target = lookup_request(req_id, search_db=dbase)
+        if target is None:
+            continue
+        source = target['object_name'] or fi
+        sources.setdefault(source, []).append((fi, req_id, target))
+
+    report_fname = "report_ztf_fritz.txt"
+    started = os.path.exists(os.path.join(target_dir, report_fname))
+    out = open(target_dir + report_fname, "a")
+    if not started:
+        out.write("\nZTF fritz marshal upload report for %s started on %s\n\n" %
+                  (target_dir.split('/')[-2],
+                   datetime.datetime.now().strftime("%c")))
+    # Upload
+    with ThreadPoolExecutor(max_workers=max(1, nproc)) as executor:
+        futures = {executor.submit(upload_source, jobs, journal,
+                                   reducedby=reducedby, testing=testing):
+                   jobs for jobs in sources.values()}
+        for future in as_completed(futures):
+            jobs = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                print("Upload of %s failed: %s" % (jobs[0][0], e))
                 continue
-        # Upload
-        r, spec, stat, spec_id, tns = update_target_by_request_id(
-            req_id, add_status=True, status='Completed', add_spectra=True,
-            spectra_file=fi, search_db=dbase, reducedby=reducedby,
-            testing=testing)
-        # Mark as uploaded
-        if stat:
-            os.system("touch " + fi.split('.')[0].replace(" ", "\ ") + ".upl")
-            # log upload
-            out.write("%s %s: " % (obs_id, objname))
-            # Was a spectrum uploaded?
-            if spec:
-                out.write("OK ")
-            else:
-                out.write("NO ")
-            # Was status updated?
-            if stat:
-                out.write("OK ")
-            else:
-                out.write("NO ")
-            # Do we have a spec id?
-            if spec_id:
-                out.write("%9d " % spec_id)
-            else:
-                out.write("       -1 ")
-            if r:
-                print("URL: " + r)
-                out.write("%s " % r)
-            else:
-                print("URL: None")
-                out.write("None ")
-            if tns:
-                print("Uploaded to TNS")
-                out.write("TNS\n")
-            else:
-                out.write("\n")
+            for (fi, _, _), res in zip(jobs, results):
+                report_upload(out, fi, res)
 
     # Close log file
     out.close()
@@ -546,6 +644,9 @@ Uploads results to the fritz marshal.
                         help='reducer (defaults to auto)')
     parser.add_argument('--testing', action="store_true", default=False,
                         help='Do not actually post to marshal (for testing)')
+    parser.add_argument('--nproc', type=int, default=_fritz_nproc,
+                        help='Number of sources to upload concurrently (%d)'
+                             % _fritz_nproc)
     args = parser.parse_args()
 
     # Check environment
@@ -571,4 +672,5 @@ Uploads results to the fritz marshal.
         import db.SedmDb
         sedmdb = db.SedmDb.SedmDB()
         parse_ztf_by_dir(srcdir, upfil=args.data_file, dbase=sedmdb,
-                         reducedby=args.reducedby, testing=args.testing)
+                         reducedby=args.reducedby, testing=args.testing,
+                         nproc=args.nproc)
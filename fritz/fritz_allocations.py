@@ -1,12 +1,9 @@
 import json
 import os
 import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 
 import sedmpy_version
-
-DEFAULT_TIMEOUT = 5  # seconds
+import marshals.client as marshal_client
 
 # URL constants
 fritz_base_url = 'https://fritz.science/'
@@ -21,45 +18,12 @@ with open(os.path.join(sedmpy_version.CONFIG_DIR, 'marshals.json')) as data_file
 
 token = params['marshals']['fritz']['alloc_token']
 
-
-class TimeoutHTTPAdapter(HTTPAdapter):
-    def __init__(self, *args, **kwargs):
-        self.timeout = DEFAULT_TIMEOUT
-        if "timeout" in kwargs:
-            self.timeout = kwargs["timeout"]
-            del kwargs["timeout"]
-        super().__init__(*args, **kwargs)
-
-    def send(self, request, **kwargs):
-        timeout = kwargs.get("timeout")
-        if timeout is None:
-            kwargs["timeout"] = self.timeout
-        return super().send(request, **kwargs)
-
-
-session = requests.Session()
-session_headers = {'Authorization': 'token {}'.format(token)}
-retries = Retry(
-    total=5,
-    backoff_factor=2,
-    status_forcelist=[405, 429, 500, 502, 503, 504],
-    method_whitelist=["HEAD", "GET", "PUT", "POST", "PATCH", "DELETE"]
-)
-adapter = TimeoutHTTPAdapter(timeout=5, max_retries=retries)
-session.mount("https://", adapter)
-session.mount("http://", adapter)
+# Shared, pooled fritz client
+client = marshal_client.get_client('fritz', 'alloc_token')
 
 
 def api(method, endpoint, data=None, verbose=False):
-    headers = {'Authorization': 'token {}'.format(token)}
-    response = session.request(method, endpoint, json=data, headers=headers)
-    print('HTTP code: {}, {}'.format(response.status_code, response.reason))
-    if response.status_code in (200, 400) and verbose:
-        print(response.text)
-        # print('JSON response: {}'.format(response.json()))
-    ret = response.json()
-
-    return ret
+    return client.api(method, endpoint, data=data, verbose=verbose)
 
 
 def delete_allocation(alloc_id, testing=False):
@@ -0,0 +1,130 @@
+"""Journal of the uploads of a night to the fritz marshal.
+
+Classes
+    * :class:`UploadJournal`  upload steps of each spectrum of a night
+
+Note:
+    Each step of the upload of a spectrum (posting the spectrum, each
+    annotation and the request status update) is appended as one json line
+    to <night>/fritz_upload_journal.jsonl and synced to disk before the
+    next step starts.  A spectrum is uploaded once its 'uploaded' step is
+    recorded, and an interrupted upload resumes after its last successful
+    step (the spectrum is not posted twice).  :meth:`UploadJournal.forget`
+    marks a spectrum for re-upload.
+
+    Spectra marked with the <spectrum>.upl files of earlier versions of the
+    uploader are also treated as uploaded.
+
+"""
+import os
+import json
+import glob
+import fnmatch
+import datetime
+import threading
+
+_journal_name = 'fritz_upload_journal.jsonl'
+
+
+def journal_file(target_dir):
+    """Return the upload journal file of a night directory"""
+    return os.path.join(target_dir, _journal_name)
+
+
+class UploadJournal:
+    """Upload steps of the spectra of a night.
+
+    Args:
+        target_dir (str): night directory with the spectra
+
+    """
+
+    def __init__(self, target_dir):
+        self.target_dir = target_dir
+        self.jfile = journal_file(target_dir)
+        self.steps = {}
+        self._lock = threading.Lock()
+        self._newline = False
+        try:
+            with open(self.jfile) as jf:
+                for line in jf:
+                    self._newline = not line.endswith('\n')
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        # partly written line from an interrupted upload
+                        continue
+        except OSError:
+            pass
+
+    def _apply(self, ent):
+        """Add journal entry ent to the steps"""
+        if ent['step'] == 'forget':
+            self.steps.pop(ent['file'], None)
+        else:
+            self.steps.setdefault(ent['file'], {})[ent['step']] = ent
+
+    def _legacy_marker(self, name):
+        """Return the .upl marker file of spectrum name"""
+        return os.path.join(self.target_dir, name.split('.')[0] + ".upl")
+
+    def record(self, fname, step, ok=True, **info):
+        """Append an upload step of spectrum fname to the journal.
+
+        Args:
+            fname (str): spectrum file
+            step (str): upload step (e.g. 'spectrum', 'snid', 'status')
+            ok (bool): did the step succeed?
+            **info: other json values to record (e.g. spec_id)
+
+        Returns:
+            dict: the journal entry
+
+        """
+        ent = dict(info, file=os.path.basename(fname), step=step, ok=bool(ok),
+                   time=datetime.datetime.utcnow().isoformat(
+                       timespec='seconds'))
+        line = json.dumps(ent) + '\n'
+        with self._lock:
+            with open(self.jfile, 'a') as jf:
+                if self._newline:
+                    jf.write('\n')
+                    self._newline = False
+                jf.write(line)
+                jf.flush()
+                os.fsync(jf.fileno())
+            self._apply(ent)
+        return ent
+
+    def entry(self, fname, step):
+        """Last journal entry of step for spectrum fname, or None"""
+        with self._lock:
+            return self.steps.get(os.path.basename(fname), {}).get(step)
+
+    def done(self, fname, step):
+        """True if step succeeded for spectrum fname"""
+        ent = self.entry(fname, step)
+        return ent is not None and ent['ok']
+
+    def uploaded(self, fname):
+        """True if spectrum fname was uploaded"""
+        name = os.path.basename(fname)
+        return self.done(name, 'uploaded') or \
+            os.path.exists(self._legacy_marker(name))
+
+    def uploaded_files(self, pattern='*'):
+        """Sorted names of the uploaded spectra matching pattern"""
+        with self._lock:
+            names = set(name for name, steps in self.steps.items()
+                        if 'uploaded' in steps and steps['uploaded']['ok'])
+        for upl in glob.glob(os.path.join(self.target_dir, '*.upl')):
+            names.add(os.path.basename(upl)[:-4] + '.txt')
+        return sorted(fnmatch.filter(names, pattern))
+
+    def forget(self, fname):
+        """Mark spectrum fname for re-upload"""
+        name = os.path.basename(fname)
+        self.record(name, 'forget')
+        upl = self._legacy_marker(name)
+        if os.path.exists(upl):
+            os.remove(upl)
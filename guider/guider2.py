@@ -28,6 +28,14 @@
 #   logs will also be uploaded to the server.
 #   Make sure user has read/write access to this directory.
 
+#   The guider runs as a GuiderService object that keeps its state in memory:
+#   files already handled, the current object and guide star, open log files
+#   and the telnet connection (re-opened if it drops).  New frames are picked
+#   up from file system events when the 'watchdog' package is available, and
+#   by scanning the remote directory every 'poll' seconds otherwise.  The
+#   time from frame arrival to the guide command being acknowledged is kept
+#   in a latency histogram that is written to the log.
+
 #   As far as I know this code handles itself well enough in terms of errors,
 #   but if it does bug out, no information should be lost. Logs are updated and
 #   saved to the server and locally after each file download/check.
@@ -38,6 +46,8 @@
 
 import os
 import sys
+import time
+import queue
 import telnetlib
 import sedmtools
 import shutil
@@ -46,6 +56,13 @@ from astropy.io import fits as pf
 from time import sleep
 from time import localtime
 
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import PatternMatchingEventHandler
+except ImportError:
+    Observer = None
+    PatternMatchingEventHandler = object
+
 # 1.2 CODE PARAMETERS
 params = {}
 params["use_telnet"] = True  # True - send guider commands; False - run code
@@ -53,8 +70,15 @@ params["use_telnet"] = True  # True - send guider commands; False - run code
 params["telnet_ip"] = "198.202.125.194"  # String: IP Addr. for Telnet commands
 params["telnet_port"] = 49302  # Integer: Port for Telnet commands
 params["handled_dir"] = "/home/sedm/guider/auto2/"  # Dir for files and logs
+params["remote_root"] = "/data2/sedm/"  # Root of the nightly image dirs
+params["poll"] = 0.5  # Seconds between scans for new files
 params["debug"] = False  # Set to true to activate debugging mode output
 
+# Bin edges (ms) of the frame arrival to guide command latency histogram
+latency_bins = [0, 50, 100, 200, 500, 1000, 2000, 5000, 10000, np.inf]
+# Write the latency histogram to the log every this many commands
+latency_report_every = 50
+
 
 def touch(path):
     """touch a file name at path"""
@@ -65,159 +89,238 @@ def touch(path):
 # END 1. SETUP
 
 
-def auto(params):  # Run this method to begin the guider
-
-    # 2 GLOBAL VARS
-    global _obName,_obRA,_obDec,_dRA_0,_dDec_0,_ra_off,_dec_off,\
-            star,_starBox,_sBs,_log, _stored,_months,_host,_user,_pass,\
-            handled_dir,_disconnect,_t,_use_telnet
-
-    _debug = params["debug"]  # Activates/de-activates debugging printing
-
-    # 2.1 Telnet for sending commands to guider
-    _use_telnet = params["use_telnet"]
-    if _use_telnet:
-        _t = telnetlib.Telnet(params["telnet_ip"], params["telnet_port"])
-        if _debug:
-            print("Connecting to telnet")
-
-    if _debug:
-        print("Creating global variables")
-
-    # 2.2 Setup directories
-    _handled_dir = params["handled_dir"]
-    if not os.path.exists(_handled_dir):
-        raise Exception("Path %s does not exist" % _handled_dir)
-    _disconnect = False 
-
-    # 2.3 Misc Variables
-    _months = {1: "01", 2: "02", 3: "03", 4: "04", 5: "05", 6: "06", 7: "07",
-               8: "08", 9: "09", 10: "10", 11: "11", 12: "12"}
-    _stored = {}
-    _obName = ""  # Object name
-    _obRA = ""  # Object RA coordinate
-    _obDec = ""  # Object DEC coordinate
-    _dRA_0, _dDec_0 = 0, 0  # Calibration variables for offset, see below
-    _ra_off, _dec_off = 0, 0  # Offset of image centre from target coordinates
-    _star = (-1, -1)  # Star position in image. (-1,-1) serves as error flag
-    _starBox = []  # Will store 2D data around star
-    _sBs = 20  # Size (pixels) of box to take around guide star
-    _log = ""
-
-    # END 2. GLOBAL VARS
-
-    # 3. METHODS
-    if _debug:
-        print("Method defintiions")
-
-    # 3.1 Log data into a file
-    def log(data, filePath):
-        log_file = open(filePath, 'a')
-        log_file.write(data)
-        log_file.close()
-
-    # 3.2 Dual output: log & stdout
-    def output(string, filePath):
-        print(string),
-        log(string, filePath)
-
-    # 3.3 Get list of new files (that contain a given substring, e.g.
-    # '.fits' or 'rc') from server
-    def getNew(handleddir, remotedir, substring):
-        have = {}
-        new_files = []
-        handled_files = os.listdir(handleddir)
-        
+# 2. FILE EVENTS
+class _FrameEventHandler(PatternMatchingEventHandler):
+    """Pass closed or renamed frames on to the guider"""
+
+    def __init__(self, service):
+        super().__init__(patterns=["*rc*"], ignore_directories=True)
+        self.service = service
+
+    def on_closed(self, event):
+        self.service.add(os.path.basename(event.src_path))
+
+    def on_moved(self, event):
+        self.service.add(os.path.basename(event.dest_path))
+
+# END 2. FILE EVENTS
+
+
+# 3. GUIDER SERVICE
+class GuiderService:
+    """Guide the telescope on rc frames as they arrive.
+
+    Args:
+        params (dict): code parameters (see 1.2 above)
+
+    """
+
+    def __init__(self, params):
+
+        self.debug = params["debug"]  # Activates/de-activates debugging
+        self.use_telnet = params["use_telnet"]
+        self.telnet_ip = params["telnet_ip"]
+        self.telnet_port = params["telnet_port"]
+        self.handled_dir = params["handled_dir"]
+        self.remote_root = params.get("remote_root", "/data2/sedm/")
+        self.poll = params.get("poll", 0.5)
+        if not os.path.exists(self.handled_dir):
+            raise Exception("Path %s does not exist" % self.handled_dir)
+
+        # Files already handled: read once, then kept in memory
+        self.seen = set(os.listdir(self.handled_dir))
+        self.queue = queue.Queue()  # (file name, arrival time)
+        self._sizes = {}
+        self._observer = None
+        self._t = None  # telnet connection
+        self.remote_dir = None
+        self._log = None
+        self._seeing = None
+        self.log_name = ""
+        self.seeing_name = ""
+
+        # Object and guide star
+        self.ob_name = ""  # Object name
+        self.ob_ra = ""  # Object RA coordinate
+        self.ob_dec = ""  # Object DEC coordinate
+        self.dra_0, self.ddec_0 = 0, 0  # Calibration variables for offset
+        self.ra_off, self.dec_off = 0, 0  # Offset of image centre from target
+        self.star = (-1, -1)  # Star position in image. (-1,-1) is error flag
+        self.star_box = None  # 2D data around star
+        self.plan = None  # Cross-correlation plan for star_box
+        self.sBs = 20  # Size (pixels) of box to take around guide star
+
+        # Frame arrival to guide command latencies in ms
+        self.latencies = []
+
+    # 3.1 LOGS
+    def open_logs(self, date_str):
+        """Open the (persistent) log files for date YYYY_MM_DD"""
+        self.close_logs()
+        # Log file for general program output
+        self.log_name = "%s_log.txt" % date_str
+        # Log file for seeing-condition data
+        self.seeing_name = "%s_seeing.txt" % date_str
+        self._log = open(os.path.join(self.handled_dir, self.log_name), 'a')
+        self._seeing = open(os.path.join(self.handled_dir, self.seeing_name),
+                            'a')
+
+    def close_logs(self):
+        for fh in (self._log, self._seeing):
+            if fh is not None:
+                fh.close()
+        self._log = None
+        self._seeing = None
+
+    def output(self, string):
+        """Dual output: log & stdout"""
+        print(string)
+        if self._log is not None:
+            self._log.write(string)
+            self._log.flush()
+
+    def upload_logs(self):
+        """Copy logs to the remote directory"""
+        self._seeing.flush()
+        for name in (self.log_name, self.seeing_name):
+            try:
+                shutil.copyfile(os.path.join(self.handled_dir, name),
+                                self.remote_dir + name)
+            except OSError as e:
+                print("Error uploading %s: %s" % (name, str(e)))
+
+    # 3.2 TELNET
+    def telnet(self):
+        """Return the telnet connection, connecting if needed"""
+        if self._t is None:
+            if self.debug:
+                print("Connecting to telnet")
+            self._t = telnetlib.Telnet(self.telnet_ip, self.telnet_port)
+        return self._t
+
+    def close_telnet(self):
+        if self._t is not None:
+            try:
+                self._t.close()
+            except Exception:
+                pass
+            self._t = None
+
+    def send_shift(self, dRA, dDec):
+        """Send a guide command, reconnecting once if the link dropped.
+
+        Returns:
+            int: telescope return code
+        """
+        cmd = "GM %s %s 10 10\n" % (round(dRA, 5), round(dDec, 5))
+        print("Doing shift %s" % cmd)
+        for attempt in range(2):
+            try:
+                t = self.telnet()
+                t.write(cmd.encode())
+                return int(t.expect([rb"-?\d"], 60)[2])
+            except (OSError, EOFError) as e:
+                self.close_telnet()
+                if attempt > 0:
+                    raise
+                self.output("Telnet connection lost (%s), reconnecting\n" %
+                            str(e))
+
+    # 3.3 NEW FILES
+    def add(self, fileName):
+        """Queue fileName if it is an rc frame not handled yet"""
+        if "rc" not in fileName or "copy" in fileName \
+                or fileName in self.seen:
+            return False
+        self.seen.add(fileName)
+        self.queue.put((fileName, time.monotonic()))
+        return True
+
+    def scan(self, stable=True):
+        """Queue new frames in the remote directory.
+
+        Args:
+            stable (bool): only queue files whose size did not change since
+                the previous scan (i.e. that are completely written)
+        """
         try:
-            remote_files = os.listdir(remotedir)
-        except:
-            print(remotedir)
-            output("Error reading file list.", _log)
-            return []
-        
-        for x in handled_files:
-            have[x] = True
-
-        for x in remote_files:
-            if x in have:
-                # print(x, "have has key")
-                ignore = True
-            else:
-                # print(x, "have does not have key")
-                ignore = False
-            if not ignore and substring in x and "copy" not in x:
-                # print("Adding %s to list" % x)
-                new_files.append(x)
-
-        return new_files
+            entries = list(os.scandir(self.remote_dir))
+        except OSError:
+            print(self.remote_dir)
+            self.output("Error reading file list.")
+            return
+        for ent in sorted(entries, key=lambda x: x.name):
+            if ent.name in self.seen:
+                continue
+            if stable:
+                try:
+                    size = ent.stat().st_size
+                except OSError:
+                    continue
+                last = self._sizes.get(ent.name)
+                self._sizes[ent.name] = size
+                if last != size:
+                    continue
+                del self._sizes[ent.name]
+            self.add(ent.name)
+
+    def watch(self, remote_dir):
+        """Start watching remote_dir for new frames"""
+        self.stop_watch()
+        self.remote_dir = remote_dir
+        self._sizes = {}
+        if Observer is not None and os.path.isdir(remote_dir):
+            self._observer = Observer()
+            self._observer.schedule(_FrameEventHandler(self), remote_dir,
+                                    recursive=False)
+            self._observer.start()
+        if self.debug:
+            print("Watching %s (events: %s)" % (remote_dir,
+                                                self._observer is not None))
+
+    def stop_watch(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
 
     # 3.4 Get whether the file is a daytime image, a new object or a new offset
-    def getStatus(path):
+    def get_status(self, header, time_str):
 
-        global _obName, _obRA, _obDec, _ra_off, _dec_off
-        # print("......Status: %s" % path)
-        try:
-            sleep(.05)
-            fitsImage = pf.open(path, mode="readonly", ignore_missing_end=True)
-            status = {"daytime": False, "new obj": False, "moved": False}
-        except Exception as e:
-            # wait 5s
-            sleep(.05)
-            print("Error in get Status")
-            print(str(e))
-            try:
-                fitsImage = pf.open(path, mode="readonly",
-                                    ignore_missing_end=True)
-                status = {"daytime": False, "new obj": False, "moved": False}
-            except Exception as e:
-                print("Error in error")
-                print(str(e))
-                status = {"daytime": False, "new obj": False, "moved": False}
-                return status
-        try:
-            # Extract time from filename
-            time = fileName[fileName.index('_')+1:fileName.index('.')]
-            # Convert to a number: '20:01' -> 2001
-            nTime = float(time[0:2])*100 + float(time[3:5])
-        except Exception as e:
-            print("Error gettingt time", str(e))
-            output("%20s Error parsing time from filename." % time, _log)
+        status = {"daytime": False, "new obj": False, "moved": False}
         try:
             # Extract Header Info
-            obRA = fitsImage[0].header['OBJRA']
-            obDec = fitsImage[0].header['OBJDEC']
-            RAoff = fitsImage[0].header['RA_OFF']
-            Decoff = fitsImage[0].header['DEC_OFF']
-            obName = fitsImage[0].header['OBJECT']
+            obRA = header['OBJRA']
+            obDec = header['OBJDEC']
+            RAoff = header['RA_OFF']
+            Decoff = header['DEC_OFF']
+            obName = header['OBJECT']
 
         except Exception as e:
             print("ERROR", str(e))
-            # winsound.PlaySound('SystemHand', winsound.SND_ASYNC)
-            output("%20s header error.\n" % time, _log)
-            status["moved"] = False
+            self.output("%20s header error.\n" % time_str)
             return status
 
-        # Is image from before sunset/after sunrise? (e.g. flats)
-        # if 530 < nTime < 2030: status["daytime"] = True
         print(obRA, obDec, obName)
-        # Are target coordinates different to current global values?
-        if obRA != _obRA or obDec != _obDec or obName != _obName:
+        # Are target coordinates different to current values?
+        if obRA != self.ob_ra or obDec != self.ob_dec or \
+                obName != self.ob_name:
 
             status["new obj"] = True
-            _obName = obName
-            _obRA = obRA
-            _obDec = obDec
-            _ra_off = RAoff
-            _dec_off = Decoff
+            self.ob_name = obName
+            self.ob_ra = obRA
+            self.ob_dec = obDec
+            self.ra_off = RAoff
+            self.dec_off = Decoff
 
         # If not a new object, has the offset changed by more than 4.5''
         # in either direction?
-        elif max(abs(_ra_off - RAoff), abs(_dec_off - Decoff)) > 3.5:
+        elif max(abs(self.ra_off - RAoff), abs(self.dec_off - Decoff)) > 3.5:
 
             status["moved"] = True
-            _obName = obName
-            _ra_off = RAoff
-            _dec_off = Decoff
+            self.ob_name = obName
+            self.ra_off = RAoff
+            self.dec_off = Decoff
         elif "(NS)" in obName:
             status["moved"] = True
             # Object is an asteroid or other small body
@@ -225,295 +328,292 @@ def auto(params):  # Run this method to begin the guider
         return status
 
     # 3.5 Formatted output for coordinates, offsets and seeing conditions
-    def outputCoords(fileName, path):
-        global _obName, _obRA, _obDec, _star, _ra_off, _dec_off, _log
-        output("\n%s" % _obName +
-               "\nCoordinates: %s %s %s" % (_obRA, _obDec, _star) +
-               "\nOffsets: %.2f %.2f\n\n" % (_ra_off, _dec_off) +
-               "%20s %10s %10s %10s %10s %10s %10s %10s\n" %
-               (fileName[0:fileName.index('_')+1], "dRA", "dDec", "sent",
-                "fwhm_x", "fwhm_y", "fwhm_x:y", "fwhm_avg"),
-               path)
+    def output_coords(self, fileName):
+        self.output("\n%s" % self.ob_name +
+                    "\nCoordinates: %s %s %s" % (self.ob_ra, self.ob_dec,
+                                                 self.star) +
+                    "\nOffsets: %.2f %.2f\n\n" % (self.ra_off, self.dec_off) +
+                    "%20s %10s %10s %10s %10s %10s %10s %10s\n" %
+                    (fileName[0:fileName.index('_')+1], "dRA", "dDec", "sent",
+                     "fwhm_x", "fwhm_y", "fwhm_x:y", "fwhm_avg"))
+
+    # 3.6 LATENCY
+    def latency_histogram(self, bins=None):
+        """Histogram of frame arrival to guide command latencies.
+
+        Returns:
+            (np.ndarray, list): counts and bin edges in ms
+        """
+        if bins is None:
+            bins = latency_bins
+        counts = np.histogram(self.latencies, bins=bins)[0]
+        return counts, bins
+
+    def latency_report(self):
+        counts, bins = self.latency_histogram()
+        report = "Latency (ms) for %d commands, median %.0f:\n" % (
+            len(self.latencies), np.median(self.latencies)
+            if self.latencies else np.nan)
+        for lo, hi, n in zip(bins[:-1], bins[1:], counts):
+            report += "%8.0f - %-8.0f %6d\n" % (lo, hi, n)
+        return report
+
+    def star_box_at(self, data, star):
+        """Deep copy of (2 sBs x 2 sBs) sized image around star"""
+        x, y = star
+        return np.array(data[x-self.sBs:x+self.sBs, y-self.sBs:y+self.sBs])
+
+    # 3.7 PROCESS ONE FRAME
+    def process(self, fileName, t_arrive, guide_telescope):
+
+        if self.debug:
+            print("....Creating local vars(2)")
+
+        # local path for file
+        handled_path = os.path.join(self.handled_dir, fileName)
+        # remote path for file
+        remote_path = os.path.join(self.remote_dir, fileName)
+        print(remote_path)
+        # time of image
+        try:
+            time_str = fileName[fileName.index('_')+1:fileName.index('.')]
+        except ValueError:
+            time_str = fileName
+            self.output("%20s Error parsing time from filename." % time_str)
 
-    # END 3. METHOD DEFINITIONS
+        # Mark file as handled
+        touch(handled_path)
 
-    # 4. MAIN
+        # Header and data are read once, memory mapped
+        try:
+            image = pf.open(remote_path, memmap=True, ignore_missing_end=True)
+        except Exception as e:
+            print("Failing at newfiles", str(e))
+            return
 
-    if _debug: 
-        print("Beginning main loop")
-        print("Disconnect = %s" % str(_disconnect))
+        # Closed (and unmapped) however processing ends
+        with image:
+            self.process_image(image, fileName, time_str, t_arrive,
+                               guide_telescope)
 
-    # 4.2 START MAIN LOOP
-    while not _disconnect:
+    def process_image(self, image, fileName, time_str, t_arrive,
+                      guide_telescope):
+        """Find the shift and seeing in the open guider image"""
+        dRA, dDec = "-", "-"  # Change in RA/Dec
+        shift_sent = False  # Boolean: move command sent to telescope?
 
-        if _debug:
-            print("..Creating local variables")
+        # Get 'status' of file (see method definition for details)
+        if self.debug:
+            print("....Getting Status")
+        status = self.get_status(image[0].header, time_str)
 
-        # 4.3 GET LOCAL VARIABLES: FILES, TIME, DATE, BOOLEANS
+        try:
+            if image[0].header['imgtype'].lower() != "guider":
+                return
+        except Exception:
+            print("Error with this new line")
 
-        # 4.3.1 COMMENT/UNCOMMENT TO SWITCH TO MANUAL DATE SELECTION
-        # date = raw_input("Date: ")
-        # date = date.split(' ')
-        # year,month,day = int(date[0]),int(date[1]),int(date[2])
+        if self.debug:
+            print("....Checking Status")
 
-        # 4.3.2 COMMENT/UNCOMMENT TO SWITCH TO AUTOMATIC DATE SELECTION
-        now = localtime()
-        year, month, day = now.tm_year, now.tm_mon, now.tm_mday
+        # Ignore all day-time images
+        if status["daytime"]:
+            if self.debug:
+                print("......Status = Day-time")
+            return
 
-        # 4.3.3 PARSE DATE INFORMATION
-        day_s = str(day) if day >= 10 else '0' + str(day)
-        month_s = str(month) if month >= 10 else '0'+str(month)
-        monthName = _months[month]
+        data = image[0].data
 
-        # 4.3.4 CREATE USEFUL STRINGS
-        # Directory containing today's files on server
-        remote_dir = os.path.join("/data2/sedm/", str(year)+monthName+day_s)
-        # Log file for general program output
-        _log = "%s_%s_%s_log.txt" % (str(year), month_s, day_s)
-        # Log file for seeing-condition data
-        seeing_log = "%s_%s_%s_seeing.txt" % (str(year), month_s, day_s)
-
-        if _debug:
-            print("..Getting new file list")
-
-        # 4.4 GET NEW FILE LIST
-        # print(_handled_dir,1)
-        new_files = getNew(_handled_dir, remote_dir,"rc")
-        # sleep(10)
-        if _debug:
-            print(".... %s" % new_files)
-        # 4.5 DECIDE WHETHER TO GUIDE TELESCOPE OR NOT
-        if len(new_files) <= 1 and _use_telnet:
-            guide_telescope = True
-        else:
-            guide_telescope = False
-
-        if _debug:
-            print("..Beginning file loop")
-        sleep(5)
-        # 4.6 RUN THROUGH NEW FILES
-        for fileName in new_files:
-
-            if _debug:
-                print("....Creating local vars(2)")
-
-            # 4.6.1 GET LOCAL VARIABLES
-            _handled_dir = "/home/sedm/guider/auto2/"
-            # local path for file
-            handled_path = _handled_dir + fileName.split("/")[-1]  # os.path.join(_handled_dir,fileName)
-            print("Handled Path", handled_path)
-            sleep(.05)
-            # remote path for file
-            remote_path = os.path.join(remote_dir, fileName)
-            print(remote_path)
-            sleep(.05)
-            print(remote_path, 2)
-            # time of image
-            time = fileName[fileName.index('_')+1:fileName.index('.')]
-            dRA, dDec = "-", "-"  # Change in RA/Dec
-            shift_sent = False  # Boolean: move command sent to telescope?
-
-            # 4.6.2 COPY FILES TO PROCESSED DIRECTORY
-            touch(handled_path)
-
-            # 4.6.3 GET 'STATUS' OF FILE (see method definition for details)
-            if _debug:
-                print("....Getting Status")
-            print(remote_path)
-            status = getStatus(remote_path)
-            sleep(.05)
-            try:
-                print(remote_path)
-                image = pf.open(remote_path, ignore_missing_end=True)
-            except Exception as e:
-                print("Failing at newfiles",str(e))
-                continue
-            # CAN'T REMEMBER WHY THIS IS HERE; DID WE ONLY WANT 60s EXPOSURES?
-            # if image[0].header['EXPTIME']!=30.0: continue
+        # If new object, moved, or no star found last time,
+        # then update star position
+        if status["new obj"] or status["moved"] or self.star == (-1, -1):
 
-            try:
-                if image[0].header['imgtype'].lower() != "guider":
-                    continue
-            except:
-                print("Error with this new line")
+            if self.debug:
+                print("......Status = Object/Telescope moved")
+                print("......Finding star")
 
-            if _debug:
-                print("....Checking Status")
+            # Get new position for star, returns (-1,-1) if not found
+            self.star = sedmtools.findstar(data, 100)
 
-            # 4.6.4 Check status of object.
+            print("These are the coords for the star at first pass:")
+            print(self.star)
+            if self.star == (-1, -1):
+                self.output("%20s: No star found in image.\n" % time_str)
+                return
 
-            # Ignore all day-time images
-            if status["daytime"]: 
+            if self.debug:
+                print("......Updating zero-shift")
 
-                if _debug:
-                    print("......Status = Day-time")
-                _stored[fileName] = True
-                continue
+            # Get image of star at current position and set up the
+            # cross-correlation against it
+            self.star_box = self.star_box_at(data, self.star)
+            self.plan = sedmtools.ShiftPlan(self.star_box)
 
-            # If new object, moved, or no star found last time,
-            # then update star position
-            elif status["new obj"] or status["moved"] or _star == (-1, -1):
+            # Calibrate offset calculations (i.e. get what the method
+            # returns for two perfectly aligned images)
+            self.dra_0, self.ddec_0 = sedmtools.getshift(
+                self.star_box, self.star_box, plan=self.plan)
 
-                if _debug: 
-                    print("......Status = Object/Telescope moved")
-                    print("......Finding star")
+            # Output coordinates
+            if "(NS)" not in self.ob_name:
+                self.output_coords(fileName)
 
-                # Get new position for star, returns (-1,-1) if not found
-                _star = sedmtools.findstar(image, 100)
+        else:  # If not moved and not a new object
 
-                print("These are the coords for the star at first pass:")
-                print(_star)
-                print("********")
-                if _star == (-1, -1):
+            if self.debug:
+                print("......Status = None, calculating shift.")
 
-                    _stored[fileName] = True
-                    output("%20s: No star found in image.\n" % time,
-                           _handled_dir + _log)
-                    continue
+            # Get shift in the star's position by checking new image
+            # against old star_box
+            try:
+                dRA, dDec = sedmtools.getshift(
+                    self.star_box, self.star_box_at(data, self.star),
+                    plan=self.plan)
+            except ValueError as e:
+                self.output("%20s shift failed: %s\n" % (time_str, str(e)))
+                self.star = (-1, -1)
+                return
+
+            # Apply offset calibrations
+            dRA -= self.dra_0
+            dDec -= self.ddec_0
+
+            # Try to telnet the command to adjust
+            # if we are currently guiding
+            if guide_telescope:
+                if (abs(dRA) < .85) or (abs(dDec) < .85):
+                    if self.debug:
+                        print("......Sending Telnet shift to telescope")
+                    try:
+                        r = self.send_shift(dRA, dDec)
+                        if r == 0:
+                            shift_sent = True
+                            self.latencies.append(
+                                (time.monotonic() - t_arrive) * 1000.)
+                            if len(self.latencies) % \
+                                    latency_report_every == 0:
+                                self.output(self.latency_report())
+                        else:
+                            if r != -3:
+                                self.output("Shift not sent. Error = %i\n |"
+                                            " Command=GM %s %s 10 10\n" %
+                                            (r, dRA, dDec))
+                    except Exception as e:
+                        shift_sent = False
+                        self.output("Error sending shift via telnet.:%s" %
+                                    str(e))
+
+        # Get seeing conditions
+        if self.debug:
+            print("....Getting FWHM")
+
+        fwhm = sedmtools.getfwhm(image, self.star)  # Get FWHM of star
+
+        # If FWHM measurement didn't work
+        if fwhm == -1:
+
+            if self.debug:
+                print("....FWHM Failed, getting new star")
+
+            # Try to get new star-coordinates
+            self.star = sedmtools.findstar(data, 100)
+
+            # If starfind failed, output error and move on
+            if self.star == (-1, -1):
+                if self.debug:
+                    print("....new star failed")
+                self.output("%20s no usable star found." % time_str)
+                return
+
+            # If starfind succeeded, output and try fwhm again
+            else:
+                if self.debug:
+                    print("....Getting FWHM (2)")
+                self.output_coords(fileName)
+                fwhm = sedmtools.getfwhm(image, self.star)
+
+                # If still failed, output error and move on
+                if fwhm == -1:
+                    self.output("%20s FWHM measurement failed." % time_str)
+                    return
+
+        # Output
+        if self.debug:
+            print("....Output stage")
+
+        # Normal results output stage
+        f_x = "%.2f" % fwhm[0]
+        f_y = "%.2f" % fwhm[1]
+        f_r = "%.2f" % fwhm[2]
+        f_a = "%.2f" % fwhm[3]
+        if type(dRA) != str:
+            dRA = "%.2f" % dRA
+        if type(dDec) != str:
+            dDec = "%.2f" % dDec
+        self.output("%20s %10s %10s %10s %10s %10s %10s %10s\n" %
+                    (time_str, dRA, dDec, shift_sent, f_x, f_y, f_r, f_a))
+        sys.stdout.flush()
+        self._seeing.write("%f-%s\n" % (fwhm[3], time_str))
+
+        # Upload logs
+        self.upload_logs()
+
+    # 3.8 MAIN LOOP
+    def run(self):
+
+        if self.debug:
+            print("Beginning main loop")
 
-                if _debug:
-                    print("......Updating zero-shift")
-
-                # Get (sBs x sBs) sized image of star at current position
-                # (deep copy from fits data)
-                _starBox = np.empty_like(image[0].data[_star[0]-_sBs:_star[0]+_sBs,
-                                        _star[1]-_sBs:_star[1]+_sBs])
-                _starBox[:] = image[0].data[_star[0]-_sBs:_star[0]+_sBs,
-                                    _star[1]-_sBs:_star[1]+_sBs]
-
-                # Calibrate offset calculations (i.e. get what the method
-                # returns for two perfectly aligned images)
-                _dRA_0, _dDec_0 = sedmtools.getshift(_starBox, _starBox)
-
-                print("These are the values from sedmtools.getshift")
-                print(_dRA_0, _dDec_0)
-                print("****************")
-                # Output coordinates
-                if "(NS)" not in _obName:
-                    outputCoords(fileName, _handled_dir+_log)
-
-            else:  # If not moved and not a new object
-
-                if _debug:
-                    print("......Status = None, calculating shift.")
-
-                # Get x,y position of star in previous image
-                x, y = _star
-
-                # Get shift in the star's position by checking new image
-                # against old _starBox
-                dRA, dDec = sedmtools.getshift(_starBox,
-                                               image[0].data[x-_sBs: x+_sBs,
-                                               y-_sBs:y+_sBs])
-
-                # Apply offset calibrations
-                dRA -= _dRA_0
-                dDec -= _dDec_0
-
-                # Try to telnet the command to adjust
-                # if we are currently guiding
-                if guide_telescope:
-                    if (abs(dRA) < .85) or (abs(dDec) < .85):
-                        if _debug:
-                            print("......Sending Telnet shift to telescope")
-
-                        try:
-                            print("Doing shift GM %s %s 10 10\n" %
-                                  (round(dRA, 5), round(dDec, 5)))
-                            _t.write("GM %s %s 10 10\n" % (round(dRA, 5),
-                                                           round(dDec, 5)))
-                            cmd = "GM %s %s 10 10\n" % (dRA, dDec)
-                            r = int(_t.expect(["-?\d"], 60)[2])
-                            if r == 0:
-                                shift_sent = True
-                            else: 
-                                if r != -3:
-                                    output("Shift not sent. Error = %i\n |"
-                                           " Command=%s" % (r, cmd),
-                                           _handled_dir+_log)
-                        except Exception as e:
-                            shift_sent = False
-                            
-                            output("Error sending shift via telnet.:%s" %
-                                   str(e), _handled_dir+_log)
-
-            # 4.6.5 GET SEEING CONDITIONS
-            if _debug:
-                print("....Getting FWHM")
-
-            fwhm = sedmtools.getfwhm(image, _star)  # Get FWHM of star
-
-            # If FWHM measurement didn't work
-            if fwhm == -1:
-
-                if _debug:
-                    print("....FWHM Failed, getting new star")
-
-                # Try to get new star-coordinates
-                _star = sedmtools.findstar(image, 100)
-
-                # If starfind failed, output error, store and move on
-                if _star == (-1, -1):
-                    if _debug:
-                        print("....new star failed")
-                    output("%20s no usable star found." % time,
-                           _handled_dir+_log)
-                    _stored[fileName] = True
+        try:
+            while True:
+                # Directory and logs for today
+                now = localtime()
+                remote_dir = os.path.join(self.remote_root, "%04d%02d%02d" %
+                                          (now.tm_year, now.tm_mon,
+                                           now.tm_mday))
+                if remote_dir != self.remote_dir or \
+                        (self._observer is None and Observer is not None and
+                         os.path.isdir(remote_dir)):
+                    self.watch(remote_dir)
+                    self.open_logs("%04d_%02d_%02d" % (now.tm_year,
+                                                       now.tm_mon,
+                                                       now.tm_mday))
+                    # Catch anything already there
+                    self.scan()
+
+                try:
+                    fileName, t_arrive = self.queue.get(timeout=self.poll)
+                except queue.Empty:
+                    # Backstop for file systems without events
+                    self.scan()
                     continue
 
-                # If starfind succeeded, output and try fwhm again
-                else:
-                    if _debug:
-                        print("....Getting FWHM (2)")
-                    outputCoords(fileName, _handled_dir+_log)
-                    fwhm = sedmtools.getfwhm(image, _star)
-
-                    # If still failed, output error, store and move on
-                    if fwhm == -1:
-                        output("%20s FWHM measurement failed." % time,
-                               _handled_dir+_log)
-                        _stored[fileName] = True
-                        continue
-
-            # 4.6.6 OUTPUT
-            if _debug:
-                print("....Output stage")
-
-            # Normal results output stage
-            f_x = "%.2f" % fwhm[0]
-            f_y = "%.2f" % fwhm[1]
-            f_r = "%.2f" % fwhm[2]
-            f_a = "%.2f" % fwhm[3]
-            if type(dRA) != str:
-                dRA = "%.2f" % dRA
-            if type(dDec) != str:
-                dDec = "%.2f" % dDec
-            output("%20s %10s %10s %10s %10s %10s %10s %10s\n" %
-                   (time, dRA, dDec, shift_sent, f_x, f_y, f_r, f_a),
-                   _handled_dir+_log)
-            sys.stdout.flush()
-            _stored[fileName] = True
-            f = open(_handled_dir+seeing_log, 'a')
-            f.write("%f-%s\n" % (fwhm[3], time))
-            f.close()
-
-            # Upload logs
-            shutil.copyfile(_handled_dir+_log, remote_dir+_log)
-            shutil.copyfile(_handled_dir+seeing_log, remote_dir+seeing_log)
-
-        if _debug:
-            print("....Sleeping")
-
-        sleep(3)  # Wait 3 seconds before rerunning
-
-
-while True:
-    try:
-        auto(params)
-    except Exception as e:
-        print("Exit error")
-        print(str(e))
-    
+                # Only guide on the most recent frame
+                guide_telescope = self.use_telnet and self.queue.empty()
+                self.process(fileName, t_arrive, guide_telescope)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stop watching, write the latency histogram and close up"""
+        self.stop_watch()
+        if self.latencies:
+            self.output(self.latency_report())
+        self.close_logs()
+        self.close_telnet()
+
+# END 3. GUIDER SERVICE
 
 
+def auto(params):  # Run this method to begin the guider
+    GuiderService(params).run()
+
 
+if __name__ == '__main__':
+    while True:
+        try:
+            auto(params)
+        except Exception as e:
+            print("Exit error")
+            print(str(e))
+            sleep(1)
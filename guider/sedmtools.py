@@ -2,6 +2,8 @@
 import numpy as np
 import astropy.io.fits as pf
 import matplotlib.pyplot as plt
+from scipy import ndimage
+from scipy import fft as sp_fft
 from scipy.optimize import leastsq
 from scipy.optimize import curve_fit
 from scipy.optimize import fmin
@@ -46,10 +48,7 @@ def focusfind(focus_dir):
             starBox = im[0].data[x-s:x+s, y-s:y+s]
 
             # Background subtract
-            median = np.median(starBox)
-            for a in range(starBox.shape[0]):
-                for b in range(starBox.shape[1]):
-                    starBox[a, b] -= median
+            starBox = starBox - np.median(starBox)
 
             # Fit 2D gaussian and deduce FWHM
             try:
@@ -99,13 +98,65 @@ def focusfind(focus_dir):
     return minFoc
 
 
-# This method convolves two 2D matrices and uses
-# the correlation matrix to return the offset
-def getshift(img1, img2, n=1):
+# FFT cross-correlation of star boxes against a fixed reference box.
+# The reference spectrum is computed once, so each new frame only costs
+# one forward and one inverse real FFT.
+class ShiftPlan:
+
+    def __init__(self, ref, workers=1):
+        ref = np.asarray(ref, dtype=float)
+        self.shape = ref.shape
+        # Zero pad to avoid wrap-around, to a fast FFT size
+        self.fshape = tuple(sp_fft.next_fast_len(2*n, real=True)
+                            for n in self.shape)
+        self.workers = workers
+        self.ref_fft = np.conj(sp_fft.rfft2(ref - np.mean(ref),
+                                            s=self.fshape, workers=workers))
+
+    # Return the (row, column) pixel shift of img relative to the reference
+    def shift(self, img):
+        img = np.asarray(img, dtype=float)
+        if img.shape != self.shape:
+            raise ValueError("Image shape %s does not match reference %s" %
+                             (img.shape, self.shape))
+        img_fft = sp_fft.rfft2(img - np.mean(img), s=self.fshape,
+                               workers=self.workers)
+        corr = sp_fft.irfft2(img_fft * self.ref_fft, s=self.fshape,
+                             workers=self.workers)
+        return xcorr_peak(corr)
+
+
+# Sub-pixel position of the peak of a (circular) correlation map, as a
+# signed shift.  A Gaussian (or, for non-positive values, a parabola) is
+# fitted through the peak and its neighbours along each axis.
+def xcorr_peak(corr):
+
+    i, j = np.unravel_index(np.argmax(corr), corr.shape)
+    ni, nj = corr.shape
+
+    def vertex(cm, c0, cp):
+        if cm > 0 and c0 > 0 and cp > 0:
+            cm, c0, cp = np.log(cm), np.log(c0), np.log(cp)
+        denom = cm - 2*c0 + cp
+        if denom == 0:
+            return 0.
+        return 0.5*(cm - cp)/denom
+
+    di = vertex(corr[(i-1) % ni, j], corr[i, j], corr[(i+1) % ni, j])
+    dj = vertex(corr[i, (j-1) % nj], corr[i, j], corr[i, (j+1) % nj])
+    si = i + di
+    sj = j + dj
+    if si > ni/2:
+        si -= ni
+    if sj > nj/2:
+        sj -= nj
+    return si, sj
+
+
+# This method cross-correlates two 2D matrices and uses
+# the correlation peak to return the offset (arcsec) of img2 from img1
+def getshift(img1, img2, n=1, plan=None):
 
-    print("These are the images being compared")
-    print(img1, img2)
-    print("******************")
     if type(img1) == pf.hdu.hdulist.HDUList:
         img1 = img1[0].data
     if type(img2) == pf.hdu.hdulist.HDUList:
@@ -113,16 +164,36 @@ def getshift(img1, img2, n=1):
     x = img1.shape[0]
     y = img1.shape[1]
 
-    conv = convolve(img1[0:x/n, 0:y/n], img2[0:x/n, 0:y/n])
-    peak = conv[np.unravel_index(np.nanargmax(conv), conv.shape)]
-    for a in range(conv.shape[0]):
-        for b in range(conv.shape[1]):
-            if conv[a, b] < peak/2:
-                conv[a, b] = 0
-    params = fitgaussian(conv)
+    if plan is None:
+        plan = ShiftPlan(img1[0:x//n, 0:y//n])
+    dx, dy = plan.shift(img2[0:x//n, 0:y//n])
 
     # Convert to RA and Dec
-    return -params[2]*0.395, -params[1]*0.395
+    return -dy*0.395, -dx*0.395
+
+
+# Return a background (median) subtracted copy of the (2s+1)^2 box
+# around c, clipped to the image.  Also returns the box origin.
+def star_cutout(data, c, s=10):
+
+    x, y = int(c[0]), int(c[1])
+    x0, y0 = max(0, x-s), max(0, y-s)
+    box = np.array(data[x0:x+s+1, y0:y+s+1], dtype=float)
+    box -= np.median(box)
+    return box, (x0, y0)
+
+
+# Flux weighted centroid of the star near c, from first moments of the
+# positive pixels in the background subtracted box
+def centroid(data, c, s=10):
+
+    box, (x0, y0) = star_cutout(data, c, s)
+    box[box < 0] = 0
+    total = box.sum()
+    if total <= 0:
+        return float(c[0]), float(c[1])
+    X, Y = np.indices(box.shape)
+    return x0 + (X*box).sum()/total, y0 + (Y*box).sum()/total
 
 
 # Returns the Full-width-half-max of a star (given or auto-found) in an image
@@ -142,18 +213,8 @@ def getfwhm(img, c=(-1, -1)):
 
     # If star coords given, extract star & fit 2d gaussian
     else:
-        print("These are the coords that are being used for getfwhm")
-        print(c)
-        print("*******************")
-        s = 10
-        x, y = c
-        starBox = img[x-s:x+s+1, y-s:y+s+1]
-
-        # Background subtract
-        median = np.median(starBox)
-        for a in range(starBox.shape[0]):
-            for b in range(starBox.shape[1]):
-                starBox[a, b] -= median
+        # Extract star & background subtract
+        starBox = star_cutout(img, c, 10)[0]
 
         # Fit 2D gaussian and deduce FWHM
         try:
@@ -173,124 +234,44 @@ def getfwhm(img, c=(-1, -1)):
         return li
 
 
+# Mask of saturated (> cap) regions, each grown to its bounding box plus
+# 'border' pixels on every side
+def saturation_mask(data, cap=40000, border=20):
+
+    mask = np.zeros(data.shape, dtype=bool)
+    labels, nlab = ndimage.label(data > cap, structure=np.ones((3, 3)))
+    if nlab == 0:
+        return mask
+    for sl in ndimage.find_objects(labels):
+        mask[max(0, sl[0].start-border):sl[0].stop+border,
+             max(0, sl[1].start-border):sl[1].stop+border] = True
+    return mask
+
+
 # This method takes in an image and finds a useable star
 # It works by roughly the following algorithm:
-# Select bright but not saturated pixel
+# Select brightest pixel outside of (masked) saturated areas
 def findstar(img, m=25):
 
     cap = 40000
-    print(type(img))
-    data = img[0].data
-    # if type(img) == pf.hdu.hdulist.HDUList: data = img[0].data
-    # elif type(img) == np.ndarray: data = img #If array
-    # else:
-    #    print("Unrecognized input type for findStar(img)")
-    #    return (-1,-1)
+    if type(img) == pf.hdu.hdulist.HDUList:
+        data = img[0].data
+    else:
+        data = img
 
     # Crop data within a certain margin, use deep copy
-    dataCropped = np.empty_like(data[m:data.shape[0]-m, m:data.shape[1]-m])
-    dataCropped[:] = data[m:data.shape[0]-m, m:data.shape[1]-m]
+    dataCropped = np.array(data[m:data.shape[0]-m, m:data.shape[1]-m],
+                           dtype=float)
 
-    # Keep taking brightest until px < 90% of Full Well Value
-    found = False
-
-    while not found:
+    # Mask entire saturated areas so that we don't select any of them
+    dataCropped[saturation_mask(dataCropped, cap, 20)] = 0
 
+    # Brightest remaining pixel
+    try:
         i, j = np.unravel_index(np.nanargmax(dataCropped), dataCropped.shape)
-
-        import sys
-        sys.stdout.flush()
-
-        # Mask entire saturated area so that we don't select
-        # any more of these saturated pixels
-        if dataCropped[i, j] > cap:
-
-            # Create a box around the original saturated pixel
-            u, d, r, l = 1, 1, 1, 1
-            box = None
-            done = False
-            count = 0
-
-            # Keep expanding box till all connected
-            # saturated pixels are enclosed
-            while not done:
-                count += 1
-                if count > 100:
-                    done = True
-
-                # Expand box
-                box = dataCropped[max(0, i-l):min(i+r+1, data.shape[0]-1),
-                                  max(0, j-d):min(j+u+1, data.shape[1]-1)]
-
-                # By default, we do not want to expand
-                expand_up, expand_down, expand_left, expand_right = \
-                    False, False, False, False
-
-                # Run vertically through right- and left-most columns of box
-                x_0 = 0
-                x_e = box.shape[0]-1
-                for y in range(box.shape[1]):
-                    # If there is a saturated pixel in the left-most column,
-                    # we need to keep expanding left
-                    if box[x_0, y] > cap:
-                        expand_left = True
-                        l += 1
-                    # If there is a saturated pixel in the right-most column,
-                    # we need to keep expanding right
-                    if box[x_e, y] > cap:
-                        expand_right = True
-                        r += 1
-
-                # Run horizontally across top and bottom rows of box
-                y_0 = 0
-                y_e = box.shape[1]-1
-                for x in range(box.shape[0]):
-                    # If there is a saturated pixel in the top row,
-                    # we need to keep expanding up
-                    if box[x, y_0] > cap:
-                        expand_down = True
-                        d += 1
-                    # If there is a saturated pixel in the bottom row,
-                    # we need to keep expanding down
-                    if box[x, y_e] > cap:
-                        expand_up = True
-                        u += 1
-
-                # Check if box has reached edge of image on any side and
-                # stop expanding if so
-                if i-l <= 0:
-                    expand_left = False
-                if j-d <= 0:
-                    expand_down = False
-                if i+r+1 >= data.shape[0]-1:
-                    expand_right = False
-                if j+u+1 >= data.shape[1]-1:
-                    expand_up = False
-
-                # If we have finally enclosed all saturated pixels,
-                # exit the loop
-                if not(expand_up or expand_down or expand_left or expand_right):
-                    done = True
-
-            border = 20
-            u += border
-            d += border
-            l += border
-            r += border
-
-            # Expand box again by 'border' amount, so we mask
-            # the surrounding area too
-            box = dataCropped[max(0, i-l):min(i+r+1, data.shape[0]-1),
-                              max(0, j-d):min(j+u+1, data.shape[1]-1)]
-
-            # Set all pixels to zero; this is masking the saturated pixels
-            # so we don't select them again
-            for a in range(box.shape[0]):
-                for b in range(box.shape[1]):
-                    dataCropped[a+max(0, i-l), b+max(0, j-d)] = 0
-
-        else:
-            found = True  # If our selection is not saturated, it may be used
+    except ValueError:
+        print("No star found")
+        return -1, -1
 
     # Add back on margin values to convert to main coord-system
     i += m
@@ -304,7 +285,7 @@ def findstar(img, m=25):
         return -1, -1
 
     # Return position of star
-    return i, j
+    return int(i), int(j)
 
 
 # Simple quadratic function
@@ -0,0 +1,370 @@
+"""Pooled client for the marshal (fritz) API.
+
+Functions
+    * :func:`get_client`  shared client for a marshal token
+
+Classes
+    * :class:`MarshalClient`  keep-alive session with rate limiting, GET
+      coalescing, a GET cache and latency metrics
+    * :class:`RateLimiter`    space requests, shared by all threads
+
+Note:
+    All modules that talk to a marshal use the client returned by
+    :func:`get_client`, one per token, so connections are kept alive and
+    re-used across modules and threads.  Identical GETs in flight at the
+    same time are sent once.  Successful GETs are only cached when a
+    caller asks for it (the ttl argument of :meth:`MarshalClient.api`, or
+    cache_ttl in marshals.json, 0 by default), since a cached response does
+    not show changes made by other processes or on the marshal itself; any
+    other request sent through the client empties the cache.  Requests to the
+    production url can be sent to another server (e.g. the stub server in
+    stub_server.py) by setting base_url in marshals.json or the
+    SEDMMARSHALURL environment variable.
+
+    This is used as a python script to measure marshal throughput as
+    follows::
+
+        usage: client.py [-h] [--url URL] [--requests N] [--nproc NPROC]
+                         [--endpoint ENDPOINT] [--ttl TTL]
+                         [--max_rate MAX_RATE]
+
+        optional arguments:
+          -h, --help           show this help message and exit
+          --url URL            marshal base url (e.g. http://localhost:8089/)
+          --requests N         number of requests to send (100)
+          --nproc NPROC        number of concurrent threads (4)
+          --endpoint ENDPOINT  api endpoint to GET (api/groups)
+          --ttl TTL            GET cache time to live in s (0)
+          --max_rate MAX_RATE  maximum requests / s (from marshals.json)
+
+"""
+import os
+import re
+import copy
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import sedmpy_version
+
+DEFAULT_TIMEOUT = 5  # seconds
+# Production url of each marshal, re-mapped to base_url if set
+marshal_urls = {'fritz': 'https://fritz.science/'}
+
+with open(os.path.join(sedmpy_version.CONFIG_DIR, 'marshals.json')) as data_file:
+    marshal_cfg = json.load(data_file)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, *args, **kwargs):
+        self.timeout = DEFAULT_TIMEOUT
+        if "timeout" in kwargs:
+            self.timeout = kwargs["timeout"]
+            del kwargs["timeout"]
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        timeout = kwargs.get("timeout")
+        if timeout is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class RateLimiter:
+    """Limit the rate of requests, shared by all threads.
+
+    Requests are spaced by at least 1/max_rate seconds, so concurrent
+    uploads stay under the marshal rate limit (429 responses are still
+    retried with backoff by the session).
+    """
+    def __init__(self, max_rate):
+        self.interval = 1. / max_rate if max_rate else 0.
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class _Call:
+    """A GET in flight, shared by the threads asking for the same url"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+def endpoint_kind(url):
+    """Metrics key of a url: the api path with ids replaced by :id"""
+    path = url.split('://', 1)[-1].split('?')[0]
+    path = path.split('/api/', 1)[-1] if '/api/' in path else \
+        path.split('/', 1)[-1]
+    return '/'.join(':id' if re.search(r'\d', p) else p
+                    for p in path.strip('/').split('/'))
+
+
+class MarshalClient:
+    """Keep-alive client for the marshal API.
+
+    Args:
+        token (str): API token
+        base_url (str): url to send requests to instead of prod_url
+            (None: prod_url)
+        prod_url (str): production url of the marshal
+        timeout (float): request timeout in s
+        max_rate (float): maximum requests / s (None or 0: no limit)
+        cache_ttl (float): time in s successful GETs are cached (0: no cache)
+        pool_size (int): number of connections kept alive
+
+    """
+
+    def __init__(self, token, base_url=None, prod_url=marshal_urls['fritz'],
+                 timeout=DEFAULT_TIMEOUT, max_rate=None, cache_ttl=0.,
+                 pool_size=10):
+        self.token = token
+        self.prod_url = prod_url
+        self.base_url = base_url or prod_url
+        if not self.base_url.endswith('/'):
+            self.base_url += '/'
+        self.cache_ttl = cache_ttl
+        self.rate_limiter = RateLimiter(max_rate)
+        self.session = requests.Session()
+        self.session.headers.update(
+            {'Authorization': 'token {}'.format(token)})
+        retries = Retry(
+            total=5,
+            backoff_factor=2,
+            status_forcelist=[405, 429, 500, 502, 503, 504],
+            method_whitelist=["HEAD", "GET", "PUT", "POST", "PATCH", "DELETE"]
+        )
+        adapter = TimeoutHTTPAdapter(timeout=timeout, max_retries=retries,
+                                     pool_connections=pool_size,
+                                     pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._cache = {}
+        self._metrics = {}
+
+    def url(self, endpoint):
+        """Return the url to send a request for endpoint to"""
+        if self.base_url != self.prod_url and \
+                endpoint.startswith(self.prod_url):
+            return self.base_url + endpoint[len(self.prod_url):]
+        return endpoint
+
+    def _count(self, method, endpoint, what, dt=None):
+        """Add a request (what='sent'), error, cache hit or coalesced GET
+        to the metrics"""
+        key = "%s %s" % (method, endpoint_kind(endpoint))
+        with self._lock:
+            met = self._metrics.setdefault(key, {
+                'sent': 0, 'errors': 0, 'cache_hits': 0, 'coalesced': 0,
+                'total_time': 0., 'max_time': 0.})
+            met[what] += 1
+            if dt is not None:
+                met['total_time'] += dt
+                met['max_time'] = max(met['max_time'], dt)
+
+    def _send(self, method, endpoint, data=None, verbose=False):
+        """Send one request, return its json response or an error dict"""
+        error_dict = {'status': 'Error', 'message': 'AnError', 'data': None}
+        self.rate_limiter.wait()
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, self.url(endpoint),
+                                            json=data)
+            logging.debug('HTTP code: {}, {}'.format(response.status_code,
+                                                     response.reason))
+            if verbose:
+                print('HTTP code: {}, {}'.format(response.status_code,
+                                                 response.reason))
+                if response.status_code in (200, 400):
+                    print(response.text)
+            ret = response.json()
+        except requests.exceptions.RetryError:
+            error_dict['message'] = 'RetryError'
+            ret = error_dict
+        except requests.exceptions.ConnectionError:
+            error_dict['message'] = 'ConnectionError'
+            ret = error_dict
+        except requests.exceptions.Timeout:
+            error_dict['message'] = 'Timeout'
+            ret = error_dict
+        except AttributeError:
+            error_dict['message'] = 'AttributeError'
+            ret = error_dict
+        except ValueError:
+            error_dict['message'] = 'JSONDecodeError'
+            ret = error_dict
+        self._count(method, endpoint, 'sent', time.monotonic() - start)
+        if not isinstance(ret, dict) or 'success' not in \
+                str(ret.get('status', '')):
+            self._count(method, endpoint, 'errors')
+        return ret
+
+    def _get(self, endpoint, ttl, verbose=False):
+        """GET endpoint, coalescing identical GETs in flight and caching
+        successful responses for ttl seconds (0: cache not used)"""
+        with self._lock:
+            hit = self._cache.get(endpoint) if ttl else None
+            if hit is not None and hit[0] > time.monotonic():
+                call = None
+                what = 'cache_hits'
+            else:
+                call = self._inflight.get(endpoint)
+                if call is None:
+                    call = self._inflight[endpoint] = _Call()
+                    what = None
+                else:
+                    what = 'coalesced'
+        if what == 'cache_hits':
+            self._count('GET', endpoint, what)
+            return copy.deepcopy(hit[1])
+        if what == 'coalesced':
+            call.done.wait()
+            self._count('GET', endpoint, what)
+            return copy.deepcopy(call.result)
+        ret = None
+        try:
+            ret = self._send('GET', endpoint, verbose=verbose)
+        finally:
+            with self._lock:
+                del self._inflight[endpoint]
+                if ttl and isinstance(ret, dict) and \
+                        'success' in str(ret.get('status', '')):
+                    self._cache[endpoint] = (time.monotonic() + ttl, ret)
+            call.result = ret
+            call.done.set()
+        return copy.deepcopy(ret)
+
+    def api(self, method, endpoint, data=None, verbose=False, ttl=None):
+        """Send a request to the marshal.
+
+        Args:
+            method (str): HTTP method
+            endpoint (str): full url of the endpoint
+            data (dict): json payload
+            verbose (bool): print the response
+            ttl (float): cache time to live of a GET in s (None: cache_ttl)
+
+        Returns:
+            dict: json response, or a dict with status 'Error' and the
+                error in message if the request failed
+
+        """
+        if method.upper() == 'GET' and data is None:
+            return self._get(endpoint,
+                             self.cache_ttl if ttl is None else ttl,
+                             verbose=verbose)
+        if method.upper() not in ('GET', 'HEAD'):
+            self.clear_cache()
+        return self._send(method, endpoint, data=data, verbose=verbose)
+
+    def clear_cache(self):
+        """Empty the GET cache"""
+        with self._lock:
+            self._cache.clear()
+
+    def metrics(self):
+        """Return request metrics by method and endpoint kind"""
+        with self._lock:
+            return copy.deepcopy(self._metrics)
+
+    def reset_metrics(self):
+        """Zero the request metrics"""
+        with self._lock:
+            self._metrics.clear()
+
+    def metrics_report(self):
+        """Return the request metrics as a printable table"""
+        lines = ["%-40s %6s %6s %6s %6s %9s %9s" %
+                 ("request", "sent", "errors", "cached", "coalsc",
+                  "mean(ms)", "max(ms)")]
+        for key, met in sorted(self.metrics().items()):
+            mean = 1000. * met['total_time'] / met['sent'] \
+                if met['sent'] else 0.
+            lines.append("%-40s %6d %6d %6d %6d %9.1f %9.1f" %
+                         (key[:40], met['sent'], met['errors'],
+                          met['cache_hits'], met['coalesced'], mean,
+                          1000. * met['max_time']))
+        return "\n".join(lines)
+
+
+def get_client(marshal='fritz', token_key='token'):
+    """Get the shared client for a marshal token.
+
+    Settings are read from the marshal entry of marshals.json: base_url,
+    max_rate (requests / s), cache_ttl (s) and timeout (s).  The
+    SEDMMARSHALURL environment variable overrides base_url.
+
+    Args:
+        marshal (str): marshal name in marshals.json
+        token_key (str): key of the token in the marshal entry (e.g.
+            'token' or 'alloc_token')
+
+    Returns:
+        MarshalClient: client shared by all callers with the same token
+
+    """
+    with _clients_lock:
+        key = (marshal, token_key)
+        if key not in _clients:
+            cfg = marshal_cfg['marshals'][marshal]
+            base_url = os.environ.get("SEDMMARSHALURL", cfg.get('base_url'))
+            _clients[key] = MarshalClient(
+                cfg[token_key], base_url=base_url,
+                prod_url=marshal_urls.get(marshal, base_url),
+                timeout=cfg.get('timeout', DEFAULT_TIMEOUT),
+                max_rate=cfg.get('max_rate', 5.),
+                cache_ttl=cfg.get('cache_ttl', 0.))
+        return _clients[key]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="""Measure marshal API throughput""",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--url', type=str, default=None,
+                        help='marshal base url (e.g. http://localhost:8089/)')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='number of requests to send (100)')
+    parser.add_argument('--nproc', type=int, default=4,
+                        help='number of concurrent threads (4)')
+    parser.add_argument('--endpoint', type=str, default='api/groups',
+                        help='api endpoint to GET (api/groups)')
+    parser.add_argument('--ttl', type=float, default=0.,
+                        help='GET cache time to live in s (0)')
+    parser.add_argument('--max_rate', type=float, default=None,
+                        help='maximum requests / s (from marshals.json)')
+    args = parser.parse_args()
+
+    if args.url:
+        os.environ["SEDMMARSHALURL"] = args.url
+    client = get_client()
+    client.cache_ttl = args.ttl
+    if args.max_rate is not None:
+        client.rate_limiter = RateLimiter(args.max_rate)
+    target = marshal_urls['fritz'] + args.endpoint
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.nproc) as executor:
+        list(executor.map(lambda _: client.api('GET', target),
+                          range(args.requests)))
+    dt = time.monotonic() - t0
+    print(client.metrics_report())
+    print("%d requests in %.2f s: %.1f requests / s" %
+          (args.requests, dt, args.requests / dt if dt > 0 else 0.))
@@ -1,71 +1,20 @@
 import os
 import json
 import glob
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 import sedmpy_version
-
-DEFAULT_TIMEOUT = 5  # seconds
+import marshals.client as marshal_client
 
 with open(os.path.join(sedmpy_version.CONFIG_DIR, 'marshals.json')) as data_file:
     marshal_cfg = json.load(data_file)
 
 token = marshal_cfg['marshals']['fritz']['token']
 
-
-class TimeoutHTTPAdapter(HTTPAdapter):
-    def __init__(self, *args, **kwargs):
-        self.timeout = DEFAULT_TIMEOUT
-        if "timeout" in kwargs:
-            self.timeout = kwargs["timeout"]
-            del kwargs["timeout"]
-        super().__init__(*args, **kwargs)
-
-    def send(self, request, **kwargs):
-        timeout = kwargs.get("timeout")
-        if timeout is None:
-            kwargs["timeout"] = self.timeout
-        return super().send(request, **kwargs)
-
-
-session = requests.Session()
-session_headers = {'Authorization': 'token {}'.format(token)}
-retries = Retry(
-    total=5,
-    backoff_factor=2,
-    status_forcelist=[405, 429, 500, 502, 503, 504],
-    method_whitelist=["HEAD", "GET", "PUT", "POST", "PATCH"]
-)
-adapter = TimeoutHTTPAdapter(timeout=5, max_retries=retries)
-session.mount("https://", adapter)
-session.mount("http://", adapter)
+# Shared, pooled fritz client (see client.py)
+client = marshal_client.get_client('fritz', 'token')
 
 
 def api(method, endpoint, data=None, verbose=False):
-    headers = {'Authorization': 'token {}'.format(token)}
-    error_dict = {'status': 'Error', 'message': 'AnError', 'data': None}
-    try:
-        response = session.request(method, endpoint, json=data, headers=headers)
-        print('HTTP code: {}, {}'.format(response.status_code, response.reason))
-        if response.status_code in (200, 400) and verbose:
-            print(response.text)
-            # print('JSON response: {}'.format(response.json()))
-        ret = response.json()
-    except requests.exceptions.RetryError:
-        error_dict['message'] = 'RetryError'
-        ret = error_dict
-    except requests.exceptions.ConnectionError:
-        error_dict['message'] = 'ConnectionError'
-        ret = error_dict
-    except AttributeError:
-        error_dict['message'] = 'AttributeError'
-        ret = error_dict
-    except json.decoder.JSONDecodeError:
-        error_dict['message'] = 'JSONDecodeError'
-        ret = error_dict
-
-    return ret
+    return client.api(method, endpoint, data=data, verbose=verbose)
 
 
 def update_status_request(status, request_id, marshal_name, save=False,
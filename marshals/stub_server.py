@@ -0,0 +1,297 @@
+"""Local stub of the fritz API, for tests and for benchmarking marshal uploads.
+
+Functions
+    * :func:`start`  start a stub server in a background thread
+
+Classes
+    * :class:`StubFritz`  threaded http server with the fritz endpoints used
+      by the pipeline, keeping everything posted in memory
+
+Note:
+    The stub answers the endpoints used by fritz.py, fritz_commenter.py,
+    fritz_allocations.py, fritz_fix_annotations.py and
+    marshals/interface.py with fritz style json responses
+    ({'status': 'success', 'data': ...}).  It can add a fixed latency to
+    every request and answer 429 (with Retry-After) above a request rate,
+    to exercise the client retries and rate limiting.  Point the pipeline
+    at it with the SEDMMARSHALURL environment variable (see client.py).
+
+    This is used as a python script as follows::
+
+        usage: stub_server.py [-h] [--port PORT] [--delay DELAY]
+                              [--max_rate MAX_RATE]
+
+        optional arguments:
+          -h, --help           show this help message and exit
+          --port PORT          port to listen on (8089)
+          --delay DELAY        latency added to each request in s (0)
+          --max_rate MAX_RATE  answer 429 above this requests / s (no limit)
+
+"""
+import re
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _ok(data=None):
+    return 200, {'status': 'success', 'message': '', 'data': data}
+
+
+def _error(code, message):
+    return code, {'status': 'error', 'message': message, 'data': None}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Dispatch requests to the StubFritz routes"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        code, ret, headers = self.server.dispatch(
+            self.command, self.path, self.headers.get('Authorization', ''),
+            body)
+        out = json.dumps(ret).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        for key, val in headers.items():
+            self.send_header(key, val)
+        self.end_headers()
+        self.wfile.write(out)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+
+class StubFritz(ThreadingHTTPServer):
+    """In-memory stub of the fritz API.
+
+    Args:
+        port (int): port to listen on (0: any free port)
+        delay (float): latency added to each request in s
+        max_rate (float): answer 429 above this many requests / s
+            (None: no limit)
+        verbose (bool): log each request
+
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, delay=0., max_rate=None, verbose=False):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.delay = delay
+        self.max_rate = max_rate
+        self.verbose = verbose
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.n_throttled = 0
+        self._recent = []
+        self._next_id = 1
+        self.spectra = {}
+        self.annotations = {}
+        self.comments = {}
+        self.classifications = {}
+        self.sources = {}
+        self.allocations = {}
+        self.statuses = {}
+        self.routes = [
+            ('POST', r'spectrum/ascii$', self.post_spectrum),
+            ('POST', r'spectra/(\d+)/comments$', self.post_comment),
+            ('POST', r'spectra/(\d+)/annotations$', self.post_spec_annotation),
+            ('GET', r'sources/([^/]+)/annotations$', self.get_annotations),
+            ('POST', r'sources/([^/]+)/annotations$', self.post_annotation),
+            ('DELETE', r'(sources|spectra)/([^/]+)/annotations/(\d+)$',
+             self.delete_annotation),
+            ('GET', r'sources/([^/]+)$', self.get_source),
+            ('PATCH', r'sources/([^/]+)$', self.patch_source),
+            ('POST', r'classification$', self.post_classification),
+            ('POST', r'facility$', self.post_status),
+            ('GET', r'followup_request/(\d+)$', self.get_followup_request),
+            ('GET', r'allocation$', self.get_allocations),
+            ('POST', r'allocation$', self.post_allocation),
+            ('PUT', r'allocation/(\d+)$', self.put_allocation),
+            ('DELETE', r'allocation/(\d+)$', self.delete_allocation),
+            ('GET', r'groups$', self.get_groups),
+        ]
+
+    def new_id(self):
+        """Return the next object id (the caller holds the lock)"""
+        self._next_id += 1
+        return self._next_id - 1
+
+    def throttled(self):
+        """True if this request is above max_rate"""
+        if not self.max_rate:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            self._recent = [t for t in self._recent if t > now - 1.]
+            if len(self._recent) >= self.max_rate:
+                self.n_throttled += 1
+                return True
+            self._recent.append(now)
+        return False
+
+    def dispatch(self, method, path, auth, body):
+        """Return http code, json response and extra headers for a request"""
+        if self.delay:
+            time.sleep(self.delay)
+        if self.throttled():
+            code, ret = _error(429, 'Rate limit exceeded')
+            return code, ret, {'Retry-After': '1'}
+        if not auth.startswith('token '):
+            code, ret = _error(401, 'Authentication required')
+            return code, ret, {}
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            code, ret = _error(400, 'Invalid json')
+            return code, ret, {}
+        path = path.split('?')[0]
+        api_path = path.split('/api/', 1)[-1]
+        for meth, pattern, route in self.routes:
+            match = re.match(pattern, api_path)
+            if meth == method and match:
+                with self.lock:
+                    key = "%s %s" % (method, pattern)
+                    self.counts[key] = self.counts.get(key, 0) + 1
+                    code, ret = route(data, *match.groups())
+                return code, ret, {}
+        code, ret = _error(404, 'No route for %s %s' % (method, path))
+        return code, ret, {}
+
+    # Routes (called with the lock held)
+    def post_spectrum(self, data):
+        for key in ('obj_id', 'instrument_id', 'ascii'):
+            if key not in data:
+                return _error(400, 'Missing %s' % key)
+        spec_id = self.new_id()
+        self.spectra[spec_id] = data
+        return _ok({'id': spec_id})
+
+    def post_comment(self, data, spec_id):
+        if int(spec_id) not in self.spectra:
+            return _error(400, 'Invalid spectrum id %s' % spec_id)
+        cid = self.new_id()
+        self.comments[cid] = dict(data, spectrum_id=int(spec_id))
+        return _ok({'comment_id': cid})
+
+    def post_spec_annotation(self, data, spec_id):
+        if int(spec_id) not in self.spectra:
+            return _error(400, 'Invalid spectrum id %s' % spec_id)
+        obj_id = self.spectra[int(spec_id)]['obj_id']
+        return self.post_annotation(dict(data, spectrum_id=int(spec_id)),
+                                    obj_id)
+
+    def get_annotations(self, data, obj_id):
+        return _ok([dict(ann, id=aid) for aid, ann in
+                    sorted(self.annotations.items())
+                    if ann['obj_id'] == obj_id])
+
+    def post_annotation(self, data, obj_id):
+        aid = self.new_id()
+        self.annotations[aid] = dict(data, obj_id=obj_id)
+        return _ok({'annotation_id': aid})
+
+    def delete_annotation(self, data, res_type, res_id, aid):
+        if self.annotations.pop(int(aid), None) is None:
+            return _error(400, 'Invalid annotation id %s' % aid)
+        return _ok()
+
+    def get_source(self, data, obj_id):
+        return _ok(self.sources.setdefault(obj_id, {'id': obj_id,
+                                                    'redshift': None}))
+
+    def patch_source(self, data, obj_id):
+        self.sources.setdefault(obj_id, {'id': obj_id,
+                                         'redshift': None}).update(data)
+        return _ok()
+
+    def post_classification(self, data):
+        cid = self.new_id()
+        self.classifications[cid] = data
+        return _ok({'classification_id': cid})
+
+    def post_status(self, data):
+        if 'followup_request_id' not in data:
+            return _error(400, 'Missing followup_request_id')
+        self.statuses[data['followup_request_id']] = data.get('new_status')
+        return _ok()
+
+    def get_followup_request(self, data, req_id):
+        return _ok({'id': int(req_id),
+                    'status': self.statuses.get(int(req_id), 'submitted')})
+
+    def get_allocations(self, data):
+        return _ok([dict(alloc, id=aid) for aid, alloc in
+                    sorted(self.allocations.items())])
+
+    def post_allocation(self, data):
+        aid = self.new_id()
+        self.allocations[aid] = data
+        return _ok({'id': aid})
+
+    def put_allocation(self, data, aid):
+        if int(aid) not in self.allocations:
+            return _error(400, 'Invalid allocation id %s' % aid)
+        self.allocations[int(aid)].update(data)
+        return _ok()
+
+    def delete_allocation(self, data, aid):
+        if self.allocations.pop(int(aid), None) is None:
+            return _error(400, 'Invalid allocation id %s' % aid)
+        return _ok()
+
+    def get_groups(self, data):
+        return _ok({'user_groups': [{'id': 209, 'name': 'SEDM'}],
+                    'all_groups': [{'id': 209, 'name': 'SEDM'}]})
+
+
+def start(port=0, delay=0., max_rate=None, verbose=False):
+    """Start a stub fritz server in a background thread.
+
+    Args:
+        port (int): port to listen on (0: any free port)
+        delay (float): latency added to each request in s
+        max_rate (float): answer 429 above this many requests / s
+        verbose (bool): log each request
+
+    Returns:
+        StubFritz: the running server, its base url is server.url (stop it
+            with server.shutdown())
+
+    """
+    server = StubFritz(port=port, delay=delay, max_rate=max_rate,
+                       verbose=verbose)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="""Run a local stub of the fritz API""",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--port', type=int, default=8089,
+                        help='port to listen on (8089)')
+    parser.add_argument('--delay', type=float, default=0.,
+                        help='latency added to each request in s (0)')
+    parser.add_argument('--max_rate', type=float, default=None,
+                        help='answer 429 above this requests / s (no limit)')
+    args = parser.parse_args()
+
+    stub = StubFritz(port=args.port, delay=args.delay, max_rate=args.max_rate,
+                     verbose=True)
+    print("Stub fritz API at %s" % stub.url)
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    stub.server_close()
@@ -6,6 +6,8 @@ import astroplan
 from astropy.time import Time, TimeDelta
 from astropy.coordinates import SkyCoord, Angle, EarthLocation, AltAz
 import astropy.units as u
+import numpy as np
+import bisect
 import os
 import psycopg2.extras
 import psycopg2
@@ -59,6 +61,10 @@ class Scheduler:
         self.obsdatetime = obsdatetime
         self.save_as = save_as
         self.dbconn = psycopg2.connect(**_dbconn)
+        # Observable windows per request for the night (see
+        # observable_windows)
+        self.vis_grid = None
+        self.window_cache = {}
         # self.ph_db = sedmpy_import.dbconnect()
         self.query = Template(
             "SELECT r.id AS req_id, r.object_id AS obj_id, \n"
@@ -587,9 +593,144 @@ class Scheduler:
 
         if len(dropped_targets) >= 1:
             df = df[-df["req_id"].isin(dropped_targets)]
+            self.invalidate_windows(dropped_targets)
 
         return {'data': df, 'elaptime': time.time() - start}
 
+    def _set_vis_grid(self, obstime, step=0.1):
+        """
+        Set up the time grid observable windows are computed on: the
+        current night, or 16 hours around obstime if it is not in the
+        current night.  Cached windows are dropped if the grid changes.
+
+        :param obstime: astropy.time.Time
+        :param step: grid resolution in hours
+        :return:
+        """
+        grid = self.vis_grid
+        if grid is not None and grid['jd'][0] <= obstime.jd <= grid['jd'][-1]:
+            return grid
+
+        t0 = self.obs_times['sun_set']
+        t1 = self.obs_times['sun_rise']
+        if not t0 <= obstime <= t1:
+            t0 = obstime - TimeDelta(3600, format='sec')
+            t1 = obstime + TimeDelta(15 * 3600, format='sec')
+        nbins = int(np.ceil((t1 - t0).to(u.hour).value / step)) + 1
+        times = t0 + TimeDelta(np.arange(nbins) * step * 3600., format='sec')
+        frame = AltAz(obstime=times, location=self.site)
+        moon = self.obs_site_plan.moon_altaz(times)
+        self.vis_grid = {'jd': times.jd, 'half': step / 48., 'frame': frame,
+                         'moon_alt': moon.alt.radian,
+                         'moon_az': moon.az.radian}
+        self.window_cache = {}
+        return self.vis_grid
+
+    @staticmethod
+    def _mask_to_windows(mask, jd, half=0.):
+        """
+        Convert a boolean mask on the time grid to a list of (start, end) jd,
+        each widened by half a grid step so a lookup uses the nearest point
+        """
+        edges = np.flatnonzero(np.diff(np.concatenate(
+            ([0], mask.astype(np.int8), [0]))))
+        return [(float(jd[i0]) - half, float(jd[i1 - 1]) + half)
+                for i0, i1 in zip(edges[::2], edges[1::2])]
+
+    @staticmethod
+    def in_windows(windows, jd):
+        """
+        Is jd within one of the (start, end) windows?
+        """
+        idx = bisect.bisect_right(windows, (jd, np.inf)) - 1
+        return idx >= 0 and windows[idx][0] <= jd <= windows[idx][1]
+
+    def observable_windows(self, target_list, obstime, altitude_min=15,
+                           airmass=(1, 3.0), moon_sep=(30, 180),
+                           do_airmass=True, do_moon_sep=True):
+        """
+        Get the windows during the night each target satisfies the
+        altitude, airmass and moon separation constraints.
+
+        Windows are computed once per night for all targets not yet cached,
+        in one vectorized pass on a 0.1 hour grid, and cached by request id,
+        request lastmodified time, coordinates and constraint parameters.
+
+        :param target_list: pd.DataFrame of targets
+        :param obstime: astropy.time.Time in the night of interest
+        :param altitude_min:
+        :param airmass:
+        :param moon_sep:
+        :param do_airmass:
+        :param do_moon_sep:
+        :return: dict of req_id: (windows with all constraints met,
+                                  [windows for each constraint])
+        """
+        grid = self._set_vis_grid(obstime)
+        cons = (altitude_min, tuple(airmass) if do_airmass else None,
+                tuple(moon_sep) if do_moon_sep else None)
+
+        ret = {}
+        todo = []
+        for row in target_list.itertuples():
+            key = (row.req_id, str(getattr(row, 'lastmodified', '')),
+                   row.ra, row.dec, cons)
+            if key in self.window_cache:
+                ret[row.req_id] = self.window_cache[key]
+            else:
+                todo.append((key, row))
+
+        # Compute new targets all at once: targets x times
+        fixed = [(key, row) for key, row in todo if row.typedesig == 'f']
+        if fixed:
+            coords = SkyCoord(ra=[row.ra for key, row in fixed],
+                              dec=[row.dec for key, row in fixed], unit="deg")
+            altaz = coords[:, np.newaxis].transform_to(grid['frame'])
+            alt = altaz.alt.radian
+            masks = [alt >= np.radians(altitude_min)]
+            if do_airmass:
+                with np.errstate(divide='ignore'):
+                    secz = np.where(alt > 0., 1. / np.sin(alt), np.inf)
+                masks.append((secz >= airmass[0]) & (secz <= airmass[1]))
+            if do_moon_sep:
+                az = altaz.az.radian
+                malt = grid['moon_alt'][np.newaxis, :]
+                maz = grid['moon_az'][np.newaxis, :]
+                cos_sep = (np.sin(alt) * np.sin(malt) +
+                           np.cos(alt) * np.cos(malt) * np.cos(az - maz))
+                sep = np.degrees(np.arccos(np.clip(cos_sep, -1., 1.)))
+                masks.append(sep >= moon_sep[0])
+            good = np.logical_and.reduce(masks)
+            for i, (key, row) in enumerate(fixed):
+                ent = (self._mask_to_windows(good[i], grid['jd'],
+                                             grid['half']),
+                       [self._mask_to_windows(m[i], grid['jd'], grid['half'])
+                        for m in masks])
+                self.window_cache[key] = ent
+                ret[row.req_id] = ent
+
+        for key, row in todo:
+            if row.typedesig != 'f':
+                ent = ([], [])
+                self.window_cache[key] = ent
+                ret[row.req_id] = ent
+
+        return ret
+
+    def invalidate_windows(self, req_ids=None):
+        """
+        Drop cached observable windows
+
+        :param req_ids: list of request ids (None: all)
+        :return:
+        """
+        if req_ids is None:
+            self.window_cache = {}
+        else:
+            req_ids = set(req_ids)
+            self.window_cache = {k: v for k, v in self.window_cache.items()
+                                 if k[0] not in req_ids}
+
     def get_next_observable_target(self, target_list=None, obsdatetime=None,
                                    airmass=(1, 3.0), moon_sep=(30, 180),
                                    altitude_min=15, ha=(18.75, 5.75),
@@ -640,6 +781,11 @@ class Scheduler:
         rej_html = ""
         target_reorder = False
         print(target_list['typedesig'])
+        windows = self.observable_windows(target_list, obsdatetime,
+                                          altitude_min=altitude_min,
+                                          airmass=airmass, moon_sep=moon_sep,
+                                          do_airmass=do_airmass,
+                                          do_moon_sep=do_moon_sep)
         for row in target_list.itertuples():
             start = obsdatetime
 
@@ -652,24 +798,14 @@ class Scheduler:
                 target_reorder = True
                 continue
 
-            # Force altitude constraint
-            constraint = [astroplan.AltitudeConstraint(
-                min=altitude_min * u.deg)]
-
-            if do_airmass:
-                constraint.append(astroplan.AirmassConstraint(min=airmass[0],
-                                                              max=airmass[1]))
-
-            if do_moon_sep:
-                constraint.append(astroplan.MoonSeparationConstraint(
-                    min=moon_sep[0] * u.degree))
+            # Constraints are altitude, airmass, moon separation:
+            # observable if met at start or finish
+            good, per_constraint = windows[row.req_id]
 
             if row.typedesig == 'f':
                 print(row.objname)
-                if astroplan.is_observable(constraint, self.obs_site_plan,
-                                           row.fixed_object,
-                                           times=[start, finish],
-                                           time_grid_resolution=0.1 * u.hour):
+                if self.in_windows(good, start.jd) or \
+                        self.in_windows(good, finish.jd):
                     print(type(row.start_ha))
                     s_ha = float(row.start_ha.to_string(unit=u.hour,
                                                         decimal=True))
@@ -736,12 +872,10 @@ class Scheduler:
                     if row.priority >= 4:
                         count = 1
                         num = []
-                        for i in constraint:
-                            ret = astroplan.is_observable(
-                                [i], self.obs_site_plan, row.fixed_object,
-                                times=[start, finish],
-                                time_grid_resolution=0.1 * u.hour)
-                            print(ret, i)
+                        for wins in per_constraint:
+                            ret = self.in_windows(wins, start.jd) or \
+                                self.in_windows(wins, finish.jd)
+                            print(ret, count)
                             if ret:
                                 num.append(str(count))
                             count += 1
@@ -950,6 +1084,7 @@ class Scheduler:
         start = time.time()
         ret = self.ph_db.update_request({'id': request_id,
                                          'status': status})
+        self.invalidate_windows([request_id])
 
         print(ret)
 
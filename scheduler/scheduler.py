@@ -4,7 +4,8 @@ import datetime
 import pandas as pd
 import astroplan
 from astropy.time import Time, TimeDelta
-from astropy.coordinates import SkyCoord, EarthLocation, Angle, get_moon
+from astropy.coordinates import SkyCoord, EarthLocation, Angle, AltAz, \
+    get_moon
 import astropy.units as u
 import numpy as np
 import os
@@ -325,15 +326,76 @@ class ScheduleNight:
 
         return target_list
 
+    def get_visibility_grid(self, targets, start_time, end_time, step=120.):
+        """
+        Compute altitude, airmass, moon separation and hour angle of all
+        targets on a grid of times, in one vectorized pass.
+
+        :param targets: pd.DataFrame with ra, dec and typedesig columns
+        :param start_time: astropy.time.Time of first time bin
+        :param end_time: astropy.time.Time the grid has to reach
+        :param step: time bin width in seconds
+        :return: dict of 'times' (Time, ntimes), 'jd' (ntimes), 'step' and
+            (ntargets, ntimes) arrays 'alt', 'airmass', 'moon_sep', 'ha'
+            (hours, 0 - 24 as astroplan target_hour_angle)
+        """
+        nbins = max(int(np.ceil((end_time - start_time).sec / step)) + 1, 1)
+        times = start_time + TimeDelta(np.arange(nbins) * step, format='sec')
+
+        # Only fixed and periodic targets with coordinates can be placed
+        ra = np.asarray(targets['ra'], dtype=float)
+        dec = np.asarray(targets['dec'], dtype=float)
+        valid = targets['typedesig'].isin(['f', 'v']).values & \
+            np.isfinite(ra) & np.isfinite(dec)
+        ra = np.where(valid, ra, 0.)
+        dec = np.where(valid, dec, 0.)
+
+        # Targets x times
+        frame = AltAz(obstime=times, location=self.site)
+        coords = SkyCoord(ra=ra, dec=dec, unit="deg")
+        altaz = coords[:, np.newaxis].transform_to(frame)
+        alt = altaz.alt.radian
+        az = altaz.az.radian
+
+        moon = get_moon(times, location=self.site).transform_to(frame)
+        malt = moon.alt.radian[np.newaxis, :]
+        maz = moon.az.radian[np.newaxis, :]
+        cos_sep = (np.sin(alt) * np.sin(malt) +
+                   np.cos(alt) * np.cos(malt) * np.cos(az - maz))
+        moon_sep = np.degrees(np.arccos(np.clip(cos_sep, -1., 1.)))
+
+        with np.errstate(divide='ignore'):
+            airmass = np.where(alt > 0., 1. / np.sin(alt), np.inf)
+
+        lst = times.sidereal_time('apparent', longitude=self.site.lon).hour
+        ha = (lst[np.newaxis, :] - ra[:, np.newaxis] / 15.) % 24.
+
+        alt = np.degrees(alt)
+        alt[~valid] = np.nan
+        airmass[~valid] = np.inf
+        moon_sep[~valid] = np.nan
+
+        return {'times': times, 'jd': times.jd, 'step': step, 'alt': alt,
+                'airmass': airmass, 'moon_sep': moon_sep, 'ha': ha}
+
     def simulate_night(self, start_time='', end_time='', do_focus=True,
-                       do_standard=True, return_type='html'):
+                       do_standard=True, return_type='html', airmass=(1, 2.7),
+                       moon_sep=(0, 180), step=120.):
         """
+        Fill the night with targets in order of priority and hour angle.
+
+        The positions of all targets are computed once on a grid of time
+        bins (see get_visibility_grid), so each slot of the night is a
+        selection from boolean masks instead of astroplan calls per target.
 
         :param start_time: 
         :param end_time: 
         :param do_focus: 
         :param do_standard:
         :param return_type:
+        :param airmass: (min, max) airmass at start and end of observation
+        :param moon_sep: (min, max) moon separation in degrees
+        :param step: time bin width of the visibility grid in seconds
         :return: 
         """
 
@@ -366,22 +428,33 @@ class ScheduleNight:
 
         # 2. Get all targets
         targets = self.load_targets(return_type='df')
-        targets = self._set_target_coordinates(targets)
-
-        # Remove non-observable targets
-        # print(len(targets), "before purge")
-        # targets = self.remove_setting_targets(targets, start_time=start_time,
-        #                                       end_time=end_time)
-        # print(len(targets), "after purge")
-
-        targets['HA'] = targets.apply(self._set_target_ha, axis=1)
+        targets = targets.reset_index(drop=True)
         targets['obs_dict'] = targets.apply(self._set_obs_seq, axis=1)
 
-        targets = targets.sort_values(['priority', 'HA'], ascending=[False,
-                                                                     False])
-        print(targets[['priority', 'HA']])
-
-        # 3. Go through all the targets until we fill up the night
+        # Per target arrays for the selection
+        total = np.array([d['total'] for d in targets['obs_dict']],
+                         dtype=float)
+        is_ifu = np.array([bool(d['ifu']) for d in targets['obs_dict']])
+        priority = np.asarray(targets['priority'], dtype=float)
+        remaining = np.ones(len(targets), dtype=bool)
+
+        # 3. Alt/az, airmass, moon separation grid for the whole night,
+        # long enough for the last observation to finish
+        max_total = total.max() if len(total) else 0.
+        grid = self.get_visibility_grid(
+            targets, start_time,
+            end_time + TimeDelta(max_total + 600., format='sec'), step=step)
+        with np.errstate(invalid='ignore'):
+            observable = ((grid['airmass'] >= airmass[0]) &
+                          (grid['airmass'] <= airmass[1]) &
+                          (grid['moon_sep'] >= moon_sep[0]) &
+                          (grid['moon_sep'] <= moon_sep[1]))
+        nbins = observable.shape[1]
+
+        def time_bin(t):
+            return min(int(round((t - start_time).sec / step)), nbins - 1)
+
+        # 4. Go through all the targets until we fill up the night
         current_time = start_time
 
         while current_time <= end_time:
@@ -401,22 +474,18 @@ class ScheduleNight:
                 break
 
             self.running_obs_time = current_time
-            targets['HA'] = targets.apply(self._set_target_ha, axis=1)
-
-            targets = targets.sort_values(['priority', 'HA'], ascending=[False,
-                                                                         False])
-            # print(targets[['priority','HA']], current_time)
-            z = self.get_next_observable_target(targets, obs_time=current_time,
-                                                max_time=time_remaining,
-                                                return_type=return_type)
-
-            # targets = self.remove_setting_targets(
-            # targets, start_time=current_time, end_time=end_time)
-
-            idx, t = z
-
-            if not idx:
-                print(len(targets))
+            ibin = time_bin(current_time)
+            # Observable at start and at end of the observation
+            fbin = np.minimum(np.rint(ibin + total / step).astype(int),
+                              nbins - 1)
+            ok = remaining & observable[:, ibin] & \
+                observable[np.arange(len(targets)), fbin]
+            if current_time < self.obs_times['evening_astronomical']:
+                ok &= ~is_ifu
+
+            cand = np.flatnonzero(ok)
+            if len(cand) == 0:
+                print(np.count_nonzero(remaining))
                 if return_type == 'html':
                     html_str += self.tr_row.substitute(
                         {
@@ -437,19 +506,56 @@ class ScheduleNight:
                     )
                 current_time += TimeDelta(200, format='sec')
             else:
+                # Highest priority, then highest hour angle
+                best = cand[np.lexsort((-grid['ha'][cand, ibin],
+                                        -priority[cand]))[0]]
+                row = targets.iloc[best]
+                print(row.objname, row.ra, row.dec)
                 if return_type == 'html':
-                    html_str += t[1]
-                    t = t[0]
+                    html_str += self._target_html(row, current_time)
 
-                targets = targets[targets.req_id != idx]
+                remaining[best] = False
                 # Adding overhead
-                current_time += TimeDelta(t['total']+60, format='sec')
+                current_time += TimeDelta(total[best]+60, format='sec')
 
         if return_type == 'html':
             html_str += "</table><br>Last Updated:%s UT" % \
                         datetime.datetime.utcnow()
             return html_str
 
+    def _target_html(self, row, obs_time):
+        """
+        Table row for a scheduled target
+        :param row: target row (namedtuple or pd.Series)
+        :param obs_time: astropy.time.Time of observation
+        :return: str
+        """
+        if row.obs_dict['rc']:
+            rc_seq = row.obs_dict['rc_obs_dict']['obs_order'],
+            rc_exptime = row.obs_dict['rc_obs_dict']['obs_exptime'],
+        else:
+            rc_seq = 'NA'
+            rc_exptime = 'NA'
+
+        return self.tr_row.substitute(
+            {
+                'allocation': row.allocation_id,
+                'obstime': obs_time.iso,
+                'objname': row.objname,
+                'contact': row.priority,
+                'project': row.designator,
+                'ra': row.ra,
+                'dec': row.dec,
+                'ifu_exptime': row.obs_dict['ifu_exptime'],
+                'rc_seq': rc_seq,
+                'rc_exptime': rc_exptime,
+                'total': row.obs_dict['total'],
+                'startdate': row.inidate,
+                'enddate': row.enddate,
+                'request_id': row.req_id
+            }
+        )
+
     def get_next_observable_target(self, target_list=None, obs_time=None,
                                    max_time=-1, airmass=(1, 2.7),
                                    moon_sep=(0, 180), ignore_target=None,
@@ -521,32 +627,7 @@ class ScheduleNight:
                                            times=[obs_time, finish]):
                     print(row.objname, row.ra, row.dec)
                     if return_type == 'html':
-                        if row.obs_dict['rc']:
-                            rc_seq = row.obs_dict['rc_obs_dict']['obs_order'],
-                            rc_exptime = row.obs_dict['rc_obs_dict'][
-                                             'obs_exptime'],
-                        else:
-                            rc_seq = 'NA'
-                            rc_exptime = 'NA'
-
-                        html = self.tr_row.substitute(
-                            {
-                                'allocation': row.allocation_id,
-                                'obstime': obs_time.iso,
-                                'objname': row.objname,
-                                'contact': row.priority,
-                                'project': row.designator,
-                                'ra': row.ra,
-                                'dec': row.dec,
-                                'ifu_exptime': row.obs_dict['ifu_exptime'],
-                                'rc_seq': rc_seq,
-                                'rc_exptime': rc_exptime,
-                                'total': row.obs_dict['total'],
-                                'startdate': row.inidate,
-                                'enddate': row.enddate,
-                                'request_id': row.req_id
-                            }
-                        )
+                        html = self._target_html(row, obs_time)
                         return row.req_id, (row.obs_dict, html)
                     else:
                         return row.req_id, row.obs_dict
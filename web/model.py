@@ -7,7 +7,6 @@ import re
 import pandas as pd
 import numpy as np
 import requests
-import glob
 import time
 from decimal import Decimal
 from bokeh.io import curdoc
@@ -25,6 +24,7 @@ import astropy.units as u
 from astropy.coordinates import EarthLocation, SkyCoord, AltAz, get_sun,\
     get_moon
 from scheduler.scheduler import ScheduleNight
+import drpifu.ProdManifest as ProdManifest
 
 pd.options.mode.chained_assignment = None   # default='warn'
 
@@ -1333,12 +1333,13 @@ def plot_stats_allocation(data):
 def get_ab_what(obsdir):
     """get a pseudo what list for A/B cubes"""
     ablist = []
-    cubes = glob.glob(os.path.join(obsdir, "e3d_crr_b_ifu*.fits"))
+    man = ProdManifest.get(obsdir, readonly=True)
+    cubes = man.glob("e3d_crr_b_ifu*.fits")
     for e3df in cubes:
         # get root filename
         rute = '_'.join(e3df.split('/')[-1].split('_')[1:7])
         # is this a standard single cube?
-        crrf = glob.glob(os.path.join(obsdir, rute + '.fit*'))
+        crrf = man.glob(rute + '.fit*')
         if len(crrf) > 0:
             continue
         fname = '_'.join(e3df.split('/')[-1].split('_')[3:7]) + '.fits'
@@ -1384,6 +1385,9 @@ def get_ifu_products(obsdir=None, user_id=None, obsdate="", show_finder=True,
     sedm_dict = {'obsdate': obsdate,
                  'sci_data': ''}
 
+    # Products of the night, from the manifest of the directory
+    man = ProdManifest.get(obsdir, readonly=True)
+
     # Now lets get the non-science products (i.e. calibrations)
     calib_dict = {'flat3d': os.path.join(obsdir, '%s_flat3d.png' % obsdate),
                   'wavesolution': os.path.join(obsdir,
@@ -1397,7 +1401,7 @@ def get_ifu_products(obsdir=None, user_id=None, obsdate="", show_finder=True,
     remove_list = []
     div_str = ''
     for k, v in calib_dict.items():
-        if not os.path.exists(v):
+        if not man.exists(os.path.basename(v)):
             remove_list.append(k)
 
     if remove_list:
@@ -1407,26 +1411,25 @@ def get_ifu_products(obsdir=None, user_id=None, obsdate="", show_finder=True,
 
     # Check for specfocus plots
     sfplots = []
-    sflist = glob.glob(os.path.join(obsdir, 'specfocus%s_*.png' % obsdate))
-    sflist.sort()
+    sflist = man.glob('specfocus%s_*.png' % obsdate)
     if len(sflist) > 0:
         for sfpf in sflist:
             sfplots.append(sfpf)
 
     if user_id == 2:    # SEDM_admin
-        if os.path.exists(os.path.join(obsdir, 'report.txt')):
+        if man.exists('report.txt'):
             ext_report = """<a href="http://minar.caltech.edu/data_r/redux/{0}/report.txt">Extraction</a>""".format(obsdate)
         else:
             ext_report = ""
-        if os.path.exists(os.path.join(obsdir, 'report_ztf_fritz.txt')):
+        if man.exists('report_ztf_fritz.txt'):
             frz_report = """<a href="http://minar.caltech.edu/data_r/redux/{0}/report_ztf_fritz.txt">Fritz</a>""".format(obsdate)
         else:
             frz_report = ""
-        if os.path.exists(os.path.join(obsdir, 'report_ztf_growth.txt')):
+        if man.exists('report_ztf_growth.txt'):
             grw_report = """<a href="http://minar.caltech.edu/data_r/redux/{0}/report_ztf_growth.txt">Growth</a>""".format(obsdate)
         else:
             grw_report = ""
-        if os.path.exists(os.path.join(obsdir, 'what.txt')):
+        if man.exists('what.txt'):
             wha_report = """<a href="http://minar.caltech.edu/data_r/redux/{0}/what.txt" type="plain/text">What</a>""".format(obsdate)
         else:
             wha_report = ""
@@ -1481,7 +1484,7 @@ def get_ifu_products(obsdir=None, user_id=None, obsdate="", show_finder=True,
     # To get ifu products we first look to see if a what.list file has been
     # created. This way we will know which files to add to our dict and
     # whether the user has permissions to see the file
-    if not os.path.exists(os.path.join(obsdir, 'what.list')):
+    if not man.exists('what.list'):
         return {'message': 'Could not find summary file (what.list) for %s UT' %
                            os.path.basename(os.path.normpath(obsdir))}
 
@@ -1489,7 +1492,7 @@ def get_ifu_products(obsdir=None, user_id=None, obsdate="", show_finder=True,
     with open(os.path.join(obsdir, 'what.list')) as f:
         what_list = f.read().splitlines()
 
-    if os.path.exists(os.path.join(obsdir, 'abpairs.tab')):
+    if man.exists('abpairs.tab'):
         what_list.extend(get_ab_what(obsdir))
 
     what_list.sort()
@@ -1602,23 +1605,19 @@ def get_ifu_products(obsdir=None, user_id=None, obsdate="", show_finder=True,
             fits_file = targ_params[0].replace('.fits', '')
             name = targ[1]
 
-            image_list = (glob.glob('%sifu_spaxels_*%s*.png' % (obsdir,
-                                                                fits_file)) +
-                          glob.glob('%simage_%s*.png' % (obsdir, name)))
+            image_list = (man.glob('ifu_spaxels_*%s*.png' % fits_file) +
+                          man.glob('image_%s*.png' % name))
 
-            spec_list = (glob.glob('%s%s_SEDM.png' % (obsdir, name)) +
-                         glob.glob('%sspec_forcepsf*%s*.png' %
-                                   (obsdir, fits_file)) +
-                         glob.glob('%sspec_auto*%s*.png' % (obsdir, fits_file)))
+            spec_list = (man.glob('%s_SEDM.png' % name) +
+                         man.glob('spec_forcepsf*%s*.png' % fits_file) +
+                         man.glob('spec_auto*%s*.png' % fits_file))
 
-            e3d_list = (glob.glob('%se3d*%s*.fits' % (obsdir, fits_file)))
+            e3d_list = man.glob('e3d*%s*.fits' % fits_file)
 
-            spec_ascii_list = (glob.glob('%sspec_forcepsf*%s*.txt' %
-                                         (obsdir, fits_file)) +
-                               glob.glob('%sspec_auto*%s*.txt' % (obsdir,
-                                                                  fits_file)))
+            spec_ascii_list = (man.glob('spec_forcepsf*%s*.txt' % fits_file) +
+                               man.glob('spec_auto*%s*.txt' % fits_file))
 
-            fluxcals = (glob.glob('%sfluxcal_*%s*.fits' % (obsdir, fits_file)))
+            fluxcals = man.glob('fluxcal_*%s*.fits' % fits_file)
 
             if name not in science_dict:
                 science_dict[name] = {'image_list': image_list,
@@ -1701,7 +1700,8 @@ def get_ifu_products(obsdir=None, user_id=None, obsdate="", show_finder=True,
                     finder_path = path2
 
                 if os.path.exists(finder_path):
-                    finder_img = glob.glob(finder_path + '/*%s*.png' % obj)
+                    finder_img = ProdManifest.get(
+                        finder_path, readonly=True).glob('*%s*.png' % obj)
                     if finder_img:
                         impathlink = "/data/%s/%s" % (
                             obsdate, os.path.basename(finder_img[-1]))
@@ -1793,9 +1793,7 @@ def get_rc_products(obsdate=None, product=None, user_id=None, camera_type='rc'):
             print("Path doesn't exist")
 
     # print("Looking in directory:", sci_path)
-    find_path = os.path.join(sci_path, ext)
-    # print(find_path, 'find_path')
-    files = glob.glob(find_path)
+    files = ProdManifest.get(sci_path, readonly=True).glob(ext)
 
     # print("Files found", files)
 
@@ -1837,7 +1835,7 @@ def get_rc_products(obsdate=None, product=None, user_id=None, camera_type='rc'):
 
     if user_id == 2:    # SEDM_admin
         obsdir = os.path.join(new_phot_dir, obsdate)
-        if os.path.exists(os.path.join(obsdir, 'rcwhat.txt')):
+        if ProdManifest.get(obsdir, readonly=True).exists('rcwhat.txt'):
             wha_report = """<a href="http://minar.caltech.edu/data_r/redux/phot/{0}/rcwhat.txt" type="plain/text">RCWhat</a>""".format(obsdate)
             div_str += """<div class="row">"""
             div_str += """<h4>{0}</h4>""".format(wha_report)
@@ -1851,8 +1849,10 @@ def get_rc_products(obsdate=None, product=None, user_id=None, camera_type='rc'):
 
             if 'reduced' in fil:
                 fits_suffix = '.fits'
-                if os.path.exists(fil.replace('/png', '').replace('.png',
-                                                                  '.fits.gz')):
+                fits_gz = fil.replace('/png', '').replace('.png', '.fits.gz')
+                gz_man = ProdManifest.get(os.path.dirname(fits_gz),
+                                          readonly=True)
+                if gz_man.exists(os.path.basename(fits_gz)):
                     fits_suffix = '.fits.gz'
                 fil = fil.replace(base_dir, '')
                 impathlink = "/data_r/%s" % fil.replace('/png/', '/').replace(
@@ -1863,11 +1863,11 @@ def get_rc_products(obsdate=None, product=None, user_id=None, camera_type='rc'):
                 png_suffix = '_all.png'
                 if 'Bias' in fil or 'Flat' in fil:
                     png_suffix = '.png'
-                if os.path.exists(
-                        os.path.join(
-                            new_phot_dir, obsdate,
-                            os.path.basename(fil).replace(png_suffix,
-                                                          '.fits.gz'))):
+                obs_man = ProdManifest.get(os.path.join(new_phot_dir,
+                                                        obsdate),
+                                           readonly=True)
+                if obs_man.exists(os.path.basename(fil).replace(png_suffix,
+                                                                '.fits.gz')):
                     fits_suffix = '.fits.gz'
                 fil = fil.replace(base_dir, '')
                 impathlink = "/data_r/%s" % \
@@ -2252,7 +2252,23 @@ def load_p18seeing(obsdate):
     return d
 
 
-def load_stats(statsfile='stats.log'):
+def _load_stats_sidecar(sidecar):
+    """Load the stats.npy record array written by drprc/stats.py"""
+    rec = np.load(sidecar, mmap_mode='r')
+    rec = rec[rec['ok'] & (rec['jd'] > 0)]
+    # JD to UTC without going through astropy Time
+    date = (np.datetime64('1970-01-01T00:00:00') +
+            np.round((rec['jd'] - 2440587.5) * 86400.e3).astype(
+                'timedelta64[ms]'))
+    data = pd.DataFrame({'date': date})
+    for col in ['ns', 'fwhm', 'ellipticity', 'bkg', 'airmass', 'in_temp',
+                'imtype', 'out_temp', 'in_hum', 'focpos']:
+        data[col] = np.array(rec[col])
+    return data.fillna(0.)
+
+
+def _load_stats_log(statsfile):
+    """Load the stats.log csv file"""
     data = pd.read_csv(statsfile, header=None,
                        names=['path', 'obj', 'jd', 'ns', 'fwhm', 'ellipticity',
                               'bkg', 'airmass', 'in_temp', 'imtype', 'out_temp',
@@ -2261,22 +2277,45 @@ def load_stats(statsfile='stats.log'):
     jds = data['jd']
     t = Time(jds, format='jd', scale='utc')
     date = t.utc.datetime
-    day_frac_diff = datetime.timedelta(
-        np.ceil((datetime.datetime.now() -
-                 datetime.datetime.utcnow()).total_seconds()) / 3600 / 24)
-    local_date = date + day_frac_diff
 
-    data2 = data.assign(localdate=local_date)
-    data2.set_index('localdate')
+    data2 = data.assign(date=date)
 
     return pd.DataFrame(
-        {'date': data2['localdate'], 'ns': data2['ns'], 'fwhm': data2['fwhm'],
+        {'date': data2['date'], 'ns': data2['ns'], 'fwhm': data2['fwhm'],
          'ellipticity': data2['ellipticity'], 'bkg': data2['bkg'],
          'airmass': data2['airmass'], 'in_temp': data2['in_temp'],
          'imtype': data2['imtype'], 'out_temp': data2['out_temp'],
          'in_hum': data2['in_hum'], 'focpos': data2['focpos']})
 
 
+# Loaded stats, keyed by file: (mtime, utc data)
+_stats_cache = {}
+
+
+def load_stats(statsfile='stats.log'):
+    # Use the sidecar written with the log, if there is one
+    sidecar = os.path.splitext(statsfile)[0] + '.npy'
+    if os.path.isfile(sidecar):
+        src = sidecar
+        loader = _load_stats_sidecar
+    else:
+        src = statsfile
+        loader = _load_stats_log
+    mtime = os.path.getmtime(src)
+    ent = _stats_cache.get(src)
+    if ent is None or ent[0] != mtime:
+        ent = (mtime, loader(src))
+        _stats_cache[src] = ent
+    data = ent[1].copy()
+
+    day_frac_diff = datetime.timedelta(
+        np.ceil((datetime.datetime.now() -
+                 datetime.datetime.utcnow()).total_seconds()) / 3600 / 24)
+    data['date'] = pd.to_datetime(data['date']) + day_frac_diff
+
+    return data
+
+
 def plot_stats(statsfile, mydate):
 
     source = ColumnDataSource(
@@ -2553,12 +2592,15 @@ def get_user_observations(username, password, obsdate):
     calib_files = ['Xe.fits', 'Hg.fits', 'Cd.fits', 'dome.fits',
                    'bkgd_dome.fits', 'e3d_dome.fits', '%s_Flat.fits' % obsdate]
 
-    pkl_list = (glob.glob('%s*.pkl' % obsdir))
+    # Products of the night, from the manifest of the directory
+    man = ProdManifest.get(obsdir, readonly=True)
+
+    pkl_list = man.glob('*.pkl')
 
     master_calib_list = []
 
     for file in calib_files:
-        if os.path.exists(os.path.join(obsdir, file)):
+        if man.exists(file):
             master_calib_list.append(os.path.join(obsdir, file))
 
     master_calib_list += pkl_list
@@ -2591,7 +2633,7 @@ def get_user_observations(username, password, obsdate):
     data_list = []
 
     for k, v in calib_dict.items():
-        if not os.path.exists(v):
+        if not man.exists(os.path.basename(v)):
             remove_list.append(k)
 
     if remove_list:
@@ -2616,7 +2658,7 @@ def get_user_observations(username, password, obsdate):
     # To get ifu products we first look to see if a what.list file has been
     # created. This way we will know which files to add to our dict and
     # whether the user has permissions to see the file
-    if not os.path.exists(os.path.join(obsdir, 'what.list')):
+    if not man.exists('what.list'):
         return {'message': 'Could not find summary file (what.list) for %s UT' %
                            os.path.basename(os.path.normpath(obsdir))}
 
@@ -2725,31 +2767,25 @@ def get_user_observations(username, password, obsdate):
             # print('%sspec_forcepsf*%s*.png' % (obsdir,fits_file))
             # print('%sspec_auto*%s*.png' % (obsdir, fits_file))
 
-            image_list = (glob.glob('%sifu_spaxels_*%s*.png' % (obsdir,
-                                                                fits_file)) +
-                          glob.glob('%simage_%s*.png' % (obsdir, name)))
+            image_list = (man.glob('ifu_spaxels_*%s*.png' % fits_file) +
+                          man.glob('image_%s*.png' % name))
 
-            spec_list = (glob.glob('%s%s_SEDM.png' % (obsdir, name)) +
-                         glob.glob('%sspec_forcepsf*%s*.png' % (obsdir,
-                                                                fits_file)) +
-                         glob.glob('%sspec_auto*%s*.png' % (obsdir, fits_file)))
+            spec_list = (man.glob('%s_SEDM.png' % name) +
+                         man.glob('spec_forcepsf*%s*.png' % fits_file) +
+                         man.glob('spec_auto*%s*.png' % fits_file))
 
-            spec_all_list = glob.glob("%sspec*%s*" % (obsdir, name))
+            spec_all_list = man.glob("spec*%s*" % name)
 
-            e3d_list = (glob.glob('%se3d*%s*.fits' % (obsdir, fits_file)))
+            e3d_list = man.glob('e3d*%s*.fits' % fits_file)
 
-            spec_ascii_list = (glob.glob('%sspec_forcepsf*%s*.txt'
-                                         % (obsdir, fits_file)) +
-                               glob.glob('%sspec_auto*%s*.txt' % (obsdir,
-                                                                  fits_file)))
+            spec_ascii_list = (man.glob('spec_forcepsf*%s*.txt' % fits_file) +
+                               man.glob('spec_auto*%s*.txt' % fits_file))
 
-            fluxcals = (glob.glob('%sfluxcal_*%s*.fits' % (obsdir, fits_file)))
+            fluxcals = man.glob('fluxcal_*%s*.fits' % fits_file)
 
-            background = (glob.glob('%sbkgd_crr_b_%s.fits' % (obsdir,
-                                                              fits_file)))
+            background = man.glob('bkgd_crr_b_%s.fits' % fits_file)
 
-            astrom_list = (glob.glob('%sguider_crr_b_%s_astrom.fits'
-                                     % (obsdir, fits_file)))
+            astrom_list = man.glob('guider_crr_b_%s_astrom.fits' % fits_file)
 
             if name not in science_dict:
 
@@ -2829,7 +2865,8 @@ def get_user_observations(username, password, obsdate):
                 finder_path = path2
 
             if os.path.exists(finder_path):
-                finder_img = glob.glob(finder_path + '/*%s*.png' % obj)
+                finder_img = ProdManifest.get(finder_path, readonly=True).glob(
+                    '*%s*.png' % obj)
                 if finder_img:
                     data_list.append("/data/%s/%s" %
                                      (obsdate,
@@ -5,6 +5,7 @@ from web.forms import *
 import json
 import os
 import web.model as model
+import drpifu.ProdManifest as ProdManifest
 # from werkzeug.datastructures import ImmutableMultiDict
 from bokeh.resources import INLINE
 from marshals import watcher
@@ -174,8 +175,9 @@ def data_static(filename):
     """
     _p, _f = os.path.split(filename)
     if _f.startswith('finder') and 'ACQ' in _f:
-        if os.path.exists(os.path.join(config['path']['path_archive'], _p,
-                                       'finders', _f)):
+        if ProdManifest.get(os.path.join(config['path']['path_archive'], _p,
+                                         'finders'),
+                            readonly=True).exists(_f):
             return send_from_directory(
                 os.path.join(config['path']['path_archive'], _p, 'finders'), _f)
         else:
@@ -196,7 +198,7 @@ def data_static(filename):
                             'guider', 'science', 'twilight']
                 for i in pathlist:
                     test_path = os.path.join(base_obspath, i)
-                    if os.path.exists(os.path.join(test_path, _f)):
+                    if ProdManifest.get(test_path, readonly=True).exists(_f):
                         return send_from_directory(test_path, _f)
         else:
             return send_from_directory(os.path.join(config['path']['path_phot'],